@@ -1,7 +1,7 @@
 from functools import lru_cache
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseSettings, Field
+from pydantic import BaseSettings, Field, root_validator
 
 
 class Settings(BaseSettings):
@@ -30,6 +30,121 @@ class Settings(BaseSettings):
         "above the connection pool size",
         default=10,
     )
+    mpi_cache_enabled: Optional[bool] = Field(
+        description="Whether to answer block lookups from an in-memory index of the "
+        "MPI instead of querying the MPI database",
+        default=False,
+    )
+    mpi_cache_refresh_interval: Optional[float] = Field(
+        description="The number of seconds after which the in-memory index of the MPI "
+        "is refreshed with patients inserted by other instances of the service",
+        default=60.0,
+    )
+    mpi_linkage_view_enabled: Optional[bool] = Field(
+        description="Whether to fetch blocks from the denormalized linkage_view table "
+        "rather than joining the normalized MPI tables on every block lookup. Only "
+        "instances with it enabled keep the table up to date, copying in any patients "
+        "missing from it on start-up, so it should be enabled for every instance",
+        default=False,
+    )
+    mpi_write_behind_enabled: Optional[bool] = Field(
+        description="Whether linked patients are queued and written to the MPI "
+        "database in batches by a background worker, rather than before the linkage "
+        "response is returned. Used in place of the in-memory index of the MPI",
+        default=False,
+    )
+    mpi_write_behind_journal_path: Optional[str] = Field(
+        description="The file patients queued for the MPI database are journaled to, "
+        "so that they're written after a restart. Unset means the queue is only held "
+        "in memory",
+        default=None,
+    )
+    mpi_write_behind_max_pending: Optional[int] = Field(
+        description="The most patients that may be queued for the MPI database before "
+        "linkage waits for the queue to be written",
+        default=10000,
+    )
+    mpi_write_behind_batch_size: Optional[int] = Field(
+        description="The most queued patients written to the MPI database in a single "
+        "transaction",
+        default=500,
+    )
+    mpi_write_behind_flush_interval: Optional[float] = Field(
+        description="The most seconds a patient waits in the queue before it's written "
+        "to the MPI database",
+        default=0.5,
+    )
+    mpi_async_enabled: Optional[bool] = Field(
+        description="Whether the /link-record endpoint queries the MPI database "
+        "asynchronously, so that a worker can link many records at once. Can't be "
+        "combined with mpi_cache_enabled or mpi_write_behind_enabled",
+        default=False,
+    )
+    linkage_parallel_passes: Optional[bool] = Field(
+        description="Whether to fetch the blocks of every linkage pass from the MPI "
+        "at once, rather than querying the MPI once per pass",
+        default=False,
+    )
+    linkage_max_block_size: Optional[int] = Field(
+        description="The most patients a block may hold in linkage passes that don't "
+        "set their own max_block_size; larger blocks are narrowed down with extra "
+        "blocking fields or sampled. Unset means blocks aren't limited",
+        default=None,
+    )
+    linkage_estimate_block_size: Optional[bool] = Field(
+        description="Whether to check block sizes against the query planner's "
+        "estimates rather than counting the patients in each block",
+        default=False,
+    )
+    linkage_similarity_cache_size: Optional[int] = Field(
+        description="The number of string similarity scores kept in a cache shared "
+        "by every linkage request, with the least recently used evicted first; 0 "
+        "disables the shared cache, leaving scores memoized per request only",
+        default=0,
+    )
+    linkage_lock_mode: Optional[Literal["none", "striped", "advisory"]] = Field(
+        description="How records sharing a block are kept from being linked at the "
+        "same time, which could otherwise link records of the same new person to two "
+        "new persons: 'striped' locks their blocks within this instance of the "
+        "service, 'advisory' locks them with Postgres advisory locks across every "
+        "instance, and 'none' doesn't lock them",
+        default="none",
+    )
+    linkage_trace_sample_rate: Optional[float] = Field(
+        description="The fraction of /link-record requests whose linkage is traced "
+        "and logged as a single structured record, whether or not the request asks "
+        "for the trace in its response",
+        default=0.0,
+    )
+    linkage_trace_max_comparisons: Optional[int] = Field(
+        description="The most record comparisons per person cluster whose "
+        "per-feature scores are kept in a linkage trace",
+        default=10,
+    )
+
+    @root_validator(skip_on_failure=True)
+    def check_async_mpi_client(cls, values: dict) -> dict:
+        """
+        Checks that the asynchronous MPI client isn't enabled along with the
+        in-memory index of the MPI or the write-behind queue, which it
+        doesn't read from or write through. Asynchronous requests would
+        otherwise miss the patients that are queued or only indexed, and
+        patients they insert would be missing from the index.
+
+        :param values: The values of the settings.
+        :return: The values of the settings.
+        :raises ValueError: If the asynchronous MPI client is enabled along
+          with the in-memory index of the MPI or the write-behind queue.
+        """
+        if values.get("mpi_async_enabled"):
+            for setting in ["mpi_cache_enabled", "mpi_write_behind_enabled"]:
+                if values.get(setting):
+                    raise ValueError(
+                        f"mpi_async_enabled can't be combined with {setting}; "
+                        + "the asynchronous MPI client queries the MPI database "
+                        + "directly."
+                    )
+        return values
 
 
 @lru_cache
@@ -0,0 +1,259 @@
+import datetime
+import itertools
+import sys
+import uuid
+from collections import Counter
+from typing import Iterable
+
+# The columns of a block of MPI data, in the order selected by
+# `DIBBsMPIConnectorClient._get_base_query`
+BLOCK_HEADER = [
+    "patient_id",
+    "person_id",
+    "birthdate",
+    "sex",
+    "mrn",
+    "last_name",
+    "given_name",
+    "address",
+    "zip",
+    "city",
+    "state",
+]
+
+
+class MPIBlock:
+    """
+    A compact, read-only block of MPI data, ready for linkage. It's built
+    in a single pass over the rows of a block query, while they're fetched:
+    each patient row is stored as a tuple, with the given names joined into
+    a first name and every string interned, and the rows are grouped into
+    clusters by person. Unlike a list of row lists, no intermediate copies
+    of the block are made, and the many repeated values in large blocks
+    (e.g. common last names, cities or first names) are stored once.
+    """
+
+    __slots__ = ("header", "rows", "clusters", "summaries")
+
+    def __init__(
+        self, header: list, rows: Iterable, converted_rows: dict = None
+    ) -> None:
+        """
+        Builds a block from the header and rows of a block query.
+
+        :param header: The column headers of the block, which begin with the
+          patient and person ID columns.
+        :param rows: An iterable of rows, such as a query result, whose
+          columns are those of the header.
+        :param converted_rows: Optionally, a dictionary in which converted
+          rows are memoized by the identity of their source row, so that
+          blocks built from overlapping sets of rows share them.
+        """
+        given_name_idx = header.index("given_name") if "given_name" in header else None
+        self.header = list(header)
+        if given_name_idx is not None:
+            self.header[given_name_idx] = "first_name"
+        self.rows = []
+        self.clusters = {}
+        self.summaries = {}
+        for row in rows:
+            if converted_rows is None:
+                compact_row = _compact_row(row, given_name_idx)
+            else:
+                compact_row = converted_rows.get(id(row))
+                if compact_row is None:
+                    compact_row = _compact_row(row, given_name_idx)
+                    converted_rows[id(row)] = compact_row
+            self.rows.append(compact_row)
+            self.clusters.setdefault(compact_row[1], []).append(compact_row)
+
+    @classmethod
+    def from_block_data(
+        cls, block_data: list[list], converted_rows: dict = None
+    ) -> "MPIBlock":
+        """
+        Builds a block from a list of rows whose first row is the column
+        headers, as returned by `get_block_data`.
+
+        :param block_data: The rows of the block, headed by the column
+          headers.
+        :param converted_rows: Optionally, a dictionary in which converted
+          rows are memoized; see `MPIBlock.__init__`.
+        :return: The compact block.
+        """
+        return cls(block_data[0], block_data[1:], converted_rows)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of rows in the block.
+        """
+        return len(self.rows)
+
+    def summary(self, person_id) -> "ClusterSummary":
+        """
+        Returns the summary of the rows linked to a person in the block,
+        which is built the first time it's asked for.
+
+        :param person_id: The ID of the person, as held in the block.
+        :return: The summary of the person's cluster.
+        """
+        summary = self.summaries.get(person_id)
+        if summary is None:
+            summary = ClusterSummary(self.clusters[person_id])
+            self.summaries[person_id] = summary
+        return summary
+
+    def to_block_data(self) -> list[list]:
+        """
+        Returns the block as a list of rows whose first row is the column
+        headers, with first names in place of given names.
+        """
+        return [list(self.header)] + [list(row) for row in self.rows]
+
+
+class ClusterSummary:
+    """
+    A summary of the MPI rows linked to a person: the distinct variants of
+    the values linkage compares, i.e. of every column but the patient and
+    person IDs, along with the variant each row holds. As records are
+    linked to a person, their cluster accumulates many identical rows
+    (e.g. the same name, address and birthdate sent in every case report),
+    but an incoming record only needs comparing once with each variant.
+    Since the variant of every row is kept in the order of the rows, the
+    cluster can still be scored exactly as it would be row by row.
+    """
+
+    __slots__ = ("variants", "row_variants")
+
+    def __init__(self, rows: Iterable[tuple]) -> None:
+        """
+        Summarizes the rows of a cluster.
+
+        :param rows: The rows linked to the person, whose first two columns
+          are the patient and person IDs.
+        """
+        self.variants = []
+        self.row_variants = []
+        variant_idx = {}
+        for row in rows:
+            values = row[2:]
+            idx = variant_idx.get(values)
+            if idx is None:
+                idx = len(self.variants)
+                variant_idx[values] = idx
+                self.variants.append(row)
+            self.row_variants.append(idx)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of rows in the cluster.
+        """
+        return len(self.row_variants)
+
+    def counts(self) -> list[int]:
+        """
+        Returns the number of rows holding each variant, in the order of
+        `variants`.
+        """
+        counts = [0] * len(self.variants)
+        for idx in self.row_variants:
+            counts[idx] += 1
+        return counts
+
+
+def _compact_row(row, given_name_idx: int) -> tuple:
+    """
+    Helper method that converts a row of a block query into a tuple, joining
+    its given names into a first name and interning its strings.
+    """
+    compact_row = []
+    for idx, value in enumerate(row):
+        if idx == given_name_idx:
+            value = " ".join(value)
+        if isinstance(value, str):
+            value = sys.intern(value)
+        compact_row.append(value)
+    return tuple(compact_row)
+
+
+def mpi_records_to_block_rows(mpi_records: dict, header: list) -> list[list]:
+    """
+    Converts the MPI table records inserted for a patient into the rows
+    that a block query returns for that patient, with one row per
+    combination of the patient's MRN, name and address, ordered according
+    to the given header.
+
+    :param mpi_records: A dictionary of MPI table names and records, as
+      built by `DIBBsMPIConnectorClient._get_mpi_records`.
+    :param header: The column headers of a block of MPI data.
+    :return: A list of rows in the same form as `get_block_data`'s.
+    """
+    patient = mpi_records["patient"][0]
+    dob = patient.get("dob")
+    if isinstance(dob, str):
+        dob = datetime.datetime.strptime(dob, "%Y-%m-%d").date()
+
+    # Identical MRNs and addresses collapse into a single row, as in the
+    # block query, whose given names are then aggregated once per duplicate
+    mrns = Counter(
+        record.get("patient_identifier")
+        for record in mpi_records.get("identifier", [])
+        if record.get("type_code") == "MR"
+    ) or Counter([None])
+    addresses = Counter(
+        (
+            record.get("line_1"),
+            record.get("zip_code"),
+            record.get("city"),
+            record.get("state"),
+        )
+        for record in mpi_records.get("address", [])
+    ) or Counter([(None, None, None, None)])
+    names = []
+    for name in mpi_records.get("name", []):
+        given_names = sorted(
+            (
+                record
+                for record in mpi_records.get("given_name", [])
+                if record["name_id"] == name["name_id"]
+            ),
+            key=lambda record: record["given_name_index"],
+        )
+        names.append(
+            (
+                name.get("last_name"),
+                [record["given_name"] for record in given_names] or [None],
+            )
+        )
+    names = names or [(None, [None])]
+
+    rows = []
+    for mrn, name, address in itertools.product(mrns, names, addresses):
+        duplicates = mrns[mrn] * addresses[address]
+        row = {
+            "patient_id": _to_uuid(patient["patient_id"]),
+            "person_id": _to_uuid(patient.get("person_id")),
+            "birthdate": dob,
+            "sex": patient.get("sex"),
+            "mrn": mrn,
+            "last_name": name[0],
+            "given_name": [
+                given_name for given_name in name[1] for _ in range(duplicates)
+            ],
+            "address": address[0],
+            "zip": address[1],
+            "city": address[2],
+            "state": address[3],
+        }
+        rows.append([row.get(column) for column in header])
+    return rows
+
+
+def _to_uuid(value):
+    """
+    Helper method that converts an ID to the `uuid.UUID` the MPI returns
+    for it, so that rows from the index and from the MPI can be mixed.
+    """
+    if isinstance(value, str):
+        return uuid.UUID(value)
+    return value
@@ -0,0 +1,252 @@
+import threading
+
+from app.linkage.block import BLOCK_HEADER, mpi_records_to_block_rows
+from app.linkage.mpi import DIBBsMPIConnectorClient
+
+# The MPI columns that blocking criteria can be evaluated against, once
+# `DIBBsMPIConnectorClient._organize_block_criteria` has mapped blocking
+# fields to their columns, grouped by table. Only MRN identifiers are held,
+# as those are the only identifiers in a block of MPI data.
+INDEXED_COLUMNS = {
+    "patient": ("dob", "sex"),
+    "identifier": ("patient_identifier", "type_code"),
+    "name": ("last_name",),
+    "given_name": ("given_name",),
+    "address": ("line_1", "zip_code", "city", "state"),
+}
+
+# The transformations supported by `_generate_where_criteria`
+BLOCKING_TRANSFORMATIONS = {
+    None: lambda value: value,
+    "first4": lambda value: value[:4],
+    "last4": lambda value: value[-4:],
+}
+
+
+class BlockingIndex:
+    """
+    An in-memory index of patients that answers block lookups the same way
+    `DIBBsMPIConnectorClient.get_block_data` does against the MPI. Each
+    patient is held as its flattened block rows, along with the values of
+    the columns blocking criteria are evaluated against, and every such
+    value is indexed under each supported transformation, so a lookup only
+    verifies the patients sharing all of a block's criteria values.
+    """
+
+    def __init__(self, mpi_client: DIBBsMPIConnectorClient):
+        """
+        Creates an empty blocking index.
+
+        :param mpi_client: The MPI client whose blocking semantics the index
+          mirrors.
+        """
+        self.mpi_client = mpi_client
+        self._patients = {}
+        self._insertion_order = {}
+        self._next_order = 0
+        self._postings = {}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patients in the index.
+        """
+        return len(self._patients)
+
+    def __contains__(self, patient_id) -> bool:
+        """
+        Returns whether the patient with the given ID is in the index.
+        """
+        return str(patient_id) in self._patients
+
+    def patient_ids(self) -> set[str]:
+        """
+        Returns the IDs of the patients in the index, as strings.
+        """
+        with self._lock:
+            return set(self._patients)
+
+    def add_patient(self, patient_resource: dict) -> None:
+        """
+        Adds a patient to the index, as it would be inserted into the MPI.
+        The resource should already reference the person it's linked to.
+
+        :param patient_resource: A FHIR patient resource.
+        """
+        mpi_records = self.mpi_client._get_mpi_records(patient_resource)
+        key = str(mpi_records["patient"][0]["patient_id"])
+        table_values = {
+            table_name: [
+                tuple(record.get(column) for column in columns)
+                for record in mpi_records.get(table_name, [])
+                if table_name != "identifier" or record.get("type_code") == "MR"
+            ]
+            for table_name, columns in INDEXED_COLUMNS.items()
+        }
+        rows = mpi_records_to_block_rows(mpi_records, BLOCK_HEADER)
+        self._add(key, table_values, rows)
+
+    def add_block_rows(self, rows: list[list]) -> None:
+        """
+        Adds the patients in a block of MPI data to the index, replacing any
+        of them already in it.
+
+        :param rows: Rows of MPI data, without the header row, whose columns
+          are those of `BLOCK_HEADER`.
+        """
+        patient_rows = {}
+        for row in rows:
+            patient_rows.setdefault(str(row[0]), []).append(tuple(row))
+        for key, rows in patient_rows.items():
+            table_values = {
+                "patient": [(rows[0][2], rows[0][3])],
+                "identifier": list(
+                    dict.fromkeys((row[4], "MR") for row in rows if row[4] is not None)
+                ),
+                "name": list(dict.fromkeys((row[5],) for row in rows)),
+                "given_name": list(
+                    dict.fromkeys(
+                        (given_name,)
+                        for row in rows
+                        for given_name in (row[6] or [])
+                        if given_name is not None
+                    )
+                ),
+                "address": list(dict.fromkeys(tuple(row[7:11]) for row in rows)),
+            }
+            self._add(key, table_values, rows)
+
+    def remove_patient(self, patient_id) -> None:
+        """
+        Removes a patient from the index, if it's there.
+
+        :param patient_id: The ID of the patient to remove.
+        """
+        with self._lock:
+            key = str(patient_id)
+            if key not in self._patients:
+                return
+            table_values, _ = self._patients.pop(key)
+            del self._insertion_order[key]
+            for posting_key in _posting_keys(table_values):
+                posting = self._postings.get(posting_key)
+                if posting is not None:
+                    posting.discard(key)
+                    if len(posting) == 0:
+                        del self._postings[posting_key]
+
+    def can_answer(self, block_criteria: dict) -> bool:
+        """
+        Returns whether the index holds the columns needed to answer a block
+        lookup with the given criteria.
+
+        :param block_criteria: A dictionary of blocking criteria, in the
+          form accepted by `get_block_data`.
+        """
+        organized_block_vals = self.mpi_client._organize_block_criteria(block_criteria)
+        for table_name, table_info in organized_block_vals.items():
+            columns = INDEXED_COLUMNS.get(table_name, ())
+            for column, criterion in table_info["criteria"].items():
+                if column not in columns:
+                    return False
+                if criterion.get("transformation") not in BLOCKING_TRANSFORMATIONS:
+                    return False
+            if table_name == "identifier" and table_info["criteria"].get(
+                "type_code"
+            ) != {"value": "MR"}:
+                return False
+        return True
+
+    def get_block_rows(self, block_criteria: dict, header: list) -> list[list]:
+        """
+        Returns the rows of every indexed patient belonging to the block
+        with the given criteria, in the same form as the rows returned by
+        `get_block_data` (without the header row).
+
+        :param block_criteria: A dictionary of blocking criteria, in the
+          form accepted by `get_block_data`.
+        :param header: The column headers the rows should be ordered by.
+        :return: A list of rows, in the order the patients were added.
+        """
+        organized_block_vals = self.mpi_client._organize_block_criteria(block_criteria)
+        column_idx = [BLOCK_HEADER.index(column) for column in header]
+        with self._lock:
+            candidates = None
+            for table_name, table_info in organized_block_vals.items():
+                for column, criterion in table_info["criteria"].items():
+                    posting_key = (table_name, column, criterion.get("transformation"))
+                    posting_key += (str(criterion["value"]),)
+                    posting = self._postings.get(posting_key, set())
+                    candidates = posting if candidates is None else candidates & posting
+            if candidates is None:
+                candidates = self._patients.keys()
+
+            rows = []
+            for key in sorted(candidates, key=self._insertion_order.__getitem__):
+                table_values, patient_rows = self._patients[key]
+                if _block_contains_patient(table_values, organized_block_vals):
+                    rows.extend(
+                        [row[idx] for idx in column_idx] for row in patient_rows
+                    )
+            return rows
+
+    def _add(self, key: str, table_values: dict, rows: list) -> None:
+        """
+        Helper method that adds a patient's indexed column values and block
+        rows to the index.
+        """
+        with self._lock:
+            self.remove_patient(key)
+            self._patients[key] = (table_values, [tuple(row) for row in rows])
+            self._insertion_order[key] = self._next_order
+            self._next_order += 1
+            for posting_key in _posting_keys(table_values):
+                self._postings.setdefault(posting_key, set()).add(key)
+
+
+def _posting_keys(table_values: dict):
+    """
+    Helper method that yields the keys a patient's indexed column values
+    are posted under, one for each value and supported transformation.
+    """
+    for table_name, records in table_values.items():
+        for record in records:
+            for column, value in zip(INDEXED_COLUMNS[table_name], record):
+                if value is None:
+                    continue
+                for transformation, transform in BLOCKING_TRANSFORMATIONS.items():
+                    yield (table_name, column, transformation, transform(str(value)))
+
+
+def _block_contains_patient(table_values: dict, organized_block_vals: dict) -> bool:
+    """
+    Helper method that determines whether a patient belongs to a block. As
+    in the block query, every table's criteria must all hold for at least
+    one of the patient's records in that table.
+    """
+    for table_name, table_info in organized_block_vals.items():
+        columns = INDEXED_COLUMNS.get(table_name, ())
+        if any(column not in columns for column in table_info["criteria"]):
+            return False
+        criteria = [
+            (columns.index(column), criterion)
+            for column, criterion in table_info["criteria"].items()
+        ]
+        if not any(
+            all(_criterion_holds(record[idx], criterion) for idx, criterion in criteria)
+            for record in table_values.get(table_name, [])
+        ):
+            return False
+    return True
+
+
+def _criterion_holds(value, criterion: dict) -> bool:
+    """
+    Helper method that evaluates a single blocking criterion against a
+    column value the way the where clauses built by
+    `_generate_where_criteria` do in the MPI.
+    """
+    if value is None:
+        return False
+    transform = BLOCKING_TRANSFORMATIONS[criterion.get("transformation")]
+    return transform(str(value)) == str(criterion["value"])
@@ -2,6 +2,8 @@ from abc import ABC, abstractmethod
 
 from sqlalchemy import Select
 
+from app.linkage.block import MPIBlock
+
 
 class BaseMPIConnectorClient(ABC):
     """
@@ -23,6 +25,19 @@ class BaseMPIConnectorClient(ABC):
         """
         pass  # pragma: no cover
 
+    def get_compact_block_data(self, block_criteria: dict) -> MPIBlock:
+        """
+        Returns the records from the MPI database that match on the incoming
+        record's block criteria and values as a compact `MPIBlock`, grouped
+        by person, rather than as a list of lists.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: The block of MPI records.
+        """
+        return MPIBlock.from_block_data(self.get_block_data(block_criteria))
+
     @abstractmethod
     def insert_matched_patient() -> None:
         """
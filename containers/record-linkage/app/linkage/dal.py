@@ -1,10 +1,17 @@
-import datetime
-import logging
+import io
+import uuid
 from contextlib import contextmanager
 
-from sqlalchemy import MetaData, Table, create_engine, select, text
+from sqlalchemy import MetaData, Table, Uuid, create_engine, inspect, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
 from sqlalchemy.orm import scoped_session, sessionmaker
 
+from app.linkage.metrics import timed
+
+# Number of records with the same columns from which an insert is streamed
+# into Postgres with COPY rather than a multi-row INSERT
+COPY_THRESHOLD = 1000
+
 
 class DataAccessLayer:
     """
@@ -31,7 +38,9 @@ class DataAccessLayer:
         self.ADDRESS_TABLE = None
         self.EXTERNAL_PERSON_TABLE = None
         self.EXTERNAL_SOURCE_TABLE = None
+        self.LINKAGE_VIEW_TABLE = None
         self.TABLE_LIST = []
+        self.TABLE_BY_COLUMN = {}
 
     def get_connection(
         self,
@@ -89,6 +98,12 @@ class DataAccessLayer:
         self.EXTERNAL_SOURCE_TABLE = Table(
             "external_source", self.Meta, autoload_with=self.engine
         )
+        # the linkage view is optional, existing only once its migration is run
+        self.LINKAGE_VIEW_TABLE = None
+        if inspect(self.engine).has_table("linkage_view"):
+            self.LINKAGE_VIEW_TABLE = Table(
+                "linkage_view", self.Meta, autoload_with=self.engine
+            )
 
         # order of the list determines the order of
         # inserts due to FK constraints
@@ -103,6 +118,18 @@ class DataAccessLayer:
         self.TABLE_LIST.append(self.PHONE_TABLE)
         self.TABLE_LIST.append(self.ADDRESS_TABLE)
 
+        # map each column to the first table in the list that has it,
+        # so that tables can be looked up by column without a scan
+        self.TABLE_BY_COLUMN = {}
+        for table in self.TABLE_LIST:
+            for column_name in table.c.keys():
+                self.TABLE_BY_COLUMN.setdefault(column_name, table)
+
+        # the linkage view copies the other tables' columns, so it's left out
+        # of the lookup by column, and is written last
+        if self.LINKAGE_VIEW_TABLE is not None:
+            self.TABLE_LIST.append(self.LINKAGE_VIEW_TABLE)
+
     @contextmanager
     def transaction(self) -> None:
         """
@@ -144,52 +171,17 @@ class DataAccessLayer:
         """
         new_primary_keys = []
         if len(records) > 0 and table is not None:
-            logging.info(
-                f"Getting primary_key_column at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
-            primary_key_column = table.primary_key.c[0]
-            with self.transaction() as session:
-                logging.info(
-                    f"Starting session at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            with timed("bulk_insert"), self.transaction() as session:
+                new_primary_keys = self._insert_records(
+                    session, table, records, return_primary_keys
                 )
-                n_records = 0
-                for record in records:
-                    n_records += 1
-                    if return_primary_keys:
-                        logging.info("Returned primary keys")
-                        statement = (
-                            table.insert().values(record).returning(primary_key_column)
-                        )
-                        logging.info(
-                            f"""Starting statement execution getting
-                              new_primary_key for record #{n_records}at:
-                                {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                        )
-                        new_primary_key = session.execute(statement)
-                        # TODO: I don't like this, but seems to
-                        # be one of the only ways to get this to work
-                        #  I have tried using the column name from the
-                        # PK defined in the table and that doesn't work
-                        logging.info(
-                            f""" Done with statement execution getting new_primary_key
-                              for record #{n_records} at: {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                        )
-                        new_primary_keys.append(new_primary_key.first()[0])
-                    else:
-                        logging.info("Did not return primary keys")
-                        statement = table.insert().values(record)
-                        logging.info(
-                            f"Starting statement execution for record #{n_records} at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                        )
-                        session.execute(statement)
-                        logging.info(
-                            f"""Done with statement execution
-                              for record #{n_records} at: {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                        )
         return new_primary_keys
 
     def bulk_insert_dict(
-        self, records_with_table: dict, return_primary_keys: bool = False
+        self,
+        records_with_table: dict,
+        return_primary_keys: bool = False,
+        skip_conflicts: list[str] = None,
     ) -> dict:
         """
         Perform a bulk insert operation on a table as defined
@@ -197,6 +189,7 @@ class DataAccessLayer:
         record(s), a list of record(s) as dictionaries.  This
         allows for several inserts to occur for different tables
         along with a single or multiple records for each table.
+        All of the inserts occur in a single transaction.
 
         :param records_with_table: a dictionary that defines the
             the SQLAlchemy table name to insert into
@@ -208,95 +201,136 @@ class DataAccessLayer:
             }
         :param return_primary_keys: boolean indicating if you want the inserted
             primary keys for the table returned or not, defaults to False
+        :param skip_conflicts: the names of tables whose records are skipped,
+            rather than failing the transaction, if they conflict with a unique
+            constraint, defaults to None
         :return: a dictionary that contains table names as keys
             along with a list of the primary keys, if requested.
         """
+        skip_conflicts = skip_conflicts or []
         return_results = {}
-        statements = []
-        with self.transaction() as session:
-            logging.info(
-                f"Starting session at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
-            n_records = 0
+        with timed("bulk_insert"), self.transaction() as session:
             for table in self.TABLE_LIST:
                 records = records_with_table.get(table.name)
                 if records is not None:
                     new_primary_keys = []
-
-                    if len(records) > 0 and table is not None:
-                        logging.info(
-                            f"Getting primary_key_column at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+                    if len(records) > 0:
+                        new_primary_keys = self._insert_records(
+                            session,
+                            table,
+                            records,
+                            return_primary_keys,
+                            table.name in skip_conflicts,
                         )
-                        primary_key_column = table.primary_key.c[0]
-
-                        for record in records:
-                            n_records += 1
-                            if return_primary_keys:
-                                logging.info("Returned primary keys")
-                                statement = (
-                                    table.insert()
-                                    .values(record)
-                                    .returning(primary_key_column)
-                                )
-                                logging.info(
-                                    f"""Starting statement execution getting
-                                    new_primary_key for record #{n_records}at:
-                                        {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                                )
-                                new_primary_key = session.execute(statement)
-                                # TODO: I don't like this, but seems to
-                                # be one of the only ways to get this to work
-                                #  I have tried using the column name from the
-                                # PK defined in the table and that doesn't work
-                                logging.info(
-                                    f""" Done with statement execution getting new_primary_key
-                                    for record #{n_records} at: {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                                )
-                                new_primary_keys.append(new_primary_key.first()[0])
-                            else:
-                                logging.info("Did not return primary keys")
-                                logging.info(
-                                    f"""Starting statement creation for record #{n_records} at:
-                                        {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                                )
-
-                                if "dob" in record:
-                                    if record["dob"] is not None:
-                                        record["dob"] = datetime.datetime.strptime(
-                                            record["dob"], "%Y-%m-%d"
-                                        )
-
-                                statement = table.insert().values(**record)
-
-                                statement = statement.compile(
-                                    self.engine,
-                                    compile_kwargs={
-                                        "literal_binds": True,
-                                        "render_postprocess": str,
-                                    },
-                                )
-                                statement = str(statement)
-                                statements.append(statement)
-                                logging.info(
-                                    f"""Done with statement creation for record #{n_records} at:
-                                        {datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                                )
-
                     return_results[table.name] = {"primary_keys": new_primary_keys}
+        return return_results
 
-            if not return_primary_keys:
-                statements = ";".join(statements)
-                logging.info(
-                    f"Starting INSERT statement execution at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+    def _insert_records(
+        self,
+        session: scoped_session,
+        table: Table,
+        records: list[dict],
+        return_primary_keys: bool,
+        skip_conflicts: bool = False,
+    ) -> list:
+        """
+        Helper method that inserts records into a table within an open
+        session. Records with the same columns are inserted together, with a
+        single multi-row INSERT, or with COPY once there are at least
+        `COPY_THRESHOLD` of them. UUID primary keys that are to be returned
+        are generated here rather than by the database, so no RETURNING
+        round trip is needed. Records that conflict with a unique constraint
+        can be skipped with `ON CONFLICT DO NOTHING`, in which case they're
+        never copied.
+
+        :param session: The session to insert the records in.
+        :param table: The table to insert the records into.
+        :param records: A list of records as dictionaries.
+        :param return_primary_keys: Whether to return the primary keys of the
+          inserted records.
+        :param skip_conflicts: Whether to skip records that conflict with a
+          unique constraint rather than fail.
+        :return: A list of primary keys, in the order of the records, or an
+          empty list.
+        """
+        statement = table.insert()
+        if skip_conflicts:
+            statement = postgresql_insert(table).on_conflict_do_nothing()
+        primary_key_column = table.primary_key.c[0]
+        records = [dict(record) for record in records]
+        new_primary_keys = []
+        if return_primary_keys:
+            if not isinstance(primary_key_column.type, Uuid):
+                returning = statement.returning(
+                    primary_key_column, sort_by_parameter_order=True
                 )
-                session.execute(text(statements))
-                logging.info(
-                    f"Done with INSERT statement execution at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+                return [row[0] for row in session.execute(returning, records)]
+            for record in records:
+                if record.get(primary_key_column.name) is None:
+                    record[primary_key_column.name] = uuid.uuid4()
+            new_primary_keys = [record[primary_key_column.name] for record in records]
+
+        # A single statement must insert the same columns for every record,
+        # so that columns left out still take their server defaults
+        records_by_columns = {}
+        for record in records:
+            records_by_columns.setdefault(tuple(sorted(record)), []).append(record)
+        for columns, column_records in records_by_columns.items():
+            unconsumed_columns = [column for column in columns if column not in table.c]
+            if len(unconsumed_columns) > 0:
+                raise ValueError(
+                    f"Unconsumed column names: {', '.join(unconsumed_columns)}"
                 )
-        return return_results
+            if (
+                len(column_records) >= COPY_THRESHOLD
+                and self.engine.dialect.driver == "psycopg2"
+                and not skip_conflicts
+            ):
+                self._copy_records(session, table, columns, column_records)
+            else:
+                session.execute(statement, column_records)
+        return new_primary_keys
+
+    def _copy_records(
+        self,
+        session: scoped_session,
+        table: Table,
+        columns: tuple[str],
+        records: list[dict],
+    ) -> None:
+        """
+        Helper method that streams records into a Postgres table with
+        `COPY ... FROM STDIN`, within an open session.
+
+        :param session: The session to insert the records in.
+        :param table: The table to insert the records into.
+        :param columns: The columns every record has values for.
+        :param records: A list of records as dictionaries.
+        """
+        preparer = self.engine.dialect.identifier_preparer
+        copy_statement = (
+            f"COPY {preparer.format_table(table)} "
+            + f"({', '.join(preparer.quote(column) for column in columns)}) "
+            + "FROM STDIN"
+        )
+        buffer = io.StringIO()
+        for record in records:
+            buffer.write(
+                "\t".join(_copy_text_value(record[column]) for column in columns)
+            )
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(copy_statement, buffer)
+        finally:
+            cursor.close()
 
     def select_results(
-        self, select_statement: select, include_col_header: bool = True
+        self,
+        select_statement: select,
+        include_col_header: bool = True,
+        params: dict = None,
     ) -> list[list]:
         """
         Perform a select query and add the results to a
@@ -308,20 +342,13 @@ class DataAccessLayer:
         :param include_col_header: boolean value to indicate if
             one wants to include a top row of the column headers
             or not, defaults to True
+        :param params: optionally, the values of any bound parameters
+            in the select statement
         :return: List of lists of select results
         """
         list_results = [[]]
-        logging.info(
-            f"In select_results, starting new session at {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-        with self.transaction() as session:
-            logging.info(
-                f"Starting to execute statement to return results at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
-            results = session.execute(select_statement)
-            logging.info(
-                f"Done executing statement to return results at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
+        with timed("select"), self.transaction() as session:
+            results = session.execute(select_statement, params)
             list_results = [list(row) for row in results]
             if include_col_header:
                 list_results.insert(0, list(results.keys()))
@@ -369,10 +396,7 @@ class DataAccessLayer:
         """
 
         if column_name is not None and column_name != "":
-            # TODO: I am sure there is an easier way to do this
-            for table in self.TABLE_LIST:
-                if column_name in table.c:
-                    return table
+            return self.TABLE_BY_COLUMN.get(column_name)
         return None
 
     def does_table_have_column(self, table: Table, column_name: str) -> bool:
@@ -388,3 +412,35 @@ class DataAccessLayer:
             return False
         else:
             return column_name in table.c
+
+
+def _copy_text_value(value) -> str:
+    """
+    Helper function that formats a value for Postgres' COPY text format.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, list):
+        value = _array_text_value(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _array_text_value(values: list) -> str:
+    """
+    Helper function that formats a list as a Postgres array literal, e.g.
+    '{"John","Jacob",NULL}'.
+    """
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append("NULL")
+        else:
+            element = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            elements.append(f'"{element}"')
+    return "{" + ",".join(elements) + "}"
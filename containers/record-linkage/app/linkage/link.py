@@ -1,15 +1,26 @@
+import asyncio
 import copy
-import datetime
 import hashlib
 import json
 import logging
 import pathlib
+import time
+import uuid
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Callable, Union
 
 from pydantic import Field
 
+from app.linkage.block import BLOCK_HEADER, ClusterSummary, MPIBlock
+from app.linkage.blocking_index import BlockingIndex
+from app.linkage.locks import AdvisoryLockTable, StripedLockTable
+from app.linkage.metrics import timed
 from app.linkage.mpi import BaseMPIConnectorClient, DIBBsMPIConnectorClient
+from app.linkage.mpi_async import AsyncDIBBsMPIConnectorClient
+from app.linkage.trace import LinkageTrace
 from app.linkage.utils import (
+    SimilarityCache,
     compare_strings,
     datetime_to_str,
     extract_value_with_resource_path,
@@ -27,6 +38,217 @@ LINKING_FIELDS_TO_FHIRPATHS = {
     "mrn": "Patient.identifier.where(type.coding.code='MR').value",
 }
 
+# Fields whose flattened values hold every address on the incoming record
+ADDRESS_FIELDS = ["address", "city", "state", "zip"]
+
+# Names of the counters tallied in the optional `linkage_stats` dictionary
+# accepted by `link_record_against_mpi`
+LINKAGE_STATS_KEYS = [
+    "record_comparisons",
+    "record_comparisons_skipped",
+    "record_comparisons_deduplicated",
+    "feature_comparisons_skipped",
+    "clusters_decided_early",
+    "oversize_blocks",
+    "blocks_refined",
+    "blocks_sampled",
+    "similarity_cache_hits",
+    "similarity_cache_misses",
+]
+
+# Maximum number of distinct MPI birthdates whose string form is kept for
+# fuzzy comparisons
+BIRTHDATE_STR_CACHE_SIZE = 65536
+
+# Extra blocking fields tried, in order, to narrow down a block that's
+# larger than its pass allows, unless the pass lists its own
+DEFAULT_REFINE_BLOCKS = [
+    {"value": "birthdate"},
+    {"value": "last_name"},
+    {"value": "zip"},
+    {"value": "first_name"},
+    {"value": "sex"},
+]
+
+
+class CompiledLinkagePass:
+    """
+    A single pass of a linkage algorithm whose configuration has been
+    validated and resolved ahead of time, so that comparing records does
+    no further configuration work: comparator functions are bound, the
+    per-field dispatch (name, address or plain comparison) is decided and
+    the keyword arguments are frozen.
+    """
+
+    def __init__(self, linkage_pass: dict):
+        """
+        Validates and compiles a single pass of a linkage algorithm.
+
+        :param linkage_pass: A dictionary describing the pass, as found in
+          an algorithm configuration (see `read_linkage_config`).
+        :raises ValueError: If the pass is malformed or refers to functions
+          that are not defined in `link.py`.
+        """
+        if not isinstance(linkage_pass, dict):
+            raise ValueError(f"Linkage pass {linkage_pass} must be a dictionary.")
+        for key in ["funcs", "blocks", "matching_rule"]:
+            if key not in linkage_pass:
+                raise ValueError(f"Linkage pass must contain a '{key}' key.")
+        if not isinstance(linkage_pass["funcs"], dict) or not linkage_pass["funcs"]:
+            raise ValueError("Linkage pass 'funcs' must be a non-empty dictionary.")
+        if not isinstance(linkage_pass["blocks"], list) or not all(
+            isinstance(b, dict) for b in linkage_pass["blocks"]
+        ):
+            raise ValueError("Linkage pass 'blocks' must be a list of dictionaries.")
+        max_block_size = linkage_pass.get("max_block_size")
+        if max_block_size is not None and (
+            not isinstance(max_block_size, int) or max_block_size < 1
+        ):
+            raise ValueError(
+                "Linkage pass 'max_block_size' must be a positive integer."
+            )
+        refine_blocks = linkage_pass.get("refine_blocks", DEFAULT_REFINE_BLOCKS)
+        if not isinstance(refine_blocks, list) or not all(
+            isinstance(b, dict) and "value" in b for b in refine_blocks
+        ):
+            raise ValueError(
+                "Linkage pass 'refine_blocks' must be a list of block dictionaries."
+            )
+
+        self.blocks = copy.deepcopy(linkage_pass["blocks"])
+        self.max_block_size = max_block_size
+        self.refine_blocks = copy.deepcopy(refine_blocks)
+        self.cluster_ratio = linkage_pass.get("cluster_ratio", 0)
+        self.kwargs = _freeze_kwargs(linkage_pass.get("kwargs", {}))
+        self.funcs = {
+            feature_col: _resolve_linkage_func(func)
+            for feature_col, func in linkage_pass["funcs"].items()
+        }
+        self.matching_rule = _resolve_linkage_func(linkage_pass["matching_rule"])
+
+        # A perfect match over boolean features fails on the first feature
+        # that doesn't match, so those passes compare the cheapest features
+        # first and stop early; any other rule sees every feature in order
+        feature_order = list(self.funcs)
+        self.short_circuit = self.matching_rule is eval_perfect_match and all(
+            f in BOOLEAN_FEATURE_FUNCS for f in self.funcs.values()
+        )
+        if self.short_circuit:
+            feature_order.sort(key=lambda col: self.funcs[col] in FUZZY_FEATURE_FUNCS)
+        self.feature_order = feature_order
+        self._comparators = [
+            _build_field_comparator(feature_col, self.funcs[feature_col], self.kwargs)
+            for feature_col in feature_order
+        ]
+
+    def compare(
+        self,
+        record: list,
+        mpi_patient: list,
+        col_to_idx: dict,
+        linkage_stats: dict = None,
+        similarity_cache: SimilarityCache = None,
+    ) -> bool:
+        """
+        Compares the flattened form of an incoming patient record to the
+        flattened form of a patient record pulled from the MPI.
+
+        :param record: The flattened incoming record.
+        :param mpi_patient: A flattened record from an MPI block.
+        :param col_to_idx: A dictionary mapping column names to their index
+          in the flattened records, not counting the two ID columns.
+        :param linkage_stats: Optionally, a dictionary of counters in which
+          to tally the feature comparisons skipped by short-circuiting.
+        :param similarity_cache: Optionally, a cache of string similarity
+          scores for fuzzy feature comparisons to reuse.
+        :return: Whether the records match under this pass.
+        """
+        # Format is patient_id, person_id, alphabetical list of FHIR keys
+        # Don't use the first two ID cols when linking
+        record = record[2:]
+        mpi_patient = mpi_patient[2:]
+        if self.short_circuit:
+            for i, comparator in enumerate(self._comparators):
+                if not comparator(record, mpi_patient, col_to_idx, similarity_cache):
+                    if linkage_stats is not None:
+                        skipped = len(self._comparators) - i - 1
+                        _increment_stat(
+                            linkage_stats, "feature_comparisons_skipped", skipped
+                        )
+                    return False
+            return True
+
+        feature_comps = [
+            comparator(record, mpi_patient, col_to_idx, similarity_cache)
+            for comparator in self._comparators
+        ]
+        return self.matching_rule(feature_comps, **self.kwargs)
+
+    def explain(
+        self,
+        record: list,
+        mpi_patient: list,
+        col_to_idx: dict,
+        similarity_cache: SimilarityCache = None,
+    ) -> tuple[bool, dict]:
+        """
+        Compares two flattened records as `compare` does, but scores every
+        feature, without short-circuiting, so that the outcome can be
+        explained.
+
+        :param record: The flattened incoming record.
+        :param mpi_patient: A flattened record from an MPI block.
+        :param col_to_idx: A dictionary mapping column names to their index
+          in the flattened records, not counting the two ID columns.
+        :param similarity_cache: Optionally, a cache of string similarity
+          scores for fuzzy feature comparisons to reuse.
+        :return: A tuple of whether the records match under this pass and a
+          dictionary mapping each feature to its comparison score.
+        """
+        feature_comps = [
+            comparator(record[2:], mpi_patient[2:], col_to_idx, similarity_cache)
+            for comparator in self._comparators
+        ]
+        matched = self.matching_rule(feature_comps, **self.kwargs)
+        return matched, dict(zip(self.feature_order, feature_comps))
+
+
+class CompiledLinkageAlgorithm:
+    """
+    A linkage algorithm configuration compiled into a sequence of
+    `CompiledLinkagePass` objects. Compiling an algorithm is meant to be done
+    once and the result reused for every record linked with it.
+    """
+
+    def __init__(self, algo_config: list[dict]):
+        """
+        Validates and compiles a linkage algorithm configuration.
+
+        :param algo_config: An algorithm configuration consisting of a list
+          of dictionaries describing the algorithm to run. See
+          `read_linkage_config` and `write_linkage_config` for more details.
+        :raises ValueError: If the configuration is malformed.
+        """
+        if not isinstance(algo_config, list):
+            raise ValueError("Algorithm configuration must be a list of passes.")
+        self.config_hash = hash_linkage_config(algo_config)
+        self.passes = [CompiledLinkagePass(lp) for lp in algo_config]
+        self._col_to_idx = {}
+
+    def col_to_idx(self, header: list) -> dict[str, int]:
+        """
+        Maps the column names in the header row of an MPI block to their
+        index in the flattened records, not counting the two ID columns. The
+        mapping is computed once per distinct header.
+
+        :param header: The header row of a block of MPI data.
+        :return: A dictionary mapping column names to indices.
+        """
+        key = tuple(header)
+        if key not in self._col_to_idx:
+            self._col_to_idx[key] = {v: k for k, v in enumerate(header[2:])}
+        return self._col_to_idx[key]
+
 
 def compile_match_lists(match_lists: list[dict], cluster_mode: bool = False):
     """
@@ -252,25 +474,30 @@ def feature_match_fuzzy_string(
       in which they occur in order in the data.
     :param **kwargs: Optionally, a dictionary including specifications for
       the string comparison metric to use, as well as the cutoff score
-      beyond which to classify the strings as a partial match.
+      beyond which to classify the strings as a partial match, and a
+      `similarity_cache` of scores to reuse.
     :return: A boolean indicating whether the features are a fuzzy match.
     """
     idx = col_to_idx[feature_col]
+    value_i = record_i[idx]
+    value_j = record_j[idx]
 
     # Convert datetime obj to str using helper function
     if feature_col == "birthdate":
-        record_i[idx] = datetime_to_str(record_i[idx])
-        record_j[idx] = datetime_to_str(record_j[idx])
+        value_i = _birthdate_to_str(value_i)
+        value_j = _birthdate_to_str(value_j)
 
     # Special case for two empty strings, since we don't want vacuous
     # equality (or in-) to penalize the score
-    if record_i[idx] == "" and record_j[idx] == "":
+    if value_i == "" and value_j == "":
         return True
-    if record_i[idx] is None and record_j[idx] is None:
+    if value_i is None and value_j is None:
         return True
 
     similarity_measure, threshold = _get_fuzzy_params(feature_col, **kwargs)
-    score = compare_strings(record_i[idx], record_j[idx], similarity_measure)
+    score = _compare_strings(
+        value_i, value_j, similarity_measure, kwargs.get("similarity_cache")
+    )
     return score >= threshold
 
 
@@ -330,19 +557,33 @@ def feature_match_log_odds_fuzzy_compare(
         raise KeyError("Mapping of columns to m/u log-odds must be provided.")
     col_odds = kwargs["log_odds"][feature_col]
     idx = col_to_idx[feature_col]
+    value_i = record_i[idx]
+    value_j = record_j[idx]
 
     # Convert datetime obj to str using helper function
     if feature_col == "birthdate":
-        record_i[idx] = datetime_to_str(record_i[idx])
-        record_j[idx] = datetime_to_str(record_j[idx])
+        value_i = _birthdate_to_str(value_i)
+        value_j = _birthdate_to_str(value_j)
 
     similarity_measure, threshold = _get_fuzzy_params(feature_col, **kwargs)
-    score = compare_strings(record_i[idx], record_j[idx], similarity_measure)
+    score = _compare_strings(
+        value_i, value_j, similarity_measure, kwargs.get("similarity_cache")
+    )
     if score < threshold:
         score = 0.0
     return score * col_odds
 
 
+# Feature comparison functions that return whether two values match and,
+# among those, the ones that score string similarity rather than equality
+BOOLEAN_FEATURE_FUNCS = [
+    feature_match_exact,
+    feature_match_four_char,
+    feature_match_fuzzy_string,
+]
+FUZZY_FEATURE_FUNCS = [feature_match_fuzzy_string]
+
+
 def generate_hash_str(linking_identifier: str, salt_str: str) -> str:
     """
     Generates a hash for a given string of concatenated patient information. The hash
@@ -360,11 +601,65 @@ def generate_hash_str(linking_identifier: str, salt_str: str) -> str:
     return hash_obj.hexdigest()
 
 
+def hash_linkage_config(algo_config: list[dict]) -> str:
+    """
+    Computes a stable hash of a linkage algorithm configuration, suitable
+    for keying a cache of compiled algorithms. Functions supplied as
+    callables rather than names are hashed by their qualified names.
+
+    :param algo_config: An algorithm configuration consisting of a list
+      of dictionaries describing the algorithm to run.
+    :return: The hex digest of the configuration's hash.
+    """
+    serialized = json.dumps(
+        algo_config,
+        sort_keys=True,
+        default=lambda obj: (
+            f"{getattr(obj, '__module__', '')}."
+            f"{getattr(obj, '__qualname__', repr(obj))}"
+        ),
+    )
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def blocking_lock_keys(
+    record: dict, algo_config: CompiledLinkageAlgorithm
+) -> list[int]:
+    """
+    Computes keys identifying the blocks a record is looked up in, one for
+    each linkage pass the record has blocking values for, hashed from the
+    pass's blocking fields and the values extracted for them. Records with
+    the same blocking values in a pass, which is how records of the same
+    person find each other, get the same key for it.
+
+    :param record: The FHIR-formatted patient resource.
+    :param algo_config: The compiled linkage algorithm.
+    :return: The sorted keys, as signed 64-bit integers.
+    """
+    keys = set()
+    for linkage_pass in algo_config.passes:
+        blocking_criteria = extract_blocking_values_from_record(
+            record, linkage_pass.blocks
+        )
+        if len(blocking_criteria) > 0:
+            serialized = json.dumps(blocking_criteria, sort_keys=True, default=str)
+            digest = hashlib.blake2b(serialized.encode("utf-8"), digest_size=8)
+            keys.add(int.from_bytes(digest.digest(), "big", signed=True))
+    return sorted(keys)
+
+
 def link_record_against_mpi(
     record: dict,
-    algo_config: list[dict],
+    algo_config: Union[list[dict], CompiledLinkageAlgorithm],
     external_person_id: str = None,
     mpi_client: BaseMPIConnectorClient = None,
+    linkage_stats: dict = None,
+    parallel_passes: bool = False,
+    max_block_size: int = None,
+    estimate_block_size: bool = False,
+    similarity_cache: SimilarityCache = None,
+    trace: LinkageTrace = None,
+    locks: Union[StripedLockTable, AdvisoryLockTable] = None,
 ) -> tuple[bool, str]:
     """
     Runs record linkage on a single incoming record (extracted from a FHIR
@@ -381,6 +676,41 @@ def link_record_against_mpi(
     :param algo_config: An algorithm configuration consisting of a list
       of dictionaries describing the algorithm to run. See
       `read_linkage_config` and `write_linkage_config` for more details.
+      May also be a `CompiledLinkageAlgorithm`, which skips validating and
+      binding the configuration on every call.
+    :param linkage_stats: Optionally, a dictionary in which to tally the
+      counters named in `LINKAGE_STATS_KEYS`, e.g. how many record
+      comparisons were skipped because a cluster's outcome was already
+      decided.
+    :param parallel_passes: Whether to fetch the blocks of every pass at
+      once, rather than querying the MPI once per pass. The blocks are
+      fetched with a single query for the patients in each block and a
+      single query for their records, so patients shared between passes
+      are only fetched and prepared for scoring once. Linkage results are
+      the same either way. Requires an MPI client implementing
+      `get_block_data_batch`. Default: `False`.
+    :param max_block_size: Optionally, the most patients a block may hold
+      in passes that don't set their own `max_block_size`. The size of each
+      block is checked before it's fetched; an oversize block is narrowed
+      down with the pass's `refine_blocks` and, failing that, sampled
+      deterministically (see `_guard_block_criteria`). Requires an MPI
+      client implementing `get_block_size`. Default: `None`, meaning
+      blocks aren't limited.
+    :param estimate_block_size: Whether to check block sizes against the
+      query planner's estimates rather than counting. Default: `False`.
+    :param similarity_cache: Optionally, a process-wide `SimilarityCache` of
+      string similarity scores to share between calls. Scores are memoized
+      for the duration of the call in any case, so each distinct pair of
+      values is only scored once per record. Default: `None`.
+    :param trace: Optionally, a `LinkageTrace` in which to record the
+      blocks, timings, cluster ratios and feature scores of every pass, and
+      the outcome of linkage. Default: `None`, meaning linkage isn't traced.
+    :param locks: Optionally, a lock table in which the record's
+      `blocking_lock_keys` are locked until its patient is inserted, so that
+      concurrent records sharing a block are linked one after the other,
+      each seeing the patients inserted by the ones before, while records in
+      disjoint blocks are linked in parallel. Default: `None`, meaning
+      concurrent records aren't serialized.
     :returns: A tuple consisting of a boolean indicating whether a match
       was found for the new record in the MPI, followed by the ID of the
       Person entity now associated with the incoming patient (either a
@@ -391,139 +721,436 @@ def link_record_against_mpi(
         logging.info("MPI client was None, instatiating new client.")
         mpi_client = DIBBsMPIConnectorClient()
 
-    # Need to bind function names back to their symbolic invocations
-    # in context of the module--i.e. turn the string of a function
-    # name back into the callable defined in link.py
+    # Compiling validates the configuration and binds function names back
+    # to their callables in link.py; callers linking many records should
+    # compile once and pass the compiled algorithm instead
+    if not isinstance(algo_config, CompiledLinkageAlgorithm):
+        with timed("bind_config"):
+            algo_config = CompiledLinkageAlgorithm(algo_config)
 
-    algo_config = copy.deepcopy(algo_config)
-    logging.info(
-        f"Starting _bind_func_names_to_invocations at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-    )
-    algo_config = _bind_func_names_to_invocations(algo_config)
-    logging.info(
-        f"Done with _bind_func_names_to_invocations at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-    )
+    if locks is not None:
+        with locks.hold(blocking_lock_keys(record, algo_config)):
+            return link_record_against_mpi(
+                record,
+                algo_config,
+                external_person_id,
+                mpi_client,
+                linkage_stats,
+                parallel_passes,
+                max_block_size,
+                estimate_block_size,
+                similarity_cache,
+                trace,
+            )
 
     # Membership ratios need to persist across linkage passes so that we can
     # find the highest scoring match across all trials
     linkage_scores = {}
-    for linkage_pass in algo_config:
-        blocking_fields = linkage_pass["blocks"]
+    similarity_cache = SimilarityCache(parent=similarity_cache)
+    if parallel_passes:
+        _score_record_against_passes(
+            record,
+            algo_config,
+            mpi_client,
+            linkage_scores,
+            linkage_stats,
+            max_block_size,
+            estimate_block_size,
+            similarity_cache,
+            trace,
+        )
+    else:
+        for p, linkage_pass in enumerate(algo_config.passes):
+            blocking_fields = linkage_pass.blocks
+
+            # MPI will be able to find patients if *any* of their names or addresses
+            # contains extracted values, so minimally block on the first line
+            # if applicable
+            with timed("extract_blocking_values"):
+                blocking_criteria = extract_blocking_values_from_record(
+                    record, blocking_fields
+                )
+            if trace is not None:
+                trace.start_pass(p, blocking_criteria)
+                start = time.perf_counter()
+
+            # We don't enforce blocking if an extracted value is empty, so if all
+            # values come back blank, skip the pass because the only alt is comparing
+            # to all found records
+            if len(blocking_criteria) == 0:
+                logging.info("No blocking criteria extracted from incoming record.")
+                continue
+            blocking_criteria, max_patients = _guard_block_criteria(
+                record,
+                blocking_criteria,
+                linkage_pass,
+                mpi_client,
+                linkage_pass.max_block_size or max_block_size,
+                estimate_block_size,
+                linkage_stats,
+            )
+            with timed("fetch_block"):
+                if max_patients is None:
+                    block = mpi_client.get_compact_block_data(blocking_criteria)
+                else:
+                    block = mpi_client.get_compact_block_data(
+                        blocking_criteria, max_patients
+                    )
+            if trace is not None:
+                trace.guard_pass(blocking_criteria, max_patients)
+                trace.add_timing("fetch", start)
 
-        # MPI will be able to find patients if *any* of their names or addresses
-        # contains extracted values, so minimally block on the first line
-        # if applicable
+            _score_record_against_block(
+                record,
+                block,
+                algo_config,
+                linkage_pass,
+                linkage_scores,
+                linkage_stats,
+                similarity_cache=similarity_cache,
+                trace=trace,
+            )
+    if linkage_stats is not None:
+        _tally_similarity_cache(linkage_stats, similarity_cache)
         logging.info(
-            f"Starting extract_blocking_values_from_record at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            "Linkage comparisons: "
+            + ", ".join(f"{k}={linkage_stats.get(k, 0)}" for k in LINKAGE_STATS_KEYS)
         )
-        blocking_criteria = extract_blocking_values_from_record(record, blocking_fields)
-        logging.info(
-            f"Done with extract_blocking_values_from_record at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+    person_id = None
+    matched = False
+
+    # If we found any matches, find the strongest one
+    if len(linkage_scores) != 0:
+        person_id = _find_strongest_link(linkage_scores)
+        matched = True
+    with timed("insert"):
+        person_id = mpi_client.insert_matched_patient(
+            record, person_id=person_id, external_person_id=external_person_id
         )
+    if trace is not None:
+        trace.set_result(matched, person_id, linkage_scores)
+
+    return (matched, person_id)
+
 
-        # We don't enforce blocking if an extracted value is empty, so if all
-        # values come back blank, skip the pass because the only alt is comparing
-        # to all found records
-        if len(blocking_criteria) == 0:
+async def link_record_against_mpi_async(
+    record: dict,
+    algo_config: Union[list[dict], CompiledLinkageAlgorithm],
+    external_person_id: str = None,
+    mpi_client: AsyncDIBBsMPIConnectorClient = None,
+    linkage_stats: dict = None,
+    max_block_size: int = None,
+    estimate_block_size: bool = False,
+    similarity_cache: SimilarityCache = None,
+    trace: LinkageTrace = None,
+    locks: Union[StripedLockTable, AdvisoryLockTable] = None,
+) -> tuple[bool, str]:
+    """
+    Runs record linkage on a single incoming record against the MPI, as
+    `link_record_against_mpi` does, without blocking the event loop while
+    waiting on the database. The blocks of every linkage pass are fetched
+    concurrently, each on its own pooled connection, and are then scored in
+    order, so results are the same as `link_record_against_mpi`'s.
+
+    :param record: The FHIR-formatted patient resource to try to match to
+      other records in the MPI.
+    :param algo_config: An algorithm configuration consisting of a list
+      of dictionaries describing the algorithm to run, or a
+      `CompiledLinkageAlgorithm`. See `link_record_against_mpi`.
+    :param external_person_id: Optionally, the external person ID supplied
+      for the record.
+    :param mpi_client: Optionally, the asynchronous MPI client to use.
+    :param linkage_stats: Optionally, a dictionary in which to tally the
+      counters named in `LINKAGE_STATS_KEYS`.
+    :param max_block_size: Optionally, the most patients a block may hold
+      in passes that don't set their own limit. See `link_record_against_mpi`.
+    :param estimate_block_size: Whether to check block sizes against the
+      query planner's estimates rather than counting. Default: `False`.
+    :param similarity_cache: Optionally, a process-wide `SimilarityCache`
+      to share between calls. See `link_record_against_mpi`.
+    :param trace: Optionally, a `LinkageTrace` in which to record how the
+      record was linked. Blocks are fetched concurrently, so their fetch
+      time is recorded for the linkage as a whole.
+    :param locks: Optionally, a lock table in which the record's
+      `blocking_lock_keys` are locked until its patient is inserted, waiting
+      without blocking the event loop. See `link_record_against_mpi`.
+    :returns: A tuple consisting of a boolean indicating whether a match
+      was found for the new record in the MPI, followed by the ID of the
+      Person entity now associated with the incoming patient.
+    """
+    if mpi_client is None:
+        logging.info("MPI client was None, instatiating new client.")
+        mpi_client = AsyncDIBBsMPIConnectorClient()
+    if not isinstance(algo_config, CompiledLinkageAlgorithm):
+        with timed("bind_config"):
+            algo_config = CompiledLinkageAlgorithm(algo_config)
+
+    if locks is not None:
+        async with locks.hold_async(blocking_lock_keys(record, algo_config)):
+            return await link_record_against_mpi_async(
+                record,
+                algo_config,
+                external_person_id,
+                mpi_client,
+                linkage_stats,
+                max_block_size,
+                estimate_block_size,
+                similarity_cache,
+                trace,
+            )
+
+    if trace is not None:
+        start = time.perf_counter()
+    with timed("extract_blocking_values"):
+        pass_criteria = [
+            extract_blocking_values_from_record(record, linkage_pass.blocks)
+            for linkage_pass in algo_config.passes
+        ]
+    to_fetch = [p for p, criteria in enumerate(pass_criteria) if len(criteria) > 0]
+    guarded = await asyncio.gather(
+        *(
+            _guard_block_criteria_async(
+                record,
+                pass_criteria[p],
+                algo_config.passes[p],
+                mpi_client,
+                algo_config.passes[p].max_block_size or max_block_size,
+                estimate_block_size,
+                linkage_stats,
+            )
+            for p in to_fetch
+        )
+    )
+    with timed("fetch_block"):
+        fetched = await asyncio.gather(
+            *(
+                mpi_client.get_compact_block_data(criteria)
+                if max_patients is None
+                else mpi_client.get_compact_block_data(criteria, max_patients)
+                for criteria, max_patients in guarded
+            )
+        )
+    pass_blocks = dict(zip(to_fetch, fetched))
+    pass_guarded = dict(zip(to_fetch, guarded))
+    if trace is not None:
+        trace.add_timing("fetch", start)
+
+    linkage_scores = {}
+    similarity_cache = SimilarityCache(parent=similarity_cache)
+    for p, linkage_pass in enumerate(algo_config.passes):
+        if trace is not None:
+            trace.start_pass(p, pass_criteria[p])
+        if p not in pass_blocks:
             logging.info("No blocking criteria extracted from incoming record.")
             continue
-        logging.info(
-            f"Starting get_block_data at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+        if trace is not None:
+            trace.guard_pass(*pass_guarded[p])
+        _score_record_against_block(
+            record,
+            pass_blocks[p],
+            algo_config,
+            linkage_pass,
+            linkage_scores,
+            linkage_stats,
+            similarity_cache=similarity_cache,
+            trace=trace,
         )
-        raw_data_block = mpi_client.get_block_data(blocking_criteria)
+    if linkage_stats is not None:
+        _tally_similarity_cache(linkage_stats, similarity_cache)
         logging.info(
-            f"Done with get_block_data at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            "Linkage comparisons: "
+            + ", ".join(f"{k}={linkage_stats.get(k, 0)}" for k in LINKAGE_STATS_KEYS)
         )
 
-        data_block = _convert_given_name_to_first_name(raw_data_block)
+    person_id = None
+    matched = False
+    if len(linkage_scores) != 0:
+        person_id = _find_strongest_link(linkage_scores)
+        matched = True
+    with timed("insert"):
+        person_id = await mpi_client.insert_matched_patient(
+            record, person_id=person_id, external_person_id=external_person_id
+        )
+    if trace is not None:
+        trace.set_result(matched, person_id, linkage_scores)
+    return (matched, person_id)
 
-        # First row of returned block is column headers
-        # Map column name to idx, not including patient/person IDs
-        col_to_idx = {v: k for k, v in enumerate(data_block[0][2:])}
-        if len(data_block[1:]) > 0:  # Check if data_block is empty
-            data_block = data_block[1:]
-            logging.info(
-                f"Starting _flatten_patient_resource at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
-            flattened_record = _flatten_patient_resource(record, col_to_idx)
-            logging.info(
-                f"Done with _flatten_patient_resource at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
 
-            logging.info(
-                f"Starting _group_patient_block_by_person at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-            )
-            clusters = _group_patient_block_by_person(data_block)
-            logging.info(
-                f"Done with _group_patient_block_by_person at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+def link_records_against_mpi(
+    records: list[dict],
+    algo_config: Union[list[dict], CompiledLinkageAlgorithm],
+    external_person_ids: list = None,
+    mpi_client: DIBBsMPIConnectorClient = None,
+    linkage_stats: dict = None,
+    max_block_size: int = None,
+    estimate_block_size: bool = False,
+    similarity_cache: SimilarityCache = None,
+    locks: Union[StripedLockTable, AdvisoryLockTable] = None,
+) -> list[tuple[bool, str]]:
+    """
+    Runs record linkage on a batch of incoming records, with the same
+    results as calling `link_record_against_mpi` on each record in turn.
+    Rather than querying the MPI once per record per pass, the blocking
+    criteria of every record are gathered up front and the blocks for each
+    pass fetched with a few set-based queries. Records are then linked in
+    memory, in order, so that a record can also link to a person created or
+    matched by an earlier record in the same batch, and all of the batch's
+    patients are inserted into the MPI in a single transaction. Blocks are
+    kept within their pass's size limit as by `link_record_against_mpi`.
+
+    :param records: The FHIR-formatted patient resources to try to match to
+      other records in the MPI.
+    :param algo_config: An algorithm configuration consisting of a list
+      of dictionaries describing the algorithm to run, or a
+      `CompiledLinkageAlgorithm`. See `link_record_against_mpi`.
+    :param external_person_ids: Optionally, the external person ID supplied
+      for each record, or None where there isn't one.
+    :param mpi_client: Optionally, the MPI client to use.
+    :param linkage_stats: Optionally, a dictionary in which to tally the
+      counters named in `LINKAGE_STATS_KEYS`.
+    :param max_block_size: Optionally, the most patients a block may hold
+      in passes that don't set their own `max_block_size`. See
+      `link_record_against_mpi`.
+    :param estimate_block_size: Whether to check block sizes against the
+      query planner's estimates rather than counting the patients in each
+      block. Default is False.
+    :param similarity_cache: Optionally, a process-wide `SimilarityCache`
+      to share between calls. Scores are memoized across the batch in any
+      case.
+    :param locks: Optionally, a lock table in which the `blocking_lock_keys`
+      of every record in the batch are locked until the batch is inserted.
+      See `link_record_against_mpi`.
+    :returns: A list with one tuple per record, each consisting of a boolean
+      indicating whether a match was found for the record, followed by the
+      ID of the Person entity now associated with it.
+    """
+    if mpi_client is None:
+        logging.info("MPI client was None, instatiating new client.")
+        mpi_client = DIBBsMPIConnectorClient()
+    if not isinstance(algo_config, CompiledLinkageAlgorithm):
+        with timed("bind_config"):
+            algo_config = CompiledLinkageAlgorithm(algo_config)
+    if external_person_ids is None:
+        external_person_ids = [None] * len(records)
+    if len(external_person_ids) != len(records):
+        raise ValueError("An external person ID must be supplied for every record.")
+    if len(records) == 0:
+        return []
+
+    if locks is not None:
+        keys = [
+            key for record in records for key in blocking_lock_keys(record, algo_config)
+        ]
+        with locks.hold(keys):
+            return link_records_against_mpi(
+                records,
+                algo_config,
+                external_person_ids,
+                mpi_client,
+                linkage_stats,
+                max_block_size,
+                estimate_block_size,
+                similarity_cache,
             )
 
-            # Check if incoming record should belong to one of the person clusters
-            kwargs = linkage_pass.get("kwargs", {})
-            for person in clusters:
-                num_matched_in_cluster = 0.0
-                for linked_patient in clusters[person]:
-                    logging.info(
-                        f"Starting _compare_records at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                    )
-                    is_match = _compare_records(
-                        flattened_record,
-                        linked_patient,
-                        linkage_pass["funcs"],
-                        col_to_idx,
-                        linkage_pass["matching_rule"],
-                        **kwargs,
-                    )
-                    logging.info(
-                        f"Done with _compare_records at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+    # Gather every record's blocking criteria for each pass, then fetch all
+    # of the pass's blocks at once, but for those that must be sampled to
+    # fit the pass's size limit
+    pass_criteria = []
+    pass_blocks = []
+    for linkage_pass in algo_config.passes:
+        with timed("extract_blocking_values"):
+            criteria = [
+                extract_blocking_values_from_record(record, linkage_pass.blocks)
+                for record in records
+            ]
+        to_fetch = []
+        blocks = [None] * len(records)
+        for i, record in enumerate(records):
+            if len(criteria[i]) == 0:
+                continue
+            criteria[i], max_patients = _guard_block_criteria(
+                record,
+                criteria[i],
+                linkage_pass,
+                mpi_client,
+                linkage_pass.max_block_size or max_block_size,
+                estimate_block_size,
+                linkage_stats,
+            )
+            if max_patients is None:
+                to_fetch.append(i)
+            else:
+                with timed("fetch_block"):
+                    blocks[i] = mpi_client.get_compact_block_data(
+                        criteria[i], max_patients
                     )
-
-                    if is_match:
-                        num_matched_in_cluster += 1.0
-
-                # Update membership score for this person cluster so that we can
-                # track best possible link across multiple passes
-                logging.info(
-                    f"Starting to update membership score at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+        if len(to_fetch) > 0:
+            with timed("fetch_block"):
+                fetched = mpi_client.get_block_data_batch(
+                    [criteria[i] for i in to_fetch]
                 )
-                belongingness_ratio = num_matched_in_cluster / len(clusters[person])
-                if belongingness_ratio >= linkage_pass.get("cluster_ratio", 0):
-                    logging.info(
-                        f"belongingness_ratio >= linkage_pass.get('cluster_ratio', 0): {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                    )
-                    if person in linkage_scores:
-                        linkage_scores[person] = max(
-                            [linkage_scores[person], belongingness_ratio]
-                        )
-                    else:
-                        linkage_scores[person] = belongingness_ratio
-                logging.info(
-                    f"Done with updating membership score at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            for i, block in zip(to_fetch, fetched):
+                blocks[i] = block
+        pass_criteria.append(criteria)
+        pass_blocks.append(blocks)
+
+    # Link the records in order; records earlier in the batch aren't in the
+    # MPI yet, so they're looked up in an index of the batch instead
+    batch_index = BlockingIndex(mpi_client)
+    similarity_cache = SimilarityCache(parent=similarity_cache)
+    results = []
+    for k, record in enumerate(records):
+        linkage_scores = {}
+        for p, linkage_pass in enumerate(algo_config.passes):
+            raw_data_block = pass_blocks[p][k]
+            if raw_data_block is None:
+                logging.info("No blocking criteria extracted from incoming record.")
+                continue
+            if isinstance(raw_data_block, MPIBlock):
+                batch_block = MPIBlock(
+                    BLOCK_HEADER,
+                    batch_index.get_block_rows(pass_criteria[p][k], BLOCK_HEADER),
                 )
-    person_id = None
-    matched = False
+                raw_data_block = MPIBlock(
+                    raw_data_block.header, raw_data_block.rows + batch_block.rows
+                )
+            else:
+                raw_data_block = raw_data_block + batch_index.get_block_rows(
+                    pass_criteria[p][k], raw_data_block[0]
+                )
+            _score_record_against_block(
+                record,
+                raw_data_block,
+                algo_config,
+                linkage_pass,
+                linkage_scores,
+                linkage_stats,
+                similarity_cache=similarity_cache,
+            )
 
-    # If we found any matches, find the strongest one
-    if len(linkage_scores) != 0:
+        if len(linkage_scores) != 0:
+            person_id = _find_strongest_link(linkage_scores)
+            results.append((True, person_id))
+        else:
+            person_id = uuid.uuid4()
+            results.append((False, person_id))
+        record["person"] = person_id
+        batch_index.add_patient(record)
+
+    if linkage_stats is not None:
+        _tally_similarity_cache(linkage_stats, similarity_cache)
         logging.info(
-            f"Starting _find_strongest_link at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            "Linkage comparisons: "
+            + ", ".join(f"{k}={linkage_stats.get(k, 0)}" for k in LINKAGE_STATS_KEYS)
         )
-        person_id = _find_strongest_link(linkage_scores)
-        matched = True
-        logging.info(
-            f"Done with _find_strongest_link at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+    with timed("insert"):
+        mpi_client.insert_matched_patients(
+            records,
+            [person_id for _, person_id in results],
+            external_person_ids,
         )
-    logging.info(
-        f"Starting mpi_client.insert_matched_patient at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-    )
-    person_id = mpi_client.insert_matched_patient(
-        record, person_id=person_id, external_person_id=external_person_id
-    )
-    logging.info(
-        f"Done with mpi_client.insert_matched_patient at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-    )
-
-    return (matched, person_id)
+    return results
 
 
 def load_json_probs(path: pathlib.Path):
@@ -729,8 +1356,8 @@ def write_linkage_config(linkage_algo: list[dict], file_to_write: pathlib.Path)
     filepath location. Algorithm descriptions are lists of dictionaries, one
     for each pass of the algorithm, whose keys are parameter values for a
     linkage pass (drawn from the list `"funcs"`, `"blocks"`, `"matching_rule"`,
-    and optionally `"cluster_ratio"` and `"kwargs"`) and whose values are
-    as follows:
+    and optionally `"cluster_ratio"`, `"kwargs"`, `"max_block_size"` and
+    `"refine_blocks"`) and whose values are as follows:
 
     - `"funcs"` should map to a dictionary mapping column name to the
     name of a function in the DIBBS linkage module (such as
@@ -743,6 +1370,10 @@ def write_linkage_config(linkage_algo: list[dict], file_to_write: pathlib.Path)
     - `"cluster_ratio"` should map to a float, if provided
     - `"kwargs"` should map to a dictionary of keyword arguments and their
     associated values, if provided
+    - `"max_block_size"` should map to the most patients the pass's blocks
+    may hold, if provided
+    - `"refine_blocks"` should map to a list of extra blocks, in the format
+    of `"blocks"`, used to narrow down oversize blocks, if provided
 
     :param linkage_algo: A list of dictionaries whose key-value pairs correspond
       to the rules above.
@@ -760,25 +1391,76 @@ def write_linkage_config(linkage_algo: list[dict], file_to_write: pathlib.Path)
             pass_json["kwargs"] = {
                 kwarg: val for (kwarg, val) in rl_pass.get("kwargs", {}).items()
             }
+        for key in ["max_block_size", "refine_blocks"]:
+            if rl_pass.get(key, None) is not None:
+                pass_json[key] = rl_pass[key]
         algo_json.append(pass_json)
     linkage_json = {"algorithm": algo_json}
     with open(file_to_write, "w") as out:
         out.write(json.dumps(linkage_json))
 
 
-def _bind_func_names_to_invocations(algo_config: list[dict]):
+def _birthdate_to_str(value) -> str:
+    """
+    Helper method that converts a birthdate to a string for fuzzy comparison,
+    as `datetime_to_str` does. Strings are returned as they are, which is
+    all `datetime_to_str` does with them, and each distinct date pulled from
+    the MPI is only converted once rather than once per comparison.
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return _date_to_str(value)
+
+
+def _build_field_comparator(
+    feature_col: str, feature_func: Callable, kwargs: dict
+) -> Callable:
+    """
+    Helper method that binds the comparison of a single feature between an
+    incoming record and an MPI record, choosing once whether the feature is
+    compared as a name, as a set of addresses, or directly.
+    """
+    if feature_col == "first_name":
+        compare_elements = _compare_name_elements
+    elif feature_col in ADDRESS_FIELDS:
+        compare_elements = _compare_address_elements
+    else:
+
+        def compare_plain(record, mpi_patient, col_to_idx, similarity_cache=None):
+            return feature_func(
+                record,
+                mpi_patient,
+                feature_col,
+                col_to_idx,
+                similarity_cache=similarity_cache,
+                **kwargs,
+            )
+
+        return compare_plain
+
+    feature_funcs = {feature_col: feature_func}
+
+    def compare(record, mpi_patient, col_to_idx, similarity_cache=None):
+        return compare_elements(
+            record,
+            mpi_patient,
+            feature_funcs,
+            feature_col,
+            col_to_idx,
+            similarity_cache=similarity_cache,
+            **kwargs,
+        )
+
+    return compare
+
+
+@lru_cache(maxsize=BIRTHDATE_STR_CACHE_SIZE)
+def _date_to_str(value) -> str:
     """
-    Helper method that re-maps the string names of functions to their
-    callable invocations as defined within the `link.py` module.
+    Helper method that converts a date to a string with `datetime_to_str`,
+    memoizing the result.
     """
-    for lp in algo_config:
-        feature_funcs = lp["funcs"]
-        for func in feature_funcs:
-            if type(feature_funcs[func]) is str:  # noqa
-                feature_funcs[func] = globals()[feature_funcs[func]]
-        if type(lp["matching_rule"]) is str:  # noqa
-            lp["matching_rule"] = globals()[lp["matching_rule"]]
-    return algo_config
+    return datetime_to_str(value)
 
 
 def _eval_record_in_cluster(
@@ -815,55 +1497,264 @@ def _eval_record_in_cluster(
     return False
 
 
-def _compare_records(
+def _eval_record_against_cluster(
     record: list,
-    mpi_patient: list,
-    feature_funcs: dict,
+    cluster: Union[list[list], ClusterSummary],
+    linkage_pass: CompiledLinkagePass,
     col_to_idx: dict[str, int],
-    matching_rule: callable,
-    **kwargs,
-) -> bool:
-    """
-    Helper method that compares the flattened form of an incoming new
-    patient record to the flattened form of a patient record pulled
-    from the MPI.
-    """
-    # Format is patient_id, person_id, alphabetical list of FHIR keys
-    # Don't use the first two ID cols when linking
-    feature_comps = [
-        _compare_records_field_helper(
-            record[2:],
-            mpi_patient[2:],
-            feature_col,
-            col_to_idx,
-            feature_funcs,
-            **kwargs,
-        )
-        for feature_col in feature_funcs
-    ]
-    is_match = matching_rule(feature_comps, **kwargs)
-    return is_match
+    prior_score: Union[float, None] = None,
+    best_score: Union[float, None] = None,
+    linkage_stats: dict = None,
+    similarity_cache: SimilarityCache = None,
+    trace: LinkageTrace = None,
+) -> Union[float, None]:
+    """
+    Helper method that computes the proportion of the records linked to a
+    person that an incoming record matches, stopping as soon as the rest
+    of the cluster can no longer change the outcome of linkage. That is
+    the case once the ratio can't reach the pass's `cluster_ratio`, can't
+    improve on the person's score from an earlier pass, or has reached the
+    `cluster_ratio` but can't catch up with the best score found so far.
+    In the last case the ratio reached so far is returned, since the
+    person is recorded as a candidate but can't be the strongest link.
+    If the cluster is given as a `ClusterSummary`, the record is compared
+    once with each distinct variant of the person's rows, and the outcome
+    reused for every other row holding it. Comparisons are recorded in
+    `trace`, if given, until it has enough, and the bounds of the ratio
+    are recorded in it if evaluation stops early.
+
+    :return: The belongingness ratio to record for the person, or None if
+      the person's score should be left as is.
+    """
+    if isinstance(cluster, ClusterSummary):
+        variants, row_variants = cluster.variants, cluster.row_variants
+    else:
+        variants, row_variants = cluster, range(len(cluster))
+    variant_matches = [None] * len(variants)
+    cluster_size = len(row_variants)
+    num_matched = 0.0
+    for num_compared, variant_idx in enumerate(row_variants):
+        remaining = cluster_size - num_compared
+        max_ratio = (num_matched + remaining) / cluster_size
+        min_ratio = num_matched / cluster_size
+        if max_ratio < linkage_pass.cluster_ratio or (
+            prior_score is not None and max_ratio <= prior_score
+        ):
+            decided_ratio = None
+        elif (
+            min_ratio >= linkage_pass.cluster_ratio
+            and best_score is not None
+            and max_ratio < best_score
+        ):
+            decided_ratio = min_ratio
+        else:
+            matched = variant_matches[variant_idx]
+            if matched is not None:
+                if linkage_stats is not None:
+                    _increment_stat(linkage_stats, "record_comparisons_deduplicated")
+            else:
+                linked_patient = variants[variant_idx]
+                if trace is not None and trace.wants_comparison():
+                    matched, feature_scores = linkage_pass.explain(
+                        record, linked_patient, col_to_idx, similarity_cache
+                    )
+                    trace.add_comparison(linked_patient[0], matched, feature_scores)
+                else:
+                    matched = linkage_pass.compare(
+                        record,
+                        linked_patient,
+                        col_to_idx,
+                        linkage_stats,
+                        similarity_cache,
+                    )
+                variant_matches[variant_idx] = matched
+                if linkage_stats is not None:
+                    _increment_stat(linkage_stats, "record_comparisons")
+            if matched:
+                num_matched += 1.0
+            continue
 
+        if linkage_stats is not None:
+            _increment_stat(linkage_stats, "record_comparisons_skipped", remaining)
+            _increment_stat(linkage_stats, "clusters_decided_early")
+        if trace is not None:
+            trace.exit_cluster_early(min_ratio, max_ratio)
+        return decided_ratio
+    return num_matched / cluster_size
 
-def _compare_records_field_helper(
-    record: list,
-    mpi_patient: list,
-    feature_col: str,
-    col_to_idx: dict[str, int],
-    feature_funcs: dict,
-    **kwargs,
-) -> bool:
-    if feature_col == "first_name":
-        return _compare_name_elements(
-            record, mpi_patient, feature_funcs, feature_col, col_to_idx, **kwargs
-        )
-    elif feature_col in ["address", "city", "state", "zip"]:
-        return _compare_address_elements(
-            record, mpi_patient, feature_funcs, feature_col, col_to_idx, **kwargs
+
+def _score_record_against_block(
+    record: dict,
+    block: Union[MPIBlock, list[list]],
+    algo_config: CompiledLinkageAlgorithm,
+    linkage_pass: CompiledLinkagePass,
+    linkage_scores: dict,
+    linkage_stats: dict = None,
+    flattened_record: list = None,
+    similarity_cache: SimilarityCache = None,
+    trace: LinkageTrace = None,
+) -> None:
+    """
+    Helper method that evaluates an incoming record against every person
+    cluster in a block of MPI data for one linkage pass, updating the
+    membership scores of the persons the record belongs to in place. The
+    block may be an `MPIBlock` or a list of rows headed by the column
+    headers, which is first compacted into one. The record is flattened
+    according to the block's header, and its values normalized for
+    comparison, unless it's supplied already flattened. Fuzzy comparisons
+    reuse the scores in `similarity_cache`, if given. The block and every
+    cluster's outcome are recorded against the current pass of `trace`, if
+    given.
+    """
+    if not isinstance(block, MPIBlock):
+        with timed("group"):
+            block = MPIBlock.from_block_data(block)
+    if trace is not None:
+        trace.set_block_size(len(block))
+        start = time.perf_counter()
+
+    # Map column name to idx, not including patient/person IDs
+    col_to_idx = algo_config.col_to_idx(block.header)
+    if len(block) > 0:  # Check if data_block is empty
+        if flattened_record is None:
+            with timed("flatten"):
+                flattened_record = _normalize_flattened_record(
+                    _flatten_patient_resource(record, col_to_idx), col_to_idx
+                )
+
+        # Check if incoming record should belong to one of the person clusters,
+        # comparing it once with each distinct variant of a person's rows
+        with timed("compare"):
+            best_score = max(linkage_scores.values(), default=None)
+            for person in block.clusters:
+                summary = block.summary(person)
+                if trace is not None:
+                    trace.start_cluster(person, len(summary), len(summary.variants))
+                belongingness_ratio = _eval_record_against_cluster(
+                    flattened_record,
+                    summary,
+                    linkage_pass,
+                    col_to_idx,
+                    prior_score=linkage_scores.get(person),
+                    best_score=best_score,
+                    linkage_stats=linkage_stats,
+                    similarity_cache=similarity_cache,
+                    trace=trace,
+                )
+                if trace is not None:
+                    trace.end_cluster(belongingness_ratio)
+
+                # Update membership score for this person cluster so that we can
+                # track best possible link across multiple passes
+                if (
+                    belongingness_ratio is not None
+                    and belongingness_ratio >= linkage_pass.cluster_ratio
+                ):
+                    if person in linkage_scores:
+                        linkage_scores[person] = max(
+                            [linkage_scores[person], belongingness_ratio]
+                        )
+                    else:
+                        linkage_scores[person] = belongingness_ratio
+                    if best_score is None or belongingness_ratio > best_score:
+                        best_score = belongingness_ratio
+    if trace is not None:
+        trace.add_timing("score", start)
+
+
+def _score_record_against_passes(
+    record: dict,
+    algo_config: CompiledLinkageAlgorithm,
+    mpi_client: DIBBsMPIConnectorClient,
+    linkage_scores: dict,
+    linkage_stats: dict = None,
+    max_block_size: int = None,
+    estimate_block_size: bool = False,
+    similarity_cache: SimilarityCache = None,
+    trace: LinkageTrace = None,
+) -> None:
+    """
+    Helper method that evaluates an incoming record against the blocks of
+    every linkage pass, fetching all of the blocks from the MPI at once.
+    MPI rows that fall in the blocks of several passes are fetched and
+    compacted once, and the record is flattened once, before
+    the passes are scored in order as `link_record_against_mpi` would.
+    Blocks that must be sampled to fit their pass's size limit are fetched
+    on their own. Since the blocks are fetched together, their fetch time is
+    recorded in `trace` for the linkage as a whole.
+    """
+    if trace is not None:
+        start = time.perf_counter()
+    with timed("extract_blocking_values"):
+        pass_criteria = [
+            extract_blocking_values_from_record(record, linkage_pass.blocks)
+            for linkage_pass in algo_config.passes
+        ]
+    to_fetch = [p for p, criteria in enumerate(pass_criteria) if len(criteria) > 0]
+
+    pass_blocks = {}
+    pass_max_patients = {}
+    for p in list(to_fetch):
+        pass_criteria[p], max_patients = _guard_block_criteria(
+            record,
+            pass_criteria[p],
+            algo_config.passes[p],
+            mpi_client,
+            algo_config.passes[p].max_block_size or max_block_size,
+            estimate_block_size,
+            linkage_stats,
         )
-    else:
-        return feature_funcs[feature_col](
-            record, mpi_patient, feature_col, col_to_idx, **kwargs
+        if max_patients is not None:
+            pass_max_patients[p] = max_patients
+            with timed("fetch_block"):
+                pass_blocks[p] = mpi_client.get_compact_block_data(
+                    pass_criteria[p], max_patients
+                )
+            to_fetch.remove(p)
+
+    fetched = []
+    if len(to_fetch) > 0:
+        with timed("fetch_block"):
+            fetched = mpi_client.get_block_data_batch(
+                [pass_criteria[p] for p in to_fetch]
+            )
+    # Rows shared between the passes' blocks are only compacted once
+    converted_rows = {}
+    with timed("group"):
+        for p, block in zip(to_fetch, fetched):
+            pass_blocks[p] = MPIBlock.from_block_data(block, converted_rows)
+    if trace is not None:
+        trace.add_timing("fetch", start)
+
+    # Blocks fetched together share a header, so the record only needs
+    # flattening once
+    flattened_records = {}
+    for p, linkage_pass in enumerate(algo_config.passes):
+        if trace is not None:
+            trace.start_pass(p, pass_criteria[p])
+        if p not in pass_blocks:
+            logging.info("No blocking criteria extracted from incoming record.")
+            continue
+        if trace is not None:
+            trace.guard_pass(pass_criteria[p], pass_max_patients.get(p))
+        block = pass_blocks[p]
+        header = tuple(block.header)
+        if header not in flattened_records:
+            col_to_idx = algo_config.col_to_idx(block.header)
+            with timed("flatten"):
+                flattened_records[header] = _normalize_flattened_record(
+                    _flatten_patient_resource(record, col_to_idx), col_to_idx
+                )
+        _score_record_against_block(
+            record,
+            block,
+            algo_config,
+            linkage_pass,
+            linkage_scores,
+            linkage_stats,
+            flattened_record=flattened_records[header],
+            similarity_cache=similarity_cache,
+            trace=trace,
         )
 
 
@@ -915,6 +1806,21 @@ def _compare_name_elements(
     return feature_comp
 
 
+def _compare_strings(
+    string1: str,
+    string2: str,
+    similarity_measure: str,
+    similarity_cache: Union[SimilarityCache, None],
+) -> float:
+    """
+    Helper method that scores the similarity of two strings, reusing the
+    scores in a `SimilarityCache` if one is given.
+    """
+    if similarity_cache is None:
+        return compare_strings(string1, string2, similarity_measure)
+    return similarity_cache.compare(string1, string2, similarity_measure)
+
+
 def _condense_extract_address_from_resource(resource: dict, field: str):
     """
     Formatting function to account for patient resources that have multiple
@@ -999,6 +1905,20 @@ def _flatten_patient_field_helper(resource: dict, field: str) -> any:
         return val if val is not None else ""
 
 
+def _freeze_kwargs(kwargs: dict) -> MappingProxyType:
+    """
+    Helper method that copies the keyword arguments of a linkage pass into
+    read-only mappings, so that a compiled pass can't be altered by changes
+    to the configuration it was compiled from.
+    """
+    return MappingProxyType(
+        {
+            k: _freeze_kwargs(v) if isinstance(v, dict) else copy.deepcopy(v)
+            for k, v in kwargs.items()
+        }
+    )
+
+
 def _get_fuzzy_params(col: str, **kwargs) -> tuple[str, str]:
     """
     Helper method to quickly determine the appropriate similarity measure
@@ -1040,6 +1960,26 @@ def _group_patient_block_by_person(data_block: list[list]) -> dict[str, list]:
     return clusters
 
 
+def _log_oversize_block(
+    key: str, blocking_criteria: dict, size: int, linkage_stats: dict = None
+) -> None:
+    """
+    Helper method that logs a step taken to keep an oversize block within
+    its limit, naming only the blocking fields so that no patient data is
+    logged, and tallies it in `linkage_stats` under `key`.
+    """
+    messages = {
+        "oversize_blocks": "Block is over its size limit",
+        "blocks_refined": "Narrowed oversize block down",
+        "blocks_sampled": "Sampling oversize block",
+    }
+    logging.warning(
+        f"{messages[key]}: {size} patients blocking on {sorted(blocking_criteria)}"
+    )
+    if linkage_stats is not None:
+        _increment_stat(linkage_stats, key)
+
+
 def _map_matches_to_record_ids(
     match_list: Union[list[tuple], list[set]], data_block, cluster_mode: bool = False
 ) -> list[tuple]:
@@ -1130,6 +2070,88 @@ def _match_within_block_cluster_ratio(
     return clusters
 
 
+def _guard_block_criteria(
+    record: dict,
+    blocking_criteria: dict,
+    linkage_pass: CompiledLinkagePass,
+    mpi_client: DIBBsMPIConnectorClient,
+    max_block_size: Union[int, None],
+    estimate_block_size: bool = False,
+    linkage_stats: dict = None,
+) -> tuple[dict, Union[int, None]]:
+    """
+    Helper method that keeps a pass's block within its size limit, so that
+    a single common blocking value (a popular last name, a shared zip code)
+    can't make linking a record arbitrarily slow. The size of the block is
+    checked with a cheap count before its records are fetched. An oversize
+    block is narrowed down by adding the pass's `refine_blocks`, one at a
+    time, as extra blocking criteria; if the block is still too large once
+    those are exhausted, the narrowest block is sampled deterministically
+    instead. Each oversize block is logged and tallied in `linkage_stats`.
+
+    :return: A tuple of the blocking criteria to fetch the block with and
+      the number of patients to sample from it, or None if it needn't be
+      sampled.
+    """
+    if max_block_size is None:
+        return blocking_criteria, None
+    size = mpi_client.get_block_size(blocking_criteria, estimate_block_size)
+    if size <= max_block_size:
+        return blocking_criteria, None
+    _log_oversize_block("oversize_blocks", blocking_criteria, size, linkage_stats)
+    for blocking_criteria in _refine_block_criteria(
+        record, blocking_criteria, linkage_pass
+    ):
+        size = mpi_client.get_block_size(blocking_criteria, estimate_block_size)
+        if size <= max_block_size:
+            _log_oversize_block(
+                "blocks_refined", blocking_criteria, size, linkage_stats
+            )
+            return blocking_criteria, None
+    _log_oversize_block("blocks_sampled", blocking_criteria, size, linkage_stats)
+    return blocking_criteria, max_block_size
+
+
+async def _guard_block_criteria_async(
+    record: dict,
+    blocking_criteria: dict,
+    linkage_pass: CompiledLinkagePass,
+    mpi_client: AsyncDIBBsMPIConnectorClient,
+    max_block_size: Union[int, None],
+    estimate_block_size: bool = False,
+    linkage_stats: dict = None,
+) -> tuple[dict, Union[int, None]]:
+    """
+    Helper method that keeps a pass's block within its size limit as
+    `_guard_block_criteria` does, using an asynchronous MPI client.
+    """
+    if max_block_size is None:
+        return blocking_criteria, None
+    size = await mpi_client.get_block_size(blocking_criteria, estimate_block_size)
+    if size <= max_block_size:
+        return blocking_criteria, None
+    _log_oversize_block("oversize_blocks", blocking_criteria, size, linkage_stats)
+    for blocking_criteria in _refine_block_criteria(
+        record, blocking_criteria, linkage_pass
+    ):
+        size = await mpi_client.get_block_size(blocking_criteria, estimate_block_size)
+        if size <= max_block_size:
+            _log_oversize_block(
+                "blocks_refined", blocking_criteria, size, linkage_stats
+            )
+            return blocking_criteria, None
+    _log_oversize_block("blocks_sampled", blocking_criteria, size, linkage_stats)
+    return blocking_criteria, max_block_size
+
+
+def _increment_stat(linkage_stats: dict, key: str, amount: int = 1) -> None:
+    """
+    Helper method that adds to one of the counters in a `linkage_stats`
+    dictionary, starting it at zero if it hasn't been tallied yet.
+    """
+    linkage_stats[key] = linkage_stats.get(key, 0) + amount
+
+
 def _is_empty_extraction_field(block_vals: dict, field: str):
     """
     Helper method that determines when a field extracted from an incoming
@@ -1153,6 +2175,66 @@ def _is_empty_extraction_field(block_vals: dict, field: str):
     return False
 
 
+def _refine_block_criteria(
+    record: dict, blocking_criteria: dict, linkage_pass: CompiledLinkagePass
+):
+    """
+    Helper method that yields ever narrower blocking criteria for an
+    oversize block, adding each of the pass's `refine_blocks` that isn't
+    already blocked on and for which the record has a value.
+    """
+    for block in linkage_pass.refine_blocks:
+        if block["value"] in blocking_criteria:
+            continue
+        extra_criteria = extract_blocking_values_from_record(record, [block])
+        if len(extra_criteria) > 0:
+            blocking_criteria = {**blocking_criteria, **extra_criteria}
+            yield blocking_criteria
+
+
+def _normalize_flattened_record(flattened_record: list, col_to_idx: dict) -> list:
+    """
+    Helper method that prepares the values of a flattened incoming record
+    for comparison once, rather than on every comparison with an MPI
+    record: the record's given names are joined into the single first name
+    they're compared as, and its birthdate is converted to a string.
+    """
+    flattened_record = list(flattened_record)
+    if "first_name" in col_to_idx:
+        idx = col_to_idx["first_name"] + 2
+        flattened_record[idx] = [" ".join(flattened_record[idx])]
+    if "birthdate" in col_to_idx:
+        idx = col_to_idx["birthdate"] + 2
+        flattened_record[idx] = datetime_to_str(flattened_record[idx])
+    return flattened_record
+
+
+def _resolve_linkage_func(func: Union[str, Callable]) -> Callable:
+    """
+    Helper method that maps the string name of a function to its callable
+    invocation as defined within the `link.py` module.
+    """
+    if isinstance(func, str):
+        if not callable(globals().get(func)):
+            raise ValueError(f"Function {func} is not defined in link.py.")
+        func = globals()[func]
+    if not callable(func):
+        raise ValueError(f"Linkage function {func} is not callable.")
+    return func
+
+
+def _tally_similarity_cache(
+    linkage_stats: dict, similarity_cache: SimilarityCache
+) -> None:
+    """
+    Helper method that tallies the string similarity scores a linkage call
+    reused from its `SimilarityCache`, and those it had to look up or
+    compute, in `linkage_stats`.
+    """
+    _increment_stat(linkage_stats, "similarity_cache_hits", similarity_cache.hits)
+    _increment_stat(linkage_stats, "similarity_cache_misses", similarity_cache.misses)
+
+
 def _write_prob_file(prob_dict: dict, file_to_write: Union[pathlib.Path, None]):
     """
     Helper method to write a probability dictionary to a JSON file, if
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Union
+
+from sqlalchemy import URL, create_engine, make_url, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.linkage.metrics import timed
+
+# Number of locks keys are spread across by `StripedLockTable`
+LOCK_STRIPES = 1024
+
+
+class StripedLockTable:
+    """
+    An in-process table of locks on blocking keys, such as those returned
+    by `blocking_lock_keys`, striped across a fixed number of locks. Linking
+    a record while holding the locks on its keys serializes it with any
+    other record sharing a block with it, while records in disjoint blocks
+    are linked in parallel (unless their keys share a stripe). The locks
+    only cover linkage within this process; see `AdvisoryLockTable` for
+    locks shared by every instance of the service.
+    """
+
+    def __init__(self, stripes: int = LOCK_STRIPES):
+        """
+        :param stripes: The number of locks keys are spread across. Default
+          is `LOCK_STRIPES`.
+        """
+        self.stripes = stripes
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._async_locks = [asyncio.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def hold(self, keys: list[int]):
+        """
+        Returns a context manager that holds the locks on the given keys
+        within it, waiting for any other thread holding one of them. Locks
+        are always taken in the same order, so holders can't deadlock.
+
+        :param keys: The keys to lock.
+        """
+        stripes = sorted({key % self.stripes for key in keys})
+        with timed("acquire_locks"):
+            for stripe in stripes:
+                self._locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._locks[stripe].release()
+
+    @asynccontextmanager
+    async def hold_async(self, keys: list[int]):
+        """
+        Returns an asynchronous context manager that holds the locks on the
+        given keys within it, as `hold` does, waiting for any other task
+        holding one of them without blocking the event loop.
+
+        :param keys: The keys to lock.
+        """
+        stripes = sorted({key % self.stripes for key in keys})
+        with timed("acquire_locks"):
+            for stripe in stripes:
+                await self._async_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._async_locks[stripe].release()
+
+
+class AdvisoryLockTable:
+    """
+    A table of locks on blocking keys backed by Postgres transaction-level
+    advisory locks, which are shared by every client of the MPI database, so
+    records sharing a block are serialized across every instance of the
+    service. Each holder keeps a connection open, in a transaction, for as
+    long as it holds its locks; these connections are pooled separately
+    from the MPI client's, so that waiting on a lock never holds up queries.
+    """
+
+    def __init__(
+        self, engine_url: Union[str, URL], pool_size: int = 5, max_overflow: int = 10
+    ):
+        """
+        :param engine_url: The URL of the MPI database, e.g. the URL of an MPI
+          client's engine.
+        :param pool_size: The number of connections to keep open for holding
+          locks.
+        :param max_overflow: The number of connections to allow in the
+          connection pool "overflow".
+        """
+        self.engine_url = make_url(engine_url)
+        self.engine = create_engine(
+            self.engine_url, pool_size=pool_size, max_overflow=max_overflow
+        )
+        self._async_engine = None
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+
+    @contextmanager
+    def hold(self, keys: list[int]):
+        """
+        Returns a context manager that holds the advisory locks on the given
+        keys within it, waiting for any other client of the database holding
+        one of them. Locks are always taken in the same order, so holders
+        can't deadlock, and are released when the transaction holding them
+        ends, even if the connection is lost.
+
+        :param keys: The keys to lock.
+        """
+        with self.engine.begin() as connection:
+            with timed("acquire_locks"):
+                for key in sorted(set(keys)):
+                    connection.execute(
+                        text("SELECT pg_advisory_xact_lock(:key)"), {"key": key}
+                    )
+            yield
+
+    @asynccontextmanager
+    async def hold_async(self, keys: list[int]):
+        """
+        Returns an asynchronous context manager that holds the advisory locks
+        on the given keys within it, as `hold` does, on a connection made
+        with the asyncpg driver.
+
+        :param keys: The keys to lock.
+        """
+        if self._async_engine is None:
+            self._async_engine = create_async_engine(
+                self.engine_url.set(drivername="postgresql+asyncpg"),
+                pool_size=self._pool_size,
+                max_overflow=self._max_overflow,
+            )
+        async with self._async_engine.begin() as connection:
+            with timed("acquire_locks"):
+                for key in sorted(set(keys)):
+                    await connection.execute(
+                        text("SELECT pg_advisory_xact_lock(:key)"), {"key": key}
+                    )
+            yield
+
+    def dispose(self) -> None:
+        """
+        Closes the connections used for holding locks.
+        """
+        self.engine.dispose()
@@ -0,0 +1,179 @@
+import math
+import threading
+import time
+from collections import deque
+
+# Number of recent durations per stage from which percentiles are computed
+TIMING_WINDOW_SIZE = 1024
+
+# Percentiles of each stage's durations reported by `StageTimings`
+TIMING_QUANTILES = [0.5, 0.95, 0.99]
+
+
+class StageTimings:
+    """
+    Aggregates the time spent in named stages of record linkage (e.g.
+    fetching a block, or comparing a record to the clusters in it). For
+    each stage, the number of times it ran and the total time it took are
+    counted, and the most recent durations are kept for computing
+    percentiles. A stage is timed with a span:
+
+        with TIMINGS.span("fetch_block"):
+            block = mpi_client.get_compact_block_data(blocking_criteria)
+
+    Timing a span costs two reads of a monotonic clock and an append under
+    a lock; nothing is formatted or logged until the timings are
+    summarized.
+    """
+
+    def __init__(self, window: int = TIMING_WINDOW_SIZE):
+        """
+        :param window: The number of recent durations to keep per stage.
+          Default is `TIMING_WINDOW_SIZE`.
+        """
+        self.window = window
+        self.counts = {}
+        self.totals = {}
+        self.recent = {}
+        self._lock = threading.Lock()
+
+    def span(self, stage: str) -> "_Span":
+        """
+        Returns a context manager that times a stage, from entering the
+        context to leaving it.
+
+        :param stage: The name of the stage.
+        :return: The span.
+        """
+        return _Span(self, stage)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        """
+        Records a duration of a stage.
+
+        :param stage: The name of the stage.
+        :param seconds: The time the stage took, in seconds.
+        """
+        with self._lock:
+            if stage not in self.counts:
+                self.counts[stage] = 0
+                self.totals[stage] = 0.0
+                self.recent[stage] = deque(maxlen=self.window)
+            self.counts[stage] += 1
+            self.totals[stage] += seconds
+            self.recent[stage].append(seconds)
+
+    def summary(self) -> dict:
+        """
+        Summarizes the durations of every stage timed so far.
+
+        :return: A dictionary mapping each stage to a dictionary of the
+          number of times it ran, the total seconds it took, and the
+          percentiles in `TIMING_QUANTILES` of its recent durations, keyed
+          e.g. "p50" and "p95".
+        """
+        with self._lock:
+            snapshot = {
+                stage: (self.counts[stage], self.totals[stage], list(durations))
+                for stage, durations in self.recent.items()
+            }
+        summary = {}
+        for stage, (count, total, durations) in snapshot.items():
+            durations.sort()
+            summary[stage] = {"count": count, "total": total}
+            for q in TIMING_QUANTILES:
+                summary[stage][f"p{round(q * 100)}"] = _quantile(durations, q)
+        return summary
+
+    def reset(self) -> None:
+        """
+        Discards every duration recorded so far.
+        """
+        with self._lock:
+            self.counts = {}
+            self.totals = {}
+            self.recent = {}
+
+    def to_prometheus(self, name: str = "record_linkage_stage_seconds") -> str:
+        """
+        Formats the summary of every stage as a Prometheus summary metric,
+        labelled by stage, in the Prometheus text exposition format.
+
+        :param name: The name of the metric.
+        :return: The metric, as lines of text.
+        """
+        lines = [
+            f"# HELP {name} Time spent in each stage of record linkage.",
+            f"# TYPE {name} summary",
+        ]
+        for stage, stats in sorted(self.summary().items()):
+            for q in TIMING_QUANTILES:
+                value = stats[f"p{round(q * 100)}"]
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {value}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {stats["total"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {stats["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+class _Span:
+    """
+    A context manager that records the time spent within it as a duration
+    of a stage.
+    """
+
+    __slots__ = ("timings", "stage", "start")
+
+    def __init__(self, timings: StageTimings, stage: str):
+        self.timings = timings
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.timings.observe(self.stage, time.perf_counter() - self.start)
+
+
+# Timings of every stage of linkage run by this process
+TIMINGS = StageTimings()
+
+
+def timed(stage: str) -> _Span:
+    """
+    Returns a span that times a stage of linkage in `TIMINGS`.
+
+    :param stage: The name of the stage, e.g. "fetch_block".
+    :return: The span, to be used as a context manager.
+    """
+    return TIMINGS.span(stage)
+
+
+def format_counters(counters: dict, prefix: str = "record_linkage") -> str:
+    """
+    Formats a dictionary of counters, such as the `linkage_stats` tallied
+    by `link_record_against_mpi`, as Prometheus counter metrics in the text
+    exposition format.
+
+    :param counters: A dictionary mapping counter names to their values.
+    :param prefix: The prefix of the metric names.
+    :return: The metrics, as lines of text.
+    """
+    lines = []
+    for key, value in sorted(counters.items()):
+        name = f"{prefix}_{key}_total"
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def _quantile(sorted_values: list, q: float) -> float:
+    """
+    Helper method that returns the q-th quantile of a sorted list of values,
+    by the nearest-rank method, or 0 for an empty list.
+    """
+    if len(sorted_values) == 0:
+        return 0.0
+    rank = max(math.ceil(q * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
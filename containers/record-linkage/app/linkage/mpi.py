@@ -1,16 +1,67 @@
-import datetime
+import json
 import logging
+import threading
 import uuid
+from collections import OrderedDict
 from functools import cache
 from typing import Union
 
-from sqlalchemy import Select, and_, select, text
+from sqlalchemy import (
+    Select,
+    String,
+    and_,
+    cast,
+    exists,
+    func,
+    literal,
+    select,
+    text,
+    tuple_,
+    union_all,
+)
 from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
+from app.linkage.block import BLOCK_HEADER, MPIBlock, mpi_records_to_block_rows
 from app.linkage.core import BaseMPIConnectorClient
 from app.linkage.dal import DataAccessLayer
+from app.linkage.metrics import timed
 from app.linkage.utils import extract_value_with_resource_path, load_mpi_env_vars_os
 
+# Maximum number of blocks whose membership is resolved in a single query
+# by `get_block_data_batch`
+BLOCK_QUERY_BATCH_SIZE = 500
+
+# Maximum number of block queries, one per combination of blocking columns
+# and transformations, that are kept for reuse
+BLOCK_QUERY_CACHE_SIZE = 128
+
+# Number of patients copied into the linkage view per transaction by
+# `_backfill_linkage_view`
+LINKAGE_VIEW_BACKFILL_BATCH_SIZE = 1000
+
+# The pair of keys of the advisory lock held while backfilling the linkage
+# view, so that clients starting together don't copy the same patients. Two
+# key locks never conflict with the single key locks of `AdvisoryLockTable`.
+LINKAGE_VIEW_LOCK_KEYS = (1, 0)
+
+# The columns of the linkage view holding the values of the MPI columns that
+# blocking criteria are evaluated against, by table and column. The linkage
+# view only holds MRN identifiers, so identifier criteria must select them
+# by type code.
+LINKAGE_VIEW_COLUMNS = {
+    ("patient", "dob"): "birthdate",
+    ("patient", "sex"): "sex",
+    ("identifier", "patient_identifier"): "mrn",
+    ("name", "last_name"): "last_name",
+    ("given_name", "given_name"): "given_name",
+    ("address", "line_1"): "address",
+    ("address", "zip_code"): "zip",
+    ("address", "city"): "city",
+    ("address", "state"): "state",
+}
+
 
 class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
     """
@@ -22,11 +73,20 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
 
     """
 
-    def __init__(self, pool_size: int = 5, max_overflow: int = 10):
+    def __init__(
+        self, pool_size: int = 5, max_overflow: int = 10, use_linkage_view: bool = False
+    ):
         """
         Initialize the MPI connector client with the MPI database.
         :param pool_size: The number of connections to keep open to the database.
         :param max_overflow: The number of connections to allow in connection pool.
+        :param use_linkage_view: Whether to fetch blocks from the denormalized
+          linkage view rather than joining the normalized MPI tables; see
+          `_get_linkage_view_block_query`. Only clients that use the view
+          write patients to it, so any patients missing from it are copied
+          in when the client is created. Default is False.
+        :raises ValueError: If the linkage view is to be used but doesn't
+          exist in the MPI.
         """
         dbsettings = load_mpi_env_vars_os()
         dbuser = dbsettings.get("user")
@@ -42,6 +102,18 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
             max_overflow=max_overflow,
         )
         self.dal.initialize_schema()
+        if use_linkage_view and self.dal.LINKAGE_VIEW_TABLE is None:
+            raise ValueError(
+                "The linkage_view table doesn't exist; run the MPI migrations first."
+            )
+        self.use_linkage_view = use_linkage_view
+        # Queries built for this client's tables, kept for reuse; see
+        # `_get_block_query`
+        self._base_query = None
+        self._linkage_view_query = None
+        self._block_queries = OrderedDict()
+        self._block_members_queries = OrderedDict()
+        self._query_cache_lock = threading.Lock()
         self.column_to_fhirpaths = {
             "patient": {
                 "root_path": "Patient",
@@ -108,6 +180,8 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
                 },
             },
         }
+        if use_linkage_view:
+            self._backfill_linkage_view()
 
     def get_block_data(self, block_criteria: dict) -> list[list]:
         """
@@ -125,53 +199,238 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
         :return: A list of records that are within the block, e.g.,
             records that all have 90210 as their ZIP.
         """
-        logging.info("In get_block_data")
+        query_w_ctes, params = self._prepare_block_query(block_criteria)
+        blocked_data = self.dal.select_results(
+            select_statement=query_w_ctes, include_col_header=True, params=params
+        )
+
+        return blocked_data
+
+    def get_compact_block_data(
+        self, block_criteria: dict, max_patients: int = None
+    ) -> MPIBlock:
+        """
+        Returns the records from the MPI database that match on the incoming
+        record's block criteria and values as a compact `MPIBlock`, which is
+        built while the rows are fetched, without first collecting them into
+        a list of lists.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param max_patients: Optionally, the most patients to fetch. A block
+          with more patients is sampled deterministically; see
+          `_prepare_sampled_block_query`. Default is None, meaning the whole
+          block is fetched.
+        :return: The block of MPI records, grouped by person.
+        """
+        if max_patients is None:
+            query_w_ctes, params = self._prepare_block_query(block_criteria)
+        else:
+            query_w_ctes, params = self._prepare_sampled_block_query(
+                block_criteria, max_patients
+            )
+        with timed("select"), self.dal.transaction() as session:
+            results = session.execute(query_w_ctes, params)
+            block = MPIBlock(list(results.keys()), results)
+        return block
+
+    def _prepare_block_query(self, block_criteria: dict) -> tuple[Select, dict]:
+        """
+        Looks up the block query for a set of blocking criteria, along with
+        the parameters to bind to it.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: A tuple of the block query and its parameters.
+        """
         if len(block_criteria) == 0:
             raise ValueError("`block_vals` cannot be empty.")
 
-        # Get the base query that will select all necessary
-        # columns for linkage with some basic filtering
-        logging.info(
-            f"Starting _get_base_query at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-        query = self._get_base_query()
-        logging.info(
-            f"Done with _get_base_query at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
+        with timed("block_query"):
+            # now get the criteria organized by table so the
+            # CTE queries can be constructed and then added
+            # to the base query
+            organized_block_vals = self._organize_block_criteria(block_criteria)
 
-        # now get the criteria organized by table so the
-        # CTE queries can be constructed and then added
-        # to the base query
-        logging.info(
-            f"Starting _organize_block_criteria at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
+            # look up the block query for these blocking columns and
+            # transformations, with the criteria values as its parameters
+            query_key, params = self._get_block_query_key(organized_block_vals)
+            query_w_ctes = self._get_block_query(query_key)
+        return query_w_ctes, params
+
+    def get_block_size(self, block_criteria: dict, estimate: bool = False) -> int:
+        """
+        Returns the number of patients in the MPI that match on the incoming
+        record's block criteria and values, without fetching their records.
+        The patients are counted from the blocking criteria alone, so the
+        name and address rows of the block are never joined or aggregated.
+        Alternatively, the query planner's estimate of the count is returned,
+        which costs no more than planning the query but may be off, e.g.
+        when the table statistics are stale.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param estimate: Whether to return the planner's estimate rather
+          than counting the patients. Default is False.
+        :return: The number of patients in the block.
+        """
+        query, params = self._prepare_block_members_query(block_criteria)
+        with timed("block_size"), self.dal.transaction() as session:
+            if estimate:
+                return _plan_rows(session.execute(ExplainJSON(query), params).scalar())
+            return session.execute(
+                select(func.count()).select_from(query.subquery()), params
+            ).scalar()
+
+    def _prepare_block_members_query(self, block_criteria: dict) -> tuple[Select, dict]:
+        """
+        Looks up the query selecting the IDs of the patients in a block, and
+        of the persons they're linked to, along with the parameters to bind
+        to it.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: A tuple of the block members query and its parameters.
+        """
+        if len(block_criteria) == 0:
+            raise ValueError("`block_vals` cannot be empty.")
         organized_block_vals = self._organize_block_criteria(block_criteria)
-        logging.info(
-            f"Done with _organize_block_criteria at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}",  # noqa
-        )
+        query_key, params = self._get_block_query_key(organized_block_vals)
+        return self._get_block_members_query(query_key), params
 
-        # now tack on the where criteria using the block_vals
-        # while ensuring they exist in the table structure ORM
-        logging.info(
-            f"Starting _generate_block_query at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-        query_w_ctes = self._generate_block_query(
-            organized_block_criteria=organized_block_vals, query=query
-        )
-        logging.info(
-            f"Done with _generate_block_query at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-        logging.info(
-            f"Starting dal.select_results at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-        blocked_data = self.dal.select_results(
-            select_statement=query_w_ctes, include_col_header=True
-        )
-        logging.info(
-            f"Done with dal.select_results at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+    def _prepare_sampled_block_query(
+        self, block_criteria: dict, max_patients: int
+    ) -> tuple[Select, dict]:
+        """
+        Looks up the query selecting a deterministic sample of at most
+        `max_patients` patients from a block, along with the parameters to
+        bind to it. Patients are taken in order of a hash of their person
+        ID, so a person's patients are sampled together, and the same
+        block always yields the same sample.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param max_patients: The most patients to sample.
+        :return: A tuple of the sampled block query and its parameters.
+        """
+        if len(block_criteria) == 0:
+            raise ValueError("`block_vals` cannot be empty.")
+        organized_block_vals = self._organize_block_criteria(block_criteria)
+        query_key, params = self._get_block_query_key(organized_block_vals)
+        members = self._get_block_members_query(query_key).subquery("block_members")
+        sample = (
+            select(members.c.patient_id)
+            .order_by(func.md5(cast(members.c.person_id, String)), members.c.patient_id)
+            .limit(max_patients)
         )
+        if self._uses_linkage_view(query_key):
+            query = self._get_linkage_view_query().where(
+                self.dal.LINKAGE_VIEW_TABLE.c.patient_id.in_(sample)
+            )
+        else:
+            query = self._get_base_query().where(
+                self.dal.PATIENT_TABLE.c.patient_id.in_(sample)
+            )
+        return query, params
 
-        return blocked_data
+    def get_block_data_batch(self, block_criteria_list: list[dict]) -> list[list[list]]:
+        """
+        Returns the blocks of MPI records matching each of a list of block
+        criteria, as `get_block_data` would for each of them, using a few
+        set-based queries rather than one query per block. The patients in
+        every block are found with one query per `BLOCK_QUERY_BATCH_SIZE`
+        blocks, then the records of all those patients are fetched at once
+        and partitioned back into blocks. As in `get_block_data`, blocks
+        are fetched from the linkage view if the client uses it and it
+        holds their criteria.
+
+        :param block_criteria_list: A list of dictionaries of blocking
+          criteria, each in the form accepted by `get_block_data`.
+        :return: A list of blocks, one per entry in `block_criteria_list`.
+          Each block is a list of records whose first row is the column
+          headers.
+        """
+        if any(len(block_criteria) == 0 for block_criteria in block_criteria_list):
+            raise ValueError("`block_vals` cannot be empty.")
+
+        # Resolve the patients belonging to each block
+        block_members = [set() for _ in block_criteria_list]
+        block_uses_view = [False for _ in block_criteria_list]
+        for start in range(0, len(block_criteria_list), BLOCK_QUERY_BATCH_SIZE):
+            member_queries = []
+            params = {}
+            for block_idx in range(
+                start, min(start + BLOCK_QUERY_BATCH_SIZE, len(block_criteria_list))
+            ):
+                # Every block in the batch binds its own parameters
+                param_prefix = f"b{block_idx - start}_"
+                organized_block_vals = self._organize_block_criteria(
+                    block_criteria_list[block_idx]
+                )
+                query_key, block_params = self._get_block_query_key(
+                    organized_block_vals, param_prefix=param_prefix
+                )
+                member_queries.append(
+                    self._get_block_members_query(
+                        query_key, param_prefix=param_prefix
+                    ).add_columns(literal(block_idx).label("block_idx"))
+                )
+                params.update(block_params)
+                block_uses_view[block_idx] = self._uses_linkage_view(query_key)
+            members = self.dal.select_results(
+                union_all(*member_queries), include_col_header=False, params=params
+            )
+            for patient_id, _, block_idx in members:
+                block_members[block_idx].add(str(patient_id))
+
+        # Fetch the records of every patient in any block at once, from the
+        # linkage view or the MPI tables as each block was found
+        patient_rows = {}
+        for uses_view in set(block_uses_view):
+            all_members = set().union(
+                *[
+                    members
+                    for members, block_view in zip(block_members, block_uses_view)
+                    if block_view == uses_view
+                ]
+            )
+            if uses_view:
+                query = self._get_linkage_view_query().where(
+                    self.dal.LINKAGE_VIEW_TABLE.c.patient_id.in_(all_members)
+                )
+            else:
+                query = self._get_base_query().where(
+                    self.dal.PATIENT_TABLE.c.patient_id.in_(all_members)
+                )
+            blocked_data = self.dal.select_results(
+                select_statement=query, include_col_header=True
+            )
+            header = blocked_data[0]
+            patient_rows[uses_view] = {}
+            for row in blocked_data[1:]:
+                patient_rows[uses_view].setdefault(str(row[0]), []).append(row)
+        # Order each block's patients as their records were fetched
+        patient_order = {
+            uses_view: {patient_id: i for i, patient_id in enumerate(rows)}
+            for uses_view, rows in patient_rows.items()
+        }
+        blocks = []
+        for members, uses_view in zip(block_members, block_uses_view):
+            rows = patient_rows[uses_view]
+            order = patient_order[uses_view]
+            block = [header]
+            for patient_id in sorted(
+                (patient_id for patient_id in members if patient_id in order),
+                key=order.get,
+            ):
+                block.extend(rows[patient_id])
+            blocks.append(block)
+        return blocks
 
     def insert_matched_patient(
         self,
@@ -185,7 +444,10 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
         matched person id, to link the new patient and matched person ID;
         else inserts a new patient into the patient table, as well as all other
         subsequent MPI tables, and inserts a new person into the person table
-        linking the new person to the new patient.
+        linking the new person to the new patient. The person, the patient and
+        the external person ID are all inserted in a single transaction, with
+        the new person's ID generated here rather than by the database, and an
+        external person ID that's already linked to the person is skipped.
 
         :param patient_resource: A FHIR patient resource.
         :param person_id: The person ID matching the patient record if a match has been
@@ -193,82 +455,429 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
         :param external_person_id: The external person id for the person that matches
           the patient record if a match has been found in the MPI, defaults to None.
         """
-        logging.info(
-            f"Starting insert_matched_patient at {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-        )
-
         try:
+            records = {}
             if person_id is None:
-                logging.info(
-                    f"person_id was None; starting _insert_person at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                )
-                person_id = self._insert_person()
-                logging.info(
-                    f"person_id was None; done with _insert_person at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                )
+                person_id = uuid.uuid4()
+                records[self.dal.PERSON_TABLE.name] = [{"person_id": person_id}]
             patient_resource["person"] = person_id
-            logging.info(
-                f"Starting _get_mpi_records at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            records.update(self._get_mpi_records(patient_resource))
+
+            if external_person_id is not None:
+                records[self.dal.EXTERNAL_PERSON_TABLE.name] = (
+                    self._get_external_person_records(person_id, external_person_id)
+                )
+            self.dal.bulk_insert_dict(
+                records_with_table=records,
+                return_primary_keys=False,
+                skip_conflicts=[self.dal.EXTERNAL_PERSON_TABLE.name],
             )
-            mpi_records = self._get_mpi_records(patient_resource)
-            logging.info(
-                f"Done with _get_mpi_records at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+        except Exception as error:  # pragma: no cover
+            raise ValueError(f"{error}")
+
+        return person_id
+
+    def insert_matched_patients(
+        self,
+        patient_resources: list[dict],
+        person_ids: list,
+        external_person_ids: list = None,
+    ) -> list:
+        """
+        Inserts a batch of patients into the MPI in a single transaction,
+        along with any new persons they're linked to. Unlike
+        `insert_matched_patient`, person IDs are never generated by the
+        database: a person ID that doesn't exist in the MPI yet is inserted
+        as a new person, which lets a batch link several new patients to
+        the same new person.
+
+        :param patient_resources: A list of FHIR patient resources.
+        :param person_ids: The person ID each patient is linked to.
+        :param external_person_ids: Optionally, the external person ID of
+          each patient's person, or None where there isn't one.
+        :return: The person ID each patient was linked to.
+        """
+        if external_person_ids is None:
+            external_person_ids = [None] * len(patient_resources)
+        if not len(patient_resources) == len(person_ids) == len(external_person_ids):
+            raise ValueError(
+                "A person ID and external person ID must be supplied for every patient."
             )
-            logging.info(
-                f"Starting dal.bulk_insert_dict at: {datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+
+        records = {}
+        try:
+            existing_persons = self._get_existing_person_ids(person_ids)
+            new_persons = []
+            for patient_resource, person_id in zip(patient_resources, person_ids):
+                if str(person_id) not in existing_persons:
+                    existing_persons.add(str(person_id))
+                    new_persons.append({"person_id": person_id})
+                patient_resource["person"] = person_id
+                mpi_records = self._get_mpi_records(patient_resource)
+                for table_name, table_records in mpi_records.items():
+                    records.setdefault(table_name, []).extend(table_records)
+            records[self.dal.PERSON_TABLE.name] = new_persons
+            records[self.dal.EXTERNAL_PERSON_TABLE.name] = (
+                self._get_new_external_person_records(person_ids, external_person_ids)
             )
             self.dal.bulk_insert_dict(
-                records_with_table=mpi_records, return_primary_keys=False
-            )
-            logging.info(
-                f"Done with dal.bulk_insert_dict at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+                records_with_table=records, return_primary_keys=False
             )
-
-            if external_person_id is not None:
-                logging.info(
-                    f"""external_person_id was not None;
-                      starting _insert_external_person_id at:{datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                )
-                self._insert_external_person_id(person_id, external_person_id)
-                logging.info(
-                    f"""external_person_id was not None;
-                      done with _insert_external_person_id at:{datetime.datetime.now().strftime("%m-%d-%yT%H:%M:%S.%f")}"""  # noqa
-                )
         except Exception as error:  # pragma: no cover
             raise ValueError(f"{error}")
 
-        return person_id
+        return person_ids
+
+    def _get_existing_person_ids(self, person_ids: list) -> set:
+        """
+        Finds which of the given person IDs already exist in the MPI.
 
-    def _generate_where_criteria(self, block_criteria: dict, table_name: str) -> list:
+        :param person_ids: A list of person IDs.
+        :return: The set of the IDs, as strings, that exist in the MPI.
+        """
+        query = select(self.dal.PERSON_TABLE.c.person_id).where(
+            self.dal.PERSON_TABLE.c.person_id.in_(set(person_ids))
+        )
+        existing = self.dal.select_results(query, include_col_header=False)
+        return {str(row[0]) for row in existing}
+
+    def _get_new_external_person_records(
+        self, person_ids: list, external_person_ids: list
+    ) -> list[dict]:
+        """
+        Builds the external person records to insert for a batch of linked
+        patients, skipping any link between a person and an external person
+        ID that already exists in the MPI or earlier in the batch.
+
+        :param person_ids: The person ID each patient is linked to.
+        :param external_person_ids: The external person ID of each patient's
+          person, or None where there isn't one.
+        :return: A list of external person records.
+        """
+        pairs = [
+            (person_id, external_person_id)
+            for person_id, external_person_id in zip(person_ids, external_person_ids)
+            if external_person_id is not None
+        ]
+        if len(pairs) == 0:
+            return []
+        external_source_id = self._get_external_source_id("IRIS")
+        if external_source_id is None:
+            return []
+
+        table = self.dal.EXTERNAL_PERSON_TABLE
+        query = select(table.c.person_id, table.c.external_person_id).where(
+            tuple_(table.c.person_id, table.c.external_person_id).in_(pairs),
+            table.c.external_source_id == external_source_id,
+        )
+        existing = self.dal.select_results(query, include_col_header=False)
+        seen = {(str(person_id), ext_id) for person_id, ext_id in existing}
+
+        new_records = []
+        for person_id, external_person_id in pairs:
+            pair = (str(person_id), external_person_id)
+            if pair in seen:
+                continue
+            seen.add(pair)
+            new_records.append(
+                {
+                    "person_id": person_id,
+                    "external_person_id": external_person_id,
+                    "external_source_id": external_source_id,
+                }
+            )
+        return new_records
+
+    def _generate_where_criteria(
+        self,
+        block_criteria: dict,
+        table_name: str,
+        bind_params: bool = False,
+        param_prefix: str = "",
+    ) -> list:
         """
         Generates a list of where criteria leveraging the blocking criteria,
         including transformations such as 'first 4' or 'last 4'.  This
         function leverages the ORM to determine the table and columns.
 
         :param block_criteria: a dictionary that contains the blocking criteria.
+        :param table_name: the name of the table the criteria apply to.
+        :param bind_params: if True, each criterion compares against a bound
+            parameter named `<table_name>_<column>` instead of its value.
+        :param param_prefix: a prefix for the names of the bound parameters.
         :return: A list of where criteria used to append to the end of a query.
 
         """
         where_criteria = []
         for key, value in block_criteria.items():
-            criteria_value = value["value"]
+            if bind_params:
+                criteria_value = f":{param_prefix}{table_name}_{key}"
+            else:
+                criteria_value = f"'{value['value']}'"
             criteria_transform = value.get("transformation", None)
 
             if criteria_transform is None:
-                where_criteria.append(f"{table_name}.{key} = '{criteria_value}'")
+                where_criteria.append(f"{table_name}.{key} = {criteria_value}")
             else:
                 if criteria_transform == "first4":
                     where_criteria.append(
-                        f"LEFT({table_name}.{key},4) = '{criteria_value}'"
+                        f"LEFT({table_name}.{key},4) = {criteria_value}"
                     )
                 elif criteria_transform == "last4":
                     where_criteria.append(
-                        f"RIGHT({table_name}.{key},4) = '{criteria_value}'"
+                        f"RIGHT({table_name}.{key},4) = {criteria_value}"
                     )
         return where_criteria
 
+    def _get_block_query_key(
+        self, organized_block_criteria: dict, param_prefix: str = ""
+    ) -> tuple:
+        """
+        Splits organized blocking criteria into the key of the block query
+        that selects them, naming the blocking columns and transformations
+        of each table, and the values to bind as the query's parameters.
+
+        :param organized_block_criteria: a dictionary organized by MPI table
+            name, with the ORM table object, and the blocking criteria.
+        :param param_prefix: a prefix for the names of the parameters.
+        :return: A tuple of the query key and a dictionary of parameters.
+        """
+        query_key = []
+        params = {}
+        for table_name, table_info in sorted(organized_block_criteria.items()):
+            columns = []
+            for column, criterion in sorted(table_info["criteria"].items()):
+                transformation = criterion.get("transformation", None)
+                columns.append((column, transformation))
+                params[f"{param_prefix}{table_name}_{column}"] = str(criterion["value"])
+            query_key.append((table_name, tuple(columns)))
+        return tuple(query_key), params
+
+    def _get_block_query(self, query_key: tuple) -> Select:
+        """
+        Returns the query selecting a block of MPI data for a combination of
+        blocking columns and transformations, as keyed by
+        `_get_block_query_key`. Criteria values are bound parameters, so each
+        query is built once and reused for every block with the same
+        columns and transformations, as is SQLAlchemy's compiled form of it.
+        The most recently used `BLOCK_QUERY_CACHE_SIZE` queries are kept.
+
+        :param query_key: The key of the block query.
+        :return: A 'Select' statement whose parameters are the criteria values.
+        """
+        query = self._get_cached_query(self._block_queries, query_key)
+        if query is not None:
+            return query
+        if self._uses_linkage_view(query_key):
+            query = self._get_linkage_view_block_query(
+                query_key, self._get_linkage_view_query()
+            )
+        else:
+            query = self._generate_block_query(
+                organized_block_criteria=self._get_block_query_criteria(query_key),
+                query=self._get_base_query(),
+                bind_params=True,
+            )
+        return self._cache_query(self._block_queries, query_key, query)
+
+    def _get_block_members_query(
+        self, query_key: tuple, param_prefix: str = ""
+    ) -> Select:
+        """
+        Returns the query selecting the patient and person IDs of the
+        patients in a block, for a combination of blocking columns and
+        transformations keyed as by `_get_block_query_key`. Criteria values
+        are bound parameters, as in `_get_block_query`. The parameters, and
+        the CTEs of the query, can be named with a prefix, so that the
+        queries of several blocks can be combined into one statement.
+
+        :param query_key: The key of the block query.
+        :param param_prefix: A prefix for the names of the parameters and
+          CTEs, as passed to `_get_block_query_key`.
+        :return: A 'Select' statement whose parameters are the criteria values.
+        """
+        cache_key = (query_key, param_prefix)
+        query = self._get_cached_query(self._block_members_queries, cache_key)
+        if query is not None:
+            return query
+        if self._uses_linkage_view(query_key):
+            view = self.dal.LINKAGE_VIEW_TABLE
+            query = self._get_linkage_view_block_query(
+                query_key,
+                select(view.c.patient_id, view.c.person_id).distinct(),
+                param_prefix=param_prefix,
+            )
+        else:
+            query = self._generate_block_query(
+                organized_block_criteria=self._get_block_query_criteria(query_key),
+                query=select(
+                    self.dal.PATIENT_TABLE.c.patient_id,
+                    self.dal.PATIENT_TABLE.c.person_id,
+                ),
+                bind_params=True,
+                param_prefix=param_prefix,
+            )
+        return self._cache_query(self._block_members_queries, cache_key, query)
+
+    def _get_cached_query(self, queries: OrderedDict, key: tuple) -> Select:
+        """
+        Looks up a query kept for reuse by `_cache_query`, marking it as the
+        most recently used.
+
+        :param queries: The queries kept for reuse, by key.
+        :param key: The key of the query.
+        :return: The query, or None if it isn't kept.
+        """
+        with self._query_cache_lock:
+            query = queries.get(key)
+            if query is not None:
+                queries.move_to_end(key)
+        return query
+
+    def _cache_query(self, queries: OrderedDict, key: tuple, query: Select) -> Select:
+        """
+        Keeps a query for reuse, evicting the least recently used query once
+        more than `BLOCK_QUERY_CACHE_SIZE` are kept.
+
+        :param queries: The queries kept for reuse, by key.
+        :param key: The key of the query.
+        :param query: The query to keep.
+        :return: The query kept under the key.
+        """
+        with self._query_cache_lock:
+            query = queries.setdefault(key, query)
+            if len(queries) > BLOCK_QUERY_CACHE_SIZE:
+                queries.popitem(last=False)
+        return query
+
+    def _uses_linkage_view(self, query_key: tuple) -> bool:
+        """
+        Determines whether the block for a combination of blocking columns
+        and transformations, keyed as by `_get_block_query_key`, is fetched
+        from the linkage view.
+
+        :param query_key: The key of the block query.
+        :return: True if the client uses the linkage view and every blocking
+          criterion can be evaluated against it.
+        """
+        return (
+            self.use_linkage_view
+            and self._get_linkage_view_criteria(query_key) is not None
+        )
+
+    def _get_linkage_view_criteria(
+        self, query_key: tuple, param_prefix: str = ""
+    ) -> Union[list, None]:
+        """
+        Generates the where criteria that evaluate the blocking criteria of a
+        block query key against the linkage view, grouped by the MPI table
+        the criteria apply to. Each group is evaluated against an alias of
+        the view named `<table_name>_view`, with the parameters named as in
+        `_generate_where_criteria`. Given names are held in arrays, so they
+        are matched, whole or by their first 4 characters, with the array
+        containment operator.
+
+        :param query_key: The key of the block query.
+        :param param_prefix: A prefix for the names of the parameters.
+        :return: A list of tuples of an alias name and its where criteria, or
+          None if a criterion can't be evaluated against the view.
+        """
+        view_criteria = []
+        for table_name, columns in query_key:
+            if table_name == "identifier" and ("type_code", None) not in columns:
+                return None
+            alias_name = f"{table_name}_view"
+            where_criteria = []
+            for column, transformation in columns:
+                criteria_value = f":{param_prefix}{table_name}_{column}"
+                if (table_name, column) == ("identifier", "type_code"):
+                    if transformation is not None:
+                        return None
+                    where_criteria.append(f"{criteria_value} = 'MR'")
+                    continue
+                view_column = LINKAGE_VIEW_COLUMNS.get((table_name, column))
+                if view_column is None:
+                    return None
+                if view_column == "given_name":
+                    if transformation == "first4":
+                        view_column = "given_name_first4"
+                    elif transformation is not None:
+                        return None
+                    where_criteria.append(
+                        f"{alias_name}.{view_column} @> "
+                        + f"ARRAY[CAST({criteria_value} AS TEXT)]"
+                    )
+                elif transformation is None:
+                    where_criteria.append(
+                        f"{alias_name}.{view_column} = {criteria_value}"
+                    )
+                elif transformation == "first4":
+                    where_criteria.append(
+                        f"LEFT({alias_name}.{view_column},4) = {criteria_value}"
+                    )
+                elif transformation == "last4":
+                    where_criteria.append(
+                        f"RIGHT({alias_name}.{view_column},4) = {criteria_value}"
+                    )
+            if len(where_criteria) > 0:
+                view_criteria.append((alias_name, where_criteria))
+        return view_criteria
+
+    def _get_linkage_view_block_query(
+        self, query_key: tuple, query: Select, param_prefix: str = ""
+    ) -> Select:
+        """
+        Restricts a query of the linkage view to the patients in a block, for
+        a combination of blocking columns and transformations keyed as by
+        `_get_block_query_key`. As in the block query over the normalized
+        tables, every table's criteria must all hold for at least one of a
+        patient's rows, which is found with an index scan of the view.
+
+        :param query_key: The key of the block query.
+        :param query: A select statement on the linkage view.
+        :param param_prefix: A prefix for the names of the parameters.
+        :return: A 'Select' statement whose parameters are the criteria values.
+        """
+        view = self.dal.LINKAGE_VIEW_TABLE
+        for alias_name, where_criteria in self._get_linkage_view_criteria(
+            query_key, param_prefix=param_prefix
+        ):
+            members = view.alias(alias_name)
+            query = query.where(
+                view.c.patient_id.in_(
+                    select(members.c.patient_id).where(
+                        text(" AND ".join(where_criteria))
+                    )
+                )
+            )
+        return query
+
+    def _get_block_query_criteria(self, query_key: tuple) -> dict:
+        """
+        Rebuilds the organized blocking criteria, without values, that a
+        block query key was made from.
+
+        :param query_key: The key of the block query.
+        :return: A dictionary organized by MPI table name, with the ORM table
+            object, and the blocking columns and transformations.
+        """
+        return {
+            table_name: {
+                "table": self.dal.get_table_by_name(table_name),
+                "criteria": {
+                    column: {"value": None, "transformation": transformation}
+                    for column, transformation in columns
+                },
+            }
+            for table_name, columns in query_key
+        }
+
     def _generate_block_query(
-        self, organized_block_criteria: dict, query: Select
+        self,
+        organized_block_criteria: dict,
+        query: Select,
+        bind_params: bool = False,
+        param_prefix: str = "",
     ) -> Select:
         """
         Generates a query for selecting a block of data from the MPI tables per the
@@ -278,6 +887,10 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
 
         :param organized_block_vals: a dictionary organized by MPI table name,
             with the ORM table object, and the blocking criteria.
+        :param bind_params: if True, the criteria compare against bound
+            parameters instead of their values; see `_generate_where_criteria`.
+        :param param_prefix: a prefix for the names of the bound parameters
+            and of the CTEs.
         :return: A 'Select' statement built by the sqlalchemy ORM utilizing
             the blocking criteria.
 
@@ -291,7 +904,10 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
 
             cte_query_table = table_info["table"]
             query_criteria = self._generate_where_criteria(
-                table_info["criteria"], table_key
+                table_info["criteria"],
+                table_key,
+                bind_params=bind_params,
+                param_prefix=param_prefix,
             )
 
             if query_criteria is not None and len(query_criteria) > 0:
@@ -300,7 +916,7 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
                         select(cte_query_table.c.patient_id.label("patient_id"))
                         .distinct()
                         .where(text(" AND ".join(query_criteria)))
-                        .cte(f"{table_key}_cte")
+                        .cte(f"{param_prefix}{table_key}_cte")
                     )
                 else:
                     fk_info = next(iter(cte_query_table.foreign_keys))
@@ -321,7 +937,7 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
                                 + f"{sub_query.name}.{fk_column.name}"
                             ),
                         )
-                    ).cte(f"{table_key}_cte")
+                    ).cte(f"{param_prefix}{table_key}_cte")
             if cte_query is not None:
                 new_query = new_query.join(
                     cte_query,
@@ -396,6 +1012,8 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
         :return: A single select statement queries all relevant
             blocking columns and tables from the MPI.
         """
+        if self._base_query is not None:
+            return self._base_query
 
         id_sub_query = (
             select(
@@ -471,8 +1089,24 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
                 self.dal.ADDRESS_TABLE.c.state,
             )
         )
+        self._base_query = query
         return query
 
+    def _get_linkage_view_query(self) -> Select:
+        """
+        Generates a select query that pulls the same columns from the
+        linkage view as `_get_base_query` does from the normalized MPI
+        tables.
+
+        :return: A select statement on the linkage view.
+        """
+        if self._linkage_view_query is None:
+            view = self.dal.LINKAGE_VIEW_TABLE
+            self._linkage_view_query = select(
+                *[view.c[column] for column in BLOCK_HEADER]
+            )
+        return self._linkage_view_query
+
     def _get_mpi_records(self, patient_resource: dict) -> dict:
         """
         Generates a dictionary with the different MPI Table
@@ -545,8 +1179,66 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
 
             records[table] = table_records
 
+        if self.use_linkage_view:
+            records[self.dal.LINKAGE_VIEW_TABLE.name] = self._get_linkage_view_records(
+                records
+            )
         return records
 
+    def _get_linkage_view_records(self, mpi_records: dict) -> list[dict]:
+        """
+        Generates the linkage view records of a patient from the records
+        inserted into the normalized MPI tables for it, one per row that
+        `_get_base_query` returns for the patient.
+
+        :param mpi_records: A dictionary of MPI Table names and records for
+            a single patient.
+        :return: A list of linkage view records.
+        """
+        return [
+            _linkage_view_record(row)
+            for row in mpi_records_to_block_rows(mpi_records, BLOCK_HEADER)
+        ]
+
+    def _backfill_linkage_view(self, batch_size: int = None) -> int:
+        """
+        Copies the patients that are missing from the linkage view into it,
+        `batch_size` patients per transaction, so that the MPI isn't locked
+        for the length of the whole copy. Patients are missing from the view
+        if it was created after they were inserted, or if they were inserted
+        by clients that don't use it.
+
+        :param batch_size: The number of patients to copy per transaction.
+          Default is `LINKAGE_VIEW_BACKFILL_BATCH_SIZE`.
+        :return: The number of patients copied.
+        """
+        batch_size = batch_size or LINKAGE_VIEW_BACKFILL_BATCH_SIZE
+        view = self.dal.LINKAGE_VIEW_TABLE
+        patient = self.dal.PATIENT_TABLE
+        missing_query = (
+            select(patient.c.patient_id)
+            .where(~exists().where(view.c.patient_id == patient.c.patient_id))
+            .limit(batch_size)
+        )
+        copied = 0
+        while True:
+            with timed("linkage_view_backfill"), self.dal.transaction() as session:
+                session.execute(
+                    select(func.pg_advisory_xact_lock(*LINKAGE_VIEW_LOCK_KEYS))
+                )
+                patient_ids = session.execute(missing_query).scalars().all()
+                if len(patient_ids) == 0:
+                    break
+                rows = session.execute(
+                    self._get_base_query().where(patient.c.patient_id.in_(patient_ids))
+                )
+                self.dal._insert_records(
+                    session, view, [_linkage_view_record(row) for row in rows], False
+                )
+            copied += len(patient_ids)
+            logging.info(f"Linkage view backfill: {copied} patients copied")
+        return copied
+
     def _extract_given_names(self, given_names: list, name_id: uuid) -> dict:
         """
         Separates given_name into it's own table and creates the given_name_index
@@ -574,47 +1266,36 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
             table_records.append(record)
         return table_records
 
-    def _insert_external_person_id(
+    def _get_external_person_records(
         self,
         person_id: str,
         external_person_id: str,
-    ):
+    ) -> list[dict]:
         """
-        Inserts a new external person id record into the MPI if the external_person_id
-        does not already exist in the MPI.
+        Builds the external person record linking a person to an external
+        person id, to be inserted skipping any conflict with a link that
+        already exists in the MPI.
 
         :param person_id: The person_id matching the patient record if a match has been
             found in the MPI.
         :param external_person_id: The external_person_id for the patient record if it
             exists.
-
+        :return: A list of the external person record, or an empty list if the
+            external source isn't in the MPI.
         """
         if person_id is None or external_person_id is None:  # pragma: no cover
             raise ValueError("person_id and external_person_id must be provided.")
 
         external_source_id = self._get_external_source_id("IRIS")
-
-        if external_source_id is not None:
-            query = select(self.dal.EXTERNAL_PERSON_TABLE).where(
-                text(
-                    f"{self.dal.EXTERNAL_PERSON_TABLE.name}.external_person_id"
-                    + f" = '{external_person_id}' AND "
-                    + f"{self.dal.EXTERNAL_PERSON_TABLE.name}.person_id = '{person_id}'"
-                    + f" AND {self.dal.EXTERNAL_PERSON_TABLE.name}.external_source_id "
-                    + f" = '{external_source_id}'"
-                )
-            )
-            external_person_record = self.dal.select_results(query, False)
-
-            if len(external_person_record) == 0:
-                new_external_person_record = {
-                    "person_id": person_id,
-                    "external_person_id": external_person_id,
-                    "external_source_id": external_source_id,
-                }
-                self.dal.bulk_insert_list(
-                    self.dal.EXTERNAL_PERSON_TABLE, [new_external_person_record], False
-                )
+        if external_source_id is None:
+            return []
+        return [
+            {
+                "person_id": person_id,
+                "external_person_id": external_person_id,
+                "external_source_id": external_source_id,
+            }
+        ]
 
     @cache
     def _get_external_source_id(self, external_source_name: str) -> Union[str, None]:
@@ -667,15 +1348,53 @@ class DIBBsMPIConnectorClient(BaseMPIConnectorClient):
                     return_records.append(columns_and_values)
         return return_records
 
-    def _insert_person(self) -> str:
-        """
-        Simple insert of a new person record, which contains
-        a new id (pk)
 
-        :return: The newly created person id.
+class ExplainJSON(Executable, ClauseElement):
+    """
+    An `EXPLAIN (FORMAT JSON)` statement, asking the query planner how it
+    would run a select query, without running it. Bound parameters of the
+    query are passed when the statement is executed, as for the query.
+    """
+
+    inherit_cache = False
+
+    def __init__(self, statement: Select):
         """
-        person_record = {}
-        person_id = self.dal.bulk_insert_list(
-            self.dal.PERSON_TABLE, [person_record], True
-        )
-        return person_id[0]
+        :param statement: The select query to explain.
+        """
+        self.statement = statement
+
+
+@compiles(ExplainJSON)
+def _compile_explain_json(element: ExplainJSON, compiler, **kwargs) -> str:
+    """
+    Helper method that renders an `ExplainJSON` statement.
+    """
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kwargs)
+
+
+def _plan_rows(plan: Union[list, str]) -> int:
+    """
+    Helper method that reads the planner's estimate of the rows a query
+    returns from the output of `EXPLAIN (FORMAT JSON)`, which some drivers
+    return unparsed.
+    """
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _linkage_view_record(row: list) -> dict:
+    """
+    Builds the linkage view record of a row of MPI data whose columns are
+    those of `BLOCK_HEADER`.
+
+    :param row: A row of MPI data.
+    :return: A linkage view record.
+    """
+    record = dict(zip(BLOCK_HEADER, row))
+    record["given_name_first4"] = [
+        given_name if given_name is None else given_name[:4]
+        for given_name in record["given_name"]
+    ]
+    return record
@@ -0,0 +1,306 @@
+import datetime
+import uuid
+
+from sqlalchemy import Column, Select, Table, func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from app.linkage.block import MPIBlock
+from app.linkage.metrics import timed
+from app.linkage.mpi import DIBBsMPIConnectorClient, ExplainJSON, _plan_rows
+from app.linkage.utils import load_mpi_env_vars_os
+
+
+class AsyncDIBBsMPIConnectorClient(DIBBsMPIConnectorClient):
+    """
+    A DIBBs MPI connector client whose block lookups and inserts are
+    coroutines, run on SQLAlchemy's asyncio engine with the asyncpg driver,
+    so an event loop can keep many linkage requests in flight at once. The
+    queries and MPI records are built exactly as by
+    `DIBBsMPIConnectorClient`.
+    """
+
+    def __init__(
+        self, pool_size: int = 5, max_overflow: int = 10, use_linkage_view: bool = False
+    ):
+        """
+        Initialize the MPI connector client with the MPI database. The schema
+        is reflected once over a single synchronous connection, which is
+        released afterwards; every query is then run on an asyncio connection
+        pool.
+
+        :param pool_size: The number of connections to keep open to the database.
+        :param max_overflow: The number of connections to allow in connection pool.
+        :param use_linkage_view: Whether to fetch blocks from the denormalized
+          linkage view. Default is False.
+        """
+        super().__init__(pool_size=1, max_overflow=0, use_linkage_view=use_linkage_view)
+        self.dal.engine.dispose()
+        dbsettings = load_mpi_env_vars_os()
+        dbuser = dbsettings.get("user")
+        dbname = dbsettings.get("dbname")
+        dbpwd = dbsettings.get("password")
+        dbhost = dbsettings.get("host")
+        dbport = dbsettings.get("port")
+        self.async_engine = create_async_engine(
+            f"postgresql+asyncpg://{dbuser}:" + f"{dbpwd}@{dbhost}:{dbport}/{dbname}",
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+        )
+        self._external_source_ids = {}
+
+    async def dispose(self) -> None:
+        """
+        Closes the client's connections to the database.
+        """
+        await self.async_engine.dispose()
+
+    async def get_block_data(self, block_criteria: dict) -> list[list]:
+        """
+        Returns a list of lists containing records from the MPI database that
+        match on the incoming record's block criteria and values, as
+        `DIBBsMPIConnectorClient.get_block_data` does.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations,
+          e.g., {"ZIP": {"value": "90210"}} or
+          {"ZIP": {"value": "90210",}, "transformation":"first4"}.
+        :return: A list of records that are within the block, whose first
+          row is the column headers.
+        """
+        query, params = self._prepare_async_block_query(block_criteria)
+        with timed("select"):
+            async with self.async_engine.connect() as connection:
+                blocked_data = await _select_results(connection, query, params)
+        return blocked_data
+
+    async def get_compact_block_data(
+        self, block_criteria: dict, max_patients: int = None
+    ) -> MPIBlock:
+        """
+        Returns the records from the MPI database that match on the incoming
+        record's block criteria and values as a compact `MPIBlock`, as
+        `DIBBsMPIConnectorClient.get_compact_block_data` does.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param max_patients: Optionally, the most patients to fetch, a larger
+          block being sampled deterministically. Default is None.
+        :return: The block of MPI records, grouped by person.
+        """
+        if max_patients is None:
+            query, params = self._prepare_async_block_query(block_criteria)
+        else:
+            query, params = self._prepare_sampled_block_query(
+                block_criteria, max_patients
+            )
+            params = self._to_async_params(block_criteria, params)
+        with timed("select"):
+            async with self.async_engine.connect() as connection:
+                results = await connection.execute(query, params)
+                return MPIBlock(list(results.keys()), results)
+
+    async def get_block_size(self, block_criteria: dict, estimate: bool = False) -> int:
+        """
+        Returns the number of patients in the MPI that match on the incoming
+        record's block criteria and values, or the query planner's estimate
+        of it, as `DIBBsMPIConnectorClient.get_block_size` does.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param estimate: Whether to return the planner's estimate rather
+          than counting the patients. Default is False.
+        :return: The number of patients in the block.
+        """
+        query, params = self._prepare_block_members_query(block_criteria)
+        params = self._to_async_params(block_criteria, params)
+        with timed("block_size"):
+            async with self.async_engine.connect() as connection:
+                if estimate:
+                    result = await connection.execute(ExplainJSON(query), params)
+                    return _plan_rows(result.scalar())
+                result = await connection.execute(
+                    select(func.count()).select_from(query.subquery()), params
+                )
+                return result.scalar()
+
+    def _prepare_async_block_query(self, block_criteria: dict) -> tuple[Select, dict]:
+        """
+        Looks up the block query for a set of blocking criteria, along with
+        the parameters to bind to it, as `_prepare_block_query` does, with
+        the parameters converted by `_to_async_params`.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: A tuple of the block query and its parameters.
+        """
+        query, params = self._prepare_block_query(block_criteria)
+        return query, self._to_async_params(block_criteria, params)
+
+    def _to_async_params(self, block_criteria: dict, params: dict) -> dict:
+        """
+        Converts the parameters of a block query for asyncpg, which doesn't
+        cast strings to the type of the column they're compared to, by
+        binding untransformed values as that type.
+
+        :param block_criteria: The blocking criteria the query was built for.
+        :param params: The parameters of the block query.
+        :return: The converted parameters.
+        """
+        organized_block_vals = self._organize_block_criteria(block_criteria)
+        for table_name, table_info in organized_block_vals.items():
+            for column, criterion in table_info["criteria"].items():
+                if criterion.get("transformation") is None:
+                    param = f"{table_name}_{column}"
+                    params[param] = _to_column_type(
+                        table_info["table"].c[column], params[param]
+                    )
+        return params
+
+    async def insert_matched_patient(
+        self,
+        patient_resource: dict,
+        person_id=None,
+        external_person_id=None,
+    ) -> uuid.UUID:
+        """
+        Inserts a new patient into the MPI, linked to the matched person if
+        one was found or to a new person otherwise, as
+        `DIBBsMPIConnectorClient.insert_matched_patient` does. Every insert,
+        including those of the new person and the external person ID, is made
+        in a single transaction, and a link to an external person ID that
+        already exists in the MPI is skipped.
+
+        :param patient_resource: A FHIR patient resource.
+        :param person_id: The person ID matching the patient record if a match has been
+          found in the MPI, defaults to None.
+        :param external_person_id: The external person id for the person that matches
+          the patient record if a match has been found in the MPI, defaults to None.
+        :return: The person ID the patient was linked to.
+        """
+        try:
+            async with self.async_engine.begin() as connection:
+                records_with_table = {}
+                if person_id is None:
+                    person_id = uuid.uuid4()
+                    records_with_table[self.dal.PERSON_TABLE.name] = [
+                        {"person_id": person_id}
+                    ]
+                patient_resource["person"] = person_id
+                records_with_table.update(self._get_mpi_records(patient_resource))
+                if external_person_id is not None:
+                    records_with_table[
+                        self.dal.EXTERNAL_PERSON_TABLE.name
+                    ] = await self._get_new_external_person_records_async(
+                        connection, person_id, external_person_id
+                    )
+                for table in self.dal.TABLE_LIST:
+                    records = records_with_table.get(table.name, [])
+                    if len(records) > 0:
+                        await _insert_records(
+                            connection,
+                            table,
+                            records,
+                            skip_conflicts=table is self.dal.EXTERNAL_PERSON_TABLE,
+                        )
+        except Exception as error:  # pragma: no cover
+            raise ValueError(f"{error}")
+        return person_id
+
+    async def _get_new_external_person_records_async(
+        self, connection: AsyncConnection, person_id, external_person_id: str
+    ) -> list[dict]:
+        """
+        Builds the external person record linking a person to an external
+        person ID, to be inserted skipping any conflict with a link that
+        already exists in the MPI, as `_get_external_person_records` does.
+
+        :param connection: The connection of the open transaction.
+        :param person_id: The person ID the patient is linked to.
+        :param external_person_id: The external person ID of the person.
+        :return: A list of the external person record, or an empty list if
+          the external source isn't in the MPI.
+        """
+        if "IRIS" not in self._external_source_ids:
+            source_table = self.dal.EXTERNAL_SOURCE_TABLE
+            result = await connection.execute(
+                select(source_table.c.external_source_id).where(
+                    source_table.c.external_source_name == "IRIS"
+                )
+            )
+            self._external_source_ids["IRIS"] = result.scalar()
+        external_source_id = self._external_source_ids["IRIS"]
+        if external_source_id is None:
+            return []
+        return [
+            {
+                "person_id": person_id,
+                "external_person_id": external_person_id,
+                "external_source_id": external_source_id,
+            }
+        ]
+
+
+async def _select_results(
+    connection: AsyncConnection, select_statement: Select, params: dict = None
+) -> list[list]:
+    """
+    Helper method that runs a select query and returns its results as a
+    list of lists whose first row is the column headers, as
+    `DataAccessLayer.select_results` does.
+    """
+    results = await connection.execute(select_statement, params)
+    return [list(results.keys())] + [list(row) for row in results]
+
+
+async def _insert_records(
+    connection: AsyncConnection,
+    table: Table,
+    records: list[dict],
+    skip_conflicts: bool = False,
+) -> None:
+    """
+    Helper method that inserts records into a table, with one multi-row
+    INSERT per set of columns the records have values for, as
+    `DataAccessLayer.bulk_insert_dict` does, optionally skipping records
+    that conflict with existing rows.
+    """
+    records_by_columns = {}
+    for record in records:
+        records_by_columns.setdefault(tuple(sorted(record)), []).append(
+            {
+                column: _to_column_type(table.c[column], value)
+                for column, value in record.items()
+            }
+        )
+    if skip_conflicts:
+        statement = postgresql_insert(table).on_conflict_do_nothing()
+    else:
+        statement = table.insert()
+    for column_records in records_by_columns.values():
+        await connection.execute(statement, column_records)
+
+
+def _to_column_type(column: Column, value):
+    """
+    Helper method that converts a string holding a date, timestamp or UUID
+    to the Python type of the column it's bound to, which asyncpg requires
+    where psycopg2 lets Postgres cast the string.
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:  # pragma: no cover
+        return value
+    if python_type is datetime.date:
+        return datetime.date.fromisoformat(value)
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    if python_type is uuid.UUID:
+        return uuid.UUID(value)
+    return value
@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import select
+
+from app.linkage.block import MPIBlock
+from app.linkage.blocking_index import BLOCK_HEADER, BlockingIndex
+from app.linkage.metrics import timed
+from app.linkage.mpi import DIBBsMPIConnectorClient
+
+# Maximum number of patients whose rows are loaded in a single query when
+# the cache is refreshed
+CACHE_REFRESH_BATCH_SIZE = 5000
+
+
+class CachedMPIConnectorClient(DIBBsMPIConnectorClient):
+    """
+    A DIBBs MPI connector client that answers block lookups from an
+    in-memory `BlockingIndex` of the MPI instead of querying the database.
+    Patients inserted through the client are written through to the index,
+    and the index is refreshed from the MPI, picking up patients inserted
+    or removed by other clients, once it is older than the refresh interval.
+    Block lookups on criteria the index doesn't hold go to the database.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        refresh_interval: float = 60.0,
+        use_linkage_view: bool = False,
+    ):
+        """
+        Initialize the MPI connector client with the MPI database. The index
+        is loaded on the first block lookup.
+
+        :param pool_size: The number of connections to keep open to the database.
+        :param max_overflow: The number of connections to allow in connection pool.
+        :param refresh_interval: The number of seconds after which the index is
+          refreshed from the MPI.
+        :param use_linkage_view: Whether block lookups the index can't answer
+          are made against the denormalized linkage view. Default is False.
+        """
+        super().__init__(
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            use_linkage_view=use_linkage_view,
+        )
+        self.refresh_interval = refresh_interval
+        self.blocking_index = BlockingIndex(self)
+        self.last_refresh = None
+        self.cache_stats = {"hits": 0, "misses": 0, "refreshes": 0}
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self) -> None:
+        """
+        Brings the index up to date with the MPI. As patients are never
+        updated once inserted, only the rows of patients the index doesn't
+        hold yet are loaded, and patients no longer in the MPI are removed.
+        Patients written through to the index while the MPI is read were
+        indexed after their insert, so only patients indexed before it is
+        read are checked for removal.
+        """
+        with self._refresh_lock, timed("mpi_cache_refresh"):
+            indexed_ids = self.blocking_index.patient_ids()
+            patient_ids = {
+                str(row[0])
+                for row in self.dal.select_results(
+                    select(self.dal.PATIENT_TABLE.c.patient_id),
+                    include_col_header=False,
+                )
+            }
+            for patient_id in indexed_ids - patient_ids:
+                self.blocking_index.remove_patient(patient_id)
+
+            new_ids = sorted(patient_ids - self.blocking_index.patient_ids())
+            for start in range(0, len(new_ids), CACHE_REFRESH_BATCH_SIZE):
+                query = self._get_base_query().where(
+                    self.dal.PATIENT_TABLE.c.patient_id.in_(
+                        new_ids[start : start + CACHE_REFRESH_BATCH_SIZE]
+                    )
+                )
+                self.blocking_index.add_block_rows(
+                    self.dal.select_results(query, include_col_header=False)
+                )
+            self.last_refresh = time.monotonic()
+            self.cache_stats["refreshes"] += 1
+            logging.info(
+                f"MPI cache refresh: {len(new_ids)} patients loaded, "
+                + f"{len(self.blocking_index)} cached"
+            )
+
+    def get_block_data(self, block_criteria: dict) -> list[list]:
+        """
+        Returns a list of lists containing records from the MPI that match
+        on the incoming record's block criteria and values, as
+        `DIBBsMPIConnectorClient.get_block_data` does, answered from the
+        index where possible.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: A list of records that are within the block, whose first
+          row is the column headers.
+        """
+        if len(block_criteria) == 0:
+            raise ValueError("`block_vals` cannot be empty.")
+        if not self.blocking_index.can_answer(block_criteria):
+            self.cache_stats["misses"] += 1
+            return super().get_block_data(block_criteria)
+
+        self._refresh_if_stale()
+        self.cache_stats["hits"] += 1
+        return [list(BLOCK_HEADER)] + self.blocking_index.get_block_rows(
+            block_criteria, BLOCK_HEADER
+        )
+
+    def get_compact_block_data(
+        self, block_criteria: dict, max_patients: int = None
+    ) -> MPIBlock:
+        """
+        Returns the MPI records that match on the incoming record's block
+        criteria and values as a compact `MPIBlock`, answered from the index
+        where possible. Sampled blocks are always fetched from the database,
+        so that they're sampled as `DIBBsMPIConnectorClient` samples them.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param max_patients: Optionally, the most patients to fetch, a larger
+          block being sampled deterministically. Default is None.
+        :return: The block of MPI records, grouped by person.
+        """
+        if max_patients is not None:
+            return super().get_compact_block_data(block_criteria, max_patients)
+        return MPIBlock.from_block_data(self.get_block_data(block_criteria))
+
+    def get_block_size(self, block_criteria: dict, estimate: bool = False) -> int:
+        """
+        Returns the number of patients in the MPI that match on the incoming
+        record's block criteria and values, counted in the index where
+        possible and otherwise as `DIBBsMPIConnectorClient.get_block_size`
+        does.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param estimate: Whether to return the planner's estimate of a
+          block the index can't answer. Default is False.
+        :return: The number of patients in the block.
+        """
+        if len(block_criteria) == 0:
+            raise ValueError("`block_vals` cannot be empty.")
+        if not self.blocking_index.can_answer(block_criteria):
+            return super().get_block_size(block_criteria, estimate)
+        self._refresh_if_stale()
+        rows = self.blocking_index.get_block_rows(block_criteria, BLOCK_HEADER)
+        return len({row[0] for row in rows})
+
+    def get_block_data_batch(self, block_criteria_list: list[dict]) -> list[list[list]]:
+        """
+        Returns the blocks of MPI records matching each of a list of block
+        criteria, as `DIBBsMPIConnectorClient.get_block_data_batch` does,
+        answering the blocks it can from the index.
+
+        :param block_criteria_list: A list of dictionaries of blocking
+          criteria, each in the form accepted by `get_block_data`.
+        :return: A list of blocks, one per entry in `block_criteria_list`.
+        """
+        if any(len(block_criteria) == 0 for block_criteria in block_criteria_list):
+            raise ValueError("`block_vals` cannot be empty.")
+
+        blocks = [None] * len(block_criteria_list)
+        uncached = []
+        for i, block_criteria in enumerate(block_criteria_list):
+            if self.blocking_index.can_answer(block_criteria):
+                self._refresh_if_stale()
+                self.cache_stats["hits"] += 1
+                blocks[i] = [list(BLOCK_HEADER)] + self.blocking_index.get_block_rows(
+                    block_criteria, BLOCK_HEADER
+                )
+            else:
+                self.cache_stats["misses"] += 1
+                uncached.append(i)
+        if len(uncached) > 0:
+            fetched = super().get_block_data_batch(
+                [block_criteria_list[i] for i in uncached]
+            )
+            for i, block in zip(uncached, fetched):
+                blocks[i] = block
+        return blocks
+
+    def insert_matched_patient(
+        self,
+        patient_resource: dict,
+        person_id=None,
+        external_person_id=None,
+    ) -> str:
+        """
+        Inserts a patient into the MPI as
+        `DIBBsMPIConnectorClient.insert_matched_patient` does, then adds it
+        to the index.
+
+        :param patient_resource: A FHIR patient resource.
+        :param person_id: The person ID matching the patient record if a match
+          has been found in the MPI, defaults to None.
+        :param external_person_id: The external person id for the person that
+          matches the patient record if a match has been found in the MPI,
+          defaults to None.
+        :return: The person id for the inserted patient.
+        """
+        person_id = super().insert_matched_patient(
+            patient_resource,
+            person_id=person_id,
+            external_person_id=external_person_id,
+        )
+        if self.last_refresh is not None:
+            self.blocking_index.add_patient(patient_resource)
+        return person_id
+
+    def insert_matched_patients(
+        self,
+        patient_resources: list[dict],
+        person_ids: list,
+        external_person_ids: list = None,
+    ) -> list:
+        """
+        Inserts a batch of patients into the MPI as
+        `DIBBsMPIConnectorClient.insert_matched_patients` does, then adds
+        them to the index.
+
+        :param patient_resources: A list of FHIR patient resources.
+        :param person_ids: The person ID each patient is linked to.
+        :param external_person_ids: Optionally, the external person ID of
+          each patient's person, or None where there isn't one.
+        :return: The person ID each patient was linked to.
+        """
+        person_ids = super().insert_matched_patients(
+            patient_resources, person_ids, external_person_ids
+        )
+        if self.last_refresh is not None:
+            for patient_resource in patient_resources:
+                self.blocking_index.add_patient(patient_resource)
+        return person_ids
+
+    def _refresh_if_stale(self) -> None:
+        """
+        Helper method that refreshes the index if it has never been loaded
+        or is older than the refresh interval.
+        """
+        if (
+            self.last_refresh is None
+            or time.monotonic() - self.last_refresh >= self.refresh_interval
+        ):
+            self.refresh()
@@ -0,0 +1,472 @@
+import copy
+import json
+import logging
+import os
+import threading
+import uuid
+
+from sqlalchemy import select
+
+from app.linkage.block import BLOCK_HEADER, MPIBlock
+from app.linkage.blocking_index import BlockingIndex
+from app.linkage.metrics import timed
+from app.linkage.mpi import DIBBsMPIConnectorClient
+
+
+class WriteBehindMPIConnectorClient(DIBBsMPIConnectorClient):
+    """
+    A DIBBs MPI connector client that returns from inserts as soon as the
+    patients are queued, and writes them to the MPI from a background
+    worker, in batches of up to `batch_size` patients per transaction.
+    Until a queued patient is written, block lookups read it from an
+    in-memory `BlockingIndex` overlay, so a record can still link to
+    another record linked moments before it. Block lookups on criteria the
+    overlay can't answer wait for the queue to be written first.
+
+    The queue is bounded: inserts wait for the worker once `max_pending`
+    patients are queued. If a journal path is given, every queued patient
+    is appended to the journal, and synced to disk, before the insert
+    returns, and patients still queued when the client stops are written to
+    the MPI when a client is next started with the same journal. A batch
+    the worker fails to write is retried, so patients are never dropped
+    from the queue.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        use_linkage_view: bool = False,
+        journal_path: str = None,
+        max_pending: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 0.5,
+    ):
+        """
+        Initialize the MPI connector client with the MPI database, replay any
+        patients left in the journal and start the background worker.
+
+        :param pool_size: The number of connections to keep open to the database.
+        :param max_overflow: The number of connections to allow in connection pool.
+        :param use_linkage_view: Whether to fetch blocks from the denormalized
+          linkage view. Default is False.
+        :param journal_path: Optionally, the path of the file queued patients
+          are journaled to. Default is None, meaning the queue is only held
+          in memory.
+        :param max_pending: The most patients that may be queued at once.
+        :param batch_size: The most patients written to the MPI in a single
+          transaction.
+        :param flush_interval: The most seconds a patient waits in the queue
+          before the worker writes it, unless a full batch is queued sooner.
+        """
+        super().__init__(
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            use_linkage_view=use_linkage_view,
+        )
+        self.journal_path = journal_path
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overlay = BlockingIndex(self)
+        self.write_stats = {"queued": 0, "flushed": 0, "batches": 0, "failures": 0}
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closing = False
+        self._journal = None
+        self._journal_flushed = 0
+        if journal_path is not None:
+            self._replay_journal()
+        self._worker = threading.Thread(
+            target=self._run, name="mpi-write-behind", daemon=True
+        )
+        self._worker.start()
+
+    def pending(self) -> int:
+        """
+        Returns the number of patients queued but not yet written to the MPI.
+        """
+        with self._condition:
+            return len(self._pending)
+
+    def insert_matched_patient(
+        self,
+        patient_resource: dict,
+        person_id=None,
+        external_person_id=None,
+    ) -> str:
+        """
+        Queues a new patient to be inserted into the MPI, linked to the
+        matched person if one was found or to a new person otherwise, as
+        `DIBBsMPIConnectorClient.insert_matched_patient` would insert it.
+        The ID of a new person, and of the patient if it has none, is
+        generated here. Once the client is closed, patients are inserted
+        directly.
+
+        :param patient_resource: A FHIR patient resource.
+        :param person_id: The person ID matching the patient record if a match has been
+          found in the MPI, defaults to None.
+        :param external_person_id: The external person id for the person that matches
+          the patient record if a match has been found in the MPI, defaults to None.
+        :return: The person ID the patient was linked to.
+        """
+        if self._closing:
+            return super().insert_matched_patient(
+                patient_resource,
+                person_id=person_id,
+                external_person_id=external_person_id,
+            )
+        if person_id is None:
+            person_id = uuid.uuid4()
+        self._enqueue([_to_entry(patient_resource, person_id, external_person_id)])
+        return person_id
+
+    def insert_matched_patients(
+        self,
+        patient_resources: list[dict],
+        person_ids: list,
+        external_person_ids: list = None,
+    ) -> list:
+        """
+        Queues a batch of patients to be inserted into the MPI, as
+        `DIBBsMPIConnectorClient.insert_matched_patients` would insert them.
+        Once the client is closed, patients are inserted directly.
+
+        :param patient_resources: A list of FHIR patient resources.
+        :param person_ids: The person ID each patient is linked to.
+        :param external_person_ids: Optionally, the external person ID of
+          each patient's person, or None where there isn't one.
+        :return: The person ID each patient was linked to.
+        """
+        if self._closing:
+            return super().insert_matched_patients(
+                patient_resources, person_ids, external_person_ids
+            )
+        if external_person_ids is None:
+            external_person_ids = [None] * len(patient_resources)
+        if not len(patient_resources) == len(person_ids) == len(external_person_ids):
+            raise ValueError(
+                "A person ID and external person ID must be supplied for every patient."
+            )
+        self._enqueue(
+            [
+                _to_entry(patient_resource, person_id, external_person_id)
+                for patient_resource, person_id, external_person_id in zip(
+                    patient_resources, person_ids, external_person_ids
+                )
+            ]
+        )
+        return person_ids
+
+    def get_block_data(self, block_criteria: dict) -> list[list]:
+        """
+        Returns a list of lists containing records from the MPI that match
+        on the incoming record's block criteria and values, as
+        `DIBBsMPIConnectorClient.get_block_data` does, followed by the rows
+        of any matching patients still queued.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :return: A list of records that are within the block, whose first
+          row is the column headers.
+        """
+        pending_rows = self._get_pending_rows(block_criteria)
+        blocked_data = super().get_block_data(block_criteria)
+        return blocked_data + _unwritten_rows(blocked_data[1:], pending_rows)
+
+    def get_compact_block_data(
+        self, block_criteria: dict, max_patients: int = None
+    ) -> MPIBlock:
+        """
+        Returns the MPI records that match on the incoming record's block
+        criteria and values as a compact `MPIBlock`, as
+        `DIBBsMPIConnectorClient.get_compact_block_data` does, along with any
+        matching patients still queued. Queued patients are never sampled
+        out of a block.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param max_patients: Optionally, the most patients to fetch from the
+          MPI, a larger block being sampled deterministically. Default is
+          None.
+        :return: The block of MPI records, grouped by person.
+        """
+        pending_rows = self._get_pending_rows(block_criteria)
+        if len(pending_rows) == 0:
+            return super().get_compact_block_data(block_criteria, max_patients)
+
+        if max_patients is None:
+            query, params = self._prepare_block_query(block_criteria)
+        else:
+            query, params = self._prepare_sampled_block_query(
+                block_criteria, max_patients
+            )
+        with timed("select"), self.dal.transaction() as session:
+            rows = [list(row) for row in session.execute(query, params)]
+        return MPIBlock(BLOCK_HEADER, rows + _unwritten_rows(rows, pending_rows))
+
+    def get_block_size(self, block_criteria: dict, estimate: bool = False) -> int:
+        """
+        Returns the number of patients in the MPI that match on the incoming
+        record's block criteria and values, as
+        `DIBBsMPIConnectorClient.get_block_size` does, plus the number of
+        matching patients still queued.
+
+        :param block_criteria: Dictionary containing key value pairs
+            for the column name for blocking and the data for the
+            incoming record as well as any transformations.
+        :param estimate: Whether to return the planner's estimate of the
+          patients in the MPI rather than counting them. Default is False.
+        :return: The number of patients in the block.
+        """
+        pending_rows = self._get_pending_rows(block_criteria)
+        return super().get_block_size(block_criteria, estimate) + len(
+            {row[0] for row in pending_rows}
+        )
+
+    def get_block_data_batch(self, block_criteria_list: list[dict]) -> list[list[list]]:
+        """
+        Returns the blocks of MPI records matching each of a list of block
+        criteria, as `DIBBsMPIConnectorClient.get_block_data_batch` does,
+        each followed by the rows of any matching patients still queued.
+
+        :param block_criteria_list: A list of dictionaries of blocking
+          criteria, each in the form accepted by `get_block_data`.
+        :return: A list of blocks, one per entry in `block_criteria_list`.
+        """
+        pending_rows = [
+            self._get_pending_rows(block_criteria)
+            for block_criteria in block_criteria_list
+        ]
+        blocks = super().get_block_data_batch(block_criteria_list)
+        return [
+            block + _unwritten_rows(block[1:], rows)
+            for block, rows in zip(blocks, pending_rows)
+        ]
+
+    def flush(self) -> None:
+        """
+        Writes every queued patient to the MPI before returning.
+
+        :raises ValueError: If a batch of patients couldn't be written.
+        """
+        while self.pending() > 0:
+            if not self._flush_batch():
+                raise ValueError("Queued patients couldn't be written to the MPI.")
+
+    def close(self, flush: bool = True) -> None:
+        """
+        Stops the background worker, after which patients are inserted
+        directly into the MPI.
+
+        :param flush: Whether to write the patients still queued to the MPI
+          first. Patients left queued remain in the journal, if there is one,
+          to be written when a client is next started with it. Default is
+          True.
+        """
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+        self._worker.join()
+        if flush:
+            self.flush()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _get_pending_rows(self, block_criteria: dict) -> list[list]:
+        """
+        Helper method that returns the rows of the queued patients belonging
+        to a block. If the overlay can't evaluate the block's criteria, the
+        queue is written to the MPI instead, so the block query finds them.
+        """
+        if len(self.overlay) == 0:
+            return []
+        if not self.overlay.can_answer(block_criteria):
+            self.flush()
+            return []
+        return self.overlay.get_block_rows(block_criteria, BLOCK_HEADER)
+
+    def _enqueue(self, entries: list[dict]) -> None:
+        """
+        Helper method that adds patients to the queue, and to the journal
+        and the overlay, once there's room for them.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: (
+                    self._closing
+                    or len(self._pending) == 0
+                    or len(self._pending) + len(entries) <= self.max_pending
+                )
+            )
+            if self._journal is not None:
+                for entry in entries:
+                    self._journal.write(json.dumps(entry, default=str) + "\n")
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            for entry in entries:
+                self.overlay.add_patient(entry["patient_resource"])
+            self._pending.extend(entries)
+            self.write_stats["queued"] += len(entries)
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        """
+        Helper method run by the background worker, which writes a batch of
+        queued patients to the MPI whenever a full batch is queued or the
+        flush interval has passed, until the client is closed.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closing or len(self._pending) >= self.batch_size,
+                    timeout=self.flush_interval,
+                )
+                if self._closing:
+                    return
+            if not self._flush_batch():
+                # wait out the flush interval before retrying a failed batch
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._closing, timeout=self.flush_interval
+                    )
+
+    def _flush_batch(self) -> bool:
+        """
+        Helper method that writes the oldest batch of queued patients to the
+        MPI in a single transaction, then removes them from the queue, the
+        journal and the overlay.
+
+        :return: Whether the batch was written.
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch = self._pending[: self.batch_size]
+            if len(batch) == 0:
+                return True
+            try:
+                with timed("write_behind_flush"):
+                    super().insert_matched_patients(
+                        [entry["patient_resource"] for entry in batch],
+                        [entry["person_id"] for entry in batch],
+                        [entry["external_person_id"] for entry in batch],
+                    )
+            except ValueError as error:
+                self.write_stats["failures"] += 1
+                logging.error(
+                    f"Failed to write {len(batch)} queued patients to the MPI: {error}"
+                )
+                return False
+
+            with self._condition:
+                del self._pending[: len(batch)]
+                if self._journal is not None:
+                    self._truncate_journal(len(batch))
+                self.write_stats["flushed"] += len(batch)
+                self.write_stats["batches"] += 1
+                self._condition.notify_all()
+            for entry in batch:
+                self.overlay.remove_patient(entry["patient_resource"]["id"])
+            return True
+
+    def _truncate_journal(self, num_flushed: int) -> None:
+        """
+        Helper method that records in the journal that its oldest patients
+        have been written to the MPI. The journal is emptied once the queue
+        is, and rewritten with just the queued patients once it holds more
+        than `max_pending` written ones.
+        """
+        self._journal_flushed += num_flushed
+        if len(self._pending) == 0 or self._journal_flushed > self.max_pending:
+            self._journal.close()
+            with open(self.journal_path + ".tmp", "w") as journal:
+                for entry in self._pending:
+                    journal.write(json.dumps(entry, default=str) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(self.journal_path + ".tmp", self.journal_path)
+            self._journal = open(self.journal_path, "a")
+            self._journal_flushed = 0
+        else:
+            self._journal.write(json.dumps({"flushed": num_flushed}) + "\n")
+            self._journal.flush()
+
+    def _replay_journal(self) -> None:
+        """
+        Helper method that queues the patients left in the journal by a
+        previous client, skipping any it wrote to the MPI before recording
+        that in the journal.
+        """
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last entry may have been cut short by a crash,
+                        # in which case its insert never returned
+                        logging.warning("Skipping a truncated write-behind entry.")
+                        continue
+                    if "flushed" in entry:
+                        del entries[: entry["flushed"]]
+                    else:
+                        entries.append(entry)
+
+        if len(entries) > 0:
+            query = select(self.dal.PATIENT_TABLE.c.patient_id).where(
+                self.dal.PATIENT_TABLE.c.patient_id.in_(
+                    [entry["patient_resource"]["id"] for entry in entries]
+                )
+            )
+            written = {
+                str(row[0])
+                for row in self.dal.select_results(query, include_col_header=False)
+            }
+            entries = [
+                entry
+                for entry in entries
+                if str(entry["patient_resource"]["id"]) not in written
+            ]
+            logging.info(f"Replaying {len(entries)} queued patients from the journal.")
+
+        self._journal_flushed = 0
+        self._journal = open(self.journal_path, "w")
+        for entry in entries:
+            self._journal.write(json.dumps(entry, default=str) + "\n")
+            self.overlay.add_patient(entry["patient_resource"])
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._pending = entries
+
+
+def _to_entry(patient_resource: dict, person_id, external_person_id) -> dict:
+    """
+    Helper method that builds the queue entry of a patient, giving it an ID
+    if it has none and linking it to its person, as it will be inserted. The
+    entry holds a copy of the resource, so the caller may go on to modify it.
+    """
+    if patient_resource.get("id") is None:
+        patient_resource["id"] = str(uuid.uuid4())
+    patient_resource["person"] = person_id
+    return {
+        "patient_resource": copy.deepcopy(patient_resource),
+        "person_id": person_id,
+        "external_person_id": external_person_id,
+    }
+
+
+def _unwritten_rows(rows: list, pending_rows: list) -> list[list]:
+    """
+    Helper method that returns the rows of queued patients that aren't
+    among a block's rows from the MPI, which they may already be if they
+    were written while the block was fetched.
+    """
+    if len(pending_rows) == 0:
+        return []
+    written = {str(row[0]) for row in rows}
+    return [row for row in pending_rows if str(row[0]) not in written]
@@ -0,0 +1,214 @@
+import time
+
+
+class LinkageTrace:
+    """
+    A structured record of how a single incoming record was linked: for
+    each linkage pass, the fields its block was fetched on, the size of the
+    block, the time spent fetching and scoring it, and the belongingness
+    ratio of every person cluster evaluated, along with the bounds the
+    ratio was known to lie within if its evaluation was cut short. Up to
+    `max_comparisons`
+    record comparisons per cluster are kept along with the score of each
+    feature, which explains why a record did or didn't match a cluster.
+
+    Building a trace only stores raw values (timings from a monotonic
+    clock, IDs and scores as they are); nothing is formatted until the
+    trace is turned into a dictionary with `to_dict`. Linkage functions
+    accept an optional trace and do no tracing work without one.
+    """
+
+    def __init__(self, max_comparisons: int = 10):
+        """
+        :param max_comparisons: The most record comparisons to keep the
+          per-feature scores of for each cluster. Default is 10.
+        """
+        self.max_comparisons = max_comparisons
+        self.passes = []
+        self.timings = {}
+        self.result = None
+        self._start = time.perf_counter()
+        self._pass = None
+        self._cluster = None
+
+    def start_pass(self, pass_index: int, blocking_criteria: dict) -> None:
+        """
+        Starts tracing a linkage pass. Clusters and timings are recorded
+        against the most recently started pass.
+
+        :param pass_index: The position of the pass in the algorithm.
+        :param blocking_criteria: The blocking criteria extracted from the
+          incoming record for the pass, of which only the field names are
+          kept.
+        """
+        self._pass = {
+            "pass": pass_index,
+            "blocking_fields": list(blocking_criteria),
+            "block_size": None,
+            "timings": {},
+            "clusters": [],
+        }
+        self.passes.append(self._pass)
+
+    def guard_pass(self, blocking_criteria: dict, max_patients: int = None) -> None:
+        """
+        Records how the current pass's block was narrowed down or sampled
+        to fit the pass's block size limit.
+
+        :param blocking_criteria: The blocking criteria the block is fetched
+          on.
+        :param max_patients: The number of patients the block is sampled
+          down to, if it's sampled.
+        """
+        self._pass["blocking_fields"] = list(blocking_criteria)
+        if max_patients is not None:
+            self._pass["sampled_to"] = max_patients
+
+    def add_timing(self, key: str, start: float) -> None:
+        """
+        Adds the time elapsed since `start` to a timing of the current pass,
+        or of the trace as a whole if no pass has started, e.g. when the
+        blocks of every pass are fetched at once.
+
+        :param key: The name of the timing, e.g. "fetch" or "score".
+        :param start: The `time.perf_counter()` reading the step began at.
+        """
+        timings = self.timings if self._pass is None else self._pass["timings"]
+        timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+
+    def set_block_size(self, block_size: int) -> None:
+        """
+        Records the number of patients in the current pass's block.
+
+        :param block_size: The number of patients in the block.
+        """
+        self._pass["block_size"] = block_size
+
+    def start_cluster(
+        self, person_id, cluster_size: int, num_variants: int = None
+    ) -> None:
+        """
+        Starts tracing the evaluation of the incoming record against a
+        person cluster in the current pass.
+
+        :param person_id: The ID of the person.
+        :param cluster_size: The number of patients linked to the person.
+        :param num_variants: The number of distinct variants of the values
+          compared among the person's patients, if known.
+        """
+        self._cluster = {
+            "person_id": person_id,
+            "size": cluster_size,
+            "variants": num_variants,
+            "belongingness_ratio": None,
+            "early_exit": False,
+            "belongingness_ratio_bounds": None,
+            "comparisons": [],
+        }
+        self._pass["clusters"].append(self._cluster)
+
+    def wants_comparison(self) -> bool:
+        """
+        Returns whether the per-feature scores of the next comparison with
+        the current cluster should be kept.
+        """
+        return len(self._cluster["comparisons"]) < self.max_comparisons
+
+    def add_comparison(self, patient_id, matched: bool, feature_scores: dict) -> None:
+        """
+        Records a comparison of the incoming record with a patient of the
+        current cluster.
+
+        :param patient_id: The ID of the MPI patient compared.
+        :param matched: Whether the records matched under the pass.
+        :param feature_scores: A dictionary mapping each feature to its
+          comparison score.
+        """
+        self._cluster["comparisons"].append(
+            {"patient_id": patient_id, "matched": matched, "features": feature_scores}
+        )
+
+    def exit_cluster_early(self, min_ratio: float, max_ratio: float) -> None:
+        """
+        Records that the evaluation of the current cluster was cut short
+        before the record was compared with every patient, so that its
+        belongingness ratio is only known to lie within bounds. Any ratio
+        then recorded by `end_cluster` is partial.
+
+        :param min_ratio: The ratio if no remaining patient had matched.
+        :param max_ratio: The ratio if every remaining patient had matched.
+        """
+        self._cluster["early_exit"] = True
+        self._cluster["belongingness_ratio_bounds"] = [min_ratio, max_ratio]
+
+    def end_cluster(self, belongingness_ratio: float = None) -> None:
+        """
+        Records the belongingness ratio of the current cluster.
+
+        :param belongingness_ratio: The ratio computed for the cluster, the
+          lower bound of its ratio if its evaluation was cut short once the
+          person couldn't be the strongest link, or None if it was cut short
+          otherwise.
+        """
+        self._cluster["belongingness_ratio"] = belongingness_ratio
+
+    def set_result(self, matched: bool, person_id, linkage_scores: dict) -> None:
+        """
+        Records the outcome of linkage, and the total time it took.
+
+        :param matched: Whether the record matched an existing person.
+        :param person_id: The ID of the person the record was linked to.
+        :param linkage_scores: The best belongingness ratio of each person
+          the record was found to belong to.
+        """
+        self.result = {
+            "matched": matched,
+            "person_id": person_id,
+            "linkage_scores": dict(linkage_scores),
+            "total_time": time.perf_counter() - self._start,
+        }
+
+    def to_dict(self) -> dict:
+        """
+        Returns the trace as a JSON-serializable dictionary, with IDs as
+        strings and timings in seconds.
+
+        :return: A dictionary of the traced passes, the timings of steps
+          shared by every pass and the linkage result.
+        """
+        passes = []
+        for traced_pass in self.passes:
+            clusters = [
+                {
+                    **cluster,
+                    "person_id": _str_or_none(cluster["person_id"]),
+                    "comparisons": [
+                        {
+                            **comparison,
+                            "patient_id": _str_or_none(comparison["patient_id"]),
+                        }
+                        for comparison in cluster["comparisons"]
+                    ],
+                }
+                for cluster in traced_pass["clusters"]
+            ]
+            passes.append({**traced_pass, "clusters": clusters})
+
+        result = None
+        if self.result is not None:
+            result = {
+                **self.result,
+                "person_id": _str_or_none(self.result["person_id"]),
+                "linkage_scores": {
+                    str(person_id): score
+                    for person_id, score in self.result["linkage_scores"].items()
+                },
+            }
+        return {"passes": passes, "timings": dict(self.timings), "result": result}
+
+
+def _str_or_none(value) -> str:
+    """
+    Helper method that converts an ID to a string, leaving None as it is.
+    """
+    return None if value is None else str(value)
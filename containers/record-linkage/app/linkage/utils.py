@@ -1,5 +1,7 @@
 import json
 import random
+import threading
+from collections import OrderedDict
 from datetime import date, datetime
 from functools import cache
 from typing import Any, Callable, Literal, Union
@@ -137,6 +139,78 @@ def compare_strings(
         )
 
 
+class SimilarityCache:
+    """
+    A memo of `compare_strings` scores, keyed by the similarity measure and
+    the pair of strings compared. Linking a record compares its values with
+    the same MPI values (a common first name, city or street) over and over,
+    across person clusters and linkage passes, so each distinct pair only
+    needs scoring once. A cache can be bounded, evicting its least recently
+    used scores, and can defer to a parent cache on a miss, so that a cache
+    kept for a single request can share scores with a process-wide one.
+    """
+
+    def __init__(self, maxsize: int = None, parent: "SimilarityCache" = None):
+        """
+        :param maxsize: Optionally, the most scores to keep. Default is None,
+          meaning the cache is unbounded.
+        :param parent: Optionally, a cache to look scores up in, and add them
+          to, before computing them.
+        """
+        self.maxsize = maxsize
+        self.parent = parent
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Returns the number of scores in the cache."""
+        return len(self.scores)
+
+    def compare(
+        self,
+        string1: str,
+        string2: str,
+        similarity_measure: Literal[
+            "JaroWinkler", "Levenshtein", "DamerauLevenshtein"
+        ] = "JaroWinkler",
+    ) -> float:
+        """
+        Returns the normalized similarity of two strings, as `compare_strings`
+        does, from the cache if the pair has been scored before.
+
+        :param string1: First string for comparison.
+        :param string2: Second string for comparison.
+        :param similarity_measure: The method used to measure the similarity
+          between the strings, defaults to "JaroWinkler".
+        :return: The normalized similarity between string1 and string2.
+        """
+        key = (similarity_measure, string1, string2)
+        score = self.scores.get(key)
+        if score is not None:
+            self.hits += 1
+            if self.maxsize is not None:
+                with self._lock:
+                    if key in self.scores:
+                        self.scores.move_to_end(key)
+            return score
+
+        self.misses += 1
+        if self.parent is not None:
+            score = self.parent.compare(string1, string2, similarity_measure)
+        else:
+            score = compare_strings(string1, string2, similarity_measure)
+        if self.maxsize is None:
+            self.scores[key] = score
+        else:
+            with self._lock:
+                self.scores[key] = score
+                while len(self.scores) > self.maxsize:
+                    self.scores.popitem(last=False)
+        return score
+
+
 selection_criteria_types = Literal["first", "last", "random", "all"]
 
 
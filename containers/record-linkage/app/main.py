@@ -1,23 +1,92 @@
 import copy
+import json
+import logging
+import random
+from collections import OrderedDict
 from pathlib import Path
 from typing import Annotated, Optional
 
 from fastapi import Body, Response, status
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
 
 from app.base_service import BaseService
 from app.linkage.algorithms import DIBBS_BASIC, DIBBS_ENHANCED
-from app.linkage.link import add_person_resource, link_record_against_mpi
+from app.linkage.link import (
+    CompiledLinkageAlgorithm,
+    add_person_resource,
+    hash_linkage_config,
+    link_record_against_mpi,
+    link_record_against_mpi_async,
+    link_records_against_mpi,
+)
+from app.linkage.locks import AdvisoryLockTable, StripedLockTable
+from app.linkage.metrics import TIMINGS, format_counters
 from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.mpi_async import AsyncDIBBsMPIConnectorClient
+from app.linkage.mpi_cache import CachedMPIConnectorClient
+from app.linkage.mpi_write_behind import WriteBehindMPIConnectorClient
+from app.linkage.trace import LinkageTrace
+from app.linkage.utils import SimilarityCache
 from app.utils import get_settings, read_json_from_assets, run_migrations
 
 # Ensure MPI is configured as expected.
 run_migrations()
 settings = get_settings()
-MPI_CLIENT = DIBBsMPIConnectorClient(
-    pool_size=settings["connection_pool_size"],
-    max_overflow=settings["connection_pool_max_overflow"],
-)
+if settings["mpi_write_behind_enabled"]:
+    MPI_CLIENT = WriteBehindMPIConnectorClient(
+        pool_size=settings["connection_pool_size"],
+        max_overflow=settings["connection_pool_max_overflow"],
+        use_linkage_view=settings["mpi_linkage_view_enabled"],
+        journal_path=settings["mpi_write_behind_journal_path"],
+        max_pending=settings["mpi_write_behind_max_pending"],
+        batch_size=settings["mpi_write_behind_batch_size"],
+        flush_interval=settings["mpi_write_behind_flush_interval"],
+    )
+elif settings["mpi_cache_enabled"]:
+    MPI_CLIENT = CachedMPIConnectorClient(
+        pool_size=settings["connection_pool_size"],
+        max_overflow=settings["connection_pool_max_overflow"],
+        refresh_interval=settings["mpi_cache_refresh_interval"],
+        use_linkage_view=settings["mpi_linkage_view_enabled"],
+    )
+else:
+    MPI_CLIENT = DIBBsMPIConnectorClient(
+        pool_size=settings["connection_pool_size"],
+        max_overflow=settings["connection_pool_max_overflow"],
+        use_linkage_view=settings["mpi_linkage_view_enabled"],
+    )
+ASYNC_MPI_CLIENT = None
+if settings["mpi_async_enabled"]:
+    ASYNC_MPI_CLIENT = AsyncDIBBsMPIConnectorClient(
+        pool_size=settings["connection_pool_size"],
+        max_overflow=settings["connection_pool_max_overflow"],
+        use_linkage_view=settings["mpi_linkage_view_enabled"],
+    )
+# Running totals of the counters named in LINKAGE_STATS_KEYS, e.g. how many
+# oversize blocks have been narrowed down or sampled, across every record
+# linked by this instance of the service
+LINKAGE_STATS = {}
+
+# Locks on the blocks of the records being linked, if enabled, so that
+# concurrent records of the same person are linked one after the other
+LINKAGE_LOCKS = None
+if settings["linkage_lock_mode"] == "striped":
+    LINKAGE_LOCKS = StripedLockTable()
+elif settings["linkage_lock_mode"] == "advisory":
+    LINKAGE_LOCKS = AdvisoryLockTable(
+        MPI_CLIENT.dal.engine.url,
+        pool_size=settings["connection_pool_size"],
+        max_overflow=settings["connection_pool_max_overflow"],
+    )
+
+# String similarity scores shared by every linkage request, if enabled
+SIMILARITY_CACHE = None
+if settings["linkage_similarity_cache_size"] > 0:
+    SIMILARITY_CACHE = SimilarityCache(
+        maxsize=settings["linkage_similarity_cache_size"]
+    )
+
 # Instantiate FastAPI via DIBBs' BaseService class
 app = BaseService(
     service_name="DIBBs Record Linkage Service",
@@ -27,6 +96,42 @@ app = BaseService(
     openapi_url="/record-linkage/openapi.json",
 ).start()
 
+# Write any patients still queued by the write-behind MPI client to the MPI
+# before the service stops
+if isinstance(MPI_CLIENT, WriteBehindMPIConnectorClient):
+    app.router.on_shutdown.append(MPI_CLIENT.close)
+
+# Compiled linkage algorithms, keyed by the hash of their configuration, so
+# that each algorithm is validated and bound only once. The DIBBs algorithms
+# are compiled up front; custom configurations are compiled on first use and
+# the least recently used ones evicted once the cache is full.
+COMPILED_ALGORITHM_CACHE_SIZE = 32
+DIBBS_BASIC_COMPILED = CompiledLinkageAlgorithm(DIBBS_BASIC)
+DIBBS_ENHANCED_COMPILED = CompiledLinkageAlgorithm(DIBBS_ENHANCED)
+compiled_algorithms = OrderedDict()
+
+
+def get_compiled_algorithm(algo_config: list[dict]) -> CompiledLinkageAlgorithm:
+    """
+    Returns the compiled form of a linkage algorithm configuration, compiling
+    and caching it if it hasn't been seen recently.
+
+    :param algo_config: An algorithm configuration consisting of a list
+      of dictionaries describing the algorithm to run.
+    :return: The compiled linkage algorithm.
+    :raises ValueError: If the configuration is malformed.
+    """
+    config_hash = hash_linkage_config(algo_config)
+    if config_hash in compiled_algorithms:
+        compiled_algorithms.move_to_end(config_hash)
+        return compiled_algorithms[config_hash]
+
+    compiled = CompiledLinkageAlgorithm(algo_config)
+    compiled_algorithms[config_hash] = compiled
+    if len(compiled_algorithms) > COMPILED_ALGORITHM_CACHE_SIZE:
+        compiled_algorithms.popitem(last=False)
+    return compiled
+
 
 # Request and response models
 class LinkRecordInput(BaseModel):
@@ -59,6 +164,13 @@ class LinkRecordInput(BaseModel):
         " for a unique patient/person that is linked to patient(s)",
         default=None,
     )
+    include_trace: Optional[bool] = Field(
+        description="Optionally, a boolean flag indicating whether to return a trace "
+        "of how the record was linked: the block fetched in each linkage pass, the "
+        "time spent fetching and scoring it, the belongingness ratio of each person "
+        "evaluated and the per-feature scores of a sample of record comparisons.",
+        default=False,
+    )
 
 
 class LinkRecordResponse(BaseModel):
@@ -81,6 +193,80 @@ class LinkRecordResponse(BaseModel):
         "not run successfully containing a description of the error that happened.",
         default="",
     )
+    trace: Optional[dict] = Field(
+        description="If include_trace is true, a trace of how the record was linked.",
+        default=None,
+    )
+
+
+class LinkRecordsEntry(BaseModel):
+    """
+    Schema for a single record in a request to the /link-records endpoint.
+    """
+
+    bundle: dict = Field(
+        description="A FHIR bundle containing a patient resource to be checked "
+        "for links to existing patient records"
+    )
+    external_person_id: Optional[str] = Field(
+        description="The External Identifier, provided by the client,"
+        " for a unique patient/person that is linked to patient(s)",
+        default=None,
+    )
+
+
+class LinkRecordsInput(BaseModel):
+    """
+    Schema for requests to the /link-records endpoint.
+    """
+
+    records: list[LinkRecordsEntry] = Field(
+        description="The records to link, in the order they should be linked. "
+        "A record may link to a record earlier in the same request."
+    )
+    use_enhanced: Optional[bool] = Field(
+        description="Optionally, a boolean flag indicating whether to use the "
+        "DIBBs enhanced algorithm (with statistical correction) for record linkage. "
+        "See the /link-record endpoint.",
+        default=False,
+    )
+    algo_config: Optional[dict] = Field(
+        description="A JSON dictionary containing the specification for a "
+        "linkage algorithm. See the /link-record endpoint.",
+        default={},
+    )
+
+
+class LinkRecordsResult(BaseModel):
+    """
+    The schema for the result of linking a single record in a response from
+    the /link-records endpoint.
+    """
+
+    found_match: bool = Field(
+        description="A true value indicates that one or more existing records "
+        "matched with the provided record, and these results have been linked."
+    )
+    updated_bundle: dict = Field(
+        description="The FHIR bundle with a reference to the Person resource "
+        "the record was linked to, as returned by the /link-record endpoint."
+    )
+
+
+class LinkRecordsResponse(BaseModel):
+    """
+    The schema for responses from the /link-records endpoint.
+    """
+
+    results: list[LinkRecordsResult] = Field(
+        description="The result of linking each record, in the order the records "
+        "were supplied."
+    )
+    message: Optional[str] = Field(
+        description="An optional message in the case that the linkage endpoint did "
+        "not run successfully containing a description of the error that happened.",
+        default="",
+    )
 
 
 class HealthCheckResponse(BaseModel):
@@ -112,6 +298,27 @@ async def health_check() -> HealthCheckResponse:
     return {"status": "OK", "mpi_connection_status": "OK"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    """
+    This endpoint reports where the time spent linking records goes, in the
+    Prometheus text exposition format. For each stage of linkage (binding
+    the algorithm configuration, extracting blocking values, fetching,
+    grouping and flattening blocks, comparing records and inserting them)
+    it reports the number of times the stage ran, its total time and the
+    50th, 95th and 99th percentiles of its recent durations. The linkage
+    counters tallied since the service started, e.g. the number of record
+    comparisons skipped, are reported alongside, as are the patients queued
+    and written by the write-behind MPI client, if it's enabled.
+    """
+    metrics = TIMINGS.to_prometheus() + format_counters(LINKAGE_STATS)
+    if isinstance(MPI_CLIENT, WriteBehindMPIConnectorClient):
+        metrics += format_counters(
+            MPI_CLIENT.write_stats, prefix="record_linkage_write_behind"
+        )
+    return PlainTextResponse(metrics, media_type="text/plain; version=0.0.4")
+
+
 # Sample requests and responses for docs
 sample_link_record_requests = read_json_from_assets("sample_link_record_requests.json")
 sample_link_record_responses = read_json_from_assets(
@@ -153,11 +360,21 @@ async def link_record(
     # Check for enhanced algo before checking custom algo
     use_enhanced = input.get("use_enhanced", False)
     if use_enhanced:
-        algo_config = DIBBS_ENHANCED
+        algo_config = DIBBS_ENHANCED_COMPILED
     else:
         algo_config = input.get("algo_config", {}).get("algorithm", [])
         if algo_config == []:
-            algo_config = DIBBS_BASIC
+            algo_config = DIBBS_BASIC_COMPILED
+        else:
+            try:
+                algo_config = get_compiled_algorithm(algo_config)
+            except ValueError as err:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {
+                    "found_match": False,
+                    "updated_bundle": input_bundle,
+                    "message": f"Invalid algorithm configuration: {err}",
+                }
 
     # Now extract the patient record we want to link
     try:
@@ -174,20 +391,54 @@ async def link_record(
             "message": "Supplied bundle contains no Patient resource to link on.",
         }
 
+    # Trace the linkage if the request asks for it, or if the request is
+    # sampled for tracing
+    include_trace = input.get("include_trace", False)
+    trace = None
+    if include_trace or random.random() < settings["linkage_trace_sample_rate"]:
+        trace = LinkageTrace(max_comparisons=settings["linkage_trace_max_comparisons"])
+
     # Now link the record
     try:
         # Make a copy of record_to_link so we don't modify the original
         record = copy.deepcopy(record_to_link)
-        (found_match, new_person_id) = link_record_against_mpi(
-            record=record,
-            algo_config=algo_config,
-            external_person_id=external_id,
-            mpi_client=MPI_CLIENT,
-        )
+        if ASYNC_MPI_CLIENT is not None:
+            found_match, new_person_id = await link_record_against_mpi_async(
+                record=record,
+                algo_config=algo_config,
+                external_person_id=external_id,
+                mpi_client=ASYNC_MPI_CLIENT,
+                linkage_stats=LINKAGE_STATS,
+                max_block_size=settings["linkage_max_block_size"],
+                estimate_block_size=settings["linkage_estimate_block_size"],
+                similarity_cache=SIMILARITY_CACHE,
+                trace=trace,
+                locks=LINKAGE_LOCKS,
+            )
+        else:
+            found_match, new_person_id = link_record_against_mpi(
+                record=record,
+                algo_config=algo_config,
+                external_person_id=external_id,
+                mpi_client=MPI_CLIENT,
+                linkage_stats=LINKAGE_STATS,
+                parallel_passes=settings["linkage_parallel_passes"],
+                max_block_size=settings["linkage_max_block_size"],
+                estimate_block_size=settings["linkage_estimate_block_size"],
+                similarity_cache=SIMILARITY_CACHE,
+                trace=trace,
+                locks=LINKAGE_LOCKS,
+            )
         updated_bundle = add_person_resource(
             new_person_id, record_to_link.get("id", ""), input_bundle
         )
-        return {"found_match": found_match, "updated_bundle": updated_bundle}
+        result = {"found_match": found_match, "updated_bundle": updated_bundle}
+        if trace is not None:
+            if include_trace:
+                result["trace"] = trace.to_dict()
+            else:
+                logging.info(f"Linkage trace: {json.dumps(trace.to_dict())}")
+        return result
 
     except ValueError as err:
         response.status_code = status.HTTP_400_BAD_REQUEST
@@ -196,3 +447,105 @@ async def link_record(
             "updated_bundle": input_bundle,
             "message": f"Could not connect to database: {err}",
         }
+
+
+@app.post("/link-records", status_code=200)
+async def link_records(
+    input: LinkRecordsInput,
+    response: Response,
+) -> LinkRecordsResponse:
+    """
+    This endpoint links a batch of FHIR bundles against the MPI, with the same
+    results as submitting each bundle to the /link-record endpoint in turn,
+    but with far fewer round trips to the MPI. Blocks for all records are
+    fetched together, records are linked in order (so a record may link to
+    one earlier in the batch), and all of the patients are written to the
+    MPI in a single transaction.
+    """
+
+    input = dict(input)
+    entries = input.get("records", [])
+
+    # Check that DB type is appropriately set up as Postgres so
+    # we can fail fast if it's not
+    db_type = get_settings().get("mpi_db_type", "")
+    if db_type != "postgres":
+        response.status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+        return {
+            "results": [],
+            "message": f"Unsupported database type {db_type} supplied. "
+            + "Make sure your environment variables include an entry "
+            + "for `mpi_db_type` and that it is set to 'postgres'.",
+        }
+
+    # Determine which algorithm to use; default is DIBBS basic
+    # Check for enhanced algo before checking custom algo
+    use_enhanced = input.get("use_enhanced", False)
+    if use_enhanced:
+        algo_config = DIBBS_ENHANCED_COMPILED
+    else:
+        algo_config = input.get("algo_config", {}).get("algorithm", [])
+        if algo_config == []:
+            algo_config = DIBBS_BASIC_COMPILED
+        else:
+            try:
+                algo_config = get_compiled_algorithm(algo_config)
+            except ValueError as err:
+                response.status_code = status.HTTP_400_BAD_REQUEST
+                return {
+                    "results": [],
+                    "message": f"Invalid algorithm configuration: {err}",
+                }
+
+    # Now extract the patient record we want to link from each bundle
+    records_to_link = []
+    for i, entry in enumerate(entries):
+        try:
+            records_to_link.append(
+                [
+                    resource.get("resource")
+                    for resource in entry.bundle.get("entry", [])
+                    if resource.get("resource", {}).get("resourceType", "") == "Patient"
+                ][0]
+            )
+        except IndexError:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return {
+                "results": [],
+                "message": f"Supplied bundle {i} contains no Patient resource "
+                + "to link on.",
+            }
+
+    # Now link the records
+    try:
+        # Make copies of records_to_link so we don't modify the originals
+        records = copy.deepcopy(records_to_link)
+        linkage_results = link_records_against_mpi(
+            records=records,
+            algo_config=algo_config,
+            external_person_ids=[entry.external_person_id for entry in entries],
+            mpi_client=MPI_CLIENT,
+            linkage_stats=LINKAGE_STATS,
+            max_block_size=settings["linkage_max_block_size"],
+            estimate_block_size=settings["linkage_estimate_block_size"],
+            similarity_cache=SIMILARITY_CACHE,
+            locks=LINKAGE_LOCKS,
+        )
+        results = []
+        for entry, record, (found_match, person_id) in zip(
+            entries, records_to_link, linkage_results
+        ):
+            updated_bundle = add_person_resource(
+                person_id, record.get("id", ""), entry.bundle
+            )
+            results.append(
+                {"found_match": found_match, "updated_bundle": updated_bundle}
+            )
+        return {"results": results}
+
+    except ValueError as err:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return {
+            "results": [],
+            "message": f"Could not connect to database: {err}",
+        }
@@ -146,6 +146,7 @@ def _clean_up(dal: DataAccessLayer | None = None) -> None:
     if dal is None:
         dal = DIBBsMPIConnectorClient().dal
     with dal.engine.connect() as pg_connection:
+        pg_connection.execute(text("""DROP TABLE IF EXISTS linkage_view CASCADE;"""))
         pg_connection.execute(text("""DROP TABLE IF EXISTS external_person CASCADE;"""))
         pg_connection.execute(text("""DROP TABLE IF EXISTS external_source CASCADE;"""))
         pg_connection.execute(text("""DROP TABLE IF EXISTS address CASCADE;"""))
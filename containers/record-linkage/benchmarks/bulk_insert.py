@@ -0,0 +1,142 @@
+"""
+Benchmarks the rate at which `DataAccessLayer.bulk_insert_dict` writes the MPI
+records of synthetic patients, against the previous implementation that
+compiled every record into a literal-bound INSERT statement and executed them
+as a single `;`-joined script.
+
+Run from `containers/record-linkage/` against a disposable MPI database
+configured through the usual `mpi_*` environment variables, e.g.:
+
+    python -m benchmarks.bulk_insert --patients 100 1000 10000
+
+Every table in the MPI is truncated between runs.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import pathlib
+import time
+import uuid
+
+from app.linkage.dal import DataAccessLayer
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.utils import run_migrations
+from sqlalchemy import text
+from tabulate import tabulate
+
+PATIENT_RESOURCE = json.load(
+    open(
+        pathlib.Path(__file__).parent.parent
+        / "assets"
+        / "general"
+        / "patient_resource_w_extensions.json"
+    )
+)
+
+
+def legacy_bulk_insert_dict(dal: DataAccessLayer, records_with_table: dict) -> None:
+    """
+    The previous `bulk_insert_dict` write path: each record is compiled into
+    a literal-bound INSERT statement and all of the statements are executed
+    as one script.
+    """
+    statements = []
+    for table in dal.TABLE_LIST:
+        for record in records_with_table.get(table.name, []):
+            record = dict(record)
+            if record.get("dob") is not None:
+                record["dob"] = datetime.datetime.strptime(record["dob"], "%Y-%m-%d")
+            statement = table.insert().values(**record)
+            statement = statement.compile(
+                dal.engine,
+                compile_kwargs={"literal_binds": True, "render_postprocess": str},
+            )
+            statements.append(str(statement))
+    with dal.transaction() as session:
+        session.execute(text(";".join(statements)))
+
+
+def generate_mpi_records(mpi_client: DIBBsMPIConnectorClient, n_patients: int):
+    """
+    Builds the MPI records of `n_patients` synthetic patients, each linked
+    to a new person, grouped by table.
+    """
+    records_with_table = {"person": []}
+    for i in range(n_patients):
+        patient = copy.deepcopy(PATIENT_RESOURCE)
+        patient["id"] = str(uuid.uuid4())
+        patient["person"] = str(uuid.uuid4())
+        patient["name"][0]["family"] = f"{patient['name'][0]['family']}-{i}"
+        records_with_table["person"].append({"person_id": patient["person"]})
+        for table_name, records in mpi_client._get_mpi_records(patient).items():
+            records_with_table.setdefault(table_name, []).extend(records)
+    return records_with_table
+
+
+def truncate_mpi(dal: DataAccessLayer) -> None:
+    """
+    Removes every patient and person from the MPI.
+    """
+    tables = ", ".join(
+        table.name for table in dal.TABLE_LIST if table.name != "external_source"
+    )
+    with dal.transaction() as session:
+        session.execute(text(f"TRUNCATE {tables} CASCADE"))
+
+
+def run_benchmark(patient_counts: list[int], repeat: int) -> list[list]:
+    """
+    Times both write paths for each number of patients, returning one row
+    of results per write path and number of patients.
+    """
+    run_migrations()
+    mpi_client = DIBBsMPIConnectorClient()
+    dal = mpi_client.dal
+    write_paths = {
+        "literal SQL script": lambda records: legacy_bulk_insert_dict(dal, records),
+        "bulk_insert_dict": lambda records: dal.bulk_insert_dict(records),
+    }
+
+    results = []
+    for n_patients in patient_counts:
+        for name, write_path in write_paths.items():
+            timings = []
+            for _ in range(repeat):
+                records_with_table = generate_mpi_records(mpi_client, n_patients)
+                n_rows = sum(len(records) for records in records_with_table.values())
+                truncate_mpi(dal)
+                start = time.perf_counter()
+                write_path(records_with_table)
+                timings.append(time.perf_counter() - start)
+            truncate_mpi(dal)
+            best = min(timings)
+            results.append(
+                [name, n_patients, n_rows, round(best, 3), round(n_rows / best)]
+            )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--patients",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="The numbers of patients to insert in each run",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="The number of runs per write path, of which the fastest is reported",
+    )
+    args = parser.parse_args()
+    print(
+        tabulate(
+            run_benchmark(args.patients, args.repeat),
+            headers=["write path", "patients", "rows", "seconds", "rows/sec"],
+        )
+    )
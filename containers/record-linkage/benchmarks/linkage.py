@@ -0,0 +1,454 @@
+"""
+Benchmarks the rate at which `link_record_against_mpi` links incoming
+records against an MPI seeded with synthetic patients, for the DIBBs basic
+and enhanced algorithms.
+
+The MPI is seeded with persons generated reproducibly from a random seed,
+each with one to three patient records that vary slightly from each other,
+converted to FHIR with `app.linkage.seed.convert_to_patient_fhir_resources`.
+Incoming records are then replayed against it: some are new variants of
+seeded persons, which should link to them, and the rest are new persons.
+For each algorithm and MPI size, the benchmark reports the records linked
+per second, percentiles of the latency of linking a record, the mean and
+largest number of MPI rows fetched in each linkage pass, and how many
+records linked to the person they were generated from.
+
+Run from `containers/record-linkage/` against a disposable MPI database
+configured through the usual `mpi_*` environment variables, e.g.:
+
+    python -m benchmarks.linkage --patients 10000 100000 --records 1000 \
+        --output results.json --baseline previous-results.json
+
+Every table in the MPI is truncated and reseeded before each algorithm is
+run, so that every algorithm sees the same MPI. Results can be written to a
+JSON file and compared against those of an earlier run.
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+from datetime import date, timedelta
+
+from app.linkage.algorithms import DIBBS_BASIC, DIBBS_ENHANCED
+from app.linkage.link import CompiledLinkageAlgorithm, link_record_against_mpi
+from app.linkage.metrics import TIMINGS, StageTimings
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.seed import convert_to_patient_fhir_resources
+from app.linkage.trace import LinkageTrace
+from app.utils import run_migrations
+from tabulate import tabulate
+
+from benchmarks.bulk_insert import truncate_mpi
+
+ALGORITHMS = {"DIBBS_BASIC": DIBBS_BASIC, "DIBBS_ENHANCED": DIBBS_ENHANCED}
+
+# Namespace of the person IDs of seeded persons, which are derived from the
+# random seed and the number of the person so that they needn't be stored
+PERSON_NAMESPACE = uuid.UUID("6f0c3f52-52e4-4a3d-8a39-1c6f4c0d6a7e")
+
+FIRST_NAMES = (
+    "James Mary John Patricia Robert Jennifer Michael Linda William Elizabeth "
+    "David Barbara Richard Susan Joseph Jessica Thomas Sarah Charles Karen "
+    "Daniel Nancy Matthew Lisa Anthony Betty Mark Margaret Jose Sandra Luis "
+    "Maria Carlos Ana Juan Rosa Wei Mei Hiroshi Yuki Ahmed Fatima Kwame Ama"
+).split()
+LAST_NAME_PARTS = (
+    "and ber son mar ti nez lo gan wick ford ham ley ros al ver kin sh ell ma ton"
+).split()
+STREETS = [
+    "Main St",
+    "Oak Ave",
+    "Pine Rd",
+    "Maple Dr",
+    "Cedar Ln",
+    "Elm St",
+    "Washington Blvd",
+    "Lake View Dr",
+    "Hill St",
+    "Park Ave",
+    "River Rd",
+]
+CITIES = [
+    ("Los Angeles", "CA", "900"),
+    ("Chicago", "IL", "606"),
+    ("Houston", "TX", "770"),
+    ("Phoenix", "AZ", "850"),
+    ("Philadelphia", "PA", "191"),
+    ("Atlanta", "GA", "303"),
+    ("Seattle", "WA", "981"),
+    ("Denver", "CO", "802"),
+]
+
+
+def generate_person(seed: int, person_number: int) -> dict:
+    """
+    Generates the demographics of a synthetic person, the same for a given
+    seed and person number.
+    """
+    rng = random.Random(f"{seed}-{person_number}")
+    city, state, zip_prefix = rng.choice(CITIES)
+    last_name = "".join(rng.choice(LAST_NAME_PARTS) for _ in range(rng.randint(2, 3)))
+    birthdate = date(1930, 1, 1) + timedelta(days=rng.randrange(90 * 365))
+    return {
+        "person_id": str(person_uuid(seed, person_number)),
+        "mrn": f"{rng.randrange(10**8):08d}",
+        "ssn": f"{rng.randrange(10**9):09d}",
+        "first_name": rng.choice(FIRST_NAMES),
+        "middle_name": rng.choice(FIRST_NAMES) if rng.random() < 0.3 else None,
+        "last_name": last_name.capitalize(),
+        "home_phone": f"{rng.randrange(10**10):010d}",
+        "cell_phone": f"{rng.randrange(10**10):010d}",
+        "email": f"person{person_number}@example.com",
+        "sex": rng.choice(["male", "female"]),
+        "birthdate": birthdate.isoformat(),
+        "address": f"{rng.randint(1, 9999)} {rng.choice(STREETS)}",
+        "city": city,
+        "state": state,
+        "zip": f"{zip_prefix}{rng.randrange(100):02d}",
+    }
+
+
+def generate_variant(rng: random.Random, person: dict) -> dict:
+    """
+    Generates a record of a person that varies slightly from its
+    demographics: a typo in a name, or a new address.
+    """
+    variant = dict(person)
+    change = rng.random()
+    if change < 0.4:
+        variant["first_name"] = _typo(rng, variant["first_name"])
+    elif change < 0.7:
+        variant["last_name"] = _typo(rng, variant["last_name"])
+    elif change < 0.85:
+        variant["address"] = f"{rng.randint(1, 9999)} {rng.choice(STREETS)}"
+    return variant
+
+
+def person_uuid(seed: int, person_number: int) -> uuid.UUID:
+    """
+    Returns the person ID of a seeded person.
+    """
+    return uuid.uuid5(PERSON_NAMESPACE, f"{seed}-{person_number}")
+
+
+def to_patient_resource(data: dict) -> dict:
+    """
+    Converts synthetic demographics to a FHIR patient resource.
+    """
+    _, bundle = convert_to_patient_fhir_resources(data)
+    return bundle["entry"][0]["resource"]
+
+
+def seed_mpi(
+    mpi_client: DIBBsMPIConnectorClient, n_patients: int, seed: int, chunk_size: int
+) -> int:
+    """
+    Seeds the MPI with `n_patients` patients belonging to synthetic persons,
+    inserted in batches of `chunk_size`, and returns the number of persons.
+    """
+    patients = []
+    person_ids = []
+    n_persons = 0
+    n_seeded = 0
+    while n_seeded < n_patients:
+        person = generate_person(seed, n_persons)
+        rng = random.Random(f"{seed}-{n_persons}-records")
+        for k in range(min(rng.randint(1, 3), n_patients - n_seeded)):
+            data = person if k == 0 else generate_variant(rng, person)
+            patients.append(to_patient_resource(data))
+            person_ids.append(person_uuid(seed, n_persons))
+            n_seeded += 1
+        n_persons += 1
+        if len(patients) >= chunk_size or n_seeded == n_patients:
+            mpi_client.insert_matched_patients(patients, person_ids)
+            patients = []
+            person_ids = []
+    return n_persons
+
+
+def generate_incoming_records(
+    n_records: int, n_persons: int, seed: int, match_rate: float
+) -> list[tuple]:
+    """
+    Generates the records to replay against a seeded MPI, each paired with
+    the ID of the person it should link to, or None for a new person.
+    """
+    rng = random.Random(f"{seed}-incoming")
+    records = []
+    for k in range(n_records):
+        if rng.random() < match_rate:
+            person_number = rng.randrange(n_persons)
+            data = generate_variant(rng, generate_person(seed, person_number))
+            expected = person_uuid(seed, person_number)
+        else:
+            data = generate_person(seed, n_persons + k)
+            expected = None
+        records.append((to_patient_resource(data), expected))
+    return records
+
+
+def replay(
+    mpi_client: DIBBsMPIConnectorClient,
+    algorithm: CompiledLinkageAlgorithm,
+    records: list[tuple],
+    max_block_size: int = None,
+) -> dict:
+    """
+    Links each incoming record in turn, returning the throughput, latency,
+    rows fetched per pass and accuracy of linkage.
+    """
+    latencies = StageTimings(window=len(records))
+    n_passes = len(algorithm.passes)
+    rows_per_pass = [[] for _ in range(n_passes)]
+    matched = 0
+    correct = 0
+    TIMINGS.reset()
+    start = time.perf_counter()
+    for record, expected in records:
+        trace = LinkageTrace(max_comparisons=0)
+        with latencies.span("link_record"):
+            found_match, person_id = link_record_against_mpi(
+                record,
+                algorithm,
+                mpi_client=mpi_client,
+                max_block_size=max_block_size,
+                trace=trace,
+            )
+        for traced_pass in trace.passes:
+            rows_per_pass[traced_pass["pass"]].append(traced_pass["block_size"] or 0)
+        matched += found_match
+        correct += found_match and str(person_id) == str(expected)
+    seconds = time.perf_counter() - start
+
+    latency = latencies.summary()["link_record"]
+    return {
+        "records": len(records),
+        "seconds": seconds,
+        "records_per_sec": len(records) / seconds,
+        "latency_ms": {
+            q: latency[q] * 1000 for q in ["p50", "p95", "p99"] if q in latency
+        },
+        "mean_rows_per_pass": [sum(r) / max(len(r), 1) for r in rows_per_pass],
+        "max_rows_per_pass": [max(r, default=0) for r in rows_per_pass],
+        "matched": matched,
+        "correctly_matched": correct,
+        "expected_matches": sum(expected is not None for _, expected in records),
+        "stages": TIMINGS.summary(),
+    }
+
+
+def run_benchmark(
+    patient_counts: list[int],
+    algorithms: list[str],
+    n_records: int,
+    seed: int,
+    match_rate: float,
+    chunk_size: int,
+    max_block_size: int = None,
+    use_linkage_view: bool = False,
+) -> list[dict]:
+    """
+    Seeds the MPI and replays incoming records for each number of patients
+    and algorithm, returning one result per run.
+    """
+    run_migrations()
+    mpi_client = DIBBsMPIConnectorClient(use_linkage_view=use_linkage_view)
+    results = []
+    for n_patients in patient_counts:
+        for name in algorithms:
+            truncate_mpi(mpi_client.dal)
+            start = time.perf_counter()
+            n_persons = seed_mpi(mpi_client, n_patients, seed, chunk_size)
+            seed_seconds = time.perf_counter() - start
+            records = generate_incoming_records(n_records, n_persons, seed, match_rate)
+            result = replay(
+                mpi_client,
+                CompiledLinkageAlgorithm(ALGORITHMS[name]),
+                records,
+                max_block_size,
+            )
+            results.append(
+                {
+                    "algorithm": name,
+                    "patients": n_patients,
+                    "persons": n_persons,
+                    "seed_seconds": seed_seconds,
+                    **result,
+                }
+            )
+    truncate_mpi(mpi_client.dal)
+    return results
+
+
+def compare_to_baseline(results: list[dict], baseline: list[dict]) -> list[list]:
+    """
+    Compares the throughput and tail latency of each run with the run of the
+    same algorithm and number of patients in a baseline, returning one row
+    per run found in both.
+    """
+    baseline_runs = {(r["algorithm"], r["patients"]): r for r in baseline}
+    rows = []
+    for result in results:
+        before = baseline_runs.get((result["algorithm"], result["patients"]))
+        if before is None:
+            continue
+        rows.append(
+            [
+                result["algorithm"],
+                result["patients"],
+                round(before["records_per_sec"], 1),
+                round(result["records_per_sec"], 1),
+                _percent_change(before["records_per_sec"], result["records_per_sec"]),
+                round(before["latency_ms"]["p95"], 2),
+                round(result["latency_ms"]["p95"], 2),
+                _percent_change(
+                    before["latency_ms"]["p95"], result["latency_ms"]["p95"]
+                ),
+            ]
+        )
+    return rows
+
+
+def _typo(rng: random.Random, value: str) -> str:
+    """
+    Helper method that introduces a typo into a string: a character is
+    dropped, repeated, or swapped with the next one.
+    """
+    if len(value) < 3:
+        return value
+    i = rng.randrange(1, len(value) - 1)
+    typo = rng.choice(["drop", "repeat", "swap"])
+    if typo == "drop":
+        return value[:i] + value[i + 1 :]
+    if typo == "repeat":
+        return value[: i + 1] + value[i:]
+    return value[:i] + value[i + 1] + value[i] + value[i + 2 :]
+
+
+def _percent_change(before: float, after: float) -> str:
+    """
+    Helper method that formats the change from one value to another as a
+    signed percentage.
+    """
+    if before == 0:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--patients",
+        type=int,
+        nargs="+",
+        default=[10000],
+        help="The numbers of patients to seed the MPI with in each run",
+    )
+    parser.add_argument(
+        "--algorithms",
+        nargs="+",
+        choices=list(ALGORITHMS),
+        default=list(ALGORITHMS),
+        help="The linkage algorithms to benchmark",
+    )
+    parser.add_argument(
+        "--records",
+        type=int,
+        default=1000,
+        help="The number of incoming records to link in each run",
+    )
+    parser.add_argument(
+        "--match-rate",
+        type=float,
+        default=0.5,
+        help="The fraction of incoming records that are variants of seeded persons",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="The seed of the synthetic data"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=10000,
+        help="The number of patients inserted per transaction when seeding",
+    )
+    parser.add_argument(
+        "--max-block-size",
+        type=int,
+        default=None,
+        help="The most patients a block may hold, as LINKAGE_MAX_BLOCK_SIZE",
+    )
+    parser.add_argument(
+        "--linkage-view",
+        action="store_true",
+        help="Fetch blocks from the linkage view, as MPI_LINKAGE_VIEW_ENABLED",
+    )
+    parser.add_argument(
+        "--output", help="A JSON file to write the results of every run to"
+    )
+    parser.add_argument(
+        "--baseline", help="A JSON file of earlier results to compare against"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.patients,
+        args.algorithms,
+        args.records,
+        args.seed,
+        args.match_rate,
+        args.chunk_size,
+        args.max_block_size,
+        args.linkage_view,
+    )
+    print(
+        tabulate(
+            [
+                [
+                    r["algorithm"],
+                    r["patients"],
+                    round(r["records_per_sec"], 1),
+                    round(r["latency_ms"]["p50"], 2),
+                    round(r["latency_ms"]["p95"], 2),
+                    round(r["latency_ms"]["p99"], 2),
+                    " / ".join(f"{rows:.1f}" for rows in r["mean_rows_per_pass"]),
+                    f"{r['correctly_matched']}/{r['expected_matches']}",
+                ]
+                for r in results
+            ],
+            headers=[
+                "algorithm",
+                "patients",
+                "records/sec",
+                "p50 ms",
+                "p95 ms",
+                "p99 ms",
+                "rows per pass",
+                "correct matches",
+            ],
+        )
+    )
+    if args.output is not None:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        print()
+        print(
+            tabulate(
+                compare_to_baseline(results, baseline),
+                headers=[
+                    "algorithm",
+                    "patients",
+                    "baseline records/sec",
+                    "records/sec",
+                    "change",
+                    "baseline p95 ms",
+                    "p95 ms",
+                    "change",
+                ],
+            )
+        )
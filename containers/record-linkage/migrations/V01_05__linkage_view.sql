@@ -0,0 +1,61 @@
+BEGIN;
+
+/*
+
+LINKAGE VIEW
+
+A denormalized copy of the MPI holding exactly the columns record linkage compares,
+with one row per combination of a patient's MRN, name and address, as the block
+query over the normalized tables returns them. Blocks can then be fetched from this
+single table with index scans, rather than joining five tables and aggregating the
+given names on every lookup. Rows are written by the service in the same transaction
+as the patients they copy; patients are never updated once inserted.
+
+The table is only written to by instances of the service that fetch blocks from it
+(MPI_LINKAGE_VIEW_ENABLED), so deployments that don't use it pay nothing to keep it.
+It's created empty: patients already in the MPI, or inserted while the view wasn't in
+use, are copied in by the service when the view is enabled, in batches of patients
+each committed on its own, rather than here in a single transaction that would hold
+up start-up on a large MPI.
+
+*/
+CREATE TABLE IF NOT EXISTS linkage_view (
+    linkage_view_id UUID DEFAULT uuid_generate_v4 (),
+    patient_id UUID,
+    person_id UUID,
+    birthdate DATE,
+    sex VARCHAR(7),
+    mrn VARCHAR(255),
+    last_name VARCHAR(255),
+    given_name TEXT[],
+    given_name_first4 TEXT[],
+    address VARCHAR(100),
+    zip VARCHAR(10),
+    city VARCHAR(255),
+    state VARCHAR(100),
+    PRIMARY KEY (linkage_view_id),
+    CONSTRAINT fk_linkage_view_to_patient FOREIGN KEY(patient_id) REFERENCES patient(patient_id)
+);
+
+CREATE INDEX IF NOT EXISTS linkage_view_patient_id_index ON linkage_view (patient_id);
+
+/*
+
+BLOCKING INDEXES
+
+The blocking expressions indexed in V01_02, on the linkage view. The patient ID is
+included so that the patients in a block are found from the index alone.
+
+*/
+
+-- Block 1 - First 4 characters of address and last 4 characters of MRN
+CREATE INDEX IF NOT EXISTS linkage_view_address_index ON linkage_view (left(address, 4)) INCLUDE (patient_id);
+
+CREATE INDEX IF NOT EXISTS linkage_view_mrn_index ON linkage_view (right(mrn, 4)) INCLUDE (patient_id);
+
+-- Block 2 - First 4 characters of last name and first 4 characters of any first name
+CREATE INDEX IF NOT EXISTS linkage_view_last_name_index ON linkage_view (left(last_name, 4)) INCLUDE (patient_id);
+
+CREATE INDEX IF NOT EXISTS linkage_view_given_name_first4_index ON linkage_view USING GIN (given_name_first4);
+
+COMMIT;
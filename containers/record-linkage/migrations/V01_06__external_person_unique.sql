@@ -0,0 +1,24 @@
+BEGIN;
+
+/*
+
+UNIQUE EXTERNAL PERSON IDS
+
+A person is linked to an external person ID from a given source at most once, so
+external person IDs can be inserted with ON CONFLICT DO NOTHING instead of being
+looked up first. Any duplicate links are removed before the constraint is added.
+
+*/
+
+DELETE FROM external_person AS duplicate
+USING external_person AS original
+WHERE duplicate.person_id = original.person_id
+    AND duplicate.external_person_id = original.external_person_id
+    AND duplicate.external_source_id = original.external_source_id
+    AND duplicate.external_id > original.external_id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS external_person_unique_index ON external_person (
+    person_id, external_person_id, external_source_id
+);
+
+COMMIT;
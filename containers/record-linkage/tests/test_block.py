@@ -0,0 +1,143 @@
+import copy
+import datetime
+import json
+import os
+import pathlib
+import sys
+
+from app.linkage.block import ClusterSummary, MPIBlock
+from app.linkage.dal import DataAccessLayer
+from app.linkage.link import (
+    _convert_given_name_to_first_name,
+    _group_patient_block_by_person,
+)
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.utils import _clean_up
+from sqlalchemy import text
+
+HEADER = ["patient_id", "person_id", "birthdate", "given_name", "last_name"]
+ROWS = [
+    ["p1", "a", datetime.date(1980, 1, 1), ["John", "Q"], "Shepard"],
+    ["p2", "b", None, ["Jane"], "Doe"],
+    ["p3", "a", datetime.date(1980, 1, 1), ["Jon"], "Shepard"],
+]
+
+
+def _init_db() -> DIBBsMPIConnectorClient:
+    os.environ = {
+        "mpi_dbname": "testdb",
+        "mpi_user": "postgres",
+        "mpi_password": "pw",
+        "mpi_host": "localhost",
+        "mpi_port": "5432",
+        "mpi_db_type": "postgres",
+    }
+
+    dal = DataAccessLayer()
+    dal.get_connection(
+        engine_url="postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+    )
+    _clean_up(dal)
+
+    # load ddl
+    schema_ddl = open(
+        pathlib.Path(__file__).parent.parent.parent.parent
+        / "containers"
+        / "record-linkage"
+        / "migrations"
+        / "V01_01__flat_schema.sql"
+    ).read()
+
+    try:
+        with dal.engine.connect() as db_conn:
+            db_conn.execute(text(schema_ddl))
+            db_conn.commit()
+    except Exception as e:
+        print(e)
+        with dal.engine.connect() as db_conn:
+            db_conn.rollback()
+    dal.initialize_schema()
+
+    return DIBBsMPIConnectorClient()
+
+
+def test_mpi_block():
+    block = MPIBlock(HEADER, ROWS)
+    converted = _convert_given_name_to_first_name([HEADER] + ROWS)
+    assert block.header == converted[0]
+    assert block.to_block_data() == converted
+    assert len(block) == 3
+    assert all(isinstance(row, tuple) for row in block.rows)
+
+    # Rows are grouped by person as they're read
+    expected_clusters = _group_patient_block_by_person(converted[1:])
+    assert {
+        person: [list(row) for row in rows] for person, rows in block.clusters.items()
+    } == expected_clusters
+
+    # Repeated strings are stored once
+    assert block.rows[0][4] is block.rows[2][4]
+    assert block.rows[0][4] is sys.intern("Shepard")
+
+    # The source rows are left as they are
+    assert ROWS[0][3] == ["John", "Q"]
+
+    assert MPIBlock.from_block_data([HEADER]).to_block_data() == [converted[0]]
+    no_given_names = [["patient_id", "person_id", "last_name"], ["p1", "a", "Doe"]]
+    assert MPIBlock.from_block_data(no_given_names).to_block_data() == no_given_names
+
+
+def test_cluster_summary():
+    rows = [
+        ("p1", "a", "John", "Shepard"),
+        ("p2", "a", "Jon", "Shepard"),
+        ("p3", "a", "John", "Shepard"),
+        ("p4", "a", "John", "Shepard"),
+    ]
+    summary = ClusterSummary(rows)
+    assert len(summary) == 4
+    assert summary.variants == [rows[0], rows[1]]
+    assert summary.row_variants == [0, 1, 0, 0]
+    assert summary.counts() == [3, 1]
+
+    block = MPIBlock(HEADER, ROWS)
+    assert block.summary("a").variants == block.clusters["a"]
+    assert block.summary("a") is block.summary("a")
+    assert len(ClusterSummary([])) == 0
+
+
+def test_mpi_block_shared_rows():
+    converted_rows = {}
+    shared_row = ROWS[0]
+    first = MPIBlock(HEADER, [shared_row, ROWS[1]], converted_rows)
+    second = MPIBlock(HEADER, [shared_row, ROWS[2]], converted_rows)
+    assert first.rows[0] is second.rows[0]
+    assert len(converted_rows) == 3
+
+
+def test_get_compact_block_data():
+    MPI = _init_db()
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    for entry in patients["entry"]:
+        if entry.get("resource", {}).get("resourceType", "") == "Patient":
+            MPI.insert_matched_patient(copy.deepcopy(entry["resource"]))
+
+    for block_criteria in [
+        {"last_name": {"value": "Shep", "transformation": "first4"}},
+        {"birthdate": {"value": "2053-11-07"}, "sex": {"value": "male"}},
+        {"zip": {"value": "00000"}},
+    ]:
+        expected = _convert_given_name_to_first_name(MPI.get_block_data(block_criteria))
+        block = MPI.get_compact_block_data(block_criteria)
+        assert block.header == expected[0]
+        assert sorted(map(str, block.to_block_data()[1:])) == sorted(
+            map(str, expected[1:])
+        )
+    _clean_up(MPI.dal)
@@ -0,0 +1,180 @@
+import copy
+import datetime
+import json
+import os
+import pathlib
+import uuid
+
+from app.linkage.blocking_index import BlockingIndex, mpi_records_to_block_rows
+from app.linkage.dal import DataAccessLayer
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.utils import _clean_up
+from sqlalchemy import text
+
+
+def _init_db() -> DataAccessLayer:
+    os.environ = {
+        "mpi_dbname": "testdb",
+        "mpi_user": "postgres",
+        "mpi_password": "pw",
+        "mpi_host": "localhost",
+        "mpi_port": "5432",
+        "mpi_db_type": "postgres",
+    }
+
+    dal = DataAccessLayer()
+    dal.get_connection(
+        engine_url="postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+    )
+    _clean_up(dal)
+
+    # load ddl
+    schema_ddl = open(
+        pathlib.Path(__file__).parent.parent.parent.parent
+        / "containers"
+        / "record-linkage"
+        / "migrations"
+        / "V01_01__flat_schema.sql"
+    ).read()
+
+    try:
+        with dal.engine.connect() as db_conn:
+            db_conn.execute(text(schema_ddl))
+            db_conn.commit()
+    except Exception as e:
+        print(e)
+        with dal.engine.connect() as db_conn:
+            db_conn.rollback()
+    dal.initialize_schema()
+
+    return DIBBsMPIConnectorClient()
+
+
+def _load_patients() -> list[dict]:
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    return [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+
+BLOCK_CRITERIA = [
+    {"first_name": {"value": "John", "transformation": "first4"}},
+    {"last_name": {"value": "Shep", "transformation": "first4"}},
+    {
+        "first_name": {"value": "John", "transformation": "first4"},
+        "last_name": {"value": "Shep", "transformation": "first4"},
+    },
+    {"dob": {"value": "1980-01-01"}, "sex": {"value": "male"}},
+    {"mrn": {"value": "3456", "transformation": "last4"}},
+    {"address": {"value": "1234", "transformation": "first4"}},
+    {"zip": {"value": "10001-0001"}, "city": {"value": "Fakeville"}},
+    {"dob": {"value": "1800-01-01"}},
+]
+
+
+def _load_patients_with_duplicates() -> list[dict]:
+    patients = _load_patients()
+    # A patient with repeated MRNs and addresses, which the block query
+    # collapses into a single row
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    patient["identifier"].append(copy.deepcopy(patient["identifier"][0]))
+    patient["address"].append(copy.deepcopy(patient["address"][0]))
+    return patients + [patient]
+
+
+def test_blocking_index_matches_get_block_data():
+    MPI = _init_db()
+    patients = _load_patients_with_duplicates()
+    MPI.insert_matched_patients(patients, [str(uuid.uuid4()) for _ in patients])
+    index = BlockingIndex(MPI)
+    for patient in patients:
+        index.add_patient(patient)
+    assert len(index) == len(patients)
+
+    for block_criteria in BLOCK_CRITERIA:
+        expected = MPI.get_block_data(block_criteria)
+        rows = index.get_block_rows(block_criteria, expected[0])
+        assert sorted(map(str, rows)) == sorted(map(str, expected[1:]))
+
+    _clean_up(MPI.dal)
+
+
+def test_blocking_index_empty():
+    MPI = _init_db()
+    index = BlockingIndex(MPI)
+    assert len(index) == 0
+    assert index.get_block_rows({"dob": {"value": "1980-01-01"}}, ["patient_id"]) == []
+    _clean_up(MPI.dal)
+
+
+def test_mpi_records_to_block_rows():
+    mpi_client = _init_db()
+    patient = copy.deepcopy(_load_patients()[0])
+    person_id = uuid.uuid4()
+    patient["person"] = str(person_id)
+    patient["address"].append(copy.deepcopy(patient["address"][0]))
+    mpi_records = mpi_client._get_mpi_records(patient)
+    header = ["patient_id", "person_id", "birthdate", "given_name", "address"]
+
+    rows = mpi_records_to_block_rows(mpi_records, header)
+    # Duplicate addresses collapse into a single row, repeating given names
+    assert len(rows) == 1
+    assert str(rows[0][0]) == patient["id"]
+    assert rows[0][1] == person_id
+    assert (
+        rows[0][2]
+        == datetime.datetime.strptime(patient["birthDate"], "%Y-%m-%d").date()
+    )
+    assert rows[0][3] == [
+        given_name for given_name in patient["name"][0]["given"] for _ in range(2)
+    ]
+    assert rows[0][4] == patient["address"][0]["line"][0]
+
+    patient["name"] = []
+    patient["address"] = []
+    rows = mpi_records_to_block_rows(mpi_client._get_mpi_records(patient), header)
+    assert rows == [[rows[0][0], person_id, rows[0][2], [None], None]]
+
+    _clean_up(mpi_client.dal)
+
+
+def test_blocking_index_add_block_rows():
+    MPI = _init_db()
+    patients = _load_patients_with_duplicates()
+    MPI.insert_matched_patients(patients, [str(uuid.uuid4()) for _ in patients])
+    all_rows = MPI.dal.select_results(MPI._get_base_query(), include_col_header=False)
+    index = BlockingIndex(MPI)
+    index.add_block_rows(all_rows)
+    assert index.patient_ids() == {patient["id"] for patient in patients}
+
+    for block_criteria in BLOCK_CRITERIA:
+        expected = MPI.get_block_data(block_criteria)
+        assert index.can_answer(block_criteria)
+        rows = index.get_block_rows(block_criteria, expected[0])
+        assert sorted(map(str, rows)) == sorted(map(str, expected[1:]))
+
+    # Removing a patient removes it from every block it belonged to
+    index.remove_patient(patients[0]["id"])
+    assert patients[0]["id"] not in index
+    assert len(index) == len(patients) - 1
+    for block_criteria in BLOCK_CRITERIA:
+        rows = index.get_block_rows(block_criteria, ["patient_id"])
+        assert uuid.UUID(patients[0]["id"]) not in [row[0] for row in rows]
+    index.remove_patient(patients[0]["id"])
+
+    # Criteria on columns the index doesn't hold can't be answered
+    assert not index.can_answer({"phone_number": {"value": "123-456-7890"}})
+    assert not index.can_answer({"patient_identifier": {"value": "1234567890"}})
+    assert not index.can_answer({"sex": {"value": "male", "transformation": "x"}})
+
+    _clean_up(MPI.dal)
@@ -1,7 +1,10 @@
 import datetime
 import os
 import pathlib
+import uuid
 
+import pytest
+from app.linkage import dal as dal_module
 from app.linkage.dal import DataAccessLayer
 from app.linkage.mpi import DIBBsMPIConnectorClient
 from app.utils import _clean_up
@@ -287,6 +290,24 @@ def test_select_results():
     assert results2[0][2] == datetime.date(1977, 11, 11)
     assert results2[0][3] == "male"
 
+    bound_query = mpi._generate_block_query(
+        {
+            "patient": {
+                "table": dal.PATIENT_TABLE,
+                "criteria": {"dob": {}, "sex": {}},
+            }
+        },
+        select(dal.PATIENT_TABLE),
+        bind_params=True,
+    )
+    results3 = dal.select_results(
+        bound_query,
+        include_col_header=False,
+        params={"patient_dob": "1988-01-01", "patient_sex": "female"},
+    )
+    assert len(results3) == 1
+    assert results3[0][0] == pks[1]
+
     _clean_up(dal)
 
 
@@ -331,3 +352,84 @@ def test_bulk_insert_list():
     assert len(pk_list2) == 0
 
     _clean_up(dal)
+
+
+@pytest.mark.parametrize("copy_threshold", [1000, 2])
+def test_bulk_insert_dict_batches(monkeypatch, copy_threshold):
+    monkeypatch.setattr(dal_module, "COPY_THRESHOLD", copy_threshold)
+    dal = _init_db()
+
+    person_ids = [uuid.uuid4() for _ in range(3)]
+    patient_ids = [uuid.uuid4() for _ in range(3)]
+    name_ids = [uuid.uuid4() for _ in range(3)]
+    records = {
+        "person": [{"person_id": person_id} for person_id in person_ids],
+        "patient": [
+            {
+                "patient_id": patient_id,
+                "person_id": person_id,
+                "dob": "1990-01-0" + str(i + 1),
+                "sex": "female",
+            }
+            for i, (patient_id, person_id) in enumerate(zip(patient_ids, person_ids))
+        ],
+        "name": [
+            {"name_id": name_id, "patient_id": patient_id, "last_name": last_name}
+            for name_id, patient_id, last_name in zip(
+                name_ids, patient_ids, ["O'Brien", "Tab\tbed", "Back\\slash\nline"]
+            )
+        ],
+        # Records without a column take its server default
+        "given_name": [
+            {"name_id": name_ids[0], "given_name": "Ann", "given_name_index": 0},
+            {"name_id": name_ids[1], "given_name": None, "given_name_index": 0},
+            {"name_id": name_ids[2], "given_name": "Bo"},
+        ],
+    }
+    assert dal.bulk_insert_dict(records) == {
+        "person": {"primary_keys": []},
+        "patient": {"primary_keys": []},
+        "name": {"primary_keys": []},
+        "given_name": {"primary_keys": []},
+    }
+
+    patients = dal.select_results(select(dal.PATIENT_TABLE), False)
+    assert [row[0] for row in patients] == patient_ids
+    assert [row[2] for row in patients] == [
+        datetime.date(1990, 1, 1),
+        datetime.date(1990, 1, 2),
+        datetime.date(1990, 1, 3),
+    ]
+    names = dal.select_results(select(dal.NAME_TABLE), False)
+    assert [row[2] for row in names] == ["O'Brien", "Tab\tbed", "Back\\slash\nline"]
+    given_names = dal.select_results(select(dal.GIVEN_NAME_TABLE), False)
+    assert sorted(row[2] or "" for row in given_names) == ["", "Ann", "Bo"]
+    assert all(row[0] is not None for row in given_names)
+
+    _clean_up(dal)
+
+
+def test_bulk_insert_client_side_primary_keys():
+    dal = _init_db()
+
+    existing_person_id = uuid.uuid4()
+    pks = dal.bulk_insert_list(
+        dal.PERSON_TABLE, [{}, {"person_id": existing_person_id}, {}], True
+    )
+    assert len(pks) == 3
+    assert all(isinstance(pk, uuid.UUID) for pk in pks)
+    assert pks[1] == existing_person_id
+    persons = dal.select_results(select(dal.PERSON_TABLE), False)
+    assert [row[0] for row in persons] == pks
+
+    pks = dal.bulk_insert_dict({"person": [{}, {}]}, True)
+    assert len(pks["person"]["primary_keys"]) == 2
+    assert len(dal.select_results(select(dal.PERSON_TABLE), False)) == 5
+
+    with pytest.raises(ValueError) as e:
+        dal.bulk_insert_dict({"person": [{}], "patient": [{"not_a_column": 1}]})
+    assert "Unconsumed column names: not_a_column" in str(e.value)
+    # The failed insert is rolled back as a whole
+    assert len(dal.select_results(select(dal.PERSON_TABLE), False)) == 5
+
+    _clean_up(dal)
@@ -2,22 +2,30 @@ import copy
 import json
 import os
 import pathlib
+import threading
+import time
 import uuid
 from datetime import date, datetime
 from json.decoder import JSONDecodeError
 
 import pytest
 from app.linkage.algorithms import DIBBS_BASIC, DIBBS_ENHANCED
+from app.linkage.block import ClusterSummary
 from app.linkage.dal import DataAccessLayer
 from app.linkage.link import (
+    DEFAULT_REFINE_BLOCKS,
+    CompiledLinkageAlgorithm,
+    CompiledLinkagePass,
     _compare_address_elements,
     _compare_name_elements,
     _condense_extract_address_from_resource,
     _convert_given_name_to_first_name,
+    _eval_record_against_cluster,
     _flatten_patient_resource,
     _get_fuzzy_params,
     _match_within_block_cluster_ratio,
     add_person_resource,
+    blocking_lock_keys,
     eval_log_odds_cutoff,
     eval_perfect_match,
     extract_blocking_values_from_record,
@@ -27,14 +35,19 @@ from app.linkage.link import (
     feature_match_log_odds_exact,
     feature_match_log_odds_fuzzy_compare,
     generate_hash_str,
+    hash_linkage_config,
     link_record_against_mpi,
+    link_records_against_mpi,
     load_json_probs,
     match_within_block,
     read_linkage_config,
     score_linkage_vs_truth,
     write_linkage_config,
 )
+from app.linkage.locks import AdvisoryLockTable, StripedLockTable
 from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.trace import LinkageTrace
+from app.linkage.utils import SimilarityCache
 from app.utils import _clean_up
 from sqlalchemy import select, text
 
@@ -221,6 +234,19 @@ def test_feature_match_fuzzy_string():
     )
 
 
+def test_feature_match_fuzzy_string_with_similarity_cache():
+    cache = SimilarityCache()
+    record_i = ["John", "Shepard", "1980-11-07"]
+    record_j = ["Jon", "Sheperd", date(1980, 11, 7)]
+    cols = {"first": 0, "last": 1, "birthdate": 2}
+    for c in cols:
+        for _ in range(2):
+            assert feature_match_fuzzy_string(
+                record_i, record_j, c, cols, similarity_cache=cache
+            ) == feature_match_fuzzy_string(record_i, record_j, c, cols)
+    assert (cache.hits, cache.misses) == (3, 3)
+
+
 def test_eval_perfect_match():
     assert eval_perfect_match([1, 1, 1])
     assert not eval_perfect_match([1, 1, 0])
@@ -880,6 +906,576 @@ def test_link_record_against_mpi_enhanced_algo():
     _clean_up(MPI.dal)
 
 
+def _group_by_person(person_ids: list) -> list[list[int]]:
+    groups = {}
+    for i, person_id in enumerate(person_ids):
+        groups.setdefault(str(person_id), []).append(i)
+    return sorted(groups.values())
+
+
+@pytest.mark.parametrize("algorithm", [DIBBS_BASIC, DIBBS_ENHANCED])
+def test_link_records_against_mpi(algorithm):
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    patient0_copy = copy.deepcopy(patients[0])
+    patient0_copy["id"] = str(uuid.uuid4())
+    patient0_copy["name"][0]["given"][0] = "Jhon"
+    patients.append(patient0_copy)
+
+    # Link the records one at a time
+    MPI = _init_db()
+    sequential = [
+        link_record_against_mpi(copy.deepcopy(patient), algorithm)
+        for patient in patients
+    ]
+    sequential_rows = {
+        table.name: len(MPI.dal.select_results(select(table))) - 1
+        for table in [MPI.dal.PATIENT_TABLE, MPI.dal.NAME_TABLE, MPI.dal.ADDRESS_TABLE]
+    }
+    _clean_up(MPI.dal)
+
+    # Link all of the records in a single batch, so that every match is
+    # made within the batch
+    MPI = _init_db()
+    linkage_stats = {}
+    similarity_cache = SimilarityCache()
+    batch = link_records_against_mpi(
+        copy.deepcopy(patients),
+        algorithm,
+        linkage_stats=linkage_stats,
+        similarity_cache=similarity_cache,
+    )
+    assert [matched for matched, _ in batch] == [m for m, _ in sequential]
+    assert _group_by_person([p for _, p in batch]) == _group_by_person(
+        [p for _, p in sequential]
+    )
+    assert linkage_stats["record_comparisons"] > 0
+    assert linkage_stats["similarity_cache_misses"] == len(similarity_cache)
+    batch_rows = {
+        table.name: len(MPI.dal.select_results(select(table))) - 1
+        for table in [MPI.dal.PATIENT_TABLE, MPI.dal.NAME_TABLE, MPI.dal.ADDRESS_TABLE]
+    }
+    assert batch_rows == sequential_rows
+    patient_records = MPI.dal.select_results(select(MPI.dal.PATIENT_TABLE))
+    assert _group_by_person([row[1] for row in patient_records[1:]]) == (
+        _group_by_person([p for _, p in batch])
+    )
+    _clean_up(MPI.dal)
+
+    # Link half of the records on their own, then the rest as a batch that
+    # links against both the MPI and itself
+    MPI = _init_db()
+    split = len(patients) // 2
+    first = [
+        link_record_against_mpi(copy.deepcopy(patient), algorithm)
+        for patient in patients[:split]
+    ]
+    rest = link_records_against_mpi(copy.deepcopy(patients[split:]), algorithm)
+    assert [m for m, _ in first + rest] == [m for m, _ in sequential]
+    assert _group_by_person([p for _, p in first + rest]) == _group_by_person(
+        [p for _, p in sequential]
+    )
+    _clean_up(MPI.dal)
+
+
+@pytest.mark.parametrize("parallel_passes", [False, True])
+def test_link_record_against_mpi_block_size_limit(parallel_passes):
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    MPI = _init_db()
+    linked = [
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI)
+        for patient in patients
+    ]
+
+    def link_duplicate(algorithm, **kwargs):
+        duplicate = copy.deepcopy(patients[0])
+        duplicate["id"] = str(uuid.uuid4())
+        linkage_stats = {}
+        result = link_record_against_mpi(
+            duplicate,
+            algorithm,
+            mpi_client=MPI,
+            linkage_stats=linkage_stats,
+            parallel_passes=parallel_passes,
+            **kwargs,
+        )
+        return result, linkage_stats
+
+    # Blocks within the limit are fetched as they are
+    result, linkage_stats = link_duplicate(DIBBS_BASIC, max_block_size=100)
+    assert result == (True, linked[0][1])
+    for key in ["oversize_blocks", "blocks_refined", "blocks_sampled"]:
+        assert key not in linkage_stats
+
+    # Oversize blocks are narrowed down with extra blocking fields where
+    # possible, and sampled otherwise
+    result, linkage_stats = link_duplicate(DIBBS_BASIC, max_block_size=2)
+    assert result == (True, linked[0][1])
+    assert linkage_stats["oversize_blocks"] == len(DIBBS_BASIC)
+    assert linkage_stats["blocks_refined"] >= 1
+    assert linkage_stats["blocks_refined"] + linkage_stats.get(
+        "blocks_sampled", 0
+    ) == len(DIBBS_BASIC)
+    result, linkage_stats = link_duplicate(DIBBS_BASIC, max_block_size=1)
+    assert result == (True, linked[0][1])
+    assert linkage_stats["oversize_blocks"] == len(DIBBS_BASIC)
+    assert linkage_stats["blocks_sampled"] == len(DIBBS_BASIC)
+
+    # A pass's own limit takes precedence, and a pass may refine its blocks
+    # with its own fields
+    algorithm = copy.deepcopy(DIBBS_BASIC)
+    for linkage_pass in algorithm:
+        linkage_pass["max_block_size"] = 1
+        linkage_pass["refine_blocks"] = []
+    result, linkage_stats = link_duplicate(algorithm, max_block_size=100)
+    assert result[0]
+    assert linkage_stats["oversize_blocks"] == len(DIBBS_BASIC)
+    assert linkage_stats["blocks_sampled"] == len(DIBBS_BASIC)
+    assert "blocks_refined" not in linkage_stats
+
+    # Planner estimates are only used to decide whether a block is oversize
+    result, _ = link_duplicate(
+        DIBBS_BASIC, max_block_size=100, estimate_block_size=True
+    )
+    assert result[0]
+    _clean_up(MPI.dal)
+
+
+def test_link_records_against_mpi_block_size_limit():
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    MPI = _init_db()
+    linked = [
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI)
+        for patient in patients
+    ]
+
+    def link_duplicates(algorithm, **kwargs):
+        duplicates = [copy.deepcopy(patients[0]) for _ in range(2)]
+        for duplicate in duplicates:
+            duplicate["id"] = str(uuid.uuid4())
+        linkage_stats = {}
+        results = link_records_against_mpi(
+            duplicates,
+            algorithm,
+            mpi_client=MPI,
+            linkage_stats=linkage_stats,
+            **kwargs,
+        )
+        return results, linkage_stats
+
+    # Oversize blocks in a batch are refined or sampled as for a single
+    # record, and sampled blocks still hold the batch's own records
+    results, linkage_stats = link_duplicates(DIBBS_BASIC, max_block_size=100)
+    assert results == [(True, linked[0][1])] * 2
+    for key in ["oversize_blocks", "blocks_refined", "blocks_sampled"]:
+        assert key not in linkage_stats
+
+    results, linkage_stats = link_duplicates(DIBBS_BASIC, max_block_size=2)
+    assert results == [(True, linked[0][1])] * 2
+    assert linkage_stats["oversize_blocks"] == 2 * len(DIBBS_BASIC)
+    assert linkage_stats.get("blocks_refined", 0) + linkage_stats.get(
+        "blocks_sampled", 0
+    ) == 2 * len(DIBBS_BASIC)
+
+    results, linkage_stats = link_duplicates(DIBBS_BASIC, max_block_size=1)
+    assert results == [(True, linked[0][1])] * 2
+    assert linkage_stats["oversize_blocks"] == 2 * len(DIBBS_BASIC)
+    assert linkage_stats["blocks_sampled"] == 2 * len(DIBBS_BASIC)
+
+    # A pass's own limit takes precedence
+    algorithm = copy.deepcopy(DIBBS_BASIC)
+    for linkage_pass in algorithm:
+        linkage_pass["max_block_size"] = 1
+        linkage_pass["refine_blocks"] = []
+    results, linkage_stats = link_duplicates(algorithm, max_block_size=100)
+    assert results == [(True, linked[0][1])] * 2
+    assert linkage_stats["blocks_sampled"] == 2 * len(DIBBS_BASIC)
+    _clean_up(MPI.dal)
+
+
+@pytest.mark.parametrize("parallel_passes", [False, True])
+def test_link_record_against_mpi_trace(parallel_passes):
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    MPI = _init_db()
+    for patient in patients:
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_ENHANCED, mpi_client=MPI)
+
+    duplicate = copy.deepcopy(patients[0])
+    duplicate["id"] = str(uuid.uuid4())
+    trace = LinkageTrace(max_comparisons=1)
+    matched, person_id = link_record_against_mpi(
+        duplicate,
+        DIBBS_ENHANCED,
+        mpi_client=MPI,
+        parallel_passes=parallel_passes,
+        trace=trace,
+    )
+    trace = json.loads(json.dumps(trace.to_dict()))
+    assert matched
+    assert trace["result"]["matched"]
+    assert trace["result"]["person_id"] == str(person_id)
+    assert trace["result"]["total_time"] > 0
+    assert [p["pass"] for p in trace["passes"]] == list(range(len(DIBBS_ENHANCED)))
+    for traced_pass, linkage_pass in zip(trace["passes"], DIBBS_ENHANCED):
+        assert traced_pass["block_size"] > 0
+        assert traced_pass["timings"]["score"] >= 0
+        assert parallel_passes == ("fetch" in trace["timings"])
+        assert parallel_passes != ("fetch" in traced_pass["timings"])
+        for cluster in traced_pass["clusters"]:
+            assert len(cluster["comparisons"]) <= 1
+            for comparison in cluster["comparisons"]:
+                assert set(comparison["features"]) == set(linkage_pass["funcs"])
+    # The matched person's ratio is traced in the pass that scored it best
+    best_ratios = [
+        cluster["belongingness_ratio"]
+        for traced_pass in trace["passes"]
+        for cluster in traced_pass["clusters"]
+        if cluster["person_id"] == str(person_id)
+    ]
+    assert (
+        max(r for r in best_ratios if r is not None)
+        == (trace["result"]["linkage_scores"][str(person_id)])
+    )
+    _clean_up(MPI.dal)
+
+
+@pytest.mark.parametrize("lock_mode", ["striped", "advisory"])
+def test_link_record_against_mpi_with_locks(monkeypatch, lock_mode):
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patient = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ][0]
+    duplicate = copy.deepcopy(patient)
+    duplicate["id"] = str(uuid.uuid4())
+    algo_config = CompiledLinkageAlgorithm(DIBBS_BASIC)
+
+    keys = blocking_lock_keys(patient, algo_config)
+    assert len(keys) == len(algo_config.passes)
+    assert keys == sorted(keys)
+    assert blocking_lock_keys(duplicate, algo_config) == keys
+    moved = copy.deepcopy(patient)
+    moved["address"][0]["postalCode"] = "11111"
+    moved_keys = blocking_lock_keys(moved, algo_config)
+    assert len(set(moved_keys) & set(keys)) == 1
+
+    MPI = _init_db()
+    locks = StripedLockTable()
+    if lock_mode == "advisory":
+        locks = AdvisoryLockTable(MPI.dal.engine.url)
+
+    # Widen the window between looking up a record's blocks and inserting
+    # it, in which a concurrent record of the same person would miss it
+    insert_matched_patient = MPI.insert_matched_patient
+
+    def slow_insert_matched_patient(*args, **kwargs):
+        time.sleep(0.2)
+        return insert_matched_patient(*args, **kwargs)
+
+    monkeypatch.setattr(MPI, "insert_matched_patient", slow_insert_matched_patient)
+
+    barrier = threading.Barrier(2)
+    results = []
+
+    def link(record: dict):
+        barrier.wait()
+        results.append(
+            link_record_against_mpi(record, algo_config, mpi_client=MPI, locks=locks)
+        )
+
+    threads = [
+        threading.Thread(target=link, args=(copy.deepcopy(record),))
+        for record in [patient, duplicate]
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The second record linked waits for the first, then matches its person
+    assert sorted(matched for matched, _ in results) == [False, True]
+    assert len({str(person_id) for _, person_id in results}) == 1
+
+    if lock_mode == "advisory":
+        locks.dispose()
+    MPI.dal.engine.dispose()
+    _clean_up(MPI.dal)
+
+
+def test_link_record_against_mpi_heavily_linked_person():
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patient = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ][0]
+    MPI = _init_db()
+    # A person with many identical records, e.g. from repeated case reports
+    copies = []
+    for _ in range(20):
+        copies.append(copy.deepcopy(patient))
+        copies[-1]["id"] = str(uuid.uuid4())
+    person_id = str(uuid.uuid4())
+    MPI.insert_matched_patients(copies, [person_id] * len(copies))
+
+    duplicate = copy.deepcopy(patient)
+    duplicate["id"] = str(uuid.uuid4())
+    linkage_stats = {}
+    trace = LinkageTrace()
+    matched, linked_person_id = link_record_against_mpi(
+        duplicate,
+        DIBBS_ENHANCED,
+        mpi_client=MPI,
+        linkage_stats=linkage_stats,
+        trace=trace,
+    )
+    assert matched
+    assert str(linked_person_id) == person_id
+    assert trace.result["linkage_scores"] == {linked_person_id: 1.0}
+    # The record is compared at most once per pass with the person's single variant
+    clusters = [c for traced_pass in trace.passes for c in traced_pass["clusters"]]
+    assert [c["variants"] for c in clusters] == [1] * len(clusters)
+    assert linkage_stats["record_comparisons"] <= len(clusters)
+    assert linkage_stats["record_comparisons_deduplicated"] > 0
+    _clean_up(MPI.dal)
+
+
+def test_compiled_linkage_pass_explain():
+    compiled = CompiledLinkagePass(DIBBS_BASIC[0])
+    col_to_idx = {"first_name": 0, "last_name": 1, "birthdate": 2}
+    record = ["1", None, ["John"], "Shepard", "1980-11-07"]
+    mpi_patient = ["2", "3", "Jon", "Sheperd", "1980-11-07"]
+    # Every feature is scored, even after one fails to match
+    assert compiled.explain(record, mpi_patient, col_to_idx) == (
+        False,
+        {"first_name": True, "last_name": False},
+    )
+    assert not compiled.compare(record, mpi_patient, col_to_idx)
+    mpi_patient[3] = "Shepard"
+    assert compiled.explain(record, mpi_patient, col_to_idx)[0]
+
+
+def test_compiled_linkage_pass_block_size_limit():
+    linkage_pass = copy.deepcopy(DIBBS_BASIC[0])
+    compiled = CompiledLinkagePass(linkage_pass)
+    assert compiled.max_block_size is None
+    assert compiled.refine_blocks == DEFAULT_REFINE_BLOCKS
+
+    for max_block_size in [0, "10", 2.5]:
+        linkage_pass["max_block_size"] = max_block_size
+        with pytest.raises(ValueError) as e:
+            CompiledLinkagePass(linkage_pass)
+        assert "'max_block_size' must be a positive integer" in str(e.value)
+    linkage_pass["max_block_size"] = 10
+    linkage_pass["refine_blocks"] = ["birthdate"]
+    with pytest.raises(ValueError) as e:
+        CompiledLinkagePass(linkage_pass)
+    assert "'refine_blocks' must be a list of block dictionaries" in str(e.value)
+
+
+@pytest.mark.parametrize("algorithm", [DIBBS_BASIC, DIBBS_ENHANCED])
+def test_link_record_against_mpi_parallel_passes(algorithm):
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+    MPI = _init_db()
+    sequential_stats = {}
+    sequential = [
+        link_record_against_mpi(
+            copy.deepcopy(patient),
+            algorithm,
+            mpi_client=MPI,
+            linkage_stats=sequential_stats,
+        )
+        for patient in patients
+    ]
+    _clean_up(MPI.dal)
+
+    MPI = _init_db()
+    block_queries = []
+    MPI.get_block_data = lambda criteria: block_queries.append(criteria)
+    get_block_data_batch = MPI.get_block_data_batch
+
+    def count_batches(block_criteria_list):
+        block_queries.append(block_criteria_list)
+        return get_block_data_batch(block_criteria_list)
+
+    MPI.get_block_data_batch = count_batches
+    parallel_stats = {}
+    parallel = [
+        link_record_against_mpi(
+            copy.deepcopy(patient),
+            algorithm,
+            mpi_client=MPI,
+            linkage_stats=parallel_stats,
+            parallel_passes=True,
+        )
+        for patient in patients
+    ]
+    # Every pass's block is fetched in a single batch per record
+    assert len(block_queries) == len(patients)
+    assert all(len(criteria) == len(algorithm) for criteria in block_queries)
+    assert [m for m, _ in parallel] == [m for m, _ in sequential]
+    assert _group_by_person([p for _, p in parallel]) == _group_by_person(
+        [p for _, p in sequential]
+    )
+    assert parallel_stats == sequential_stats
+    _clean_up(MPI.dal)
+
+
+def test_link_record_against_mpi_parallel_passes_quoted_values():
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p["resource"]
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+    MPI = _init_db()
+    for patient in patients:
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI)
+
+    # Blocking values with quotes are fetched as any others in a batch
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    patient["name"][0]["family"] = "O'Brien"
+    matched, person_id = link_record_against_mpi(
+        copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI, parallel_passes=True
+    )
+    patient["id"] = str(uuid.uuid4())
+    assert link_record_against_mpi(
+        patient, DIBBS_BASIC, mpi_client=MPI, parallel_passes=True
+    ) == (True, person_id)
+
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    patient["name"][0]["family"] = "x' OR '1'='1"
+    patient["birthDate"] = "1900-01-01"
+    patient["address"][0]["postalCode"] = "00000"
+    matched, new_person_id = link_record_against_mpi(
+        patient, DIBBS_BASIC, mpi_client=MPI, parallel_passes=True
+    )
+    assert not matched
+    assert new_person_id != person_id
+    _clean_up(MPI.dal)
+
+
+def test_link_records_against_mpi_external_person_ids():
+    MPI = _init_db()
+    patients = [
+        p["resource"]
+        for p in json.load(
+            open(
+                pathlib.Path(__file__).parent.parent
+                / "assets"
+                / "linkage"
+                / "patient_bundle_to_link_with_mpi.json"
+            )
+        )["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ][:2]
+
+    with pytest.raises(ValueError) as e:
+        link_records_against_mpi(patients, DIBBS_BASIC, external_person_ids=["EXT-1"])
+    assert "An external person ID must be supplied for every record" in str(e.value)
+
+    assert link_records_against_mpi([], DIBBS_BASIC) == []
+
+    results = link_records_against_mpi(
+        patients, DIBBS_BASIC, external_person_ids=["EXT-1", "EXT-1"]
+    )
+    assert [matched for matched, _ in results] == [False, True]
+    external_person_records = MPI.dal.select_results(
+        select(MPI.dal.EXTERNAL_PERSON_TABLE)
+    )
+    # The second record links to the same person, so the pair is only
+    # recorded once
+    assert len(external_person_records[1:]) == 1
+    assert external_person_records[1][2] == "EXT-1"
+    assert str(external_person_records[1][1]) == str(results[0][1])
+    _clean_up(MPI.dal)
+
+
 def test_add_person_resource():
     bundle = json.load(
         open(
@@ -1149,3 +1745,209 @@ def test_convert_given_name_to_first_name():
         ["333333333", "HARRISON", "GEORGE HAROLD", "Liverpool"],
         ["444444444", "STARKLEY", "RICHARD", "Liverpool"],
     ], "Given names should be concatenated into a single string"
+
+
+def test_compiled_linkage_algorithm():
+    compiled = CompiledLinkageAlgorithm(DIBBS_ENHANCED)
+    assert len(compiled.passes) == 2
+    assert compiled.config_hash == hash_linkage_config(copy.deepcopy(DIBBS_ENHANCED))
+
+    first_pass = compiled.passes[0]
+    assert first_pass.matching_rule is eval_log_odds_cutoff
+    assert first_pass.funcs["first_name"] is feature_match_log_odds_fuzzy_compare
+    assert first_pass.cluster_ratio == 0.9
+    with pytest.raises(TypeError):
+        first_pass.kwargs["true_match_threshold"] = 0.0
+
+    # Mutating the source config must not alter the compiled algorithm
+    algo_config = copy.deepcopy(DIBBS_BASIC)
+    compiled = CompiledLinkageAlgorithm(algo_config)
+    algo_config[0]["kwargs"]["thresholds"]["first_name"] = 0.0
+    assert compiled.passes[0].kwargs["thresholds"]["first_name"] == 0.9
+
+    header = ["patient_id", "person_id", "address", "birthdate", "first_name"]
+    col_to_idx = compiled.col_to_idx(header)
+    assert col_to_idx == {"address": 0, "birthdate": 1, "first_name": 2}
+    assert compiled.col_to_idx(list(header)) is col_to_idx
+
+    record = [
+        "p1",
+        None,
+        ["123 Main St"],
+        "1980-01-01",
+        ["John", "Paul"],
+        "Shepard",
+    ]
+    mpi_patient = ["p2", "P", "123 Main St", "1980-01-01", "John Paul", "Shepard"]
+    col_to_idx = {"address": 0, "birthdate": 1, "first_name": 2, "last_name": 3}
+    assert compiled.passes[0].compare(record, mpi_patient, col_to_idx)
+    assert compiled.passes[1].compare(record, mpi_patient, col_to_idx)
+    mpi_patient[5] = "Shepherd"
+    assert not compiled.passes[0].compare(record, mpi_patient, col_to_idx)
+
+
+def test_compiled_linkage_algorithm_invalid_config():
+    with pytest.raises(ValueError) as e:
+        CompiledLinkageAlgorithm({"funcs": {}})
+    assert "must be a list of passes" in str(e.value)
+
+    bad_pass = copy.deepcopy(DIBBS_BASIC[0])
+    bad_pass.pop("blocks")
+    with pytest.raises(ValueError) as e:
+        CompiledLinkageAlgorithm([bad_pass])
+    assert "must contain a 'blocks' key" in str(e.value)
+
+    bad_pass = copy.deepcopy(DIBBS_BASIC[0])
+    bad_pass["funcs"]["first_name"] = "feature_match_nonexistent"
+    with pytest.raises(ValueError) as e:
+        CompiledLinkageAlgorithm([bad_pass])
+    assert "feature_match_nonexistent is not defined" in str(e.value)
+
+    bad_pass = copy.deepcopy(DIBBS_BASIC[0])
+    bad_pass["matching_rule"] = "LINKING_FIELDS_TO_FHIRPATHS"
+    with pytest.raises(ValueError):
+        CompiledLinkageAlgorithm([bad_pass])
+
+
+def test_hash_linkage_config():
+    assert hash_linkage_config(DIBBS_BASIC) == hash_linkage_config(
+        copy.deepcopy(DIBBS_BASIC)
+    )
+    assert hash_linkage_config(DIBBS_BASIC) != hash_linkage_config(DIBBS_ENHANCED)
+
+    algo_config = copy.deepcopy(DIBBS_BASIC)
+    algo_config[0]["matching_rule"] = eval_perfect_match
+    assert hash_linkage_config(algo_config) != hash_linkage_config(DIBBS_BASIC)
+
+
+def test_compiled_linkage_pass_short_circuits():
+    compiled_pass = CompiledLinkageAlgorithm(DIBBS_BASIC).passes[0]
+    assert compiled_pass.short_circuit
+    assert compiled_pass.feature_order == ["last_name", "first_name"]
+
+    record = ["p1", None, ["John"], "Shepard"]
+    mpi_patient = ["p2", "P", "Jon", "Shepherd"]
+    col_to_idx = {"first_name": 0, "last_name": 1}
+    linkage_stats = {}
+    assert not compiled_pass.compare(record, mpi_patient, col_to_idx, linkage_stats)
+    assert linkage_stats == {"feature_comparisons_skipped": 1}
+
+    # Log-odds scores are summed, so every feature is compared in order
+    enhanced_pass = CompiledLinkageAlgorithm(DIBBS_ENHANCED).passes[1]
+    assert not enhanced_pass.short_circuit
+    assert enhanced_pass.feature_order == ["address", "birthdate"]
+
+
+def test_eval_record_against_cluster():
+    algo_config = copy.deepcopy(DIBBS_BASIC[:1])
+    algo_config[0]["cluster_ratio"] = 0.5
+    compiled_pass = CompiledLinkageAlgorithm(algo_config).passes[0]
+    col_to_idx = {"first_name": 0, "last_name": 1}
+    record = ["p0", None, ["John"], "Shepard"]
+    match = ["p1", "P", "John", "Shepard"]
+    non_match = ["p2", "P", "Jane", "Smith"]
+
+    # Every comparison is made when the outcome is open until the end
+    linkage_stats = {}
+    cluster = [match, non_match, match, non_match]
+    ratio = _eval_record_against_cluster(
+        record, cluster, compiled_pass, col_to_idx, linkage_stats=linkage_stats
+    )
+    assert ratio == 0.5
+    assert linkage_stats["record_comparisons"] == 4
+    assert "record_comparisons_skipped" not in linkage_stats
+
+    # Stops once the cluster ratio can no longer be reached
+    linkage_stats = {}
+    cluster = [non_match, non_match, non_match, match]
+    ratio = _eval_record_against_cluster(
+        record, cluster, compiled_pass, col_to_idx, linkage_stats=linkage_stats
+    )
+    assert ratio is None
+    assert linkage_stats["record_comparisons"] == 3
+    assert linkage_stats["record_comparisons_skipped"] == 1
+    assert linkage_stats["clusters_decided_early"] == 1
+
+    # Nothing to compare if the person can't improve on an earlier pass
+    linkage_stats = {}
+    ratio = _eval_record_against_cluster(
+        record,
+        cluster,
+        compiled_pass,
+        col_to_idx,
+        prior_score=1.0,
+        linkage_stats=linkage_stats,
+    )
+    assert ratio is None
+    assert linkage_stats["record_comparisons_skipped"] == 4
+
+    # Stops once the person is a candidate but can't be the strongest link
+    linkage_stats = {}
+    cluster = [match, match, non_match, match]
+    ratio = _eval_record_against_cluster(
+        record,
+        cluster,
+        compiled_pass,
+        col_to_idx,
+        best_score=1.0,
+        linkage_stats=linkage_stats,
+    )
+    assert ratio == 0.5
+    assert linkage_stats["record_comparisons"] == 3
+    assert linkage_stats["record_comparisons_skipped"] == 1
+
+    # The trace records that such a ratio is partial, along with its bounds
+    trace = LinkageTrace()
+    trace.start_pass(0, {})
+    for cluster, kwargs, early_exit in [
+        ([match, match, non_match, match], {"best_score": 1.0}, True),
+        ([non_match, non_match, non_match, match], {}, True),
+        ([match, non_match, match, non_match], {}, False),
+    ]:
+        trace.start_cluster("person", len(cluster))
+        ratio = _eval_record_against_cluster(
+            record, cluster, compiled_pass, col_to_idx, trace=trace, **kwargs
+        )
+        trace.end_cluster(ratio)
+    clusters = trace.to_dict()["passes"][0]["clusters"]
+    assert [c["early_exit"] for c in clusters] == [True, True, False]
+    assert clusters[0]["belongingness_ratio"] == 0.5
+    assert clusters[0]["belongingness_ratio_bounds"] == [0.5, 0.75]
+    assert clusters[1]["belongingness_ratio"] is None
+    assert clusters[1]["belongingness_ratio_bounds"] == [0.0, 0.25]
+    assert clusters[2]["belongingness_ratio"] == 0.5
+    assert clusters[2]["belongingness_ratio_bounds"] is None
+
+    # A summarized cluster is compared once per distinct variant, with the
+    # same outcome as comparing every row
+    for cluster, kwargs in [
+        ([match, non_match, match, non_match], {}),
+        ([non_match, non_match, non_match, match], {}),
+        ([match, match, non_match, match], {"best_score": 1.0}),
+        ([match] * 6 + [non_match] * 2, {"prior_score": 0.5}),
+    ]:
+        summary = ClusterSummary([tuple(row) for row in cluster])
+        row_stats = {}
+        summary_stats = {}
+        ratio = _eval_record_against_cluster(
+            record,
+            cluster,
+            compiled_pass,
+            col_to_idx,
+            linkage_stats=row_stats,
+            **kwargs,
+        )
+        assert ratio == _eval_record_against_cluster(
+            record,
+            summary,
+            compiled_pass,
+            col_to_idx,
+            linkage_stats=summary_stats,
+            **kwargs,
+        )
+        assert summary_stats["record_comparisons"] <= len(summary.variants)
+        assert (
+            summary_stats["record_comparisons"]
+            + summary_stats.get("record_comparisons_deduplicated", 0)
+            == row_stats["record_comparisons"]
+        )
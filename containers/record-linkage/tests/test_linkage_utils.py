@@ -2,6 +2,7 @@ from datetime import date, datetime
 
 import pytest
 from app.linkage.link import datetime_to_str
+from app.linkage.utils import SimilarityCache, compare_strings
 
 
 @pytest.mark.parametrize(
@@ -40,3 +41,31 @@ def test_valid_datetime_to_str_with_time(input_value, expected_output):
 )
 def test_bad_input_datetime_to_str(input_value, expected_output):
     assert datetime_to_str(input_value) == expected_output
+
+
+def test_similarity_cache():
+    cache = SimilarityCache()
+    score = cache.compare("John", "Jhon")
+    assert score == compare_strings("John", "Jhon")
+    assert cache.compare("John", "Jhon") == score
+    assert (cache.hits, cache.misses) == (1, 1)
+    # Scores are kept per similarity measure
+    assert cache.compare("John", "Jhon", "Levenshtein") == compare_strings(
+        "John", "Jhon", "Levenshtein"
+    )
+    assert len(cache) == 2
+
+
+def test_bounded_similarity_cache_with_parent():
+    parent = SimilarityCache(maxsize=2)
+    cache = SimilarityCache(parent=parent)
+    for string in ["Ann", "Anne", "Anna"]:
+        cache.compare("Ann", string)
+    # The least recently used score is evicted from the bounded parent
+    assert len(parent) == 2
+    assert ("JaroWinkler", "Ann", "Ann") not in parent.scores
+
+    # A fresh child cache finds the parent's scores
+    child = SimilarityCache(parent=parent)
+    assert child.compare("Ann", "Anna") == compare_strings("Ann", "Anna")
+    assert (child.misses, parent.hits) == (1, 1)
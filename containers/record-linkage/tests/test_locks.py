@@ -0,0 +1,76 @@
+import asyncio
+import threading
+import time
+
+from app.linkage.locks import AdvisoryLockTable, StripedLockTable
+
+ENGINE_URL = "postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+
+
+def _run_concurrently(locks, first_keys: list[int], second_keys: list[int]) -> list:
+    """
+    Holds the locks on `first_keys` while another thread takes the locks on
+    `second_keys`, and returns the order in which the holders finished.
+    """
+    events = []
+    first_holding = threading.Event()
+
+    def first():
+        with locks.hold(first_keys):
+            first_holding.set()
+            time.sleep(0.2)
+            events.append("first")
+
+    def second():
+        first_holding.wait()
+        with locks.hold(second_keys):
+            events.append("second")
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return events
+
+
+def test_striped_lock_table():
+    locks = StripedLockTable(stripes=8)
+    # Keys sharing a stripe are serialized, keys in disjoint stripes aren't
+    assert _run_concurrently(locks, [1, 2], [2, 3]) == ["first", "second"]
+    assert _run_concurrently(locks, [1, -7], [10]) == ["second", "first"]
+    assert _run_concurrently(locks, [1], [9]) == ["first", "second"]
+
+    # A holder that fails releases its locks
+    try:
+        with locks.hold([1]):
+            raise ValueError("linkage failed")
+    except ValueError:
+        pass
+    assert not any(lock.locked() for lock in locks._locks)
+
+
+def test_striped_lock_table_async():
+    locks = StripedLockTable(stripes=8)
+
+    async def hold(keys: list[int], events: list, name: str, delay: float):
+        async with locks.hold_async(keys):
+            await asyncio.sleep(delay)
+            events.append(name)
+
+    async def run(first_keys: list[int], second_keys: list[int]) -> list:
+        events = []
+        first = asyncio.create_task(hold(first_keys, events, "first", 0.2))
+        await asyncio.sleep(0)
+        await asyncio.gather(first, hold(second_keys, events, "second", 0))
+        return events
+
+    assert asyncio.run(run([1, 2], [2])) == ["first", "second"]
+    assert asyncio.run(run([1, 2], [3])) == ["second", "first"]
+
+
+def test_advisory_lock_table():
+    locks = AdvisoryLockTable(ENGINE_URL)
+    assert _run_concurrently(locks, [42, -1], [-1]) == ["first", "second"]
+    assert _run_concurrently(locks, [42], [43]) == ["second", "first"]
+    locks.dispose()
@@ -0,0 +1,44 @@
+import time
+
+from app.linkage.metrics import StageTimings, format_counters
+
+
+def test_stage_timings():
+    timings = StageTimings(window=100)
+    for ms in range(1, 201):
+        timings.observe("compare", ms / 1000)
+    with timings.span("fetch_block"):
+        time.sleep(0.001)
+
+    summary = timings.summary()
+    assert summary["compare"]["count"] == 200
+    assert round(summary["compare"]["total"], 6) == round(sum(range(1, 201)) / 1000, 6)
+    # Percentiles are computed over the most recent durations only
+    assert summary["compare"]["p50"] == 0.15
+    assert summary["compare"]["p95"] == 0.195
+    assert summary["compare"]["p99"] == 0.199
+    assert summary["fetch_block"]["count"] == 1
+    assert summary["fetch_block"]["p50"] >= 0.001
+
+    timings.reset()
+    assert timings.summary() == {}
+
+
+def test_stage_timings_to_prometheus():
+    timings = StageTimings()
+    timings.observe("insert", 0.5)
+    lines = timings.to_prometheus().splitlines()
+    assert lines[:2] == [
+        "# HELP record_linkage_stage_seconds Time spent in each stage of record "
+        "linkage.",
+        "# TYPE record_linkage_stage_seconds summary",
+    ]
+    assert 'record_linkage_stage_seconds{stage="insert",quantile="0.95"} 0.5' in lines
+    assert 'record_linkage_stage_seconds_sum{stage="insert"} 0.5' in lines
+    assert 'record_linkage_stage_seconds_count{stage="insert"} 1' in lines
+
+    assert format_counters({}) == ""
+    assert format_counters({"record_comparisons": 3}).splitlines() == [
+        "# TYPE record_linkage_record_comparisons_total counter",
+        "record_linkage_record_comparisons_total 3",
+    ]
@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import os
@@ -5,11 +6,13 @@ import pathlib
 import re
 import uuid
 
+import app.linkage.dal as dal_module
+import app.linkage.mpi as mpi_module
 import pytest
 from app.linkage.dal import DataAccessLayer
 from app.linkage.mpi import DIBBsMPIConnectorClient
 from app.utils import _clean_up
-from sqlalchemy import Select, select, text
+from sqlalchemy import Select, func, select, text
 
 patient_resource = json.load(
     open(
@@ -310,6 +313,97 @@ def test_generate_block_query():
     assert re.sub(r"\s+", "", str(my_query2)) == re.sub(r"\s+", "", expected_result2)
 
 
+def test_get_block_query_key():
+    MPI = _init_db()
+    organized_block_vals = MPI._organize_block_criteria(
+        {
+            "mrn": {"value": "3456", "transformation": "last4"},
+            "sex": {"value": "M"},
+            "dob": {"value": "1977-11-11"},
+        }
+    )
+    query_key, params = MPI._get_block_query_key(organized_block_vals)
+    assert query_key == (
+        ("identifier", (("patient_identifier", "last4"), ("type_code", None))),
+        ("patient", (("dob", None), ("sex", None))),
+    )
+    assert params == {
+        "identifier_patient_identifier": "3456",
+        "identifier_type_code": "MR",
+        "patient_dob": "1977-11-11",
+        "patient_sex": "M",
+    }
+
+    # The same columns and transformations share a key, whatever the values
+    other_key, other_params = MPI._get_block_query_key(
+        MPI._organize_block_criteria(
+            {
+                "dob": {"value": "1988-01-01"},
+                "sex": {"value": "F"},
+                "mrn": {"value": "9999", "transformation": "last4"},
+            }
+        )
+    )
+    assert other_key == query_key
+    assert other_params["patient_sex"] == "F"
+    _clean_up(MPI.dal)
+
+
+def test_get_block_data_reuses_block_query():
+    MPI = _init_db()
+    test_data = [
+        {"person_id": None, "dob": "1977-11-11", "sex": "M"},
+        {"person_id": None, "dob": "1988-01-01", "sex": "F"},
+    ]
+    pks = MPI.dal.bulk_insert_list(MPI.dal.PATIENT_TABLE, test_data, True)
+    MPI.dal.bulk_insert_list(
+        MPI.dal.NAME_TABLE,
+        [
+            {"patient_id": pks[0], "last_name": "O'Brien"},
+            {"patient_id": pks[1], "last_name": "Obrien"},
+        ],
+        False,
+    )
+
+    block_1 = MPI.get_block_data(
+        {"dob": {"value": "1977-11-11"}, "sex": {"value": "M"}}
+    )
+    query = next(iter(MPI._block_queries.values()))
+    block_2 = MPI.get_block_data(
+        {"dob": {"value": "1988-01-01"}, "sex": {"value": "F"}}
+    )
+    assert list(MPI._block_queries.values()) == [query]
+    assert [row[0] for row in block_1[1:]] == [pks[0]]
+    assert [row[0] for row in block_2[1:]] == [pks[1]]
+
+    # Criteria values are bound rather than spliced into the SQL
+    block = MPI.get_block_data({"last_name": {"value": "O'Brien"}})
+    assert [row[0] for row in block[1:]] == [pks[0]]
+    block = MPI.get_block_data(
+        {"last_name": {"value": "O'Br", "transformation": "first4"}}
+    )
+    assert [row[0] for row in block[1:]] == [pks[0]]
+    blocks = MPI.get_block_data_batch(
+        [
+            {"last_name": {"value": "O'Brien"}},
+            {"last_name": {"value": "O'Br", "transformation": "first4"}},
+        ]
+    )
+    assert [[row[0] for row in block[1:]] for block in blocks] == [[pks[0]]] * 2
+
+    # Queries are kept by each client, not shared between them
+    other_MPI = DIBBsMPIConnectorClient()
+    assert len(other_MPI._block_queries) == 0
+    assert other_MPI._get_base_query() is not MPI._get_base_query()
+    other_MPI.dal.engine.dispose()
+
+    # Unsupported transformations are ignored, as before
+    block = MPI.get_block_data({"last_name": {"value": "x", "transformation": "x"}})
+    assert len(block[1:]) == 2
+
+    _clean_up(MPI.dal)
+
+
 def test_init():
     os.environ = {
         "mpi_dbname": "testdb",
@@ -382,6 +476,40 @@ def test_insert_matched_patient():
     assert len(phone_rec) == 2
     assert len(id_rec) == 2
 
+    # Linking another patient to the person skips the existing external person ID
+    migration = open(
+        pathlib.Path(__file__).parent.parent
+        / "migrations"
+        / "V01_06__external_person_unique.sql"
+    ).read()
+    with MPI.dal.engine.connect() as db_conn:
+        db_conn.execute(text(migration))
+        db_conn.commit()
+    second_patient = copy.deepcopy(patient_resource)
+    second_patient["id"] = str(uuid.uuid4())
+    assert (
+        MPI.insert_matched_patient(
+            patient_resource=second_patient,
+            person_id=result,
+            external_person_id=external_person_id,
+        )
+        == result
+    )
+    EXTERNAL_PERSON_rec = MPI.dal.select_results(select(MPI.dal.EXTERNAL_PERSON_TABLE))
+    patient_rec = MPI.dal.select_results(select(MPI.dal.PATIENT_TABLE))
+    assert len(EXTERNAL_PERSON_rec) == 2
+    assert len(patient_rec) == 3
+
+    # A failed insert leaves neither a new person nor a patient behind
+    failed_patient = copy.deepcopy(patient_resource)
+    failed_patient["id"] = "not a uuid"
+    with pytest.raises(ValueError):
+        MPI.insert_matched_patient(
+            patient_resource=failed_patient, external_person_id="EXT-999"
+        )
+    assert len(MPI.dal.select_results(select(MPI.dal.PERSON_TABLE))) == 2
+    assert len(MPI.dal.select_results(select(MPI.dal.EXTERNAL_PERSON_TABLE))) == 2
+
     _clean_up(MPI.dal)
 
     # Test for missing external_person_id
@@ -467,6 +595,156 @@ def test_block_data_with_transform():
     assert blocked_data[1][8] == add1[0].get("zip_code")
 
 
+def test_get_block_data_batch():
+    MPI = _init_db()
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    for patient in patients:
+        MPI.insert_matched_patient(patient)
+
+    block_criteria_list = [
+        {"first_name": {"value": "John", "transformation": "first4"}},
+        {"last_name": {"value": "Shep", "transformation": "first4"}},
+        {"dob": {"value": "1980-01-01"}, "sex": {"value": "male"}},
+        {"mrn": {"value": "3456", "transformation": "last4"}},
+        {"address": {"value": "1234", "transformation": "first4"}},
+        {"dob": {"value": "1800-01-01"}},
+        {"first_name": {"value": "John", "transformation": "first4"}},
+    ]
+    blocks = MPI.get_block_data_batch(block_criteria_list)
+
+    assert len(blocks) == len(block_criteria_list)
+    for block_criteria, block in zip(block_criteria_list, blocks):
+        expected = MPI.get_block_data(block_criteria)
+        assert block[0] == expected[0]
+        assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+    # The block with no matching patients only has a header row
+    assert len(blocks[5]) == 1
+    assert blocks[0] == blocks[6]
+
+    # Blocking values are bound as parameters rather than spliced into the SQL
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    patient["name"][0]["family"] = "O'Brien"
+    MPI.insert_matched_patient(patient)
+    blocks = MPI.get_block_data_batch(
+        [
+            {"last_name": {"value": "O'Brien"}},
+            {"last_name": {"value": "x' OR '1'='1"}},
+        ]
+    )
+    assert [str(row[0]) for row in blocks[0][1:]] == [patient["id"]]
+    assert len(blocks[1]) == 1
+
+    with pytest.raises(ValueError) as e:
+        MPI.get_block_data_batch([{"dob": {"value": "1980-01-01"}}, {}])
+    assert "`block_vals` cannot be empty." in str(e.value)
+
+    _clean_up(MPI.dal)
+
+
+def test_get_block_size_and_sampled_block():
+    MPI = _init_db()
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    for patient in patients:
+        MPI.insert_matched_patient(patient)
+
+    block_criteria_list = [
+        {"first_name": {"value": "John", "transformation": "first4"}},
+        {"last_name": {"value": "Shep", "transformation": "first4"}},
+        {"dob": {"value": "1980-01-01"}, "sex": {"value": "male"}},
+        {"address": {"value": "1234", "transformation": "first4"}},
+        {"dob": {"value": "1800-01-01"}},
+    ]
+    for block_criteria in block_criteria_list:
+        block = MPI.get_block_data(block_criteria)
+        assert MPI.get_block_size(block_criteria) == len({r[0] for r in block[1:]})
+        assert MPI.get_block_size(block_criteria, estimate=True) >= 0
+
+    # Sampling keeps whole patients, and always picks the same ones
+    block_criteria = {"last_name": {"value": "Shep", "transformation": "first4"}}
+    block_size = MPI.get_block_size(block_criteria)
+    assert block_size > 1
+    sample = MPI.get_compact_block_data(block_criteria, max_patients=1)
+    assert len({r[0] for r in sample.rows}) == 1
+    resample = MPI.get_compact_block_data(block_criteria, max_patients=1)
+    assert resample.clusters.keys() == sample.clusters.keys()
+    whole_block = MPI.get_compact_block_data(block_criteria, max_patients=block_size)
+    assert whole_block.clusters.keys() == (
+        MPI.get_compact_block_data(block_criteria).clusters.keys()
+    )
+
+    with pytest.raises(ValueError) as e:
+        MPI.get_block_size({})
+    assert "`block_vals` cannot be empty." in str(e.value)
+
+    _clean_up(MPI.dal)
+
+
+def test_insert_matched_patients():
+    MPI = _init_db()
+    patients = [copy.deepcopy(patient_resource) for _ in range(3)]
+    for i, patient in enumerate(patients):
+        patient["id"] = str(uuid.uuid4())
+        patient["name"][0]["family"] = f"Family-{i}"
+    existing_person_id = MPI.dal.bulk_insert_list(MPI.dal.PERSON_TABLE, [{}], True)[0]
+    new_person_id = str(uuid.uuid4())
+
+    person_ids = MPI.insert_matched_patients(
+        patients,
+        [existing_person_id, new_person_id, new_person_id],
+        ["EXT-1", "EXT-2", "EXT-2"],
+    )
+    assert person_ids == [existing_person_id, new_person_id, new_person_id]
+
+    person_rec = MPI.dal.select_results(select(MPI.dal.PERSON_TABLE))
+    patient_rec = MPI.dal.select_results(select(MPI.dal.PATIENT_TABLE))
+    name_rec = MPI.dal.select_results(select(MPI.dal.NAME_TABLE))
+    external_person_rec = MPI.dal.select_results(select(MPI.dal.EXTERNAL_PERSON_TABLE))
+    # The existing person and a single new person shared by two patients
+    assert len(person_rec[1:]) == 2
+    assert len(patient_rec[1:]) == 3
+    assert len(name_rec[1:]) == 3
+    assert sorted(row[2] for row in external_person_rec[1:]) == ["EXT-1", "EXT-2"]
+    new_patients = {str(row[0]): str(row[1]) for row in patient_rec[1:]}
+    assert new_patients[patients[0]["id"]] == str(existing_person_id)
+    assert new_patients[patients[2]["id"]] == new_person_id
+
+    # A failed insert leaves the MPI untouched
+    patients[0]["id"] = "not a uuid"
+    with pytest.raises(Exception):
+        MPI.insert_matched_patients(patients[:1], [str(uuid.uuid4())])
+    assert len(MPI.dal.select_results(select(MPI.dal.PERSON_TABLE))[1:]) == 2
+
+    with pytest.raises(ValueError):
+        MPI.insert_matched_patients(patients, [existing_person_id])
+
+    _clean_up(MPI.dal)
+
+
 def test_generate_dict_record_from_results():
     MPI = _init_db()
     pt1 = {
@@ -662,6 +940,7 @@ def test_get_external_source_id():
     MPI = _init_db()
 
     # Success
+    MPI._get_external_source_id.cache_clear()
     external_source_id = MPI._get_external_source_id("IRIS")
     assert isinstance(external_source_id, uuid.UUID)
 
@@ -673,3 +952,144 @@ def test_get_external_source_id():
     MPI._get_external_source_id("IRIS")
     assert MPI._get_external_source_id.cache_info().hits == 1
     _clean_up(MPI.dal)
+
+
+def _init_linkage_view(MPI: DIBBsMPIConnectorClient) -> DIBBsMPIConnectorClient:
+    migration = open(
+        pathlib.Path(__file__).parent.parent / "migrations" / "V01_05__linkage_view.sql"
+    ).read()
+    with MPI.dal.engine.connect() as db_conn:
+        db_conn.execute(text(migration))
+        db_conn.commit()
+    return DIBBsMPIConnectorClient(use_linkage_view=True)
+
+
+def test_linkage_view(monkeypatch):
+    MPI = _init_db()
+    with pytest.raises(ValueError) as e:
+        DIBBsMPIConnectorClient(use_linkage_view=True)
+    assert "The linkage_view table doesn't exist" in str(e.value)
+
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    patients = [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+    # Patients with repeated MRNs and addresses, and with several names
+    for patient in patients[:2]:
+        patient = copy.deepcopy(patient)
+        patient["id"] = str(uuid.uuid4())
+        patient["identifier"].append(copy.deepcopy(patient["identifier"][0]))
+        patient["address"].append(copy.deepcopy(patient["address"][0]))
+        patient["name"].append({"family": "Sheperd", "given": ["Jonathan", "T"]})
+        patients.append(patient)
+
+    # Patients already in the MPI are copied into the view, in batches, when
+    # a client that uses it is created, and patients inserted by it
+    # afterwards are written to it along with the MPI
+    for patient in patients[:2]:
+        MPI.insert_matched_patient(patient)
+    monkeypatch.setattr(mpi_module, "LINKAGE_VIEW_BACKFILL_BATCH_SIZE", 1)
+    view_MPI = _init_linkage_view(MPI)
+    view_count = select(func.count()).select_from(view_MPI.dal.LINKAGE_VIEW_TABLE)
+    with view_MPI.dal.engine.connect() as db_conn:
+        assert db_conn.execute(view_count).scalar() == (
+            len(MPI.dal.select_results(MPI._get_base_query())) - 1
+        )
+    view_MPI.dal.engine.dispose()
+
+    # Clients that don't use the view leave it alone, until a client that
+    # does catches it up
+    MPI = DIBBsMPIConnectorClient()
+    MPI.insert_matched_patient(patients[2])
+    with MPI.dal.engine.connect() as db_conn:
+        rows_before = db_conn.execute(view_count).scalar()
+        assert (
+            db_conn.execute(
+                select(func.count())
+                .select_from(MPI.dal.LINKAGE_VIEW_TABLE)
+                .where(MPI.dal.LINKAGE_VIEW_TABLE.c.patient_id == patients[2]["id"])
+            ).scalar()
+            == 0
+        )
+    view_MPI = DIBBsMPIConnectorClient(use_linkage_view=True)
+    with MPI.dal.engine.connect() as db_conn:
+        assert db_conn.execute(view_count).scalar() > rows_before
+    assert view_MPI._backfill_linkage_view() == 0
+    view_MPI.insert_matched_patient(patients[3])
+    monkeypatch.setattr(dal_module, "COPY_THRESHOLD", 1)
+    view_MPI.insert_matched_patients(
+        patients[4:], [str(uuid.uuid4()) for _ in patients[4:]]
+    )
+
+    base_rows = MPI.dal.select_results(MPI._get_base_query(), False)
+    view_rows = view_MPI.dal.select_results(view_MPI._get_linkage_view_query(), False)
+    assert len(view_rows) > len(patients)
+    assert sorted(map(str, view_rows)) == sorted(map(str, base_rows))
+
+    block_criteria_list = [
+        {"first_name": {"value": "John", "transformation": "first4"}},
+        {"first_name": {"value": "Jonathan"}},
+        {
+            "first_name": {"value": "John", "transformation": "first4"},
+            "last_name": {"value": "Shep", "transformation": "first4"},
+        },
+        {"dob": {"value": "1980-01-01"}, "sex": {"value": "male"}},
+        {
+            "mrn": {"value": "3456", "transformation": "last4"},
+            "address": {"value": "1234", "transformation": "first4"},
+        },
+        {"zip": {"value": "10001-0001"}, "city": {"value": "Fakeville"}},
+        {"dob": {"value": "1800-01-01"}},
+    ]
+    for block_criteria in block_criteria_list:
+        query_key, _ = view_MPI._get_block_query_key(
+            view_MPI._organize_block_criteria(block_criteria)
+        )
+        assert view_MPI._uses_linkage_view(query_key)
+        expected = MPI.get_block_data(block_criteria)
+        block = view_MPI.get_block_data(block_criteria)
+        assert block[0] == expected[0]
+        assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+        block_size = MPI.get_block_size(block_criteria)
+        assert view_MPI.get_block_size(block_criteria) == block_size
+        sample = view_MPI.get_compact_block_data(block_criteria, max_patients=1)
+        expected_sample = MPI.get_compact_block_data(block_criteria, max_patients=1)
+        assert sorted(map(str, sample.rows)) == sorted(map(str, expected_sample.rows))
+
+    # Criteria the view doesn't hold are evaluated against the MPI tables
+    block_criteria = {"first_name": {"value": "John", "transformation": "last4"}}
+    query_key, _ = view_MPI._get_block_query_key(
+        view_MPI._organize_block_criteria(block_criteria)
+    )
+    assert not view_MPI._uses_linkage_view(query_key)
+    assert len(view_MPI.get_block_data(block_criteria)) > 1
+
+    # Batches of blocks are fetched from the view, or the MPI tables, alike
+    block_criteria_list.append(block_criteria)
+    base_query = view_MPI._get_base_query()
+    view_MPI._base_query = base_query.where(text("false"))
+    blocks = view_MPI.get_block_data_batch(block_criteria_list[:-1])
+    expected_blocks = MPI.get_block_data_batch(block_criteria_list[:-1])
+    for block, expected in zip(blocks, expected_blocks):
+        assert block[0] == expected[0]
+        assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+    view_MPI._base_query = base_query
+    blocks = view_MPI.get_block_data_batch(block_criteria_list)
+    expected_blocks = MPI.get_block_data_batch(block_criteria_list)
+    assert len(blocks[-1]) > 1
+    for block, expected in zip(blocks, expected_blocks):
+        assert block[0] == expected[0]
+        assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+
+    _clean_up(MPI.dal)
+    MPI.dal.engine.dispose()
+    view_MPI.dal.engine.dispose()
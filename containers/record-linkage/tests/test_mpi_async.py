@@ -0,0 +1,305 @@
+import asyncio
+import copy
+import json
+import os
+import pathlib
+import uuid
+
+import pytest
+from app.linkage.algorithms import DIBBS_BASIC, DIBBS_ENHANCED
+from app.linkage.dal import DataAccessLayer
+from app.linkage.link import (
+    CompiledLinkageAlgorithm,
+    _guard_block_criteria,
+    _guard_block_criteria_async,
+    extract_blocking_values_from_record,
+    link_record_against_mpi,
+    link_record_against_mpi_async,
+)
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.mpi_async import AsyncDIBBsMPIConnectorClient
+from app.utils import _clean_up
+from sqlalchemy import select, text
+
+
+def _init_db() -> DataAccessLayer:
+    os.environ = {
+        "mpi_dbname": "testdb",
+        "mpi_user": "postgres",
+        "mpi_password": "pw",
+        "mpi_host": "localhost",
+        "mpi_port": "5432",
+        "mpi_db_type": "postgres",
+    }
+
+    dal = DataAccessLayer()
+    dal.get_connection(
+        engine_url="postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+    )
+    _clean_up(dal)
+
+    # load ddl
+    schema_ddl = open(
+        pathlib.Path(__file__).parent.parent.parent.parent
+        / "containers"
+        / "record-linkage"
+        / "migrations"
+        / "V01_01__flat_schema.sql"
+    ).read()
+
+    try:
+        with dal.engine.connect() as db_conn:
+            db_conn.execute(text(schema_ddl))
+            db_conn.commit()
+    except Exception as e:
+        print(e)
+        with dal.engine.connect() as db_conn:
+            db_conn.rollback()
+    dal.initialize_schema()
+
+    return DIBBsMPIConnectorClient()
+
+
+def _load_patients() -> list[dict]:
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    return [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+
+def _group_by_person(person_ids: list) -> list[list[int]]:
+    groups = {}
+    for i, person_id in enumerate(person_ids):
+        groups.setdefault(str(person_id), []).append(i)
+    return sorted(groups.values())
+
+
+BLOCK_CRITERIA = [
+    {"first_name": {"value": "John", "transformation": "first4"}},
+    {"birthdate": {"value": "2053-11-07"}, "sex": {"value": "male"}},
+    {"mrn": {"value": "7890", "transformation": "last4"}},
+    {"zip": {"value": "99999"}, "city": {"value": "Boston"}},
+]
+
+
+def test_async_get_block_data():
+    MPI = _init_db()
+    patients = _load_patients()
+    for patient in patients[:3]:
+        MPI.insert_matched_patient(copy.deepcopy(patient))
+
+    async def get_blocks():
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            return await asyncio.gather(
+                *(async_client.get_block_data(criteria) for criteria in BLOCK_CRITERIA)
+            )
+        finally:
+            await async_client.dispose()
+
+    blocks = asyncio.run(get_blocks())
+    for block_criteria, block in zip(BLOCK_CRITERIA, blocks):
+        expected = MPI.get_block_data(block_criteria)
+        assert block[0] == expected[0]
+        assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+    assert any(len(block) > 1 for block in blocks)
+
+    async def get_empty_block():
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            await async_client.get_block_data({})
+        finally:
+            await async_client.dispose()
+
+    with pytest.raises(ValueError) as e:
+        asyncio.run(get_empty_block())
+    assert "`block_vals` cannot be empty." in str(e.value)
+
+    _clean_up(MPI.dal)
+
+
+def test_async_insert_matched_patient():
+    MPI = _init_db()
+    patient = _load_patients()[0]
+    MPI.dal.bulk_insert_list(
+        MPI.dal.EXTERNAL_SOURCE_TABLE,
+        [{"external_source_name": "IRIS", "external_source_description": "IRIS"}],
+        False,
+    )
+    migration = open(
+        pathlib.Path(__file__).parent.parent
+        / "migrations"
+        / "V01_06__external_person_unique.sql"
+    ).read()
+    with MPI.dal.engine.connect() as db_conn:
+        db_conn.execute(text(migration))
+        db_conn.commit()
+
+    async def insert_patients():
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            person_id = await async_client.insert_matched_patient(
+                copy.deepcopy(patient), external_person_id="EXT-1"
+            )
+            second_patient = copy.deepcopy(patient)
+            second_patient["id"] = "e2bd4cb6-5fb7-4d3c-a7b4-e4f0a4c2fbcf"
+            matched_person_id = await async_client.insert_matched_patient(
+                second_patient, person_id=str(person_id), external_person_id="EXT-1"
+            )
+            return person_id, matched_person_id
+        finally:
+            await async_client.dispose()
+
+    person_id, matched_person_id = asyncio.run(insert_patients())
+    assert str(matched_person_id) == str(person_id)
+
+    persons = MPI.dal.select_results(select(MPI.dal.PERSON_TABLE), False)
+    assert [row[0] for row in persons] == [person_id]
+    patients = MPI.dal.select_results(select(MPI.dal.PATIENT_TABLE), False)
+    assert len(patients) == 2
+    assert all(row[1] == person_id for row in patients)
+    assert str(patients[0][2]) == patient["birthDate"]
+    names = MPI.dal.select_results(select(MPI.dal.NAME_TABLE), False)
+    assert len(names) == 2 * len(patient["name"])
+    # The external person ID is only linked to the person once
+    external_persons = MPI.dal.select_results(
+        select(MPI.dal.EXTERNAL_PERSON_TABLE), False
+    )
+    assert len(external_persons) == 1
+    assert external_persons[0][1] == person_id
+    assert external_persons[0][2] == "EXT-1"
+
+    _clean_up(MPI.dal)
+
+
+@pytest.mark.parametrize("algorithm", [DIBBS_BASIC, DIBBS_ENHANCED])
+def test_link_record_against_mpi_async(algorithm):
+    patients = _load_patients()
+
+    MPI = _init_db()
+    sequential_stats = {}
+    sequential = [
+        link_record_against_mpi(
+            copy.deepcopy(patient),
+            algorithm,
+            mpi_client=MPI,
+            linkage_stats=sequential_stats,
+        )
+        for patient in patients
+    ]
+    _clean_up(MPI.dal)
+
+    MPI = _init_db()
+
+    async def link_patients(linkage_stats: dict):
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            return [
+                await link_record_against_mpi_async(
+                    copy.deepcopy(patient),
+                    algorithm,
+                    mpi_client=async_client,
+                    linkage_stats=linkage_stats,
+                )
+                for patient in patients
+            ]
+        finally:
+            await async_client.dispose()
+
+    async_stats = {}
+    linked = asyncio.run(link_patients(async_stats))
+    assert [m for m, _ in linked] == [m for m, _ in sequential]
+    assert _group_by_person([p for _, p in linked]) == _group_by_person(
+        [p for _, p in sequential]
+    )
+    assert async_stats == sequential_stats
+    _clean_up(MPI.dal)
+
+
+def test_async_get_block_size():
+    MPI = _init_db()
+    for patient in _load_patients():
+        MPI.insert_matched_patient(copy.deepcopy(patient))
+
+    async def get_block_sizes(estimate: bool):
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            return await asyncio.gather(
+                *(
+                    async_client.get_block_size(criteria, estimate)
+                    for criteria in BLOCK_CRITERIA
+                )
+            )
+        finally:
+            await async_client.dispose()
+
+    assert asyncio.run(get_block_sizes(False)) == [
+        MPI.get_block_size(criteria) for criteria in BLOCK_CRITERIA
+    ]
+    assert all(size >= 0 for size in asyncio.run(get_block_sizes(True)))
+    _clean_up(MPI.dal)
+
+
+def test_link_record_against_mpi_async_block_size_limit():
+    patients = _load_patients()
+    MPI = _init_db()
+    for patient in patients:
+        MPI.insert_matched_patient(copy.deepcopy(patient))
+    duplicate = copy.deepcopy(patients[0])
+    duplicate["id"] = str(uuid.uuid4())
+    algorithm = CompiledLinkageAlgorithm(DIBBS_BASIC)
+
+    # Oversize blocks are narrowed down and sampled as they are by the
+    # synchronous client, so the same patients are linked against
+    sequential_stats = {}
+    sequential = []
+    for linkage_pass in algorithm.passes:
+        criteria = extract_blocking_values_from_record(duplicate, linkage_pass.blocks)
+        criteria, max_patients = _guard_block_criteria(
+            duplicate, criteria, linkage_pass, MPI, 1, False, sequential_stats
+        )
+        block = MPI.get_compact_block_data(criteria, max_patients)
+        sequential.append(sorted(str(row[0]) for row in block.rows))
+
+    async def link_duplicate(linkage_stats: dict):
+        async_client = AsyncDIBBsMPIConnectorClient()
+        try:
+            blocks = []
+            for linkage_pass in algorithm.passes:
+                criteria = extract_blocking_values_from_record(
+                    duplicate, linkage_pass.blocks
+                )
+                criteria, max_patients = await _guard_block_criteria_async(
+                    duplicate,
+                    criteria,
+                    linkage_pass,
+                    async_client,
+                    1,
+                    False,
+                    linkage_stats,
+                )
+                block = await async_client.get_compact_block_data(
+                    criteria, max_patients
+                )
+                blocks.append(sorted(str(row[0]) for row in block.rows))
+            await link_record_against_mpi_async(
+                duplicate, algorithm, mpi_client=async_client, max_block_size=1
+            )
+            return blocks
+        finally:
+            await async_client.dispose()
+
+    async_stats = {}
+    assert asyncio.run(link_duplicate(async_stats)) == sequential
+    assert async_stats == sequential_stats
+    assert async_stats["oversize_blocks"] > 0
+    _clean_up(MPI.dal)
@@ -0,0 +1,222 @@
+import copy
+import json
+import os
+import pathlib
+import uuid
+
+from app.linkage.algorithms import DIBBS_BASIC
+from app.linkage.blocking_index import BLOCK_HEADER
+from app.linkage.dal import DataAccessLayer
+from app.linkage.link import link_record_against_mpi
+from app.linkage.metrics import TIMINGS
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.mpi_cache import CachedMPIConnectorClient
+from app.utils import _clean_up
+from sqlalchemy import text
+
+
+def _init_db(refresh_interval: float = 60.0) -> DataAccessLayer:
+    os.environ = {
+        "mpi_dbname": "testdb",
+        "mpi_user": "postgres",
+        "mpi_password": "pw",
+        "mpi_host": "localhost",
+        "mpi_port": "5432",
+        "mpi_db_type": "postgres",
+    }
+
+    dal = DataAccessLayer()
+    dal.get_connection(
+        engine_url="postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+    )
+    _clean_up(dal)
+
+    # load ddl
+    schema_ddl = open(
+        pathlib.Path(__file__).parent.parent.parent.parent
+        / "containers"
+        / "record-linkage"
+        / "migrations"
+        / "V01_01__flat_schema.sql"
+    ).read()
+
+    try:
+        with dal.engine.connect() as db_conn:
+            db_conn.execute(text(schema_ddl))
+            db_conn.commit()
+    except Exception as e:
+        print(e)
+        with dal.engine.connect() as db_conn:
+            db_conn.rollback()
+    dal.initialize_schema()
+
+    return CachedMPIConnectorClient(refresh_interval=refresh_interval)
+
+
+def _load_patients() -> list[dict]:
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    return [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+
+BLOCK_CRITERIA = [
+    {"first_name": {"value": "John", "transformation": "first4"}},
+    {"last_name": {"value": "Shep", "transformation": "first4"}},
+    {"birthdate": {"value": "2053-11-07"}, "sex": {"value": "male"}},
+    {"mrn": {"value": "7890", "transformation": "last4"}},
+    {"address": {"value": "1234", "transformation": "first4"}},
+    {"zip": {"value": "99999"}, "city": {"value": "Boston"}},
+]
+
+
+def _assert_same_block(block: list[list], expected: list[list]):
+    assert block[0] == expected[0]
+    assert sorted(map(str, block[1:])) == sorted(map(str, expected[1:]))
+
+
+def test_cached_get_block_data():
+    MPI = _init_db()
+    uncached_client = DIBBsMPIConnectorClient()
+    patients = _load_patients()
+    uncached_client.insert_matched_patients(
+        patients[:3], [str(uuid.uuid4()) for _ in patients[:3]]
+    )
+
+    # The first lookup loads the MPI into the index
+    for block_criteria in BLOCK_CRITERIA:
+        _assert_same_block(
+            MPI.get_block_data(block_criteria),
+            uncached_client.get_block_data(block_criteria),
+        )
+    assert MPI.cache_stats == {
+        "hits": len(BLOCK_CRITERIA),
+        "misses": 0,
+        "refreshes": 1,
+    }
+    assert len(MPI.blocking_index) == 3
+
+    # Patients inserted through the cached client are written through
+    for patient in patients[3:]:
+        MPI.insert_matched_patient(patient)
+    blocks = MPI.get_block_data_batch(BLOCK_CRITERIA)
+    for block_criteria, block in zip(BLOCK_CRITERIA, blocks):
+        _assert_same_block(block, uncached_client.get_block_data(block_criteria))
+    assert MPI.cache_stats["refreshes"] == 1
+    assert len(MPI.blocking_index) == len(patients)
+
+    # Criteria the index can't answer are looked up in the MPI
+    block_criteria = {"phone_number": {"value": "123-456-7890"}}
+    _assert_same_block(
+        MPI.get_block_data(block_criteria),
+        uncached_client.get_block_data(block_criteria),
+    )
+    assert MPI.cache_stats["misses"] == 1
+    assert MPI.get_block_data_batch([block_criteria, BLOCK_CRITERIA[0]])[0][0] == (
+        BLOCK_HEADER
+    )
+
+    _clean_up(MPI.dal)
+
+
+def test_cached_get_block_size():
+    MPI = _init_db()
+    for patient in _load_patients():
+        MPI.insert_matched_patient(patient)
+
+    # Block sizes are counted in the index, matching the MPI's counts
+    for block_criteria in BLOCK_CRITERIA:
+        assert MPI.get_block_size(block_criteria) == (
+            DIBBsMPIConnectorClient.get_block_size(MPI, block_criteria)
+        )
+    assert MPI.cache_stats["misses"] == 0
+
+    # Sampled blocks are fetched from the MPI
+    block_criteria = BLOCK_CRITERIA[1]
+    sample = MPI.get_compact_block_data(block_criteria, max_patients=1)
+    assert len({row[0] for row in sample.rows}) == 1
+    assert (
+        sample.clusters.keys()
+        == (
+            DIBBsMPIConnectorClient.get_compact_block_data(MPI, block_criteria, 1)
+        ).clusters.keys()
+    )
+
+    _clean_up(MPI.dal)
+
+
+def test_cached_refresh():
+    MPI = _init_db(refresh_interval=3600)
+    uncached_client = DIBBsMPIConnectorClient()
+    patients = _load_patients()
+    block_criteria = {"last_name": {"value": "Shep", "transformation": "first4"}}
+    assert len(MPI.get_block_data(block_criteria)) == 1
+
+    # Patients inserted by another client only appear once the index is
+    # refreshed
+    uncached_client.insert_matched_patient(copy.deepcopy(patients[0]))
+    assert len(MPI.get_block_data(block_criteria)) == 1
+    refreshes = TIMINGS.summary().get("mpi_cache_refresh", {}).get("count", 0)
+    MPI.refresh()
+    assert TIMINGS.summary()["mpi_cache_refresh"]["count"] == refreshes + 1
+    _assert_same_block(
+        MPI.get_block_data(block_criteria),
+        uncached_client.get_block_data(block_criteria),
+    )
+
+    # Stale indexes are refreshed on lookup
+    MPI.refresh_interval = 0
+    uncached_client.insert_matched_patient(copy.deepcopy(patients[1]))
+    _assert_same_block(
+        MPI.get_block_data(block_criteria),
+        uncached_client.get_block_data(block_criteria),
+    )
+
+    # Patients removed from the MPI are removed from the index
+    _clean_up(MPI.dal)
+    MPI = _init_db()
+    MPI.blocking_index.add_patient(copy.deepcopy(patients[0]))
+    MPI.refresh()
+    assert len(MPI.blocking_index) == 0
+
+    # Patients written through while the MPI is read are kept in the index
+    MPI.refresh()
+    select_results = MPI.dal.select_results
+    patient = copy.deepcopy(patients[0])
+
+    def insert_after_select(*args, **kwargs):
+        results = select_results(*args, **kwargs)
+        if patient["id"] not in MPI.blocking_index:
+            MPI.insert_matched_patient(patient)
+        return results
+
+    MPI.dal.select_results = insert_after_select
+    MPI.refresh()
+    MPI.dal.select_results = select_results
+    assert patient["id"] in MPI.blocking_index
+
+    _clean_up(MPI.dal)
+
+
+def test_cached_link_record_against_mpi():
+    MPI = _init_db()
+    patients = _load_patients()
+
+    matches = [
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI)[0]
+        for patient in patients
+    ]
+    assert matches == [False, True, False, False, False, False]
+    assert MPI.cache_stats["misses"] == 0
+    assert MPI.cache_stats["refreshes"] == 1
+
+    _clean_up(MPI.dal)
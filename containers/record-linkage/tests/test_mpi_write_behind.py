@@ -0,0 +1,189 @@
+import copy
+import json
+import os
+import pathlib
+import time
+import uuid
+
+from app.linkage.algorithms import DIBBS_BASIC
+from app.linkage.dal import DataAccessLayer
+from app.linkage.link import link_record_against_mpi
+from app.linkage.mpi import DIBBsMPIConnectorClient
+from app.linkage.mpi_write_behind import WriteBehindMPIConnectorClient
+from app.utils import _clean_up
+from sqlalchemy import select, text
+
+
+def _init_db(**kwargs) -> WriteBehindMPIConnectorClient:
+    os.environ = {
+        "mpi_dbname": "testdb",
+        "mpi_user": "postgres",
+        "mpi_password": "pw",
+        "mpi_host": "localhost",
+        "mpi_port": "5432",
+        "mpi_db_type": "postgres",
+    }
+
+    dal = DataAccessLayer()
+    dal.get_connection(
+        engine_url="postgresql+psycopg2://postgres:pw@localhost:5432/testdb"
+    )
+    _clean_up(dal)
+
+    # load ddl
+    schema_ddl = open(
+        pathlib.Path(__file__).parent.parent.parent.parent
+        / "containers"
+        / "record-linkage"
+        / "migrations"
+        / "V01_01__flat_schema.sql"
+    ).read()
+
+    try:
+        with dal.engine.connect() as db_conn:
+            db_conn.execute(text(schema_ddl))
+            db_conn.commit()
+    except Exception as e:
+        print(e)
+        with dal.engine.connect() as db_conn:
+            db_conn.rollback()
+    dal.initialize_schema()
+    dal.engine.dispose()
+
+    return WriteBehindMPIConnectorClient(**kwargs)
+
+
+def _load_patients() -> list[dict]:
+    patients = json.load(
+        open(
+            pathlib.Path(__file__).parent.parent
+            / "assets"
+            / "linkage"
+            / "patient_bundle_to_link_with_mpi.json"
+        )
+    )
+    return [
+        p.get("resource")
+        for p in patients["entry"]
+        if p.get("resource", {}).get("resourceType", "") == "Patient"
+    ]
+
+
+def _count_patients(MPI: DIBBsMPIConnectorClient) -> int:
+    return len(MPI.dal.select_results(select(MPI.dal.PATIENT_TABLE))[1:])
+
+
+def test_write_behind_read_your_writes():
+    # The worker never flushes on its own, so every patient stays queued
+    MPI = _init_db(flush_interval=60.0)
+    patients = _load_patients()
+
+    matches = [
+        link_record_against_mpi(copy.deepcopy(patient), DIBBS_BASIC, mpi_client=MPI)[0]
+        for patient in patients
+    ]
+    # The same links as made by a client writing each patient straight away
+    assert matches == [False, True, False, False, False, False]
+    assert MPI.pending() == len(patients)
+    assert _count_patients(MPI) == 0
+
+    block_criteria = {"last_name": {"value": "Shep", "transformation": "first4"}}
+    queued_block = MPI.get_block_data(block_criteria)
+    queued_compact_block = MPI.get_compact_block_data(block_criteria)
+    assert len(queued_block) > 1
+    assert MPI.get_block_size(block_criteria) == len(
+        {row[0] for row in queued_block[1:]}
+    )
+    assert MPI.get_block_data_batch([block_criteria]) == [queued_block]
+
+    MPI.flush()
+    assert MPI.pending() == 0
+    assert len(MPI.overlay) == 0
+    assert _count_patients(MPI) == len(patients)
+    assert MPI.write_stats["queued"] == MPI.write_stats["flushed"] == len(patients)
+    written_block = MPI.get_block_data(block_criteria)
+    assert written_block[0] == queued_block[0]
+    assert sorted(map(str, written_block[1:])) == sorted(map(str, queued_block[1:]))
+    assert (
+        MPI.get_compact_block_data(block_criteria).clusters.keys()
+        == queued_compact_block.clusters.keys()
+    )
+
+    # Criteria the overlay can't evaluate wait for the queue to be written
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    MPI.insert_matched_patient(patient)
+    assert MPI.pending() == 1
+    MPI.get_block_data({"phone_number": {"value": "5555555555"}})
+    assert MPI.pending() == 0
+
+    MPI.close()
+    MPI.dal.engine.dispose()
+    _clean_up(MPI.dal)
+
+
+def test_write_behind_worker():
+    MPI = _init_db(batch_size=2, flush_interval=0.05)
+    patients = _load_patients()
+    person_id = str(uuid.uuid4())
+    MPI.insert_matched_patients(
+        copy.deepcopy(patients), [person_id] * len(patients), ["EXT-1"] * len(patients)
+    )
+
+    deadline = time.monotonic() + 10
+    while MPI.pending() > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert MPI.pending() == 0
+    assert MPI.write_stats["batches"] == 3
+    assert _count_patients(MPI) == len(patients)
+    external_person_rec = MPI.dal.select_results(select(MPI.dal.EXTERNAL_PERSON_TABLE))
+    assert [row[2] for row in external_person_rec[1:]] == ["EXT-1"]
+
+    # Once closed, patients are inserted straight away
+    MPI.close()
+    patient = copy.deepcopy(patients[0])
+    patient["id"] = str(uuid.uuid4())
+    MPI.insert_matched_patient(patient, person_id=person_id)
+    assert _count_patients(MPI) == len(patients) + 1
+
+    MPI.dal.engine.dispose()
+    _clean_up(MPI.dal)
+
+
+def test_write_behind_journal(tmp_path):
+    journal_path = str(tmp_path / "write_behind.jsonl")
+    MPI = _init_db(journal_path=journal_path, flush_interval=60.0)
+    patients = _load_patients()
+    for patient in patients[:3]:
+        MPI.insert_matched_patient(copy.deepcopy(patient))
+    MPI.flush()
+    assert open(journal_path).read() == ""
+
+    for patient in patients[3:]:
+        MPI.insert_matched_patient(copy.deepcopy(patient))
+    # Stop as if the service were killed just after writing one more patient
+    MPI.close(flush=False)
+    assert MPI.pending() == 3
+    direct_client = DIBBsMPIConnectorClient()
+    direct_client.insert_matched_patient(copy.deepcopy(patients[3]))
+    direct_client.dal.engine.dispose()
+    assert _count_patients(MPI) == 4
+    MPI.dal.engine.dispose()
+
+    # The patients left queued are written by the next client using the journal
+    replayed = WriteBehindMPIConnectorClient(
+        journal_path=journal_path, flush_interval=60.0
+    )
+    assert replayed.pending() == 2
+    block_criteria = {
+        "birthdate": {"value": patients[5]["birthDate"]},
+        "sex": {"value": patients[5]["gender"]},
+    }
+    block = replayed.get_block_data(block_criteria)
+    assert patients[5]["id"] in {str(row[0]) for row in block[1:]}
+    replayed.close()
+    assert _count_patients(replayed) == len(patients)
+    assert open(journal_path).read() == ""
+
+    replayed.dal.engine.dispose()
+    _clean_up(replayed.dal)
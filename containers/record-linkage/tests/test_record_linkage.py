@@ -6,7 +6,7 @@ import os
 import pathlib
 
 import pytest
-from app.config import get_settings
+from app.config import Settings, get_settings
 from app.utils import pop_mpi_env_vars
 from app.utils import set_mpi_env_vars
 
@@ -67,6 +67,7 @@ def test_linkage_bundle_with_no_patient():
         "message": "Supplied bundle contains no Patient resource to link on.",
         "found_match": False,
         "updated_bundle": bad_bundle,
+        "trace": None,
     }
     actual_response = client.post(
         "/link-record",
@@ -89,12 +90,43 @@ def test_linkage_invalid_db_type():
         + "for `mpi_db_type` and that it is set to 'postgres'.",
         "found_match": False,
         "updated_bundle": test_bundle,
+        "trace": None,
     }
     actual_response = client.post("/link-record", json={"bundle": test_bundle})
     assert actual_response.json() == expected_response
     assert actual_response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
+@pytest.mark.parametrize("setting", ["mpi_cache_enabled", "mpi_write_behind_enabled"])
+def test_settings_reject_async_mpi_client_with(setting):
+    with pytest.raises(ValueError) as e:
+        Settings(mpi_db_type="postgres", mpi_async_enabled=True, **{setting: True})
+    assert f"mpi_async_enabled can't be combined with {setting}" in str(e.value)
+    Settings(mpi_db_type="postgres", mpi_async_enabled=True)
+    Settings(mpi_db_type="postgres", **{setting: True})
+
+
+def test_linkage_invalid_algo_config():
+    test_bundle = load_test_bundle()
+    algo_config = {"algorithm": [{"funcs": {"first_name": "not_a_function"}}]}
+    actual_response = client.post(
+        "/link-record", json={"bundle": test_bundle, "algo_config": algo_config}
+    )
+    assert actual_response.status_code == status.HTTP_400_BAD_REQUEST
+    assert not actual_response.json()["found_match"]
+    assert actual_response.json()["message"].startswith(
+        "Invalid algorithm configuration:"
+    )
+
+
+def test_get_compiled_algorithm_caches_by_config():
+    from app.linkage.algorithms import DIBBS_BASIC
+    from app.main import get_compiled_algorithm
+
+    compiled = get_compiled_algorithm(copy.deepcopy(DIBBS_BASIC))
+    assert get_compiled_algorithm(copy.deepcopy(DIBBS_BASIC)) is compiled
+
+
 def test_linkage_success():
     test_bundle = load_test_bundle()
     entry_list = copy.deepcopy(test_bundle["entry"])
@@ -156,6 +188,56 @@ def test_linkage_success():
     assert not resp_6.json()["found_match"]
 
 
+def test_linkage_trace():
+    test_bundle = load_test_bundle()
+    entry_list = copy.deepcopy(test_bundle["entry"])
+
+    bundle_1 = copy.deepcopy(test_bundle)
+    bundle_1["entry"] = [entry_list[0]]
+    resp_1 = client.post("/link-record", json={"bundle": bundle_1})
+    assert resp_1.json()["trace"] is None
+
+    bundle_2 = copy.deepcopy(test_bundle)
+    bundle_2["entry"] = [entry_list[1]]
+    resp_2 = client.post(
+        "/link-record", json={"bundle": bundle_2, "include_trace": True}
+    )
+    assert resp_2.json()["found_match"]
+    trace = resp_2.json()["trace"]
+    assert trace["result"]["matched"]
+    person = [
+        r.get("resource")
+        for r in resp_2.json()["updated_bundle"]["entry"]
+        if r.get("resource").get("resourceType") == "Person"
+    ][0]
+    assert trace["result"]["person_id"] == person["id"]
+    matched_clusters = [
+        cluster
+        for traced_pass in trace["passes"]
+        for cluster in traced_pass["clusters"]
+        if cluster["person_id"] == person["id"]
+    ]
+    assert any(c["belongingness_ratio"] for c in matched_clusters)
+    assert any(len(c["comparisons"]) > 0 for c in matched_clusters)
+
+
+def test_metrics():
+    test_bundle = load_test_bundle()
+    for entry in test_bundle["entry"][:2]:
+        bundle = copy.deepcopy(test_bundle)
+        bundle["entry"] = [entry]
+        client.post("/link-record", json={"bundle": bundle})
+
+    actual_response = client.get("/metrics")
+    assert actual_response.status_code == 200
+    assert actual_response.headers["content-type"].startswith("text/plain")
+    for stage in ["extract_blocking_values", "fetch_block", "compare", "insert"]:
+        assert f'record_linkage_stage_seconds_count{{stage="{stage}"}}' in (
+            actual_response.text
+        )
+    assert "record_linkage_record_comparisons_total" in actual_response.text
+
+
 def test_use_enhanced_algo():
     test_bundle = load_test_bundle()
     entry_list = copy.deepcopy(test_bundle["entry"])
@@ -227,3 +309,69 @@ def test_use_enhanced_algo():
         if r.get("resource").get("resourceType") == "Person"
     ][0]
     assert not resp_6.json()["found_match"]
+
+
+def test_link_records_bundle_with_no_patient():
+    test_bundle = load_test_bundle()
+    bundle_1 = copy.deepcopy(test_bundle)
+    bundle_1["entry"] = [test_bundle["entry"][0]]
+    actual_response = client.post(
+        "/link-records",
+        json={"records": [{"bundle": bundle_1}, {"bundle": {"entry": []}}]},
+    )
+    assert actual_response.json() == {
+        "results": [],
+        "message": "Supplied bundle 1 contains no Patient resource to link on.",
+    }
+    assert actual_response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_link_records_invalid_algo_config():
+    test_bundle = load_test_bundle()
+    algo_config = {"algorithm": [{"funcs": {"first_name": "not_a_function"}}]}
+    actual_response = client.post(
+        "/link-records",
+        json={"records": [{"bundle": test_bundle}], "algo_config": algo_config},
+    )
+    assert actual_response.status_code == status.HTTP_400_BAD_REQUEST
+    assert actual_response.json()["results"] == []
+    assert actual_response.json()["message"].startswith(
+        "Invalid algorithm configuration:"
+    )
+
+
+@pytest.mark.parametrize(
+    "use_enhanced,expected_matches",
+    [
+        (False, [False, True, False, False, False, False]),
+        (True, [False, True, False, True, False, False]),
+    ],
+)
+def test_link_records_success(use_enhanced, expected_matches):
+    test_bundle = load_test_bundle()
+    records = []
+    for entry in test_bundle["entry"][:6]:
+        bundle = copy.deepcopy(test_bundle)
+        bundle["entry"] = [entry]
+        records.append({"bundle": bundle})
+
+    resp = client.post(
+        "/link-records", json={"records": records, "use_enhanced": use_enhanced}
+    )
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [result["found_match"] for result in results] == expected_matches
+
+    person_ids = [
+        [
+            r.get("resource")
+            for r in result["updated_bundle"]["entry"]
+            if r.get("resource").get("resourceType") == "Person"
+        ][0].get("id")
+        for result in results
+    ]
+    # The second record links to the first within the same batch
+    assert person_ids[1] == person_ids[0]
+    if use_enhanced:
+        assert person_ids[3] == person_ids[0]
+    assert len(set(person_ids)) == len(person_ids) - sum(expected_matches)
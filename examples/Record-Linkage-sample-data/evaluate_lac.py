@@ -1,3 +1,4 @@
+import os
 import time
 import warnings
 from typing import Union
@@ -411,6 +412,7 @@ matches = phdi_linkage_algorithm(
     use_log_odds_enhancement=True,
     idx_to_col=idx_to_col,
     log_odds=log_odds,
+    max_workers=os.cpu_count(),
 )
 end = time.time()
 
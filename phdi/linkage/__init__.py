@@ -1,5 +1,20 @@
 from phdi.linkage.algorithms import DIBBS_BASIC, DIBBS_ENHANCED
+from phdi.linkage.blocking import (
+    BlockingStrategy,
+    ExactBlocking,
+    MultiKeyBlocking,
+    PhoneticBlocking,
+    QGramLSHBlocking,
+    SortedNeighborhoodBlocking,
+    block_size_stats,
+)
+from phdi.linkage.clusters import (
+    DisjointSet,
+    cluster_match_lists,
+    score_cluster_labels,
+)
 from phdi.linkage.core import BaseMPIConnectorClient
+from phdi.linkage.em import calculate_em_log_odds, estimate_em_probs, fit_em_probs
 from phdi.linkage.link import (
     add_person_resource,
     block_data,
@@ -26,6 +41,11 @@ from phdi.linkage.link import (
     write_linkage_config,
 )
 from phdi.linkage.mpi import DIBBsMPIConnectorClient
+from phdi.linkage.scoring import (
+    evaluate_match_matrix,
+    match_records_pairwise,
+    score_feature_matrix,
+)
 from phdi.linkage.seed import convert_to_patient_fhir_resources
 from phdi.linkage.utils import datetime_to_str
 
@@ -34,11 +54,21 @@ __all__ = [
     "DIBBS_ENHANCED",
     "generate_hash_str",
     "block_data",
+    "BlockingStrategy",
+    "ExactBlocking",
+    "SortedNeighborhoodBlocking",
+    "PhoneticBlocking",
+    "QGramLSHBlocking",
+    "MultiKeyBlocking",
+    "block_size_stats",
     "match_within_block",
     "feature_match_exact",
     "feature_match_fuzzy_string",
     "eval_perfect_match",
     "compile_match_lists",
+    "DisjointSet",
+    "cluster_match_lists",
+    "score_cluster_labels",
     "feature_match_four_char",
     "perform_linkage_pass",
     "score_linkage_vs_truth",
@@ -50,6 +80,9 @@ __all__ = [
     "feature_match_log_odds_fuzzy_compare",
     "profile_log_odds",
     "eval_log_odds_cutoff",
+    "estimate_em_probs",
+    "fit_em_probs",
+    "calculate_em_log_odds",
     "BaseMPIConnectorClient",
     "extract_blocking_values_from_record",
     "write_linkage_config",
@@ -61,4 +94,7 @@ __all__ = [
     "convert_to_patient_fhir_resources",
     "DIBBsMPIConnectorClient",
     "datetime_to_str",
+    "score_feature_matrix",
+    "evaluate_match_matrix",
+    "match_records_pairwise",
 ]
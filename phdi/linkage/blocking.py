@@ -0,0 +1,352 @@
+import logging
+import zlib
+from abc import ABC, abstractmethod
+from itertools import product
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from phdi.harmonization.double_metaphone import DoubleMetaphone
+
+# Modulus of the universal hash functions used to compute MinHash signatures
+_MINHASH_PRIME = (1 << 31) - 1
+
+
+class BlockingStrategy(ABC):
+    """
+    Represents a way of partitioning a data set of records into blocks of
+    candidates to compare, for use in place of a list of blocking columns
+    in `block_data` and `perform_linkage_pass`. Implementing classes define
+    which records share a block; blocks may overlap, in which case a pair
+    of records can be compared (and matched) in more than one block. After
+    blocking, the distribution of block sizes is kept in `stats`.
+    """
+
+    def __init__(self):
+        self.stats = None
+
+    @abstractmethod
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        """
+        Returns the positions of the records in each block of a data set.
+
+        :param data: A pandas dataframe of records to block.
+        :return: A dictionary mapping each block key to an array of the
+          (zero-based) positions of the records in that block.
+        """
+        pass  # pragma: no cover
+
+    def block(self, data: pd.DataFrame) -> dict:
+        """
+        Generates a dictionary of blocked data, as `block_data` does, and
+        records the distribution of block sizes in `stats`.
+
+        :param data: A pandas dataframe of records to block.
+        :return: A dictionary with the keys as the blocks and the values as
+          the data within each block, stored as a list of lists.
+        """
+        rows = data.values.tolist()
+        blocked_data = {
+            key: [rows[i] for i in np.sort(indices)]
+            for key, indices in self.get_block_indices(data).items()
+        }
+        self.stats = block_size_stats(blocked_data)
+        logging.info(f"{type(self).__name__} block sizes: {self.stats}")
+        return blocked_data
+
+
+class ExactBlocking(BlockingStrategy):
+    """
+    Blocks records that share exact values in every one of a list of
+    columns, as `block_data` does. Records missing a value belong to no
+    block.
+    """
+
+    def __init__(self, columns: list[str]):
+        """
+        :param columns: The columns whose values records must share.
+        """
+        super().__init__()
+        self.columns = list(columns)
+
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        return dict(data.reset_index(drop=True).groupby(self.columns).indices)
+
+
+class SortedNeighborhoodBlocking(BlockingStrategy):
+    """
+    Sorts records by a key built from a list of columns and slides a window
+    over them, blocking the records in each window. Windows of `window`
+    records start every `window // 2` records, so records within
+    `window - window // 2` positions of each other in sort order always
+    share a block, and a common key value can never produce a block larger
+    than the window.
+    """
+
+    def __init__(self, columns: list[str], window: int = 10):
+        """
+        :param columns: The columns whose values, joined, form the sort key.
+        :param window: The number of records in each window.
+        :raises ValueError: If the window holds fewer than two records.
+        """
+        super().__init__()
+        if window < 2:
+            raise ValueError("A sorted neighborhood window must hold two records.")
+        self.columns = list(columns)
+        self.window = window
+
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        order = np.argsort(_sort_keys(data, self.columns), kind="stable")
+        return {
+            start: order[start : start + self.window]
+            for start in _window_starts(len(order), self.window)
+        }
+
+
+class PhoneticBlocking(BlockingStrategy):
+    """
+    Blocks records whose values in every one of a list of columns sound
+    alike, i.e. share a Double Metaphone encoding. A record is blocked by
+    its primary encodings and, if `use_secondary` is set, by every
+    combination of its primary and secondary encodings, so names spelled
+    differently (e.g. "Smith" and "Smyth") land in a common block. Records
+    missing a value, or whose value has no encoding, belong to no block.
+    """
+
+    def __init__(self, columns: list[str], use_secondary: bool = True):
+        """
+        :param columns: The columns to encode phonetically.
+        :param use_secondary: Whether to also block records by their
+          secondary encodings. Default is True.
+        """
+        super().__init__()
+        self.columns = list(columns)
+        self.use_secondary = use_secondary
+
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        dmeta = DoubleMetaphone()
+        encodings = {}
+        blocks = {}
+        columns = [data[c].tolist() for c in self.columns]
+        for position, values in enumerate(zip(*columns)):
+            value_codes = []
+            for value in values:
+                if _is_missing(value):
+                    break
+                if value not in encodings:
+                    primary, secondary = dmeta(str(value))
+                    codes = [primary]
+                    if self.use_secondary and secondary and secondary != primary:
+                        codes.append(secondary)
+                    encodings[value] = [code for code in codes if code]
+                if len(encodings[value]) == 0:
+                    break
+                value_codes.append(encodings[value])
+            else:
+                for key in product(*value_codes):
+                    blocks.setdefault(key, []).append(position)
+        return {key: np.array(positions) for key, positions in blocks.items()}
+
+
+class QGramLSHBlocking(BlockingStrategy):
+    """
+    Blocks records whose values in a list of columns share many q-grams,
+    using MinHash locality-sensitive hashing: each record's set of q-grams
+    is summarized by `num_bands * band_size` MinHash values, and records
+    agreeing on every value of a band share that band's block. Two records
+    whose q-gram sets have Jaccard similarity s share a block with
+    probability 1 - (1 - s ** band_size) ** num_bands, so typos and
+    transpositions are tolerated while unrelated records rarely collide.
+    """
+
+    def __init__(
+        self,
+        columns: list[str],
+        q: int = 2,
+        num_bands: int = 8,
+        band_size: int = 3,
+        seed: int = 0,
+    ):
+        """
+        :param columns: The columns whose values, joined, are split into
+          q-grams.
+        :param q: The number of characters in each q-gram. Default is 2.
+        :param num_bands: The number of bands of MinHash values, i.e. the
+          number of blocks each record belongs to. Default is 8.
+        :param band_size: The number of MinHash values in each band.
+          Default is 3.
+        :param seed: The seed of the MinHash functions. Default is 0.
+        """
+        super().__init__()
+        self.columns = list(columns)
+        self.q = q
+        self.num_bands = num_bands
+        self.band_size = band_size
+        rng = np.random.default_rng(seed)
+        n_hashes = num_bands * band_size
+        self._hash_a = rng.integers(1, _MINHASH_PRIME, n_hashes, dtype=np.int64)
+        self._hash_b = rng.integers(0, _MINHASH_PRIME, n_hashes, dtype=np.int64)
+
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        blocks = {}
+        for position, key in enumerate(_sort_keys(data, self.columns)):
+            grams = _qgram_hashes(key.lower(), self.q)
+            if len(grams) == 0:
+                continue
+            signature = (
+                (np.outer(grams, self._hash_a) + self._hash_b) % _MINHASH_PRIME
+            ).min(axis=0)
+            for band in range(self.num_bands):
+                band_values = signature[
+                    band * self.band_size : (band + 1) * self.band_size
+                ]
+                blocks.setdefault((band, *band_values.tolist()), []).append(position)
+        return {key: np.array(positions) for key, positions in blocks.items()}
+
+
+class MultiKeyBlocking(BlockingStrategy):
+    """
+    Blocks records by several blocking keys at once, so that a pair of
+    records is compared if any key blocks them together. Each key's blocks
+    can be capped in size: a block larger than its cap (e.g. a common last
+    name, or an address prefix such as "123 ") is split with sorted
+    neighborhood windows of that many records, sorted on `sort_columns`.
+    Similar records within a giant block stay close in sort order and
+    still share a window, so recall is kept while the pairs compared grow
+    linearly rather than quadratically with the block.
+    """
+
+    def __init__(
+        self,
+        strategies: list[BlockingStrategy],
+        max_block_size: Union[int, list, None] = None,
+        sort_columns: Union[list[str], None] = None,
+    ):
+        """
+        :param strategies: The blocking strategies, one per blocking key.
+        :param max_block_size: Optionally, the largest block to allow, either
+          for every key or as a list with an entry (or None) per key.
+          Default is None, meaning blocks aren't capped.
+        :param sort_columns: Optionally, the columns to sort the records of
+          a capped block on. Default is None, meaning every column.
+        :raises ValueError: If a cap is given per key for a different
+          number of keys.
+        """
+        super().__init__()
+        if not isinstance(max_block_size, list):
+            max_block_size = [max_block_size] * len(strategies)
+        if len(max_block_size) != len(strategies):
+            raise ValueError("A block size cap must be given for each blocking key.")
+        self.strategies = list(strategies)
+        self.max_block_sizes = max_block_size
+        self.sort_columns = sort_columns
+
+    def get_block_indices(self, data: pd.DataFrame) -> dict:
+        sort_columns = self.sort_columns
+        if sort_columns is None:
+            sort_columns = list(data.columns)
+        sort_keys = None
+
+        blocks = {}
+        capped_blocks = 0
+        for k, (strategy, max_block_size) in enumerate(
+            zip(self.strategies, self.max_block_sizes)
+        ):
+            for key, indices in strategy.get_block_indices(data).items():
+                if max_block_size is None or len(indices) <= max_block_size:
+                    blocks[(k, key)] = indices
+                    continue
+                capped_blocks += 1
+                if sort_keys is None:
+                    sort_keys = _sort_keys(data, sort_columns)
+                indices = np.asarray(indices)
+                indices = indices[np.argsort(sort_keys[indices], kind="stable")]
+                for start in _window_starts(len(indices), max_block_size):
+                    blocks[(k, key, start)] = indices[start : start + max_block_size]
+        self._capped_blocks = capped_blocks
+        return blocks
+
+    def block(self, data: pd.DataFrame) -> dict:
+        self._capped_blocks = 0
+        blocked_data = super().block(data)
+        self.stats["capped_blocks"] = self._capped_blocks
+        return blocked_data
+
+
+def block_size_stats(blocked_data: dict) -> dict:
+    """
+    Summarizes the distribution of block sizes in a dictionary of blocked
+    data, such as `block_data` returns. Giant blocks dominate the cost of
+    linkage, which grows with the number of pairs in each block.
+
+    :param blocked_data: A dictionary mapping blocks to lists of records.
+    :return: A dictionary of the number of blocks, the number of records
+      across blocks (counting a record once per block it's in), the
+      smallest, largest, mean, median and 95th percentile block sizes, and
+      the number of pairs of records compared within blocks.
+    """
+    sizes = np.array([len(block) for block in blocked_data.values()], dtype=np.int64)
+    if len(sizes) == 0:
+        sizes = np.zeros(1, dtype=np.int64)
+        n_blocks = 0
+    else:
+        n_blocks = len(sizes)
+    return {
+        "blocks": n_blocks,
+        "records": int(sizes.sum()),
+        "min": int(sizes.min()),
+        "max": int(sizes.max()),
+        "mean": float(sizes.mean()),
+        "median": float(np.median(sizes)),
+        "p95": float(np.percentile(sizes, 95)),
+        "pairs": int((sizes * (sizes - 1) // 2).sum()),
+    }
+
+
+def _is_missing(value) -> bool:
+    """
+    Helper method that determines whether a value is missing (None, NaN or
+    the empty string), meaning a record can't be blocked on it.
+    """
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+def _sort_keys(data: pd.DataFrame, columns: list[str]) -> np.ndarray:
+    """
+    Helper method that joins the values of the given columns of each record
+    into a string key, with missing values left empty.
+    """
+    keys = None
+    for c in columns:
+        values = data[c].astype(object).where(data[c].notna(), "").astype(str)
+        keys = values if keys is None else keys + " " + values
+    return keys.to_numpy(dtype=object)
+
+
+def _window_starts(n_records: int, window: int) -> list[int]:
+    """
+    Helper method that returns the starting positions of windows of
+    `window` records, starting every `window // 2` records, that together
+    cover `n_records` records.
+    """
+    if n_records == 0:
+        return []
+    step = max(1, window // 2)
+    starts = list(range(0, max(n_records - window, 0) + 1, step))
+    if starts[-1] + window < n_records:
+        starts.append(n_records - window)
+    return starts
+
+
+def _qgram_hashes(string: str, q: int) -> np.ndarray:
+    """
+    Helper method that returns a stable hash of each distinct q-gram of a
+    string, or of the whole string if it's shorter than q.
+    """
+    grams = {string[i : i + q] for i in range(max(len(string) - q + 1, 1))}
+    grams.discard("")
+    return np.array(
+        [zlib.crc32(gram.encode("utf-8")) & _MINHASH_PRIME for gram in grams],
+        dtype=np.int64,
+    )
@@ -0,0 +1,234 @@
+from collections import Counter
+from typing import Hashable, Iterable, Union
+
+
+class DisjointSet:
+    """
+    A disjoint-set (union-find) forest over record IDs, used to take the
+    transitive closure of matches: records linked by any chain of matches
+    end up in the same cluster. With path halving and union by size, a
+    sequence of unions and finds over n records runs in near-linear time.
+    """
+
+    def __init__(self, records: Iterable[Hashable] = ()):
+        """
+        Creates a forest in which each of the given records is a singleton.
+
+        :param records: Optionally, the records to start with.
+        """
+        self.parents = {}
+        self.sizes = {}
+        for record in records:
+            self.add(record)
+
+    def __contains__(self, record: Hashable) -> bool:
+        return record in self.parents
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def add(self, record: Hashable) -> None:
+        """
+        Adds a record as a singleton, if it isn't already in the forest.
+
+        :param record: The ID of the record.
+        """
+        if record not in self.parents:
+            self.parents[record] = record
+            self.sizes[record] = 1
+
+    def find(self, record: Hashable) -> Hashable:
+        """
+        Returns the root of the cluster a record belongs to, adding the
+        record as a singleton if it isn't in the forest yet.
+
+        :param record: The ID of the record.
+        :return: The ID of the root record of its cluster.
+        """
+        self.add(record)
+        parents = self.parents
+        while parents[record] != record:
+            # Path halving: point every other record on the path at its
+            # grandparent, flattening the tree as it's walked
+            parents[record] = parents[parents[record]]
+            record = parents[record]
+        return record
+
+    def union(self, record_i: Hashable, record_j: Hashable) -> Hashable:
+        """
+        Merges the clusters of two records, attaching the smaller cluster's
+        root to the larger's.
+
+        :param record_i: The ID of one record.
+        :param record_j: The ID of the other record.
+        :return: The ID of the root of the merged cluster.
+        """
+        root_i = self.find(record_i)
+        root_j = self.find(record_j)
+        if root_i == root_j:
+            return root_i
+        if self.sizes[root_i] < self.sizes[root_j]:
+            root_i, root_j = root_j, root_i
+        self.parents[root_j] = root_i
+        self.sizes[root_i] += self.sizes.pop(root_j)
+        return root_i
+
+    def union_all(self, records: Iterable[Hashable]) -> None:
+        """
+        Merges the clusters of every one of the given records.
+
+        :param records: The IDs of the records to merge, e.g. a matched pair
+          or a cluster.
+        """
+        first = None
+        for k, record in enumerate(records):
+            if k == 0:
+                first = record
+                self.add(first)
+            else:
+                self.union(first, record)
+
+    def labels(self) -> dict:
+        """
+        Returns the cluster label of each record, namely the ID of the root
+        of its cluster.
+
+        :return: A dictionary mapping each record to its cluster label.
+        """
+        return {record: self.find(record) for record in self.parents}
+
+    def clusters(self) -> list[set]:
+        """
+        Returns the clusters of the forest.
+
+        :return: A list of the sets of records in each cluster.
+        """
+        clusters = {}
+        for record in self.parents:
+            clusters.setdefault(self.find(record), set()).add(record)
+        return list(clusters.values())
+
+
+def cluster_match_lists(match_lists: list[dict]) -> DisjointSet:
+    """
+    Merges the matches found by every pass of a linkage algorithm into
+    clusters of records that are linked, directly or through other records,
+    by any match. Works on the output of `perform_linkage_pass` in either
+    pairwise or cluster mode, in time near-linear in the number of matches.
+
+    :param match_lists: A list of the dictionaries obtained during a run
+      of the linkage algorithm, one dictionary per rule used in the run.
+    :return: The forest of merged clusters.
+    """
+    forest = DisjointSet()
+    for matches_from_rule in match_lists:
+        for matches_within_blocks in matches_from_rule.values():
+            for candidate_set in matches_within_blocks:
+                forest.union_all(candidate_set)
+    return forest
+
+
+def cluster_matches(matches: dict[Hashable, set]) -> DisjointSet:
+    """
+    Builds the transitive closure of a dictionary of matches, such as that
+    returned by `compile_match_lists`, mapping records to the sets of other
+    records they match.
+
+    :param matches: A dictionary mapping record IDs to sets of the IDs of
+      the records they match.
+    :return: The forest of clusters.
+    """
+    forest = DisjointSet()
+    for root_record, matched_records in matches.items():
+        forest.add(root_record)
+        for matched_record in matched_records:
+            forest.union(root_record, matched_record)
+    return forest
+
+
+def count_cluster_pairs(labels: dict) -> int:
+    """
+    Counts the pairs of records that share a cluster, without enumerating
+    them: a cluster of k records holds k * (k - 1) / 2 pairs.
+
+    :param labels: A dictionary mapping records to cluster labels.
+    :return: The number of pairs of records in the same cluster.
+    """
+    return sum(k * (k - 1) // 2 for k in Counter(labels.values()).values())
+
+
+def score_cluster_labels(
+    found_labels: Union[dict, DisjointSet],
+    true_labels: Union[dict, DisjointSet],
+    records_in_dataset: int,
+) -> tuple:
+    """
+    Compute the statistical qualities of a run of record linkage against
+    known true clusters, from the cluster label of each record rather than
+    from every matching pair. Two records are a predicted match if they
+    share a found cluster, and a true match if they share a true cluster;
+    records without a label are singletons. Pairs are counted from the
+    sizes of clusters and of their intersections, in time linear in the
+    number of records.
+
+    :param found_labels: A dictionary mapping records to the labels of the
+      clusters found by linkage, or a forest of those clusters.
+    :param true_labels: A dictionary mapping records to the labels of their
+      true clusters, or a forest of those clusters.
+    :param records_in_dataset: The number of records in the original data
+      set to-link.
+    :return: A tuple reporting the sensitivity/precision, specificity/recall,
+      positive prediction value, and F1 score of the linkage algorithm.
+    """
+    if isinstance(found_labels, DisjointSet):
+        found_labels = found_labels.labels()
+    if isinstance(true_labels, DisjointSet):
+        true_labels = true_labels.labels()
+
+    # Pairs sharing both a found and a true cluster are true positives
+    shared_clusters = Counter(
+        (label, true_labels[record])
+        for record, label in found_labels.items()
+        if record in true_labels
+    )
+    true_positives = sum(k * (k - 1) // 2 for k in shared_clusters.values())
+    false_positives = count_cluster_pairs(found_labels) - true_positives
+    false_negatives = count_cluster_pairs(true_labels) - true_positives
+    return score_pair_counts(
+        true_positives, false_positives, false_negatives, records_in_dataset
+    )
+
+
+def score_pair_counts(
+    true_positives: float,
+    false_positives: float,
+    false_negatives: float,
+    records_in_dataset: int,
+) -> tuple:
+    """
+    Computes the statistical qualities of a run of record linkage from its
+    counts of true positive, false positive and false negative pairs, out
+    of every pair of records in the data set.
+
+    :param true_positives: The number of matched pairs that truly match.
+    :param false_positives: The number of matched pairs that don't truly
+      match.
+    :param false_negatives: The number of true matches that weren't matched.
+    :param records_in_dataset: The number of records in the data set.
+    :return: A tuple reporting the sensitivity/precision, specificity/recall,
+      positive prediction value, and F1 score.
+    """
+    # Need division by 2 because ordering is irrelevant, matches are symmetric
+    total_possible_matches = (records_in_dataset * (records_in_dataset - 1)) / 2.0
+    true_negatives = (
+        total_possible_matches - true_positives - false_positives - false_negatives
+    )
+
+    sensitivity = round(true_positives / (true_positives + false_negatives), 3)
+    specificity = round(true_negatives / (true_negatives + false_positives), 3)
+    ppv = round(true_positives / (true_positives + false_positives), 3)
+    f1 = round(
+        (2 * true_positives) / (2 * true_positives + false_negatives + false_positives),
+        3,
+    )
+    return (sensitivity, specificity, ppv, f1)
@@ -0,0 +1,369 @@
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, Union
+
+import numpy as np
+import pandas as pd
+
+from phdi.linkage.link import _write_prob_file, calculate_log_odds
+from phdi.linkage.pairs import RECORD_CHUNK_SIZE, get_record_columns, iter_record_chunks
+
+# Number of candidate pairs compared at once, which bounds the size of each
+# comparison matrix and is the unit of work handed to each worker process
+PAIR_CHUNK_SIZE = 1000000
+
+# Bounds within which estimated probabilities are kept, so that no
+# comparison pattern is ever impossible and log-odds are always finite
+EM_PROB_EPSILON = 1e-6
+
+# Comparison patterns are packed into the bits of a 64-bit integer
+_MAX_EM_COLUMNS = 62
+
+# The encoded columns of the records, set once in each worker process
+_WORKER_CODES = None
+
+
+def encode_columns(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    cols: list[str],
+    chunk_size: int = RECORD_CHUNK_SIZE,
+) -> np.ndarray:
+    """
+    Encodes the values of the given columns of a data set of records as
+    integer codes, such that two values share a code exactly when they're
+    equal. Missing values (None or NaN) are encoded as -1. Files are
+    streamed, so only the codes are held in memory.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :param cols: The columns to encode.
+    :param chunk_size: The number of records to read at once from a file.
+    :return: An array with a row of codes for each record and a column for
+      each of the given columns.
+    """
+    tables = [{} for _ in cols]
+    encoded_chunks = []
+    for chunk in iter_record_chunks(data, cols, chunk_size):
+        chunk_codes = np.empty((len(chunk), len(cols)), dtype=np.int64)
+        for k, c in enumerate(cols):
+            codes, uniques = pd.factorize(chunk[c], use_na_sentinel=True)
+            table = tables[k]
+            unique_codes = np.array(
+                [table.setdefault(value, len(table)) for value in uniques] + [-1],
+                dtype=np.int64,
+            )
+            # The sentinel -1 indexes the trailing -1 of the unique codes
+            chunk_codes[:, k] = unique_codes[codes]
+        encoded_chunks.append(chunk_codes)
+    if len(encoded_chunks) == 0:
+        return np.empty((0, len(cols)), dtype=np.int64)
+    return np.concatenate(encoded_chunks)
+
+
+def iter_block_pairs(
+    block_codes: np.ndarray, chunk_size: int = PAIR_CHUNK_SIZE
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Streams the candidate pairs of records that share a block, i.e. that
+    agree on every blocking column, as `block_data` groups them. Records
+    missing a blocking value belong to no block.
+
+    :param block_codes: The encoded blocking columns of the records, as
+      returned by `encode_columns`.
+    :param chunk_size: The number of pairs to yield at once; a chunk holds
+      fewer pairs only if it's the last, or more only if a single record
+      has that many candidates.
+    :return: An iterator of tuples of arrays of the lower and higher
+      position of each pair.
+    """
+    in_block = np.flatnonzero((block_codes >= 0).all(axis=1))
+    if len(in_block) == 0:
+        return
+    _, block_ids = np.unique(block_codes[in_block], axis=0, return_inverse=True)
+    order = np.argsort(block_ids.ravel(), kind="stable")
+    block_sizes = np.bincount(block_ids.ravel())
+    blocks = np.split(in_block[order], np.cumsum(block_sizes)[:-1])
+
+    firsts = []
+    seconds = []
+    n_pairs = 0
+    for block in blocks:
+        n_block = len(block)
+        if n_block * (n_block - 1) // 2 <= chunk_size:
+            i, j = np.triu_indices(n_block, 1)
+            firsts.append(block[i])
+            seconds.append(block[j])
+            n_pairs += len(i)
+        else:
+            # Too many pairs to enumerate at once; take them a record at a time
+            for i in range(n_block - 1):
+                firsts.append(np.full(n_block - i - 1, block[i]))
+                seconds.append(block[i + 1 :])
+                n_pairs += n_block - i - 1
+                if n_pairs >= chunk_size:
+                    yield np.concatenate(firsts), np.concatenate(seconds)
+                    firsts, seconds, n_pairs = [], [], 0
+        if n_pairs >= chunk_size:
+            yield np.concatenate(firsts), np.concatenate(seconds)
+            firsts, seconds, n_pairs = [], [], 0
+    if n_pairs > 0:
+        yield np.concatenate(firsts), np.concatenate(seconds)
+
+
+def count_comparison_patterns(
+    codes: np.ndarray,
+    pair_chunks: Iterator[tuple[np.ndarray, np.ndarray]],
+    max_workers: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compares every candidate pair of records on each encoded column and
+    counts how many pairs share each comparison vector, i.e. each pattern
+    of agreement and disagreement across the columns. Two values agree
+    when they're equal and not missing.
+
+    :param codes: The encoded comparison columns of the records, as
+      returned by `encode_columns`.
+    :param pair_chunks: An iterable of tuples of arrays of the positions of
+      the records in each candidate pair, such as `iter_block_pairs` yields.
+    :param max_workers: The number of processes to compare chunks of pairs
+      in. With a single worker, pairs are compared in this process.
+    :raises ValueError: If more columns are compared than can be packed
+      into a pattern.
+    :return: A tuple of a boolean array with a row for each observed
+      comparison vector, and an array of the number of pairs sharing it.
+    """
+    n_cols = codes.shape[1]
+    if n_cols > _MAX_EM_COLUMNS:
+        raise ValueError(f"At most {_MAX_EM_COLUMNS} columns can be compared.")
+
+    pattern_counts = {}
+    if max_workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_pattern_worker,
+            initargs=(codes,),
+        ) as executor:
+            futures = [
+                executor.submit(_count_pattern_chunk, None, first, second)
+                for first, second in pair_chunks
+            ]
+            chunk_counts = [future.result() for future in futures]
+    else:
+        chunk_counts = (
+            _count_pattern_chunk(codes, first, second) for first, second in pair_chunks
+        )
+    for packed, counts in chunk_counts:
+        for pattern, count in zip(packed.tolist(), counts.tolist()):
+            pattern_counts[pattern] = pattern_counts.get(pattern, 0) + count
+
+    packed = np.array(sorted(pattern_counts), dtype=np.int64)
+    counts = np.array([pattern_counts[p] for p in packed.tolist()], dtype=np.int64)
+    patterns = ((packed[:, None] >> np.arange(n_cols)) & 1).astype(bool)
+    return patterns, counts
+
+
+def fit_em_probs(
+    patterns: np.ndarray,
+    counts: np.ndarray,
+    cols: list[str],
+    m_init: Union[dict, None] = None,
+    u_init: Union[dict, None] = None,
+    match_prob_init: float = 0.1,
+    max_iter: int = 100,
+    tol: float = 1e-6,
+) -> tuple[dict, dict, float]:
+    """
+    Fits the Fellegi-Sunter model of comparison vectors to observed counts
+    with Expectation-Maximization. Candidate pairs are modeled as a mixture
+    of matches and non-matches, in which each column agrees independently
+    with its m-probability among matches and its u-probability among
+    non-matches. Each iteration weighs every distinct comparison vector by
+    its posterior probability of being a match (the E-step), then
+    re-estimates the probabilities from the weighted counts (the M-step),
+    so an iteration costs the same however many pairs share a vector.
+
+    :param patterns: A boolean array with a row for each comparison vector
+      and a column for each compared column.
+    :param counts: The number of candidate pairs sharing each vector.
+    :param cols: The names of the compared columns, in order.
+    :param m_init: Optionally, a dictionary of starting m-probabilities per
+      column. Columns not supplied start at 0.9.
+    :param u_init: Optionally, a dictionary of starting u-probabilities per
+      column. Columns not supplied start at their rate of agreement across
+      all candidate pairs, most of which are non-matches.
+    :param match_prob_init: The starting proportion of candidate pairs that
+      are matches. Default is 0.1.
+    :param max_iter: The maximum number of iterations. Default is 100.
+    :param tol: The largest change in any probability between iterations
+      at which the fit is deemed converged. Default is 1e-6.
+    :raises ValueError: If no candidate pairs were compared.
+    :return: A tuple of dictionaries of the m- and u-probabilities of each
+      column, and the proportion of candidate pairs that are matches.
+    """
+    gamma = np.asarray(patterns, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        raise ValueError("At least one candidate pair must be compared.")
+    if m_init is None:
+        m_init = {}
+    if u_init is None:
+        u_init = {}
+
+    agreement = (counts @ gamma) / total
+    m = np.array([m_init.get(c, 0.9) for c in cols], dtype=np.float64)
+    u = np.array(
+        [u_init.get(c, agreement[k]) for k, c in enumerate(cols)], dtype=np.float64
+    )
+    m = np.clip(m, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON)
+    u = np.clip(u, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON)
+    match_prob = float(np.clip(match_prob_init, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON))
+
+    for _ in range(max_iter):
+        # E-step: posterior probability that each comparison vector is a match
+        log_match = np.log(match_prob) + gamma @ np.log(m) + (1 - gamma) @ np.log(1 - m)
+        log_non_match = (
+            np.log(1 - match_prob) + gamma @ np.log(u) + (1 - gamma) @ np.log(1 - u)
+        )
+        weights = 1.0 / (1.0 + np.exp(log_non_match - log_match))
+
+        # M-step: re-estimate the probabilities from the weighted counts
+        match_counts = counts * weights
+        non_match_counts = counts - match_counts
+        n_matches = match_counts.sum()
+        n_non_matches = non_match_counts.sum()
+        new_m = m if n_matches == 0 else (match_counts @ gamma) / n_matches
+        new_u = u if n_non_matches == 0 else (non_match_counts @ gamma) / n_non_matches
+        new_m = np.clip(new_m, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON)
+        new_u = np.clip(new_u, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON)
+        new_match_prob = float(
+            np.clip(n_matches / total, EM_PROB_EPSILON, 1 - EM_PROB_EPSILON)
+        )
+
+        change = max(
+            np.abs(new_m - m).max(initial=0.0),
+            np.abs(new_u - u).max(initial=0.0),
+            abs(new_match_prob - match_prob),
+        )
+        m, u, match_prob = new_m, new_u, new_match_prob
+        if change < tol:
+            break
+
+    m_probs = {c: float(m[k]) for k, c in enumerate(cols)}
+    u_probs = {c: float(u[k]) for k, c in enumerate(cols)}
+    return m_probs, u_probs, match_prob
+
+
+def estimate_em_probs(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    blocks: list[str],
+    cols: Union[list[str], None] = None,
+    max_iter: int = 100,
+    tol: float = 1e-6,
+    max_workers: int = 1,
+    chunk_size: int = RECORD_CHUNK_SIZE,
+    pair_chunk_size: int = PAIR_CHUNK_SIZE,
+    m_file_to_write: Union[pathlib.Path, None] = None,
+    u_file_to_write: Union[pathlib.Path, None] = None,
+) -> tuple[dict, dict]:
+    """
+    For a given set of patient records, estimate the per-field m- and
+    u-probabilities without any known true matches. The records are
+    blocked on the given columns, as `block_data` blocks them, every pair
+    of records sharing a block is compared on each field, and the
+    Fellegi-Sunter model is fit to the resulting comparison vectors with
+    Expectation-Maximization (see `fit_em_probs`).
+
+    Records are encoded once, streaming them from a parquet or CSV file
+    if given one, and pairs are compared in chunks, optionally across a
+    pool of processes, so the number of candidate pairs only bounds the
+    running time.
+
+    :param data: A pandas dataframe of patient records to compute
+      probabilities for, or the path of a parquet or CSV file of them.
+    :param blocks: The columns to block the records on.
+    :param cols: Optionally, a list of columns to compute probabilities
+      for. If not supplied, computes probabilities across all fields that
+      aren't blocked on. Default is None.
+    :param max_iter: The maximum number of EM iterations. Default is 100.
+    :param tol: The change in probabilities at which EM is deemed
+      converged. Default is 1e-6.
+    :param max_workers: The number of processes to compare pairs in.
+      Default is 1, comparing them in this process.
+    :param chunk_size: The number of records to read at once when streaming
+      a file. Default is `RECORD_CHUNK_SIZE`.
+    :param pair_chunk_size: The number of pairs to compare at once. Default
+      is `PAIR_CHUNK_SIZE`.
+    :param m_file_to_write: Optionally, a destination filepath at which to
+      write the m-probabilities in JSON format. Default is None.
+    :param u_file_to_write: Optionally, a destination filepath at which to
+      write the u-probabilities in JSON format. Default is None.
+    :return: A tuple of dictionaries of the m- and u-probabilities of each
+      column.
+    """
+    if cols is None:
+        cols = [c for c in get_record_columns(data) if c not in blocks]
+    block_codes = encode_columns(data, blocks, chunk_size)
+    codes = encode_columns(data, cols, chunk_size)
+    patterns, counts = count_comparison_patterns(
+        codes, iter_block_pairs(block_codes, pair_chunk_size), max_workers
+    )
+    m_probs, u_probs, _ = fit_em_probs(
+        patterns, counts, cols, max_iter=max_iter, tol=tol
+    )
+    _write_prob_file(m_probs, m_file_to_write)
+    _write_prob_file(u_probs, u_file_to_write)
+    return m_probs, u_probs
+
+
+def calculate_em_log_odds(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    blocks: list[str],
+    cols: Union[list[str], None] = None,
+    file_to_write: Union[pathlib.Path, None] = None,
+    **kwargs,
+) -> dict:
+    """
+    Calculate the per-field log odds ratio scores of a set of patient
+    records without any known true matches, from the m- and u-probabilities
+    estimated by `estimate_em_probs`. The result can be used as the
+    `log_odds` keyword argument of an algorithm such as `DIBBS_ENHANCED`,
+    whose `eval_log_odds_cutoff` rule weighs feature comparisons by it.
+
+    :param data: A pandas dataframe of patient records, or the path of a
+      parquet or CSV file of them.
+    :param blocks: The columns to block the records on.
+    :param cols: Optionally, a list of columns to compute log-odds for.
+      Default is None, meaning all fields that aren't blocked on.
+    :param file_to_write: Optionally, a destination filepath at which to
+      write the log-odds in JSON format. Default is None.
+    :param **kwargs: Keyword arguments forwarded to `estimate_em_probs`.
+    :return: A dictionary mapping each column to its log-odds score.
+    """
+    m_probs, u_probs = estimate_em_probs(data, blocks, cols, **kwargs)
+    return calculate_log_odds(m_probs, u_probs, file_to_write)
+
+
+def _init_pattern_worker(codes: np.ndarray) -> None:
+    """
+    Helper method that hands the encoded records to a worker process once,
+    rather than with every chunk of pairs it compares.
+    """
+    global _WORKER_CODES
+    _WORKER_CODES = codes
+
+
+def _count_pattern_chunk(
+    codes: Union[np.ndarray, None], first: np.ndarray, second: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Helper method that compares a chunk of candidate pairs on every encoded
+    column and counts the pairs sharing each packed comparison vector. If no
+    codes are given, those handed to the worker process are used.
+    """
+    if codes is None:
+        codes = _WORKER_CODES
+    codes_i = codes[first]
+    agree = (codes_i == codes[second]) & (codes_i >= 0)
+    packed = agree.astype(np.int64) @ (np.int64(1) << np.arange(codes.shape[1]))
+    return np.unique(packed, return_counts=True)
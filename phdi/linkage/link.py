@@ -4,18 +4,43 @@ import hashlib
 import json
 import logging
 import pathlib
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
 from math import log
 from random import sample
 from typing import Callable, Union
 
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 from pydantic import Field
 
 from phdi.fhir.utils import extract_value_with_resource_path
 from phdi.harmonization.utils import compare_strings
+from phdi.linkage.blocking import BlockingStrategy
+from phdi.linkage.clusters import (
+    cluster_match_lists,
+    cluster_matches,
+    count_cluster_pairs,
+    score_pair_counts,
+)
 from phdi.linkage.mpi import BaseMPIConnectorClient, DIBBsMPIConnectorClient
+from phdi.linkage.pairs import (
+    RECORD_CHUNK_SIZE,
+    count_equal_value_pairs,
+    count_equal_values,
+    count_records,
+    gather_column_values,
+    get_record_columns,
+    sample_non_match_pairs,
+    true_match_pairs,
+)
+from phdi.linkage.scoring import (
+    SCORING_CHUNK_SIZE,
+    evaluate_match_matrix,
+    match_records_pairwise,
+    score_feature_matrix,
+)
 from phdi.linkage.utils import datetime_to_str
 
 LINKING_FIELDS_TO_FHIRPATHS = {
@@ -30,19 +55,28 @@ LINKING_FIELDS_TO_FHIRPATHS = {
     "mrn": "Patient.identifier.where(type.coding.code='MR').value",
 }
 
+# Number of candidate pairs batched into each task when blocks are matched
+# in a pool of processes, so small blocks don't each cost a round trip
+PARALLEL_TASK_PAIRS = 1000000
 
-def block_data(data: pd.DataFrame, blocks: list) -> dict:
+
+def block_data(data: pd.DataFrame, blocks: Union[list, BlockingStrategy]) -> dict:
     """
     Generates dictionary of blocked data where each key is a block
     and each value is a distinct list of lists containing the data
     for a given block.
 
     :param data: A pandas dataframe of records to be linked.
-    :param blocks: list of columns to be used in blocks.
+    :param blocks: list of columns to be used in blocks, or a blocking
+      strategy (such as sorted neighborhood, phonetic or q-gram blocking)
+      that determines the blocks instead.
     :return: A dictionary of with the keys as the blocks and the
       values as the data within each block, stored as a list of
       lists.
     """
+    if isinstance(blocks, BlockingStrategy):
+        return blocks.block(data)
+
     blocked_data_tuples = tuple(data.groupby(blocks))
 
     # Convert data to list of lists within dict
@@ -87,10 +121,11 @@ def calculate_log_odds(
 # examination, it does come with substantial overhead. Maybe make this work
 # on a list of lists at some point.
 def calculate_m_probs(
-    data: pd.DataFrame,
+    data: Union[pd.DataFrame, pathlib.Path, str],
     true_matches: dict,
     cols: Union[list[str], None] = None,
     file_to_write: Union[pathlib.Path, None] = None,
+    chunk_size: int = RECORD_CHUNK_SIZE,
 ):
     """
     For a given set of patient records, calculate the per-field
@@ -100,46 +135,52 @@ def calculate_m_probs(
     incorporates LaPlacian Smoothing to account for unseen data and
     to resolve future logarithms against 0.
 
+    The values of the records in true matching pairs are looked up once
+    and compared a column at a time, so large data sets can be streamed
+    from a parquet or CSV file rather than loaded whole.
+
     :param data: A pandas dataframe of patient records to compute
-      probabilities for.
+      probabilities for, or the path of a parquet or CSV file of them.
     :param true_matches: A dictionary holding the IDs of record pairs
       that are true matches in the data set. The format of the dictionary
       should be such that the IDs of the "lower numbered" records in each
       match pair are the keys, and the values are sets of the "higher
-      numbered" records in each pair.
+      numbered" records in each pair. IDs are the positions of the records
+      in the data set.
     :param cols: Optionally, a list of columns to compute probabilities
       for. If not supplied, computes probabilities across all fields.
       Default is None.
     :param file_to_write: Optionally, a destination filepath at which to
       write the probabilities in JSON format. Default is None.
+    :param chunk_size: Optionally, the number of records to read at once
+      when streaming a file. Default is `RECORD_CHUNK_SIZE`.
     """
     if cols is None:
-        cols = data.columns
+        cols = get_record_columns(data)
+    first, second = true_match_pairs(true_matches)
+    values = gather_column_values(
+        data, cols, np.concatenate([first, second]), chunk_size
+    )
+
     m_probs = {c: 1.0 for c in cols}
-    total_pairs = 1.0
-    for root_record, paired_records in true_matches.items():
-        total_pairs += len(paired_records)
-        for pr in paired_records:
-            for c in cols:
-                if data[c].iloc[root_record] == data[c].iloc[pr]:
-                    m_probs[c] += 1
+    total_pairs = 1.0 + len(first)
     for c in cols:
+        m_probs[c] += count_equal_values(
+            values[c][: len(first)], values[c][len(first) :]
+        )
         m_probs[c] /= total_pairs
 
     _write_prob_file(m_probs, file_to_write)
     return m_probs
 
 
-# TODO: We will eventually want to move away from pandas in favor of something
-# more light-weight. While pandas is good for pre-computing and model
-# examination, it does come with substantial overhead. Maybe make this work
-# on a list of lists at some point.
 def calculate_u_probs(
-    data: pd.DataFrame,
+    data: Union[pd.DataFrame, pathlib.Path, str],
     true_matches: dict,
     n_samples: Union[int, None] = None,
     cols: Union[list, None] = None,
     file_to_write: Union[pathlib.Path, None] = None,
+    chunk_size: int = RECORD_CHUNK_SIZE,
 ):
     """
     For a given set of patient records, calculate the per-field
@@ -149,19 +190,23 @@ def calculate_u_probs(
     incorporates LaPlacian Smoothing to account for unseen data and
     to handle future logarithms against 0.
 
-    Note: This function can be slow to compute for large data sets.
-    It is recommended to pass only a representative subsample of the
-    data to the function (we recommend sampling ~25k candidate pairs
-    from a sub-sample of ~25k records), even if the sample operation
-    is used.
+    Pairs of records are never enumerated. When sampling, the sampled
+    non-matching pairs are drawn by their position among all non-matching
+    pairs and then looked up, which draws the same pairs, for the same
+    random state, as sampling from a list of every non-matching pair.
+    Otherwise, equal values are counted across all pairs from each column's
+    value counts, less those among the true matches. Either way, memory
+    use doesn't grow with the number of pairs, and large data sets can be
+    streamed from a parquet or CSV file rather than loaded whole.
 
     :param data: A pandas dataframe of patient records to compute
-      probabilities for.
+      probabilities for, or the path of a parquet or CSV file of them.
     :param true_matches: A dictionary holding the IDs of record pairs
       that are true matches in the data set. The format of the dictionary
       should be such that the IDs of the "lower numbered" records in each
       match pair are the keys, and the values are sets of the "higher
-      numbered" records in each pair.
+      numbered" records in each pair. IDs are the positions of the records
+      in the data set.
     :param n_samples: Optionally, a number of samples to take from the
       list of possible pairs to compute probabilities over.
     :param cols: Optionally, a list of columns to compute probabilities
@@ -169,38 +214,50 @@ def calculate_u_probs(
       Default is None.
     :param file_to_write: Optionally, a destination filepath at which to
       write the probabilities in JSON format. Default is None.
+    :param chunk_size: Optionally, the number of records to read at once
+      when streaming a file. Default is `RECORD_CHUNK_SIZE`.
     """
     if cols is None:
-        cols = data.columns
+        cols = get_record_columns(data)
 
     u_probs = {c: 1.0 for c in cols}
 
     # Want only the pairs of candidates that aren't true matches
-    base_pairs = list(combinations(data.index, 2))
-    neg_pairs = [
-        x
-        for x in base_pairs
-        if x[0] not in true_matches or x[1] not in true_matches[x[0]]
-    ]
-
-    if n_samples is not None and n_samples < len(neg_pairs):
-        neg_pairs = sample(neg_pairs, n_samples)
-    for index in neg_pairs:
+    n_records = count_records(data, chunk_size)
+    first, second, n_non_matches = sample_non_match_pairs(
+        n_records, true_matches, n_samples
+    )
+    if first is not None:
+        values = gather_column_values(
+            data, cols, np.concatenate([first, second]), chunk_size
+        )
         for c in cols:
-            if data[c].iloc[index[0]] == data[c].iloc[index[1]]:
-                u_probs[c] += 1.0
-
-    for c in cols:
-        if n_samples is not None and n_samples < len(neg_pairs):
-            u_probs[c] = u_probs[c] / (n_samples + 1.0)
-        else:
-            u_probs[c] = u_probs[c] / (len(neg_pairs) + 1.0)
+            u_probs[c] += count_equal_values(
+                values[c][: len(first)], values[c][len(first) :]
+            )
+            u_probs[c] /= n_samples + 1.0
+    else:
+        # Every pair of equal values, less those among the true matches
+        equal_pairs = count_equal_value_pairs(data, cols, chunk_size)
+        first, second = true_match_pairs(true_matches)
+        valid = (first >= 0) & (first < second) & (second < n_records)
+        pairs = np.unique(np.stack([first[valid], second[valid]]), axis=1)
+        values = gather_column_values(
+            data, cols, np.concatenate([pairs[0], pairs[1]]), chunk_size
+        )
+        for c in cols:
+            u_probs[c] += equal_pairs[c] - count_equal_values(
+                values[c][: pairs.shape[1]], values[c][pairs.shape[1] :]
+            )
+            u_probs[c] /= n_non_matches + 1.0
 
     _write_prob_file(u_probs, file_to_write)
     return u_probs
 
 
-def compile_match_lists(match_lists: list[dict], cluster_mode: bool = False):
+def compile_match_lists(
+    match_lists: list[dict], cluster_mode: bool = False, transitive: bool = False
+):
     """
     Turns a list of matches of either clusters or candidate pairs found
     during linkage into a single unified structure holding all found matches
@@ -215,8 +272,21 @@ def compile_match_lists(match_lists: list[dict], cluster_mode: bool = False):
       of the linkage algorithm, one dictionary per rule used in the run.
     :param cluster_mode: An optional boolean indicating whether the linkage
       algorithm was run in cluster mode. Default is False.
+    :param transitive: An optional boolean indicating whether to merge the
+      matches into person clusters, linking records matched through any
+      chain of other records, with a disjoint-set forest. The dictionary
+      then maps the lowest ID of each cluster to the other records in it,
+      as in cluster mode, and is built in near-linear time. Default is False.
     :return: The aggregated dictionary of unified matches.
     """
+    if transitive:
+        matches = {}
+        for cluster in cluster_match_lists(match_lists).clusters():
+            if len(cluster) > 1:
+                root_record = min(cluster)
+                matches[root_record] = cluster - {root_record}
+        return matches
+
     matches = {}
     for matches_from_rule in match_lists:
         for matches_within_blocks in matches_from_rule.values():
@@ -639,26 +709,29 @@ def link_record_against_mpi(
 
             # Check if incoming record should belong to one of the person clusters
             kwargs = linkage_pass.get("kwargs", {})
-            for person in clusters:
-                num_matched_in_cluster = 0.0
-                for linked_patient in clusters[person]:
-                    logging.info(
-                        f"Starting _compare_records at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
-                    )
-                    is_match = _compare_records(
-                        flattened_record,
-                        linked_patient,
-                        linkage_pass["funcs"],
-                        col_to_idx,
-                        linkage_pass["matching_rule"],
-                        **kwargs,
-                    )
-                    logging.info(
-                        f"Done with _compare_records at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            logging.info(
+                f"Starting _compare_records_in_block at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            )
+            is_match = _compare_records_in_block(
+                flattened_record,
+                data_block,
+                linkage_pass["funcs"],
+                col_to_idx,
+                linkage_pass["matching_rule"],
+                **kwargs,
+            )
+            logging.info(
+                f"Done with _compare_records_in_block at:{datetime.datetime.now().strftime('%m-%d-%yT%H:%M:%S.%f')}"  # noqa
+            )
+            matches_by_person = {}
+            for mpi_patient, patient_matched in zip(data_block, is_match.tolist()):
+                if patient_matched:
+                    matches_by_person[mpi_patient[1]] = (
+                        matches_by_person.get(mpi_patient[1], 0.0) + 1.0
                     )
 
-                    if is_match:
-                        num_matched_in_cluster += 1.0
+            for person in clusters:
+                num_matched_in_cluster = matches_by_person.get(person, 0.0)
 
                 # Update membership score for this person cluster so that we can
                 # track best possible link across multiple passes
@@ -773,22 +846,21 @@ def match_within_block(
     """
     match_pairs = []
 
-    # Dynamic programming table: order doesn't matter, so only need to
-    # check each combo of i,j once
-    for i, record_i in enumerate(block):
-        for j in range(i + 1, len(block)):
-            record_j = block[j]
-            feature_comps = [
-                feature_funcs[feature_col](
-                    record_i, record_j, feature_col, col_to_idx, **kwargs
-                )
-                for feature_col in feature_funcs
-            ]
-
-            # If it's a match, store the result
-            is_match = match_eval(feature_comps, **kwargs)
-            if is_match:
-                match_pairs.append((i, j))
+    # Order doesn't matter, so only need to check each combo of i,j once:
+    # score the block a chunk of rows at a time against every later record,
+    # itself a chunk of columns at a time
+    for start in range(0, len(block), SCORING_CHUNK_SIZE):
+        match_pairs.extend(
+            (i + start, j + start)
+            for i, j in _match_leading_records(
+                block[start:],
+                SCORING_CHUNK_SIZE,
+                feature_funcs,
+                col_to_idx,
+                match_eval,
+                **kwargs,
+            )
+        )
 
     return match_pairs
 
@@ -803,6 +875,7 @@ def perform_linkage_pass(
     feature_funcs: dict[str, Callable],
     matching_rule: Callable,
     cluster_ratio: Union[float, None] = None,
+    max_workers: int = 1,
     **kwargs,
 ) -> dict:
     """
@@ -810,10 +883,20 @@ def perform_linkage_pass(
     Each rule in an algorithm is associated with its own pass through the
     data.
 
+    With more than one worker, blocks are matched in a pool of processes.
+    Blocks are scheduled by size: the largest start first, blocks too large
+    for one task are split into chunks of `SCORING_CHUNK_SIZE` rows (unless
+    clustering, which must see a block whole), and small blocks are batched
+    into tasks of about `PARALLEL_TASK_PAIRS` candidate pairs. The matches
+    found are the same as when matching blocks one after another. Feature
+    functions and the matching rule must then be picklable, i.e. defined at
+    the top level of a module.
+
     :param data: Currently, a pandas dataframe of records to link. When we
       move out of testing, this should become a LoL.
     :param blocks: A list of column headers to use as blocking assignments
-      by which to partition the data.
+      by which to partition the data, or a blocking strategy to partition
+      it with (see `block_data`).
     :param feature_funcs: A dictionary mapping feature indices to functions
       used to evaluate those features for a match.
     :param matching_rule: A function for determining whether a given set of
@@ -821,6 +904,8 @@ def perform_linkage_pass(
     :param cluster_ratio: An optional parameter indicating, if using the
       algorithm in cluster mode, the required membership percentage a record
       must score with an existing cluster in order to join.
+    :param max_workers: The number of processes to match blocks in. Default
+      is 1, matching blocks one after another in this process.
     :return: A dictionary mapping each block found in the pass to the matches
       discovered within that block.
     """
@@ -829,6 +914,16 @@ def perform_linkage_pass(
     col_to_idx = dict(zip(cols, range(len(cols))))
 
     blocked_data = block_data(data, blocks)
+    if max_workers > 1:
+        return _perform_linkage_pass_in_processes(
+            blocked_data,
+            feature_funcs,
+            col_to_idx,
+            matching_rule,
+            cluster_ratio,
+            max_workers,
+            **kwargs,
+        )
     matches = {}
     for block in blocked_data:
         if cluster_ratio:
@@ -1006,35 +1101,38 @@ def score_linkage_vs_truth(
       other records which are _known_ to be a true match.
     :param records_in_dataset: The number of records in the original data
       set to-link.
-    :param expand_clusters_pairwise: Optionally, whether we need to take
-      the cross-product of members within the sets of the match list. This
+    :param expand_clusters_pairwise: Optionally, whether the sets of the
+      match list are clusters whose members all match one another. This
       parameter only needs to be used if the linkage algorithm was run in
-      cluster mode. Default is False.
+      cluster mode, or matches were compiled transitively. Clusters are
+      merged in a disjoint-set forest and their pairs counted from their
+      sizes rather than enumerated. Default is False.
     :return: A tuple reporting the sensitivity/precision, specificity/recall,
       positive prediction value, and F1 score of the linkage algorithm.
     """
-
-    # If cluster mode was used, only the "master" patient's set will exist
-    # Need to expand other permutations for accurate statistics
-    if expand_clusters_pairwise:
-        new_found_matches = {}
-        for root_rec in found_matches:
-            if root_rec not in new_found_matches:
-                new_found_matches[root_rec] = found_matches[root_rec]
-            for paired_record in found_matches[root_rec]:
-                if paired_record not in new_found_matches:
-                    new_found_matches[paired_record] = set()
-                for other_record in found_matches[root_rec]:
-                    if other_record > paired_record:
-                        new_found_matches[paired_record].add(other_record)
-        found_matches = new_found_matches
-
-    # Need division by 2 because ordering is irrelevant, matches are symmetric
-    total_possible_matches = (records_in_dataset * (records_in_dataset - 1)) / 2.0
     true_positives = 0.0
     false_positives = 0.0
     false_negatives = 0.0
 
+    # If cluster mode was used, only the "master" patient's set will exist,
+    # so count the pairs within each cluster rather than listing them
+    if expand_clusters_pairwise:
+        forest = cluster_matches(found_matches)
+        for root_record, paired_records in true_matches.items():
+            for paired_record in paired_records:
+                if (
+                    root_record in forest
+                    and paired_record in forest
+                    and forest.find(root_record) == forest.find(paired_record)
+                ):
+                    true_positives += 1
+                else:
+                    false_negatives += 1
+        false_positives = count_cluster_pairs(forest.labels()) - true_positives
+        return _print_and_score_pair_counts(
+            true_positives, false_positives, false_negatives, records_in_dataset
+        )
+
     for root_record in true_matches:
         if root_record in found_matches:
             true_positives += len(
@@ -1051,23 +1149,10 @@ def score_linkage_vs_truth(
     for record in set(set(found_matches.keys()).difference(true_matches.keys())):
         false_positives += len(found_matches[record])
 
-    true_negatives = (
-        total_possible_matches - true_positives - false_positives - false_negatives
+    return _print_and_score_pair_counts(
+        true_positives, false_positives, false_negatives, records_in_dataset
     )
 
-    print("True Positives:", true_positives)
-    print("False Positives:", false_positives)
-    print("False Negatives:", false_negatives)
-
-    sensitivity = round(true_positives / (true_positives + false_negatives), 3)
-    specificity = round(true_negatives / (true_negatives + false_positives), 3)
-    ppv = round(true_positives / (true_positives + false_positives), 3)
-    f1 = round(
-        (2 * true_positives) / (2 * true_positives + false_negatives + false_positives),
-        3,
-    )
-    return (sensitivity, specificity, ppv, f1)
-
 
 def write_linkage_config(linkage_algo: list[dict], file_to_write: pathlib.Path) -> None:
     """
@@ -1161,22 +1246,20 @@ def _eval_record_in_cluster(
     """
     A helper function used to evaluate whether a given incoming record
     satisfies the matching proportion threshold of an existing cluster,
-    and therefore would belong to the cluster.
-    """
-    record_i = block[i]
-    num_matched = 0.0
-    for j in cluster:
-        record_j = block[j]
-        feature_comps = [
-            feature_funcs[feature_col](
-                record_i, record_j, feature_col, col_to_idx, **kwargs
-            )
-            for feature_col in feature_funcs
-        ]
-
-        is_match = match_eval(feature_comps)
-        if is_match:
-            num_matched += 1.0
+    and therefore would belong to the cluster. The record is scored
+    against the cluster's members at once; evaluation rules are called
+    without keyword arguments, as in the pairwise implementation.
+    """
+    is_match = match_records_pairwise(
+        [block[i]],
+        [block[j] for j in sorted(cluster)],
+        feature_funcs,
+        col_to_idx,
+        match_eval,
+        eval_kwargs={},
+        **kwargs,
+    )
+    num_matched = float(np.count_nonzero(is_match))
     if (num_matched / len(cluster)) >= cluster_ratio:
         return True
     return False
@@ -1212,6 +1295,89 @@ def _compare_records(
     return is_match
 
 
+def _compare_records_in_block(
+    record: list,
+    data_block: list[list],
+    feature_funcs: dict,
+    col_to_idx: dict[str, int],
+    matching_rule: callable,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Batched form of `_compare_records`: compares the flattened form of an
+    incoming new patient record to every flattened patient record in a block
+    pulled from the MPI at once, returning one match decision per MPI patient.
+    """
+    # Format is patient_id, person_id, alphabetical list of FHIR keys
+    # Don't use the first two ID cols when linking
+    record = record[2:]
+    mpi_patients = [mpi_patient[2:] for mpi_patient in data_block]
+    feature_comps = [
+        _compare_records_in_block_field_helper(
+            record, mpi_patients, feature_col, col_to_idx, feature_funcs, **kwargs
+        )
+        for feature_col in feature_funcs
+    ]
+    if len(feature_comps) == 0:
+        return np.full(len(data_block), bool(matching_rule([], **kwargs)))
+    return evaluate_match_matrix(feature_comps, matching_rule, **kwargs)[0]
+
+
+def _compare_records_in_block_field_helper(
+    record: list,
+    mpi_patients: list[list],
+    feature_col: str,
+    col_to_idx: dict[str, int],
+    feature_funcs: dict,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Scores a single feature of an incoming record against every MPI patient
+    in a block, returning a one-row score matrix. Names and address elements
+    follow the same rules as `_compare_name_elements` and
+    `_compare_address_elements`.
+    """
+    feature_func = feature_funcs[feature_col]
+    if feature_col != "first_name" and feature_col not in [
+        "address",
+        "city",
+        "state",
+        "zip",
+    ]:
+        return score_feature_matrix(
+            [record], mpi_patients, feature_col, feature_func, col_to_idx, **kwargs
+        )
+
+    idx = col_to_idx[feature_col]
+    mpi_values = [[mpi_patient[idx]] for mpi_patient in mpi_patients]
+    if feature_col == "first_name":
+        return score_feature_matrix(
+            [[" ".join(record[idx])]],
+            mpi_values,
+            feature_col,
+            feature_func,
+            {feature_col: 0},
+            **kwargs,
+        )
+
+    if len(record[idx]) == 0:
+        return np.zeros((1, len(mpi_values)), dtype=bool)
+    scores = score_feature_matrix(
+        [[r] for r in record[idx]],
+        mpi_values,
+        feature_col,
+        feature_func,
+        {feature_col: 0},
+        **kwargs,
+    )
+    # Each patient takes the score of the first of the incoming record's
+    # address elements that matched, or of the last one if none did
+    feature_comp = scores[0]
+    for element_scores in scores[1:]:
+        feature_comp = np.where(feature_comp.astype(bool), feature_comp, element_scores)
+    return feature_comp[None, :]
+
+
 def _compare_records_field_helper(
     record: list,
     mpi_patient: list,
@@ -1414,6 +1580,153 @@ def _map_matches_to_record_ids(
     return matched_records
 
 
+def _match_leading_records(
+    block: list[list],
+    n_records: int,
+    feature_funcs: dict[str, Callable],
+    col_to_idx: dict[str, int],
+    match_eval: Callable,
+    **kwargs,
+) -> list[tuple]:
+    """
+    Helper method that scores the first `n_records` records of a block
+    against every record of the block, `SCORING_CHUNK_SIZE` records at a
+    time, returning the matching pairs (i, j) of block indices with i < j.
+    """
+    match_pairs = []
+    for start in range(0, len(block), SCORING_CHUNK_SIZE):
+        is_match = match_records_pairwise(
+            block[:n_records],
+            block[start : start + SCORING_CHUNK_SIZE],
+            feature_funcs,
+            col_to_idx,
+            match_eval,
+            **kwargs,
+        )
+        # Keep the pairs above the diagonal of the whole block
+        rows, cols = np.nonzero(np.triu(is_match, k=1 - start))
+        match_pairs.extend(zip(rows.tolist(), (cols + start).tolist()))
+    match_pairs.sort()
+    return match_pairs
+
+
+def _match_block_tasks(
+    tasks: list[tuple],
+    feature_funcs: dict[str, Callable],
+    col_to_idx: dict[str, int],
+    matching_rule: Callable,
+    cluster_ratio: Union[float, None],
+    kwargs: dict,
+) -> list[tuple]:
+    """
+    Helper method, run in a worker process, that matches a batch of blocks
+    or chunks of blocks scheduled by `_schedule_block_tasks`, returning the
+    block key, chunk number and matched record IDs of each.
+    """
+    results = []
+    for block_key, part, records, n_records in tasks:
+        if cluster_ratio:
+            matches_in_block = _match_within_block_cluster_ratio(
+                records,
+                cluster_ratio,
+                feature_funcs,
+                col_to_idx,
+                matching_rule,
+                **kwargs,
+            )
+        else:
+            matches_in_block = _match_leading_records(
+                records, n_records, feature_funcs, col_to_idx, matching_rule, **kwargs
+            )
+        results.append(
+            (
+                block_key,
+                part,
+                _map_matches_to_record_ids(
+                    matches_in_block, records, cluster_ratio is not None
+                ),
+            )
+        )
+    return results
+
+
+def _schedule_block_tasks(blocked_data: dict, split_blocks: bool) -> list[list]:
+    """
+    Helper method that divides the blocks of a linkage pass into batches of
+    work for a process pool, largest first. Each task is a tuple of the
+    block key, the chunk number within the block, the records to match and
+    the number of leading records to score against the rest. Blocks with
+    more rows than `SCORING_CHUNK_SIZE` are split into chunks if
+    `split_blocks` is set, and tasks are batched until they hold about
+    `PARALLEL_TASK_PAIRS` candidate pairs.
+    """
+    tasks = []
+    for block_key, block in blocked_data.items():
+        if split_blocks and len(block) > SCORING_CHUNK_SIZE:
+            for part, start in enumerate(range(0, len(block), SCORING_CHUNK_SIZE)):
+                n_records = min(SCORING_CHUNK_SIZE, len(block) - start)
+                cost = n_records * (len(block) - start)
+                tasks.append((cost, (block_key, part, block[start:], n_records)))
+        else:
+            tasks.append((len(block) ** 2, (block_key, 0, block, len(block))))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+
+    batches = []
+    batch = []
+    batch_cost = 0
+    for cost, task in tasks:
+        batch.append(task)
+        batch_cost += cost
+        if batch_cost >= PARALLEL_TASK_PAIRS:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def _perform_linkage_pass_in_processes(
+    blocked_data: dict,
+    feature_funcs: dict[str, Callable],
+    col_to_idx: dict[str, int],
+    matching_rule: Callable,
+    cluster_ratio: Union[float, None],
+    max_workers: int,
+    **kwargs,
+) -> dict:
+    """
+    Helper method that matches the blocks of a linkage pass in a pool of
+    processes, as scheduled by `_schedule_block_tasks`, and assembles the
+    matches in the order `perform_linkage_pass` finds them serially.
+    """
+    batches = _schedule_block_tasks(blocked_data, not cluster_ratio)
+    parts = {block_key: {} for block_key in blocked_data}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _match_block_tasks,
+                batch,
+                feature_funcs,
+                col_to_idx,
+                matching_rule,
+                cluster_ratio,
+                kwargs,
+            )
+            for batch in batches
+        ]
+        for future in futures:
+            for block_key, part, matches_in_part in future.result():
+                parts[block_key][part] = matches_in_part
+
+    matches = {}
+    for block_key, block_parts in parts.items():
+        matches[block_key] = []
+        for part in sorted(block_parts):
+            matches[block_key].extend(block_parts[part])
+    return matches
+
+
 def _match_within_block_cluster_ratio(
     block: list[list],
     cluster_ratio: float,
@@ -1502,6 +1815,24 @@ def _is_empty_extraction_field(block_vals: dict, field: str):
     return False
 
 
+def _print_and_score_pair_counts(
+    true_positives: float,
+    false_positives: float,
+    false_negatives: float,
+    records_in_dataset: int,
+) -> tuple:
+    """
+    Helper method that reports the pair counts of a linkage run and
+    computes its statistical qualities with `score_pair_counts`.
+    """
+    print("True Positives:", true_positives)
+    print("False Positives:", false_positives)
+    print("False Negatives:", false_negatives)
+    return score_pair_counts(
+        true_positives, false_positives, false_negatives, records_in_dataset
+    )
+
+
 def _write_prob_file(prob_dict: dict, file_to_write: Union[pathlib.Path, None]):
     """
     Helper method to write a probability dictionary to a JSON file, if
@@ -0,0 +1,277 @@
+import pathlib
+from collections import Counter
+from random import sample
+from typing import Iterator, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Number of records read at once when streaming a parquet or CSV file of
+# records, which bounds the memory used to estimate probabilities over it
+RECORD_CHUNK_SIZE = 100000
+
+
+def get_record_columns(data: Union[pd.DataFrame, pathlib.Path, str]) -> list[str]:
+    """
+    Returns the names of the columns of a data set of records, without
+    reading the records themselves.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :return: The list of column names.
+    """
+    if isinstance(data, pd.DataFrame):
+        return list(data.columns)
+    path = pathlib.Path(data)
+    if path.suffix == ".parquet":
+        return pq.read_schema(path).names
+    return list(pd.read_csv(path, nrows=0, index_col=False).columns)
+
+
+def iter_record_chunks(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    cols: list[str],
+    chunk_size: int = RECORD_CHUNK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """
+    Streams the given columns of a data set of records in chunks of
+    consecutive records. A dataframe is yielded whole; a parquet file is
+    read in batches of `chunk_size` records and a CSV file in chunks of
+    `chunk_size` rows, with every value read as a string and empty
+    values kept as empty strings.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :param cols: The columns to read.
+    :param chunk_size: The number of records to read at once from a file.
+    :return: An iterator of dataframes holding the columns of consecutive
+      records, in order.
+    """
+    if isinstance(data, pd.DataFrame):
+        yield data
+        return
+    path = pathlib.Path(data)
+    if path.suffix == ".parquet":
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(
+            batch_size=chunk_size, columns=list(cols)
+        ):
+            yield batch.to_pandas()
+        return
+    yield from pd.read_csv(
+        path,
+        usecols=list(cols),
+        chunksize=chunk_size,
+        index_col=False,
+        dtype="object",
+        keep_default_na=False,
+    )
+
+
+def count_records(
+    data: Union[pd.DataFrame, pathlib.Path, str], chunk_size: int = RECORD_CHUNK_SIZE
+) -> int:
+    """
+    Counts the records in a data set, reading a parquet file's metadata or
+    streaming a single column of a CSV file.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :param chunk_size: The number of records to read at once from a file.
+    :return: The number of records.
+    """
+    if isinstance(data, pd.DataFrame):
+        return len(data)
+    path = pathlib.Path(data)
+    if path.suffix == ".parquet":
+        return pq.ParquetFile(path).metadata.num_rows
+    first_col = get_record_columns(path)[:1]
+    return sum(len(chunk) for chunk in iter_record_chunks(path, first_col, chunk_size))
+
+
+def gather_column_values(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    cols: list[str],
+    positions: np.ndarray,
+    chunk_size: int = RECORD_CHUNK_SIZE,
+) -> dict[str, np.ndarray]:
+    """
+    Looks up the values of the given columns at the given record positions,
+    streaming a file of records rather than loading it whole.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :param cols: The columns to look up.
+    :param positions: An array of (zero-based) record positions, which may
+      repeat.
+    :param chunk_size: The number of records to read at once from a file.
+    :raises IndexError: If a position is beyond the last record.
+    :return: A dictionary mapping each column to an array of its values at
+      the given positions.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    if isinstance(data, pd.DataFrame):
+        return {c: data[c].to_numpy()[positions] for c in cols}
+
+    values = {c: np.empty(len(positions), dtype=object) for c in cols}
+    start = 0
+    for chunk in iter_record_chunks(data, cols, chunk_size):
+        in_chunk = (positions >= start) & (positions < start + len(chunk))
+        for c in cols:
+            values[c][in_chunk] = chunk[c].to_numpy()[positions[in_chunk] - start]
+        start += len(chunk)
+    if len(positions) > 0 and (positions.max() >= start or positions.min() < 0):
+        raise IndexError(f"Record positions must be between 0 and {start - 1}.")
+    return values
+
+
+def count_equal_values(values_i: np.ndarray, values_j: np.ndarray) -> int:
+    """
+    Counts the positions at which two arrays of column values are equal,
+    comparing them with Python equality as `==` between the scalar values
+    would.
+
+    :param values_i: The first array of values.
+    :param values_j: The second array of values, of the same length.
+    :return: The number of equal pairs of values.
+    """
+    if len(values_i) == 0:
+        return 0
+    return int(np.count_nonzero(values_i == values_j))
+
+
+def count_equal_value_pairs(
+    data: Union[pd.DataFrame, pathlib.Path, str],
+    cols: list[str],
+    chunk_size: int = RECORD_CHUNK_SIZE,
+) -> dict[str, int]:
+    """
+    Counts, for each column, the number of pairs of distinct records whose
+    values in that column are equal, without enumerating the pairs: a value
+    shared by k records accounts for k * (k - 1) / 2 pairs. As with Python
+    equality, missing values such as NaN never equal one another, except
+    for None.
+
+    :param data: A pandas dataframe of records, or the path of a parquet
+      or CSV file of records.
+    :param cols: The columns to count equal pairs in.
+    :param chunk_size: The number of records to read at once from a file.
+    :return: A dictionary mapping each column to its number of equal pairs.
+    """
+    value_counts = {c: Counter() for c in cols}
+    none_counts = {c: 0 for c in cols}
+    for chunk in iter_record_chunks(data, cols, chunk_size):
+        for c in cols:
+            column = chunk[c]
+            value_counts[c].update(column.value_counts(dropna=True).to_dict())
+            missing = column[column.isna()]
+            none_counts[c] += sum(value is None for value in missing)
+
+    equal_pairs = {}
+    for c in cols:
+        counts = list(value_counts[c].values()) + [none_counts[c]]
+        equal_pairs[c] = sum(k * (k - 1) // 2 for k in counts)
+    return equal_pairs
+
+
+def pair_offsets(first: np.ndarray, n_records: int) -> np.ndarray:
+    """
+    Returns the rank, among all pairs of `n_records` records ordered as
+    `itertools.combinations` orders them, of the first pair whose lower
+    record is at each of the given positions.
+    """
+    first = np.asarray(first, dtype=np.int64)
+    return first * (2 * n_records - first - 1) // 2
+
+
+def rank_pairs(first: np.ndarray, second: np.ndarray, n_records: int) -> np.ndarray:
+    """
+    Returns the rank of each pair of record positions (with `first` lower
+    than `second`) among all pairs of `n_records` records, ordered as
+    `itertools.combinations(range(n_records), 2)` orders them.
+    """
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    return pair_offsets(first, n_records) + second - first - 1
+
+
+def unrank_pairs(ranks: np.ndarray, n_records: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the pairs of record positions with the given ranks among all
+    pairs of `n_records` records, ordered as
+    `itertools.combinations(range(n_records), 2)` orders them, without
+    enumerating the pairs.
+
+    :param ranks: An array of pair ranks.
+    :param n_records: The number of records.
+    :return: A tuple of arrays of the lower and higher position of each pair.
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    if len(ranks) == 0:
+        return ranks, ranks
+    # Invert the offset of each pair's lower record, then correct any error
+    # introduced by floating point precision
+    b = 2 * n_records - 1
+    first = np.floor((b - np.sqrt(float(b) ** 2 - 8.0 * ranks)) / 2).astype(np.int64)
+    first = np.clip(first, 0, max(n_records - 2, 0))
+    first = np.where(pair_offsets(first + 1, n_records) <= ranks, first + 1, first)
+    first = np.where(pair_offsets(first, n_records) > ranks, first - 1, first)
+    second = ranks - pair_offsets(first, n_records) + first + 1
+    return first, second
+
+
+def true_match_pairs(true_matches: dict) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Flattens a dictionary of true matches, keyed by the lower record of each
+    pair, into arrays of the positions of the records in each pair.
+
+    :param true_matches: A dictionary mapping record positions to the sets
+      of higher record positions they truly match.
+    :return: A tuple of arrays of the lower and higher position of each pair.
+    """
+    first = []
+    second = []
+    for root_record, paired_records in true_matches.items():
+        for pr in paired_records:
+            first.append(root_record)
+            second.append(pr)
+    return np.array(first, dtype=np.int64), np.array(second, dtype=np.int64)
+
+
+def sample_non_match_pairs(
+    n_records: int, true_matches: dict, n_samples: Union[int, None] = None
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    Samples pairs of records that aren't true matches without enumerating
+    every pair. The non-matching pairs are numbered as they'd appear in the
+    list of `itertools.combinations(range(n_records), 2)` once the true
+    matches are removed, `n_samples` of those numbers are drawn with
+    `random.sample`, and the numbers are then mapped back to pairs. This
+    draws the same pairs, for the same random state, as sampling from that
+    list would.
+
+    :param n_records: The number of records.
+    :param true_matches: A dictionary mapping record positions to the sets
+      of higher record positions they truly match.
+    :param n_samples: The number of pairs to sample. If None, or at least
+      the number of non-matching pairs, no pairs are sampled.
+    :return: A tuple of arrays of the lower and higher position of each
+      sampled pair, followed by the number of non-matching pairs. The
+      arrays are None if no pairs were sampled.
+    """
+    first, second = true_match_pairs(true_matches)
+    valid = (first >= 0) & (first < second) & (second < n_records)
+    true_ranks = np.unique(rank_pairs(first[valid], second[valid], n_records))
+    n_non_matches = n_records * (n_records - 1) // 2 - len(true_ranks)
+    if n_samples is None or n_samples >= n_non_matches:
+        return None, None, n_non_matches
+
+    non_match_ranks = np.array(sample(range(n_non_matches), n_samples), dtype=np.int64)
+    # Skip over the ranks of the true matches that precede each sampled pair
+    preceding_non_matches = true_ranks - np.arange(len(true_ranks))
+    ranks = non_match_ranks + np.searchsorted(
+        preceding_non_matches, non_match_ranks, side="right"
+    )
+    first, second = unrank_pairs(ranks, n_records)
+    return first, second, n_non_matches
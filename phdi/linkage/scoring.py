@@ -0,0 +1,294 @@
+import datetime
+from typing import Callable
+
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import DamerauLevenshtein, JaroWinkler, Levenshtein
+
+from phdi.linkage.utils import datetime_to_str
+
+# Number of records from each side of a comparison that are scored at once
+# when matching a block, so that each score matrix holds at most
+# SCORING_CHUNK_SIZE ** 2 entries
+SCORING_CHUNK_SIZE = 2048
+
+SIMILARITY_SCORERS = {
+    "JaroWinkler": JaroWinkler.normalized_similarity,
+    "Levenshtein": Levenshtein.normalized_similarity,
+    "DamerauLevenshtein": DamerauLevenshtein.normalized_similarity,
+}
+
+# Value types for which Python equality can be reproduced exactly by
+# comparing integer codes assigned through a shared dictionary
+_CODEABLE_TYPES = (str, int, float, datetime.date, type(None))
+
+
+def score_feature_matrix(
+    rows_i: list[list],
+    rows_j: list[list],
+    feature_col: str,
+    feature_func: Callable,
+    col_to_idx: dict[str, int],
+    **kwargs,
+) -> np.ndarray:
+    """
+    Computes the result of a single feature comparison function for every
+    pair of records drawn from two lists of records, returning a matrix
+    whose entry (i, j) is what `feature_func(rows_i[i], rows_j[j], ...)`
+    would have returned.
+
+    The feature comparison functions defined in `phdi.linkage.link` are
+    evaluated column-wise, using NumPy for equality comparisons and
+    rapidfuzz's `process.cdist` for string similarities. Any other
+    function, or a column holding values the vectorized kernels can't
+    reproduce exactly, falls back to calling the function once per pair.
+
+    :param rows_i: The records forming the rows of the result matrix.
+    :param rows_j: The records forming the columns of the result matrix.
+    :param feature_col: The name of the column being evaluated (e.g. "city").
+    :param feature_func: The feature comparison function to evaluate.
+    :param col_to_idx: A dictionary mapping column names to the numeric index
+      in which they occur in order in the data.
+    :param **kwargs: Keyword arguments forwarded to the comparison, such as
+      `similarity_measure`, `threshold` or `log_odds`.
+    :return: A `len(rows_i)` by `len(rows_j)` array of feature comparisons.
+    """
+    shape = (len(rows_i), len(rows_j))
+    if shape[0] == 0 or shape[1] == 0:
+        return np.zeros(shape, dtype=bool)
+
+    kernel = None
+    if getattr(feature_func, "__module__", None) == "phdi.linkage.link":
+        kernel = _FEATURE_KERNELS.get(feature_func.__name__)
+    if kernel is not None:
+        idx = col_to_idx[feature_col]
+        values_i = [r[idx] for r in rows_i]
+        values_j = [r[idx] for r in rows_j]
+        scores = kernel(values_i, values_j, feature_col, **kwargs)
+        if scores is not None:
+            return scores
+
+    scores = np.empty(shape, dtype=object)
+    for i, record_i in enumerate(rows_i):
+        for j, record_j in enumerate(rows_j):
+            scores[i, j] = feature_func(
+                record_i, record_j, feature_col, col_to_idx, **kwargs
+            )
+    return scores
+
+
+def evaluate_match_matrix(
+    feature_scores: list[np.ndarray], match_eval: Callable, **kwargs
+) -> np.ndarray:
+    """
+    Applies a match evaluation rule to a list of feature score matrices (one
+    per compared feature, as produced by `score_feature_matrix`), returning a
+    boolean matrix of the pairs the rule deems a match. `eval_perfect_match`
+    and `eval_log_odds_cutoff` are evaluated on whole matrices at once; any
+    other rule is called once per pair with the list of that pair's scores.
+
+    :param feature_scores: A non-empty list of equally shaped score matrices.
+    :param match_eval: A function for determining whether a given set of
+      feature comparisons constitutes a match for linkage.
+    :param **kwargs: Keyword arguments forwarded to the evaluation rule.
+    :return: A boolean matrix of pairwise match decisions.
+    """
+    shape = feature_scores[0].shape
+    if shape[0] == 0 or shape[1] == 0:
+        return np.zeros(shape, dtype=bool)
+
+    eval_name = None
+    if getattr(match_eval, "__module__", None) == "phdi.linkage.link":
+        eval_name = match_eval.__name__
+
+    if eval_name in ("eval_perfect_match", "eval_log_odds_cutoff"):
+        # Accumulate in feature order so that float sums are identical
+        # to the builtin `sum` used by the scalar evaluation rules
+        total = np.zeros(shape, dtype=np.float64)
+        for scores in feature_scores:
+            total = total + scores
+        if eval_name == "eval_perfect_match":
+            return np.asarray(total == len(feature_scores), dtype=bool)
+        if "true_match_threshold" not in kwargs:
+            raise KeyError("Cutoff threshold for true matches must be passed.")
+        return np.asarray(total >= kwargs["true_match_threshold"], dtype=bool)
+
+    score_lists = [scores.tolist() for scores in feature_scores]
+    matches = np.zeros(shape, dtype=bool)
+    for i in range(shape[0]):
+        for j in range(shape[1]):
+            feature_comps = [scores[i][j] for scores in score_lists]
+            matches[i, j] = bool(match_eval(feature_comps, **kwargs))
+    return matches
+
+
+def match_records_pairwise(
+    rows_i: list[list],
+    rows_j: list[list],
+    feature_funcs: dict[str, Callable],
+    col_to_idx: dict[str, int],
+    match_eval: Callable,
+    eval_kwargs: dict = None,
+    **kwargs,
+) -> np.ndarray:
+    """
+    Scores every configured feature for every pair of records drawn from
+    two lists of records, then applies the match evaluation rule, yielding
+    a boolean matrix whose entry (i, j) indicates whether `rows_i[i]` and
+    `rows_j[j]` are a match.
+
+    :param rows_i: The records forming the rows of the result matrix.
+    :param rows_j: The records forming the columns of the result matrix.
+    :param feature_funcs: A dictionary mapping feature columns to functions
+      used to evaluate those features for a match.
+    :param col_to_idx: A dictionary mapping column names to the numeric index
+      in which they occur in order in the data.
+    :param match_eval: A function for determining whether a given set of
+      feature comparisons constitutes a match for linkage.
+    :param eval_kwargs: Optionally, the keyword arguments to pass to the
+      evaluation rule. Defaults to the feature keyword arguments.
+    :return: A boolean matrix of pairwise match decisions.
+    """
+    if eval_kwargs is None:
+        eval_kwargs = kwargs
+    feature_scores = [
+        score_feature_matrix(
+            rows_i,
+            rows_j,
+            feature_col,
+            feature_funcs[feature_col],
+            col_to_idx,
+            **kwargs,
+        )
+        for feature_col in feature_funcs
+    ]
+    if len(feature_scores) == 0:
+        return np.full((len(rows_i), len(rows_j)), bool(match_eval([], **eval_kwargs)))
+    return evaluate_match_matrix(feature_scores, match_eval, **eval_kwargs)
+
+
+def _encode_values(values_i: list, values_j: list) -> tuple:
+    """
+    Maps the values of two columns to integer codes such that two codes are
+    equal exactly when the underlying values compare equal. Returns None if
+    either column holds a value whose equality can't be encoded this way.
+    """
+    codes = {}
+    encoded = []
+    unique_code = -1
+    for values in (values_i, values_j):
+        column_codes = np.empty(len(values), dtype=np.int64)
+        for k, value in enumerate(values):
+            if not isinstance(value, _CODEABLE_TYPES):
+                return None
+            # NaN never equals anything, itself included
+            if isinstance(value, float) and value != value:
+                column_codes[k] = unique_code
+                unique_code -= 1
+                continue
+            column_codes[k] = codes.setdefault(value, len(codes))
+        encoded.append(column_codes)
+    return encoded[0], encoded[1]
+
+
+def _string_similarities(
+    values_i: list, values_j: list, similarity_measure: str
+) -> np.ndarray:
+    """
+    Computes the similarity of every pair of strings drawn from two columns
+    with rapidfuzz's `process.cdist`. Returns None if the similarity
+    measure is unsupported or either column holds a non-string value.
+    """
+    scorer = SIMILARITY_SCORERS.get(similarity_measure)
+    if scorer is None:
+        return None
+    for values in (values_i, values_j):
+        if not all(isinstance(v, str) or v is None for v in values):
+            return None
+
+    # A missing value is never similar to anything when compared on its
+    # own, but cdist treats it as an empty string, so mask it out
+    none_i = np.array([v is None for v in values_i])
+    none_j = np.array([v is None for v in values_j])
+    similarities = process.cdist(
+        ["" if v is None else v for v in values_i],
+        ["" if v is None else v for v in values_j],
+        scorer=scorer,
+        dtype=np.float64,
+    )
+    similarities[none_i, :] = 0.0
+    similarities[:, none_j] = 0.0
+    return similarities
+
+
+def _exact_kernel(values_i: list, values_j: list, feature_col: str, **kwargs):
+    codes = _encode_values(values_i, values_j)
+    if codes is None:
+        return None
+    return codes[0][:, None] == codes[1][None, :]
+
+
+def _four_char_kernel(values_i: list, values_j: list, feature_col: str, **kwargs):
+    for values in (values_i, values_j):
+        if not all(isinstance(v, str) for v in values):
+            return None
+    return _exact_kernel(
+        [v[:4] for v in values_i], [v[:4] for v in values_j], feature_col
+    )
+
+
+def _fuzzy_string_kernel(values_i: list, values_j: list, feature_col: str, **kwargs):
+    if feature_col == "birthdate":
+        values_i = [datetime_to_str(v) for v in values_i]
+        values_j = [datetime_to_str(v) for v in values_j]
+    similarity_measure = kwargs.get("similarity_measure", "JaroWinkler")
+    threshold = kwargs.get("threshold", 0.7)
+    similarities = _string_similarities(values_i, values_j, similarity_measure)
+    if similarities is None:
+        return None
+
+    matches = similarities >= threshold
+    # Two empty strings (or two missing values) are vacuously a match
+    empty_i = np.array([v == "" for v in values_i])
+    empty_j = np.array([v == "" for v in values_j])
+    none_i = np.array([v is None for v in values_i])
+    none_j = np.array([v is None for v in values_j])
+    matches |= empty_i[:, None] & empty_j[None, :]
+    matches |= none_i[:, None] & none_j[None, :]
+    return matches
+
+
+def _log_odds_exact_kernel(values_i: list, values_j: list, feature_col: str, **kwargs):
+    if "log_odds" not in kwargs:
+        raise KeyError("Mapping of columns to m/u log-odds must be provided.")
+    col_odds = kwargs["log_odds"][feature_col]
+    matches = _exact_kernel(values_i, values_j, feature_col)
+    if matches is None:
+        return None
+    return np.where(matches, col_odds, 0.0)
+
+
+def _log_odds_fuzzy_kernel(values_i: list, values_j: list, feature_col: str, **kwargs):
+    if "log_odds" not in kwargs:
+        raise KeyError("Mapping of columns to m/u log-odds must be provided.")
+    threshold = kwargs.get("threshold", 0.7)
+    col_odds = kwargs["log_odds"][feature_col]
+    if feature_col == "birthdate":
+        values_i = [datetime_to_str(v) for v in values_i]
+        values_j = [datetime_to_str(v) for v in values_j]
+    similarities = _string_similarities(values_i, values_j, "JaroWinkler")
+    if similarities is None:
+        return None
+    similarities[similarities < threshold] = 0.0
+    return similarities * col_odds
+
+
+# Vectorized equivalents of the feature comparison functions in link.py,
+# keyed by function name
+_FEATURE_KERNELS = {
+    "feature_match_exact": _exact_kernel,
+    "feature_match_four_char": _four_char_kernel,
+    "feature_match_fuzzy_string": _fuzzy_string_kernel,
+    "feature_match_log_odds_exact": _log_odds_exact_kernel,
+    "feature_match_log_odds_fuzzy_compare": _log_odds_fuzzy_kernel,
+}
@@ -0,0 +1,153 @@
+import pathlib
+from itertools import combinations
+
+import pandas as pd
+import pytest
+
+from phdi.linkage import (
+    ExactBlocking,
+    MultiKeyBlocking,
+    PhoneticBlocking,
+    QGramLSHBlocking,
+    SortedNeighborhoodBlocking,
+    block_data,
+    block_size_stats,
+    compile_match_lists,
+    eval_perfect_match,
+    feature_match_fuzzy_string,
+    perform_linkage_pass,
+)
+
+PATIENT_CSV = (
+    pathlib.Path(__file__).parent.parent / "assets" / "linkage" / "patient_lol.csv"
+)
+
+
+def _load_patients() -> pd.DataFrame:
+    return pd.read_csv(
+        PATIENT_CSV, index_col=False, dtype="object", keep_default_na=False
+    )
+
+
+def _blocked_pairs(blocked_data: dict) -> set:
+    pairs = set()
+    for block in blocked_data.values():
+        pairs.update(combinations(sorted(row[-1] for row in block), 2))
+    return pairs
+
+
+def test_exact_blocking_matches_block_data():
+    data = _load_patients()
+    for columns in [["ZIP"], ["LAST", "GENDER"]]:
+        strategy = ExactBlocking(columns)
+        assert block_data(data, strategy) == block_data(data, columns)
+        assert strategy.stats == block_size_stats(block_data(data, columns))
+
+
+def test_block_size_stats():
+    stats = block_size_stats({"a": [[1]], "b": [[2], [3], [4]], "c": [[5], [6]]})
+    assert stats["blocks"] == 3
+    assert stats["records"] == 6
+    assert (stats["min"], stats["max"], stats["median"]) == (1, 3, 2.0)
+    assert stats["mean"] == 2.0
+    assert stats["pairs"] == 4
+    assert block_size_stats({})["blocks"] == 0
+
+
+def test_sorted_neighborhood_blocking():
+    data = pd.DataFrame(
+        {"LAST": [f"Name{i:02d}" for i in range(23)][::-1], "ID": list(range(23))}
+    )
+    strategy = SortedNeighborhoodBlocking(["LAST"], window=6)
+    blocked = block_data(data, strategy)
+    assert strategy.stats["max"] == 6
+    # Every record is blocked, and records within 3 places of each other in
+    # sort order always share a block
+    assert {row[-1] for block in blocked.values() for row in block} == set(range(23))
+    pairs = _blocked_pairs(blocked)
+    for i in range(23):
+        for j in range(i + 1, min(i + 4, 23)):
+            assert (i, j) in pairs
+
+    with pytest.raises(ValueError) as e:
+        SortedNeighborhoodBlocking(["LAST"], window=1)
+    assert "window must hold two records" in str(e.value)
+
+
+def test_phonetic_blocking():
+    data = pd.DataFrame(
+        {
+            "LAST": ["Smith", "Smyth", "Schmidt", "Jones", "", None],
+            "ID": [0, 1, 2, 3, 4, 5],
+        }
+    )
+    pairs = _blocked_pairs(block_data(data, PhoneticBlocking(["LAST"])))
+    assert (0, 1) in pairs
+    # "Schmidt" only shares a secondary encoding with "Smith"
+    assert (0, 2) in pairs
+    assert (0, 2) not in _blocked_pairs(
+        block_data(data, PhoneticBlocking(["LAST"], use_secondary=False))
+    )
+    assert all(3 not in pair and 4 not in pair and 5 not in pair for pair in pairs)
+
+
+def test_qgram_lsh_blocking():
+    data = pd.DataFrame(
+        {
+            "FIRST": ["Jonathan", "Jonathon", "Johnathan", "Maria", "Mariah", None],
+            "LAST": ["Shepard", "Shepard", "Shepard", "Lopez", "Lopez", None],
+            "ID": [0, 1, 2, 3, 4, 5],
+        }
+    )
+    strategy = QGramLSHBlocking(["FIRST", "LAST"], num_bands=16, band_size=2)
+    pairs = _blocked_pairs(block_data(data, strategy))
+    assert {(0, 1), (0, 2), (1, 2), (3, 4)} <= pairs
+    assert all(not (i < 3 <= j) for i, j in pairs)
+    # Blocks are reproducible for the same seed
+    assert block_data(data, strategy) == block_data(
+        data, QGramLSHBlocking(["FIRST", "LAST"], num_bands=16, band_size=2)
+    )
+
+
+def test_multi_key_blocking_caps_giant_blocks():
+    n_records = 200
+    data = pd.DataFrame(
+        {
+            "LAST": ["Smith"] * n_records,
+            "FIRST": [f"First{i // 2:03d}" for i in range(n_records)],
+            "ZIP": [str(10000 + i % 5) for i in range(n_records)],
+            "ID": list(range(n_records)),
+        }
+    )
+    strategy = MultiKeyBlocking(
+        [ExactBlocking(["LAST"]), ExactBlocking(["ZIP"])],
+        max_block_size=[20, None],
+        sort_columns=["FIRST"],
+    )
+    blocked = block_data(data, strategy)
+    assert strategy.stats["capped_blocks"] == 1
+    assert max(len(b) for k, b in blocked.items() if k[0] == 0) == 20
+    assert strategy.stats["pairs"] < n_records * (n_records - 1) // 2
+    # Records with the same first name stay in a common window
+    pairs = _blocked_pairs(blocked)
+    assert all((i, i + 1) in pairs for i in range(0, n_records, 2))
+    # The uncapped key still blocks every record sharing a zip code
+    assert (0, 5) in pairs
+
+    with pytest.raises(ValueError) as e:
+        MultiKeyBlocking([ExactBlocking(["LAST"])], max_block_size=[1, 2])
+    assert "A block size cap must be given for each blocking key." in str(e.value)
+
+
+def test_perform_linkage_pass_with_blocking_strategy():
+    data = _load_patients()
+    funcs = {"FIRST": feature_match_fuzzy_string, "LAST": feature_match_fuzzy_string}
+    exact = perform_linkage_pass(data, ["ZIP"], funcs, eval_perfect_match)
+    capped = perform_linkage_pass(
+        data,
+        MultiKeyBlocking([ExactBlocking(["ZIP"])], max_block_size=4),
+        funcs,
+        eval_perfect_match,
+    )
+    assert compile_match_lists([capped]).keys() <= compile_match_lists([exact]).keys()
+    assert len(compile_match_lists([capped])) > 0
@@ -0,0 +1,117 @@
+import random
+from itertools import combinations
+
+from phdi.linkage import (
+    DisjointSet,
+    cluster_match_lists,
+    compile_match_lists,
+    score_cluster_labels,
+    score_linkage_vs_truth,
+)
+from phdi.linkage.clusters import cluster_matches, count_cluster_pairs
+
+
+def _pairs_by_lower_id(clusters: list[set]) -> dict:
+    pairs = {}
+    for cluster in clusters:
+        for i, j in combinations(sorted(cluster), 2):
+            pairs.setdefault(i, set()).add(j)
+    return pairs
+
+
+def test_disjoint_set():
+    forest = DisjointSet([1, 2, 3])
+    assert len(forest) == 3
+    assert forest.find(2) == 2
+    forest.union(1, 2)
+    forest.union_all([4, 5, 6])
+    forest.union(6, 3)
+    assert 5 in forest and 7 not in forest
+    assert forest.find(1) == forest.find(2) != forest.find(3)
+    assert forest.find(3) == forest.find(4) == forest.find(5)
+    assert sorted(map(sorted, forest.clusters())) == [[1, 2], [3, 4, 5, 6]]
+    labels = forest.labels()
+    assert labels[4] == labels[6] and labels[1] != labels[4]
+    assert count_cluster_pairs(labels) == 1 + 6
+
+    # A long chain of unions is flattened as it's walked
+    forest = DisjointSet()
+    for record in range(100000):
+        forest.union(record, record + 1)
+    assert len(forest.clusters()) == 1
+    assert count_cluster_pairs(forest.labels()) == 100001 * 100000 // 2
+
+
+def test_cluster_match_lists():
+    pass_1 = {"a": [(1, 5), (5, 11)], "b": [(23, 24)], "c": []}
+    pass_2 = {"d": [(11, 12), (24, 31)], "e": [(40, 41)]}
+    forest = cluster_match_lists([pass_1, pass_2])
+    assert sorted(map(sorted, forest.clusters())) == [
+        [1, 5, 11, 12],
+        [23, 24, 31],
+        [40, 41],
+    ]
+    assert compile_match_lists([pass_1, pass_2], transitive=True) == {
+        1: {5, 11, 12},
+        23: {24, 31},
+        40: {41},
+    }
+
+    # Overlapping clusters from cluster mode passes are merged
+    cluster_pass_1 = {"a": [{1, 5}, {7}], "b": [{23, 24, 31}]}
+    cluster_pass_2 = {"c": [{5, 11}, {31, 32}]}
+    assert compile_match_lists(
+        [cluster_pass_1, cluster_pass_2], cluster_mode=True, transitive=True
+    ) == {1: {5, 11}, 23: {24, 31, 32}}
+
+
+def test_score_cluster_labels():
+    num_records = 12
+    true_matches = {
+        1: {5, 11, 12},
+        5: {11, 12},
+        11: {12},
+        23: {24, 31, 32},
+        24: {31, 32},
+        31: {32},
+    }
+    found_clusters = cluster_matches({1: {5, 11, 12, 13}, 23: {24, 31, 32}})
+    true_clusters = cluster_matches(true_matches)
+    assert score_cluster_labels(found_clusters, true_clusters, num_records) == (
+        1.0,
+        0.926,
+        0.75,
+        0.857,
+    )
+
+
+def test_score_cluster_labels_matches_pairwise_scores():
+    rng = random.Random(3)
+    n_records = 300
+    true_labels = {record: rng.randrange(80) for record in range(n_records)}
+    found_labels = {
+        record: label if rng.random() < 0.8 else rng.randrange(80, 100)
+        for record, label in true_labels.items()
+    }
+
+    def _clusters(labels):
+        clusters = {}
+        for record, label in labels.items():
+            clusters.setdefault(label, set()).add(record)
+        return list(clusters.values())
+
+    true_matches = _pairs_by_lower_id(_clusters(true_labels))
+    found_matches = _pairs_by_lower_id(_clusters(found_labels))
+    expected = score_linkage_vs_truth(found_matches, true_matches, n_records)
+    assert score_cluster_labels(found_labels, true_labels, n_records) == expected
+
+    # Cluster mode scoring counts the pairs of each cluster without listing
+    cluster_mode_matches = {
+        min(cluster): cluster - {min(cluster)}
+        for cluster in _clusters(found_labels)
+        if len(cluster) > 1
+    }
+    assert (
+        score_linkage_vs_truth(cluster_mode_matches, true_matches, n_records, True)
+        == expected
+    )
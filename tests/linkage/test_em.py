@@ -0,0 +1,154 @@
+import json
+import random
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phdi.linkage import (
+    DIBBS_ENHANCED,
+    calculate_em_log_odds,
+    estimate_em_probs,
+    eval_log_odds_cutoff,
+    fit_em_probs,
+)
+from phdi.linkage.em import (
+    count_comparison_patterns,
+    encode_columns,
+    iter_block_pairs,
+)
+
+
+def _synthetic_records(n_people: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Builds records of people who each appear two or three times, with
+    fields that are sometimes mistyped or missing.
+    """
+    rng = random.Random(seed)
+    first_names = ["John", "Jane", "Alex", "Maria", "Sam", "Li", "Ana", "Omar"]
+    last_names = [f"Last{i}" for i in range(40)]
+    records = []
+    for person in range(n_people):
+        person_fields = {
+            "first_name": rng.choice(first_names),
+            "last_name": rng.choice(last_names),
+            "birthdate": f"19{rng.randint(40, 99)}-0{rng.randint(1, 9)}-1{person % 10}",
+            "zip": str(rng.randint(10000, 10004)),
+            "city": rng.choice(["Boston", "Salem"]),
+        }
+        for _ in range(rng.choice([2, 3])):
+            record = dict(person_fields)
+            for field in ["first_name", "last_name", "birthdate"]:
+                draw = rng.random()
+                if draw < 0.1:
+                    record[field] = record[field] + "x"
+                elif draw < 0.12:
+                    record[field] = None
+            records.append(record)
+    rng.shuffle(records)
+    return pd.DataFrame(records)
+
+
+def test_encode_columns():
+    data = pd.DataFrame(
+        {"a": ["x", "y", None, "x", ""], "b": [1.0, float("nan"), 1.0, 2.0, 2.0]}
+    )
+    codes = encode_columns(data, ["a", "b"])
+    assert codes.shape == (5, 2)
+    assert codes[0, 0] == codes[3, 0] != codes[1, 0]
+    assert codes[2, 0] == -1 and codes[4, 0] >= 0
+    assert codes[1, 1] == -1
+    assert codes[0, 1] == codes[2, 1] and codes[3, 1] == codes[4, 1]
+
+
+def test_iter_block_pairs():
+    data = _synthetic_records(60)
+    data.loc[3, "zip"] = None
+    codes = encode_columns(data, ["zip", "city"])
+    expected = set()
+    for _, block in data.groupby(["zip", "city"]):
+        expected.update(combinations(sorted(block.index), 2))
+
+    for chunk_size in [1, 7, 100000]:
+        pairs = []
+        for first, second in iter_block_pairs(codes, chunk_size):
+            assert (first < second).all()
+            pairs.extend(zip(first.tolist(), second.tolist()))
+        assert len(pairs) == len(expected)
+        assert set(pairs) == expected
+
+
+def test_fit_em_probs_recovers_parameters():
+    rng = np.random.default_rng(0)
+    cols = ["first_name", "last_name", "birthdate"]
+    m = np.array([0.95, 0.9, 0.85])
+    u = np.array([0.1, 0.02, 0.01])
+    n_pairs = 200000
+    is_match = rng.random(n_pairs) < 0.2
+    probs = np.where(is_match[:, None], m, u)
+    gamma = rng.random((n_pairs, len(cols))) < probs
+    patterns, counts = np.unique(gamma, axis=0, return_counts=True)
+
+    m_probs, u_probs, match_prob = fit_em_probs(patterns, counts, cols)
+    assert match_prob == pytest.approx(0.2, abs=0.01)
+    for k, c in enumerate(cols):
+        assert m_probs[c] == pytest.approx(m[k], abs=0.01)
+        assert u_probs[c] == pytest.approx(u[k], abs=0.01)
+
+    with pytest.raises(ValueError) as e:
+        fit_em_probs(patterns, np.zeros(len(counts)), cols)
+    assert "At least one candidate pair must be compared." in str(e.value)
+
+
+def test_count_comparison_patterns_across_processes():
+    data = _synthetic_records(80)
+    codes = encode_columns(data, ["first_name", "last_name", "birthdate"])
+    block_codes = encode_columns(data, ["zip"])
+    expected = count_comparison_patterns(codes, iter_block_pairs(block_codes))
+    patterns, counts = count_comparison_patterns(
+        codes, iter_block_pairs(block_codes, 50), max_workers=2
+    )
+    assert np.array_equal(patterns, expected[0])
+    assert np.array_equal(counts, expected[1])
+    # Every candidate pair has exactly one comparison vector
+    n_pairs = sum(len(first) for first, _ in iter_block_pairs(block_codes))
+    assert counts.sum() == n_pairs
+
+
+def test_estimate_em_probs(tmp_path):
+    data = _synthetic_records(300)
+    cols = ["first_name", "last_name", "birthdate"]
+    m_path = tmp_path / "m.json"
+    u_path = tmp_path / "u.json"
+    m_probs, u_probs = estimate_em_probs(
+        data, ["zip", "city"], m_file_to_write=m_path, u_file_to_write=u_path
+    )
+    assert list(m_probs) == cols
+    assert json.load(open(m_path)) == m_probs
+    assert json.load(open(u_path)) == u_probs
+    for c in cols:
+        # Fields are mistyped or missing in about 12% of records
+        assert m_probs[c] == pytest.approx(0.88**2, abs=0.06)
+        assert u_probs[c] < 0.2
+
+    # Files are streamed with the same result
+    csv_path = tmp_path / "records.csv"
+    data.fillna("").to_csv(csv_path, index=False)
+    assert estimate_em_probs(
+        data.fillna(""), ["zip", "city"], chunk_size=50
+    ) == estimate_em_probs(csv_path, ["zip", "city"], chunk_size=50)
+
+
+def test_calculate_em_log_odds():
+    data = _synthetic_records(300)
+    log_odds = calculate_em_log_odds(
+        data, ["zip"], cols=["first_name", "last_name", "birthdate", "city"]
+    )
+    assert set(log_odds) == {"first_name", "last_name", "birthdate", "city"}
+    assert log_odds["birthdate"] > log_odds["city"] > 0
+
+    # The log-odds drop in to the kwargs of the enhanced algorithm
+    kwargs = dict(DIBBS_ENHANCED[0]["kwargs"], log_odds=log_odds)
+    feature_scores = [kwargs["log_odds"][c] for c in DIBBS_ENHANCED[0]["funcs"]]
+    assert eval_log_odds_cutoff(feature_scores, **kwargs)
@@ -12,6 +12,7 @@ import pandas as pd
 import pytest
 from sqlalchemy import select, text
 
+import phdi.linkage.link as link_module
 from phdi.linkage import (
     DIBBS_BASIC,
     DIBBS_ENHANCED,
@@ -275,6 +276,56 @@ def test_match_within_block_cluster_ratio():
     assert matches == [{0, 1, 2, 3}, {4}, {5}, {6}, {7, 8, 10, 11}, {9}]
 
 
+def test_match_within_block_bounded_scoring(monkeypatch):
+    data = [
+        [1, "John", "Shepard", "11-7-2153", "90909"],
+        [23, "Alejandro", "Villanueve", "1-1-1980", "15935"],
+        [5, "Jhon", "Sheperd", "11-7-2153", "90909"],
+        [24, "Alejandro", "Villanueva", "1-1-1980", "15935"],
+        [11, "Jon", "Shepherd", "11-7-2153", "90909"],
+        [14, "Jane", "Smith", "01-10-1986", "12345"],
+        [12, "Johnathan", "Shepard", "11-7-2153", "90909"],
+        [31, "Alejandr", "Villanueve", "1-1-1980", "15935"],
+    ]
+    funcs = {
+        "first_name": feature_match_fuzzy_string,
+        "last_name": feature_match_fuzzy_string,
+        "birthdate": feature_match_exact,
+        "zip": feature_match_exact,
+    }
+    col_to_idx = {"first_name": 1, "last_name": 2, "birthdate": 3, "zip": 4}
+    expected_pairs = match_within_block(data, funcs, col_to_idx, eval_perfect_match)
+    expected_clusters = _match_within_block_cluster_ratio(
+        data, 0.6, funcs, col_to_idx, eval_perfect_match, threshold=0.8
+    )
+
+    shapes = []
+    match_records_pairwise = link_module.match_records_pairwise
+
+    def record_shapes(rows_i, rows_j, *args, **kwargs):
+        shapes.append((len(rows_i), len(rows_j)))
+        return match_records_pairwise(rows_i, rows_j, *args, **kwargs)
+
+    monkeypatch.setattr(link_module, "match_records_pairwise", record_shapes)
+    monkeypatch.setattr(link_module, "SCORING_CHUNK_SIZE", 3)
+
+    # Blocks are scored a chunk of rows against a chunk of columns at a time
+    assert (
+        match_within_block(data, funcs, col_to_idx, eval_perfect_match)
+        == expected_pairs
+    )
+    assert max(max(shape) for shape in shapes) <= 3
+
+    # Each record is only scored against the clusters it's checked against
+    shapes.clear()
+    clusters = _match_within_block_cluster_ratio(
+        data, 0.6, funcs, col_to_idx, eval_perfect_match, threshold=0.8
+    )
+    assert clusters == expected_clusters
+    assert all(rows == 1 for rows, _ in shapes)
+    assert sum(columns for _, columns in shapes) < len(data) * (len(data) - 1) / 2
+
+
 def test_match_within_block():
     # Data will be of the form:
     # patient_id, first_name, last_name, DOB, zip code
@@ -434,6 +485,35 @@ def test_perform_linkage_pass():
     }
 
 
+@pytest.mark.parametrize("cluster_ratio", [None, 0.75])
+def test_perform_linkage_pass_in_processes(monkeypatch, cluster_ratio):
+    data = pd.read_csv(
+        pathlib.Path(__file__).parent.parent / "assets" / "linkage" / "patient_lol.csv",
+        index_col=False,
+        dtype="object",
+        keep_default_na=False,
+    )
+    funcs = {
+        "FIRST": feature_match_fuzzy_string,
+        "LAST": feature_match_fuzzy_string,
+        "BIRTHDATE": feature_match_exact,
+    }
+    for blocks in [["ZIP"], ["CITY"], ["BIRTHDATE", "GENDER"]]:
+        expected = perform_linkage_pass(
+            data, blocks, funcs, eval_perfect_match, cluster_ratio
+        )
+        # Split large blocks into chunks of 2 rows and batch small tasks
+        with monkeypatch.context() as m:
+            m.setattr("phdi.linkage.link.SCORING_CHUNK_SIZE", 2)
+            m.setattr("phdi.linkage.link.PARALLEL_TASK_PAIRS", 5)
+            matches = perform_linkage_pass(
+                data, blocks, funcs, eval_perfect_match, cluster_ratio, max_workers=2
+            )
+        assert list(matches) == list(expected)
+        assert matches == expected
+    assert any(len(matches_in_block) > 1 for matches_in_block in expected.values())
+
+
 def test_score_linkage_vs_truth():
     num_records = 12
     matches = {
@@ -0,0 +1,170 @@
+import pathlib
+import random
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phdi.linkage import calculate_m_probs, calculate_u_probs
+from phdi.linkage.pairs import (
+    count_equal_value_pairs,
+    count_records,
+    gather_column_values,
+    get_record_columns,
+    rank_pairs,
+    sample_non_match_pairs,
+    unrank_pairs,
+)
+
+PATIENT_CSV = (
+    pathlib.Path(__file__).parent.parent / "assets" / "linkage" / "patient_lol.csv"
+)
+TRUE_MATCHES = {
+    0: {1, 2, 3},
+    1: {2, 3},
+    2: {3},
+    7: {8, 10, 11},
+    8: {10, 11},
+    10: {11},
+}
+
+
+def _reference_m_probs(data, true_matches, cols):
+    m_probs = {c: 1.0 for c in cols}
+    total_pairs = 1.0
+    for root_record, paired_records in true_matches.items():
+        total_pairs += len(paired_records)
+        for pr in paired_records:
+            for c in cols:
+                if data[c].iloc[root_record] == data[c].iloc[pr]:
+                    m_probs[c] += 1
+    return {c: m_probs[c] / total_pairs for c in cols}
+
+
+def _reference_u_probs(data, true_matches, n_samples, cols):
+    u_probs = {c: 1.0 for c in cols}
+    neg_pairs = [
+        x
+        for x in combinations(data.index, 2)
+        if x[0] not in true_matches or x[1] not in true_matches[x[0]]
+    ]
+    if n_samples is not None and n_samples < len(neg_pairs):
+        neg_pairs = random.sample(neg_pairs, n_samples)
+    for index in neg_pairs:
+        for c in cols:
+            if data[c].iloc[index[0]] == data[c].iloc[index[1]]:
+                u_probs[c] += 1.0
+    return {c: u_probs[c] / (len(neg_pairs) + 1.0) for c in cols}
+
+
+def _random_records(n_records: int) -> pd.DataFrame:
+    rng = random.Random(42)
+    return pd.DataFrame(
+        {
+            "FIRST": [
+                rng.choice(["John", "Jane", "Jo", None]) for _ in range(n_records)
+            ],
+            "ZIP": [rng.choice(["02120", "02121", ""]) for _ in range(n_records)],
+            "SCORE": [rng.choice([1.0, 2.0, float("nan")]) for _ in range(n_records)],
+        }
+    )
+
+
+def test_rank_and_unrank_pairs():
+    for n_records in [2, 3, 7, 50]:
+        pairs = list(combinations(range(n_records), 2))
+        first, second = unrank_pairs(np.arange(len(pairs)), n_records)
+        assert list(zip(first.tolist(), second.tolist())) == pairs
+        ranks = rank_pairs(first, second, n_records)
+        assert ranks.tolist() == list(range(len(pairs)))
+
+    # Precision holds for the pairs of millions of records
+    n_records = 5_000_000
+    first = np.array([0, 1, 2_500_000, n_records - 2])
+    second = np.array([1, n_records - 1, 2_500_001, n_records - 1])
+    unranked = unrank_pairs(rank_pairs(first, second, n_records), n_records)
+    assert unranked[0].tolist() == first.tolist()
+    assert unranked[1].tolist() == second.tolist()
+
+
+def test_sample_non_match_pairs():
+    n_records = 12
+    neg_pairs = [
+        x
+        for x in combinations(range(n_records), 2)
+        if x[0] not in TRUE_MATCHES or x[1] not in TRUE_MATCHES[x[0]]
+    ]
+    for seed in range(20):
+        random.seed(seed)
+        expected = random.sample(neg_pairs, 10)
+        random.seed(seed)
+        first, second, n_non_matches = sample_non_match_pairs(
+            n_records, TRUE_MATCHES, 10
+        )
+        assert list(zip(first.tolist(), second.tolist())) == expected
+        assert n_non_matches == len(neg_pairs)
+
+    first, second, n_non_matches = sample_non_match_pairs(
+        n_records, TRUE_MATCHES, len(neg_pairs)
+    )
+    assert first is None and second is None
+    assert n_non_matches == len(neg_pairs)
+
+
+def test_count_equal_value_pairs():
+    data = _random_records(40)
+    equal_pairs = count_equal_value_pairs(data, list(data.columns))
+    for c in data.columns:
+        expected = sum(
+            data[c].iloc[i] == data[c].iloc[j] for i, j in combinations(range(40), 2)
+        )
+        assert equal_pairs[c] == expected
+
+
+@pytest.mark.parametrize("n_samples", [None, 5, 30, 1000])
+def test_calculate_probs_match_reference(n_samples):
+    data = _random_records(40)
+    cols = list(data.columns)
+    true_matches = {0: {5, 9}, 3: {4}, 12: {30, 39}}
+    assert calculate_m_probs(data, true_matches) == _reference_m_probs(
+        data, true_matches, cols
+    )
+
+    # Pairs out of order or out of range aren't true matches to exclude
+    true_matches.update({39: {12}, 50: {51}})
+    random.seed(7)
+    expected = _reference_u_probs(data, true_matches, n_samples, cols)
+    random.seed(7)
+    assert calculate_u_probs(data, true_matches, n_samples=n_samples) == expected
+
+
+@pytest.mark.parametrize("n_samples", [None, 10])
+def test_calculate_probs_from_files(tmp_path, n_samples):
+    data = pd.read_csv(
+        PATIENT_CSV, index_col=False, dtype="object", keep_default_na=False
+    )
+    parquet_path = tmp_path / "patients.parquet"
+    data.to_parquet(parquet_path)
+
+    expected_m = calculate_m_probs(data, TRUE_MATCHES)
+    random.seed(0)
+    expected_u = calculate_u_probs(data, TRUE_MATCHES, n_samples=n_samples)
+    for path in [PATIENT_CSV, parquet_path]:
+        assert get_record_columns(path) == list(data.columns)
+        assert count_records(path, chunk_size=5) == len(data)
+        assert calculate_m_probs(path, TRUE_MATCHES, chunk_size=5) == expected_m
+        random.seed(0)
+        assert (
+            calculate_u_probs(path, TRUE_MATCHES, n_samples=n_samples, chunk_size=5)
+            == expected_u
+        )
+
+    # Only the requested columns are read
+    assert list(
+        calculate_m_probs(PATIENT_CSV, TRUE_MATCHES, cols=["FIRST", "LAST"])
+    ) == ["FIRST", "LAST"]
+
+    with pytest.raises(IndexError) as e:
+        gather_column_values(PATIENT_CSV, ["FIRST"], np.array([0, 100]), 5)
+    assert "Record positions must be between 0 and" in str(e.value)
@@ -0,0 +1,162 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from phdi.linkage import (
+    eval_log_odds_cutoff,
+    eval_perfect_match,
+    evaluate_match_matrix,
+    feature_match_exact,
+    feature_match_four_char,
+    feature_match_fuzzy_string,
+    feature_match_log_odds_exact,
+    feature_match_log_odds_fuzzy_compare,
+    match_records_pairwise,
+    score_feature_matrix,
+)
+from phdi.linkage.link import _compare_records, _compare_records_in_block
+
+COL_TO_IDX = {"first": 0, "last": 1, "birthdate": 2}
+LOG_ODDS = {"first": 4.0, "last": 6.5, "birthdate": 9.8}
+
+ROWS = [
+    ["John", "Shepard", "1980-01-01"],
+    ["Jon", "Shepherd", datetime.date(1980, 1, 1)],
+    ["Johnathan", "", "1980-01-10"],
+    ["", "", None],
+    [None, None, None],
+    ["Jane", "Shepard", datetime.datetime(1980, 1, 1)],
+]
+
+
+def _pairwise_reference(rows_i, rows_j, feature_col, feature_func, **kwargs):
+    return [
+        [
+            feature_func(record_i, record_j, feature_col, COL_TO_IDX, **kwargs)
+            for record_j in rows_j
+        ]
+        for record_i in rows_i
+    ]
+
+
+@pytest.mark.parametrize(
+    "feature_func,kwargs",
+    [
+        (feature_match_exact, {}),
+        (feature_match_fuzzy_string, {}),
+        (feature_match_fuzzy_string, {"similarity_measure": "Levenshtein"}),
+        (feature_match_fuzzy_string, {"threshold": 0.95}),
+        (feature_match_log_odds_exact, {"log_odds": LOG_ODDS}),
+        (feature_match_log_odds_fuzzy_compare, {"log_odds": LOG_ODDS}),
+    ],
+)
+def test_score_feature_matrix_matches_pairwise(feature_func, kwargs):
+    for feature_col in COL_TO_IDX:
+        expected = _pairwise_reference(ROWS, ROWS, feature_col, feature_func, **kwargs)
+        scores = score_feature_matrix(
+            ROWS, ROWS, feature_col, feature_func, COL_TO_IDX, **kwargs
+        )
+        assert scores.shape == (len(ROWS), len(ROWS))
+        assert scores.tolist() == expected
+
+
+def test_score_feature_matrix_four_char():
+    rows = [["Johnathan", "x"], ["John", "y"], ["Joh", "z"], ["", "w"]]
+    col_to_idx = {"first": 0, "last": 1}
+    expected = [
+        [feature_match_four_char(ri, rj, "first", col_to_idx) for rj in rows]
+        for ri in rows
+    ]
+    scores = score_feature_matrix(
+        rows, rows, "first", feature_match_four_char, col_to_idx
+    )
+    assert scores.tolist() == expected
+
+
+def test_score_feature_matrix_custom_function():
+    def first_letter(record_i, record_j, feature_col, col_to_idx, **kwargs):
+        idx = col_to_idx[feature_col]
+        return (record_i[idx] or " ")[0] == (record_j[idx] or " ")[0]
+
+    expected = _pairwise_reference(ROWS, ROWS, "first", first_letter)
+    scores = score_feature_matrix(ROWS, ROWS, "first", first_letter, COL_TO_IDX)
+    assert scores.tolist() == expected
+
+
+def test_score_feature_matrix_empty_and_missing_log_odds():
+    scores = score_feature_matrix([], ROWS, "first", feature_match_exact, COL_TO_IDX)
+    assert scores.shape == (0, len(ROWS))
+
+    with pytest.raises(KeyError) as e:
+        score_feature_matrix(
+            ROWS, ROWS, "first", feature_match_log_odds_exact, COL_TO_IDX
+        )
+    assert "Mapping of columns to m/u log-odds must be provided" in str(e.value)
+
+
+def test_evaluate_match_matrix():
+    first = np.array([[True, False], [True, True]])
+    last = np.array([[True, True], [False, True]])
+    assert evaluate_match_matrix([first, last], eval_perfect_match).tolist() == [
+        [True, False],
+        [False, True],
+    ]
+
+    odds_a = np.array([[4.0, 0.0], [2.5, 6.0]])
+    odds_b = np.array([[3.0, 1.0], [2.5, 0.0]])
+    matches = evaluate_match_matrix(
+        [odds_a, odds_b], eval_log_odds_cutoff, true_match_threshold=5.0
+    )
+    assert matches.tolist() == [[True, False], [True, True]]
+
+    with pytest.raises(KeyError) as e:
+        evaluate_match_matrix([odds_a, odds_b], eval_log_odds_cutoff)
+    assert "Cutoff threshold for true matches must be passed" in str(e.value)
+
+    def any_match(feature_comparisons, **kwargs):
+        return any(feature_comparisons)
+
+    assert evaluate_match_matrix([first, last], any_match).tolist() == [
+        [True, True],
+        [True, True],
+    ]
+
+
+def test_match_records_pairwise():
+    funcs = {"first": feature_match_fuzzy_string, "last": feature_match_exact}
+    matches = match_records_pairwise(ROWS, ROWS, funcs, COL_TO_IDX, eval_perfect_match)
+    expected = [
+        [
+            eval_perfect_match([funcs[col](ri, rj, col, COL_TO_IDX) for col in funcs])
+            for rj in ROWS
+        ]
+        for ri in ROWS
+    ]
+    assert matches.tolist() == expected
+
+
+def test_compare_records_in_block_matches_compare_records():
+    col_to_idx = {"first_name": 0, "last_name": 1, "birthdate": 2, "address": 3}
+    record = [None, None, ["John", "Q"], "Shepard", "1980-01-01", ["1 Main St", "2"]]
+    data_block = [
+        ["p1", "a", "John Q", "Shepard", datetime.date(1980, 1, 1), "1 Main St"],
+        ["p2", "a", "John", "Shepard", "1980-01-01", "2"],
+        ["p3", "b", "Jane", "Shepherd", None, ""],
+        ["p4", "c", "", None, "1981-11-21", None],
+    ]
+    funcs = {col: feature_match_log_odds_fuzzy_compare for col in col_to_idx}
+    log_odds = {"first_name": 4.0, "last_name": 6.5, "birthdate": 9.8, "address": 3}
+    kwargs = {"log_odds": log_odds, "true_match_threshold": 12.0}
+
+    expected = [
+        _compare_records(
+            record, mpi_patient, funcs, col_to_idx, eval_log_odds_cutoff, **kwargs
+        )
+        for mpi_patient in data_block
+    ]
+    matches = _compare_records_in_block(
+        record, data_block, funcs, col_to_idx, eval_log_odds_cutoff, **kwargs
+    )
+    assert matches.tolist() == expected
+    assert any(expected) and not all(expected)